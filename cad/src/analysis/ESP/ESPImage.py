@@ -78,6 +78,8 @@ from geometry.Slab import Slab
 
 from utilities.Log import redmsg, greenmsg
 from utilities.debug_prefs import debug_pref, Choice_boolean_False
+from utilities.debug_prefs import Choice
+from utilities.prefs_constants import nanohive_enabled_prefs_key
 from model.jigs import Jig # REVIEW: all uses of this are suspicious!
 from graphics.images.ImageUtils import nEImageOps
 
@@ -96,9 +98,37 @@ from platform_dependent.PlatformDependent import find_or_make_Nanorex_subdir
 from analysis.ESP.NanoHiveUtils import get_nh_espimage_filename
 from analysis.ESP.NanoHiveUtils import run_nh_simulation
 from analysis.ESP.NanoHive_SimParameters import NanoHive_SimParameters
+from analysis.ESP import esp_grid
 from utilities.debug import print_compact_traceback
 # ==
 
+def debug_pref_esp_grid_method():
+    """
+    Which method the built-in ESP engine uses for atoms far from
+    a block of grid points (see esp_grid.py).
+    """
+    res = debug_pref("ESP Image: built-in engine method",
+                     Choice(list(esp_grid.METHODS)),
+                     prefs_key = True
+                 )
+    return res
+
+def debug_pref_esp_grid_processes():
+    """
+    How many processes the built-in ESP engine can use
+    (0 means one per CPU). The default is 1, so NE1 doesn't start
+    worker processes from the GUI unless asked to.
+    """
+    res = debug_pref("ESP Image: built-in engine processes",
+                     Choice([1, 2, 4, 8, 0],
+                            names = ["1", "2", "4", "8", "all CPUs"],
+                            defaultValue = 1),
+                     prefs_key = True
+                 )
+    return res
+
+# ==
+
 class ESPImage(RectGadget):
     """
     Electrostatic potential image, displayed as a translucent square in 3D.
@@ -604,6 +634,72 @@ class ESPImage(RectGadget):
         return sim_parms
 
     def calculate_esp(self):
+        """
+        Compute the ESP image of the atoms inside self's bounding box,
+        using the Nano-Hive MPQC plug-in if it's enabled, or the built-in
+        engine in esp_grid.py if not, and display it.
+        """
+        if env.prefs[nanohive_enabled_prefs_key]:
+            self._calculate_esp_with_nanohive()
+        else:
+            self._calculate_esp_with_esp_grid()
+        return
+
+    def _calculate_esp_with_esp_grid(self):
+        """
+        Compute self's ESP image with the built-in engine (which estimates
+        partial charges classically, rather than by a quantum-mechanical
+        calculation).
+        """
+        cmd = greenmsg("Calculate ESP: ")
+
+        atoms = []
+        for obj in self._findObjsInside():
+            if isinstance(obj, Chunk):
+                atoms.extend(obj.atoms.values())
+            else:
+                atoms.append(obj)
+        if not atoms:
+            msg = redmsg("No atoms inside [%s]'s bounding box." % self.name)
+            env.history.message( cmd + msg )
+            return
+
+        espimage_file = get_nh_espimage_filename(self.assy, self.name)
+
+        msg = "Running built-in ESP calculation on [%s]. " \
+              "Results will be written to: [%s]" % (self.name, espimage_file)
+        env.history.message( cmd + msg )
+
+        try:
+            vrange, seconds = esp_grid.calculate_esp_image(
+                atoms, self.center, self.quat, self.width, self.resolution,
+                espimage_file,
+                method = debug_pref_esp_grid_method(),
+                processes = debug_pref_esp_grid_processes() )
+        except:
+            print_compact_traceback("exception in built-in ESP calculation: ")
+            msg = redmsg("Built-in ESP calculation on [%s] failed." %
+                         self.name)
+            env.history.message( cmd + msg )
+            return
+
+        msg = "ESP calculation on [%s] finished: %d atoms, %d x %d grid, " \
+              "-%.3f to +%.3f volts, %.2f seconds." % \
+              (self.name, len(atoms), self.resolution, self.resolution,
+               vrange, vrange, seconds)
+        env.history.message( cmd + msg )
+
+        self._load_calculated_espimage_file(espimage_file)
+        return
+
+    def _load_calculated_espimage_file(self, espimage_file):
+        self.espimage_file = espimage_file
+        self.load_espimage_file()
+        self.assy.changed()
+        self.assy.w.win_update()
+        return
+
+    def _calculate_esp_with_nanohive(self):
 
         cmd = greenmsg("Calculate ESP: ")
 
@@ -652,11 +748,7 @@ class ESPImage(RectGadget):
                   " does not exist. Image not loaded."
             return
 
-        self.espimage_file = espimage_file
-        self.load_espimage_file()
-        self.assy.changed()
-        self.assy.w.win_update()
-
+        self._load_calculated_espimage_file(espimage_file)
         return
 
     def __CM_Calculate_ESP(self):
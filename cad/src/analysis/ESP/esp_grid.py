@@ -0,0 +1,434 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+esp_grid.py - built-in engine for ESP Image jigs, which computes the
+electrostatic potential of a set of atoms on the jig's plane and writes
+it as the png file which ESPImage.load_espimage_file displays, without
+needing the Nano-Hive plug-in.
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+The potential at each grid point is the Coulomb sum K * q / r over the
+atoms, with r no smaller than MIN_DISTANCE (so grid points which pass
+through atoms don't dominate the color scale). The partial charges q
+are a rough classical estimate (see estimate_partial_charges), so the
+image shows the qualitative layout of positive and negative regions,
+not the quantum-mechanical potential computed by the MPQC plug-in.
+
+The grid is evaluated in blocks of points small enough that the arrays
+of point-atom distances stay small, using Numeric for each block. For
+large systems, atoms are grouped into cubic cells; for each block, the
+cells within near_distance of it are summed exactly, and the others
+(with method "multipole") by their total charge and dipole moment.
+(Just ignoring the far cells, even with a shifted potential, gives
+errors of about a quarter of the potential's range, so that isn't
+offered.) High resolution grids are split into bands of rows which are
+computed by a pool of worker processes, if the multiprocessing module
+is available.
+"""
+
+import math
+import sys
+import time
+
+import Numeric
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+from geometry.VQT import V
+
+# Coulomb's constant, in volts * Angstroms per electron charge
+K = 14.399645
+
+# distances from atoms (in Angstroms) are clamped to at least this
+MIN_DISTANCE = 1.0
+
+# maximum number of (grid point, atom or cell) pairs in one block
+BLOCK_ELEMENTS = 500000
+
+# side of the cubic cells atoms are grouped into, in Angstroms
+CELL_SIZE = 6.0
+
+# methods for compute_esp_grid
+METHODS = ("auto", "exact", "multipole")
+
+# "auto" uses "multipole" above this many (grid point, atom) pairs
+AUTO_MULTIPOLE_PAIRS = 50000000
+
+# grids with fewer points than this are never split among processes
+MIN_POINTS_FOR_POOL = 128 * 128
+
+# Pauling electronegativities, by element symbol (bondpoints are treated
+# as hydrogen, as in the simulator; unknown elements, like PAM
+# pseudoatoms, get no charge from their bonds)
+PAULING_ELECTRONEGATIVITY = {
+    'X': 2.20, 'H': 2.20,
+    'Li': 0.98, 'Be': 1.57, 'B': 2.04, 'C': 2.55, 'N': 3.04, 'O': 3.44,
+    'F': 3.98, 'Na': 0.93, 'Mg': 1.31, 'Al': 1.61, 'Si': 1.90, 'P': 2.19,
+    'S': 2.58, 'Cl': 3.16, 'K': 0.82, 'Ca': 1.00, 'Ga': 1.81, 'Ge': 2.01,
+    'As': 2.18, 'Se': 2.55, 'Br': 2.96, 'I': 2.66,
+ }
+
+# electron charges moved along a bond per unit of electronegativity
+# difference (e.g. about +0.3 on each H of water)
+CHARGE_PER_ELECTRONEGATIVITY = 0.25
+
+# ==
+
+def estimate_partial_charges(atoms):
+    """
+    Return a Numeric array of partial charges (in electron charges)
+    for the given atoms, estimated by bond increments: each bond moves
+    CHARGE_PER_ELECTRONEGATIVITY * (the difference in the Pauling
+    electronegativities of its atoms) toward the more electronegative
+    atom. Bonds to atoms not in the list count too.
+    """
+    res = []
+    for atom in atoms:
+        chi = PAULING_ELECTRONEGATIVITY.get(atom.element.symbol)
+        q = 0.0
+        if chi is not None:
+            for bond in atom.bonds:
+                other = bond.other(atom)
+                chi2 = PAULING_ELECTRONEGATIVITY.get(other.element.symbol)
+                if chi2 is not None:
+                    q += CHARGE_PER_ELECTRONEGATIVITY * (chi2 - chi)
+        res.append(q)
+    return Numeric.array(res, Numeric.Float)
+
+class _Cells:
+    """
+    The atoms, grouped into cubic cells of side CELL_SIZE, with each
+    cell's atoms' centroid, total charge, dipole moment about the
+    centroid, and radius (largest distance of an atom from the centroid).
+    """
+    def __init__(self, positions, charges):
+        keys = Numeric.floor(positions / CELL_SIZE).astype(Numeric.Int)
+        members = {}
+        for i in range(len(positions)):
+            members.setdefault(tuple(keys[i]), []).append(i)
+        self.indices = [Numeric.array(members[key]) for key in members.keys()]
+        centers = []
+        totals = []
+        dipoles = []
+        radii = []
+        for indices in self.indices:
+            pos = Numeric.take(positions, indices, 0)
+            q = Numeric.take(charges, indices)
+            center = Numeric.add.reduce(pos) / len(indices)
+            rel = pos - center
+            centers.append(center)
+            totals.append(Numeric.add.reduce(q))
+            dipoles.append(Numeric.dot(q, rel))
+            radii.append(math.sqrt(max(Numeric.add.reduce(rel * rel, -1))))
+        self.centers = Numeric.array(centers, Numeric.Float)
+        self.totals = Numeric.array(totals, Numeric.Float)
+        self.dipoles = Numeric.array(dipoles, Numeric.Float)
+        self.radii = Numeric.array(radii, Numeric.Float)
+        return
+
+    def near_cells(self, lo, hi, distance):
+        """
+        Return an array of 0 or 1 for each cell: whether any of its atoms
+        might be within distance of the box with corners lo, hi.
+        """
+        below = Numeric.maximum(lo - self.centers, 0.0)
+        above = Numeric.maximum(self.centers - hi, 0.0)
+        outside = below + above # (at most one of them is nonzero)
+        gap = Numeric.sqrt(Numeric.add.reduce(outside * outside, -1))
+        return Numeric.less_equal(gap - self.radii, distance)
+
+    pass
+
+class ESPGridProblem:
+    """
+    The potential of some charged atoms on a square grid of points.
+    Instances are picklable, so they can be sent to worker processes.
+
+    The grid has resolution rows and columns, covers a square of side
+    width centered at center, with rows running along xaxis and columns
+    along -yaxis (so the first row is the top of the image), and point
+    (row, col) at the center of its square pixel.
+    """
+    def __init__(self, positions, charges, center, xaxis, yaxis, width,
+                 resolution, method = "auto", near_distance = 12.0):
+        """
+        @param method: one of METHODS (see module docstring)
+        @param near_distance: in Angstroms, for method "multipole"
+        """
+        assert method in METHODS
+        self.positions = Numeric.array(positions, Numeric.Float)
+        self.charges = Numeric.array(charges, Numeric.Float)
+        self.center = Numeric.array(center, Numeric.Float)
+        self.xaxis = Numeric.array(xaxis, Numeric.Float)
+        self.yaxis = Numeric.array(yaxis, Numeric.Float)
+        self.width = float(width)
+        self.resolution = int(resolution)
+        self.npoints = self.resolution ** 2
+        if method == "auto":
+            if self.npoints * len(self.positions) > AUTO_MULTIPOLE_PAIRS:
+                method = "multipole"
+            else:
+                method = "exact"
+        self.method = method
+        self.near_distance = float(near_distance)
+        self.cells = None
+        if method != "exact" and len(self.positions):
+            self.cells = _Cells(self.positions, self.charges)
+        return
+
+    def points(self, start, stop):
+        """
+        Return an array of the positions of grid points start to stop
+        (counting along the rows, starting at the top left).
+        """
+        step = self.width / self.resolution
+        hw = self.width / 2.0
+        index = Numeric.arange(start, stop)
+        cols = index % self.resolution
+        rows = index / self.resolution
+        x = (cols + 0.5) * step - hw
+        y = hw - (rows + 0.5) * step
+        return self.center + Numeric.outerproduct(x, self.xaxis) + \
+               Numeric.outerproduct(y, self.yaxis)
+
+    def potential(self, start, stop):
+        """
+        Return an array of the potential (in volts) at grid points
+        start to stop.
+        """
+        natoms = max(1, len(self.positions))
+        if self.cells is not None:
+            natoms = max(natoms, len(self.cells.centers))
+        blocksize = max(1, BLOCK_ELEMENTS // natoms)
+        res = Numeric.zeros(stop - start, Numeric.Float)
+        if not len(self.positions):
+            return res
+        for i in range(start, stop, blocksize):
+            j = min(stop, i + blocksize)
+            res[i - start : j - start] = self._potential_of_block(i, j)
+        return res
+
+    def _potential_of_block(self, start, stop):
+        points = self.points(start, stop)
+        if self.cells is None:
+            return self._coulomb(points, self.positions, self.charges)
+        cells = self.cells
+        lo = Numeric.minimum.reduce(points)
+        hi = Numeric.maximum.reduce(points)
+        near = cells.near_cells(lo, hi, self.near_distance)
+        near_indices = [cells.indices[i] for i in Numeric.nonzero(near)]
+        res = Numeric.zeros(len(points), Numeric.Float)
+        if near_indices:
+            indices = Numeric.concatenate(near_indices)
+            res = res + self._coulomb(
+                points,
+                Numeric.take(self.positions, indices, 0),
+                Numeric.take(self.charges, indices))
+        far = Numeric.nonzero(Numeric.logical_not(near))
+        if len(far):
+            res = res + self._multipole(
+                points,
+                Numeric.take(cells.centers, far, 0),
+                Numeric.take(cells.totals, far),
+                Numeric.take(cells.dipoles, far, 0))
+        return res
+
+    def _coulomb(self, points, positions, charges):
+        delta = points[:, Numeric.NewAxis, :] - positions[Numeric.NewAxis, :, :]
+        r = Numeric.sqrt(Numeric.add.reduce(delta * delta, -1))
+        r = Numeric.maximum(r, MIN_DISTANCE)
+        return K * Numeric.dot(1.0 / r, charges)
+
+    def _multipole(self, points, centers, totals, dipoles):
+        delta = points[:, Numeric.NewAxis, :] - centers[Numeric.NewAxis, :, :]
+        r2 = Numeric.add.reduce(delta * delta, -1)
+        r = Numeric.sqrt(r2)
+        p_dot_r = Numeric.add.reduce(delta * dipoles[Numeric.NewAxis, :, :], -1)
+        return K * (Numeric.dot(1.0 / r, totals) +
+                    Numeric.add.reduce(p_dot_r / (r2 * r), -1))
+
+    pass
+
+# ==
+
+# the problem being solved by a worker process (set by _init_worker)
+_worker_problem = None
+
+def _init_worker(problem):
+    global _worker_problem
+    _worker_problem = problem
+    return
+
+def _worker_potential(band):
+    start, stop = band
+    return _worker_problem.potential(start, stop)
+
+def number_of_processors():
+    if multiprocessing is None:
+        return 1
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+    pass
+
+def compute_esp_grid(problem, processes = 1):
+    """
+    Return an array of shape (resolution, resolution) of the potential
+    (in volts) at the points of the given ESPGridProblem, with the top
+    row of the image first.
+
+    @param processes: the number of worker processes to use
+                      (0 means one per processor). They're only used
+                      for large grids, if multiprocessing is available,
+                      and if we're not running from a frozen (packaged)
+                      executable, which can't start them; if the pool
+                      can't be started, the grid is computed in this
+                      process.
+    """
+    if not processes:
+        processes = number_of_processors()
+    n = problem.npoints
+    pool = None
+    if processes > 1 and multiprocessing is not None and \
+       not getattr(sys, 'frozen', False) and \
+       n >= MIN_POINTS_FOR_POOL:
+        try:
+            pool = multiprocessing.Pool(processes, _init_worker, (problem,))
+        except (OSError, ImportError, ValueError), e:
+            print "esp_grid: can't start %d worker processes (%s); " \
+                  "computing ESP grid in this process" % (processes, e)
+            pool = None
+    if pool is not None:
+        # several bands per process, so they finish at about the same time
+        nbands = processes * 4
+        bands = [(n * i // nbands, n * (i + 1) // nbands)
+                 for i in range(nbands)]
+        try:
+            results = pool.map(_worker_potential, bands)
+        finally:
+            pool.close()
+            pool.join()
+        res = Numeric.concatenate(results)
+    else:
+        res = problem.potential(0, n)
+    return Numeric.reshape(res, (problem.resolution, problem.resolution))
+
+def esp_range(potential, fraction = 0.98):
+    """
+    Return the smallest absolute potential which at least the given
+    fraction of the grid points don't exceed (used as the range of the
+    color scale, so a few points next to atoms don't wash it out).
+    """
+    values = Numeric.sort(abs(Numeric.ravel(potential)))
+    if not len(values):
+        return 0.0
+    return float(values[int(fraction * (len(values) - 1))])
+
+def esp_colors(potential, vrange):
+    """
+    Return an array of shape potential.shape + (3,) of RGB bytes
+    for the potential: red for negative, white for zero,
+    and blue for positive, saturating at -vrange and vrange.
+    """
+    if vrange <= 0:
+        vrange = 1.0
+    t = Numeric.clip(potential / vrange, -1.0, 1.0)
+    neg = Numeric.maximum(-t, 0.0) # 0 to 1 toward red
+    pos = Numeric.maximum(t, 0.0) # 0 to 1 toward blue
+    rgb = Numeric.zeros(potential.shape + (3,), Numeric.Float)
+    rgb[..., 0] = 1.0 - pos
+    rgb[..., 1] = 1.0 - pos - neg
+    rgb[..., 2] = 1.0 - neg
+    return (rgb * 255.0 + 0.5).astype(Numeric.UnsignedInt8)
+
+def write_esp_image(potential, filename, vrange = None):
+    """
+    Write the potential (an array from compute_esp_grid) as a png file
+    of the same size, colored by esp_colors.
+
+    @return: the vrange used (in volts)
+    """
+    import Image # from PIL; only needed here
+    if vrange is None:
+        vrange = esp_range(potential)
+    rgb = esp_colors(potential, vrange)
+    height, width = potential.shape
+    image = Image.fromstring("RGB", (width, height), rgb.tostring())
+    image.save(filename, "PNG")
+    return vrange
+
+def calculate_esp_image(atoms, center, quat, width, resolution, filename,
+                        method = "auto", processes = 1):
+    """
+    Compute the potential of the given atoms on the plane of an ESP Image
+    jig with the given center, quat, width and resolution, and write it
+    to filename as a png image.
+
+    @return: (vrange, seconds), the range of the color scale in volts
+             and the time the computation took
+    """
+    t0 = time.time()
+    positions = [atom.sim_posn() for atom in atoms]
+    charges = estimate_partial_charges(atoms)
+    problem = ESPGridProblem(positions, charges, center,
+                             quat.rot(V(1, 0, 0)), quat.rot(V(0, 1, 0)),
+                             width, resolution, method = method)
+    potential = compute_esp_grid(problem, processes = processes)
+    vrange = write_esp_image(potential, filename)
+    return vrange, time.time() - t0
+
+# ==
+
+if __name__ == '__main__':
+    # self-test: compare the methods on random polar bonds (pairs of
+    # opposite charges 1 Angstrom apart), and time them
+    import random
+    # multipole errors must stay below this fraction of the range
+    # (they're about 4% for this test)
+    MAX_RELATIVE_ERROR = 0.1
+    random.seed(0)
+    n = 3000
+    positions = []
+    charges = []
+    for i in range(n // 2):
+        p = V(random.uniform(-40, 40), random.uniform(-40, 40),
+              random.uniform(-15, 15))
+        d = V(random.gauss(0, 1), random.gauss(0, 1), random.gauss(0, 1))
+        positions += [p, p + d / math.sqrt(Numeric.dot(d, d))]
+        charges += [0.3, -0.3]
+    for resolution in (64, 256):
+        exact = None
+        for method in ("exact", "multipole"):
+            t0 = time.time()
+            problem = ESPGridProblem(positions, charges, (0, 0, 0),
+                                     (1, 0, 0), (0, 1, 0), 80.0, resolution,
+                                     method = method)
+            potential = compute_esp_grid(problem)
+            seconds = time.time() - t0
+            if exact is None:
+                exact = potential
+                print "%d x %d grid, %d atoms: %s %.2f sec, range %.3f V" % \
+                      (resolution, resolution, n, method, seconds,
+                       esp_range(exact))
+            else:
+                err = max(abs(Numeric.ravel(potential - exact)))
+                print "  %s %.2f sec, max error %.4f V" % \
+                      (method, seconds, err)
+                assert err <= MAX_RELATIVE_ERROR * esp_range(exact), \
+                       "%s error too large" % method
+    processes = number_of_processors()
+    if processes > 1:
+        problem = ESPGridProblem(positions, charges, (0, 0, 0), (1, 0, 0),
+                                 (0, 1, 0), 80.0, 256, method = "multipole")
+        t0 = time.time()
+        potential = compute_esp_grid(problem, processes = processes)
+        print "  multipole with %d processes: %.2f sec" % \
+              (processes, time.time() - t0)
+
+# end
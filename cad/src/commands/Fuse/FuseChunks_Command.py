@@ -34,6 +34,7 @@ from commands.Move.Move_Command import Move_Command
 from commands.Fuse.fusechunksMode import fusechunksBase
 
 from commands.Fuse.fusechunksMode import fusechunks_lambda_tol_natoms, fusechunks_lambda_tol_nbonds
+from commands.Fuse.fusechunksMode import debug_pref_fuse_with_spatial_index
 
 #@ Warning: MAKEBONDS and FUSEATOMS must be the same exact strings used in the
 #  PM combo box "fuseComboBox" widget in FusePropertyManager.
@@ -113,6 +114,7 @@ class FuseChunks_Command(Move_Command, fusechunksBase):
 
     def command_exit_misc_actions(self):
         self.w.toolsFuseChunksAction.setChecked(0)
+        self._forget_fusables_indexes()
 
 
 ##    def Backup(self): # REVIEW: I suspect there is no way to call this method, so I commented it out. [bruce 080806 comment]
@@ -279,6 +281,64 @@ class FuseChunks_Command(Move_Command, fusechunksBase):
 
         self.overlapping_atoms = []
 
+        if debug_pref_fuse_with_spatial_index():
+            self._find_overlapping_atoms_using_index()
+        else:
+            self._find_overlapping_atoms_using_bboxes()
+
+        # Update tolerance label and status bar msgs.
+        natoms = len(self.overlapping_atoms)
+        tol_str = fusechunks_lambda_tol_natoms(self.tol, natoms)
+        tolerenceLabel = tol_str
+        self.propMgr.toleranceSlider.labelWidget.setText(tolerenceLabel)
+
+    def _find_overlapping_atoms_using_index(self):
+        """
+        [private helper for find_overlapping_atoms]
+
+        Find the same overlapping atoms (in the same order) as
+        _find_overlapping_atoms_using_bboxes, using a spatial index of the
+        atoms of all unselected chunks, which is kept between calls while
+        those chunks don't change.
+        """
+        selmols = self.o.assy.selmols
+        mols = [mol for mol in self.o.assy.molecules
+                if not (mol.hidden or mol.display == diINVISIBLE)
+                and mol not in selmols]
+        index = self._get_fusables_index('atoms',
+                                         mols,
+                                         lambda mol: mol.atoms.values())
+        for chunk in selmols:
+            if chunk.hidden or chunk.display == diINVISIBLE:
+                # Skip selected chunk if hidden or invisible.
+                # Fixes bug 970. mark 060404
+                continue
+            # Singlets can't be overlapping atoms --
+            atoms = [a1 for a1 in chunk.atoms.itervalues()
+                     if a1.element is not Singlet]
+            positions = [a1.posn() for a1 in atoms]
+            found = {} # (molindex, i) pairs which already have an overlap
+            for molindex, i, a2 in index.pairs_near(positions, self.tol):
+                # Only atoms of the same type can be overlapping.
+                # This also screens singlets, since a1 can't be a singlet.
+                a1 = atoms[i]
+                if a1.element is not a2.element:
+                    continue
+                # Only the first overlapping atom in each chunk counts
+                # (in the old code, this was a break from the inner loop).
+                if (molindex, i) in found:
+                    continue
+                found[(molindex, i)] = True
+                self.overlapping_atoms.append( (a1,a2) )
+        return
+
+    def _find_overlapping_atoms_using_bboxes(self):
+        """
+        [private helper for find_overlapping_atoms]
+
+        Find overlapping atoms by comparing every atom of each selected
+        chunk to every atom of each nearby chunk (the old way).
+        """
         for chunk in self.o.assy.selmols:
 
             if chunk.hidden or chunk.display == diINVISIBLE:
@@ -333,12 +393,7 @@ class FuseChunks_Command(Move_Command, fusechunksBase):
                                 self.overlapping_atoms.append( (a1,a2) )
                                 # No need to check other atoms in this chunk--
                                 break
-
-        # Update tolerance label and status bar msgs.
-        natoms = len(self.overlapping_atoms)
-        tol_str = fusechunks_lambda_tol_natoms(self.tol, natoms)
-        tolerenceLabel = tol_str
-        self.propMgr.toleranceSlider.labelWidget.setText(tolerenceLabel)
+        return
 
 
     def find_overlapping_atoms_to_delete_from_atomlists(self,
@@ -11,10 +11,19 @@ should be renamed.
 """
 
 import foundation.env as env
-from geometry.VQT import vlen
+from geometry.VQT import vlen, A
+from geometry.CellListIndex import CellListIndex
 from model.bonds import bond_at_singlets
 from utilities.Log import orangemsg
 from utilities.constants import diINVISIBLE
+from utilities.debug_prefs import debug_pref, Choice_boolean_True
+
+def debug_pref_fuse_with_spatial_index():
+    res = debug_pref("Fuse Chunks: use spatial index (faster)?",
+                     Choice_boolean_True, # use False for the old nested loops
+                     prefs_key = True
+                 )
+    return res
 
 def fusechunks_lambda_tol_nbonds(tol, nbonds, mbonds, bondable_pairs):
     """
@@ -58,6 +67,91 @@ def fusechunks_lambda_tol_natoms(tol, natoms):
 
     return "%s => %s overlapping atoms" % (tol_str, natoms_str)
 
+# ==
+
+# The tolerance slider goes up to 300%, i.e. 3.0 Angstroms. The index is
+# built with cells this big (or bigger, if tol is ever larger), so it needn't
+# be rebuilt when the slider moves.
+_MIN_INDEX_RADIUS = 3.0
+
+# Extra query radius, since the index only finds items strictly closer than
+# the query radius, but the old code accepted distances equal to tol.
+_TOL_EPSILON = 1e-6
+
+class _FusablesIndex:
+    """
+    A spatial index over the bondpoints or atoms of some chunks (the chunks
+    the selected chunks might fuse with), which finds the ones within tol of
+    a set of query positions, in the same order as the old nested loops over
+    chunks and atoms found them.
+
+    It remembers each indexed chunk's atpos array (which is replaced whenever
+    any of its atoms move or are added or removed), so its owner can tell
+    when it needs to be rebuilt. Moving only the selected chunks, or moving
+    the tolerance slider, doesn't invalidate it.
+    """
+    def __init__(self, mols, atoms_of, tol):
+        """
+        @param mols: the chunks to index, in the order the old code
+                     looped over them.
+
+        @param atoms_of: function from a chunk to the list of its atoms
+                         (or bondpoints) to index, in the order the old code
+                         looped over them.
+
+        @param tol: the largest tolerance we expect to be queried with.
+        """
+        self.mols = list(mols)
+        self._atpos = [mol.atpos for mol in self.mols]
+        self.maxradius = max(_MIN_INDEX_RADIUS, tol) + _TOL_EPSILON
+        self.atoms = [] # the indexed atoms; their ids are indices in this
+        self.molindices = [] # for each atom, the index in self.mols of its chunk
+        for i in range(len(self.mols)):
+            atoms = atoms_of(self.mols[i])
+            self.atoms.extend(atoms)
+            self.molindices.extend([i] * len(atoms))
+        positions = A([atom.posn() for atom in self.atoms])
+        self._cells = CellListIndex(positions, self.maxradius)
+        return
+
+    def is_valid_for(self, mols, tol):
+        """
+        Is self still a correct index for the given chunks and tolerance?
+        """
+        if tol + _TOL_EPSILON > self.maxradius or len(mols) != len(self.mols):
+            return False
+        for mol, mymol, atpos in zip(mols, self.mols, self._atpos):
+            if mol is not mymol or mol.atpos is not atpos:
+                return False
+        return True
+
+    def pairs_near(self, positions, tol):
+        """
+        Find all (query position, indexed atom) pairs no farther apart
+        than tol.
+
+        @return: sorted list of tuples (molindex, qindex, atom), where
+                 qindex indexes positions, and atom is in the indexed chunk
+                 self.mols[molindex]. (Within a chunk and query position,
+                 atoms are in the order they were indexed.)
+        """
+        if not len(positions) or not self.atoms:
+            return []
+        qi, ids, dist2 = self._cells.neighbors_of(positions,
+                                                  tol + _TOL_EPSILON,
+                                                  return_dist2 = True)
+        tol2 = tol * tol
+        molindices = self.molindices
+        res = [(molindices[i], q, i)
+               for (q, i, d2) in zip(qi.tolist(), ids.tolist(), dist2.tolist())
+               if d2 <= tol2]
+        res.sort()
+        atoms = self.atoms
+        return [(m, q, atoms[i]) for (m, q, i) in res]
+
+    pass
+
+# ==
 
 class fusechunksBase:
     """
@@ -76,6 +170,45 @@ class fusechunksBase:
         # For "Make Bonds", tol is the distance between two bondable singlets
         # For "Fuse Atoms", tol is the distance between two atoms to be considered overlapping
 
+    _fusables_indexes = None # private cache of _FusablesIndex objects, by kind
+
+    def _get_fusables_index(self, kind, mols, atoms_of):
+        """
+        Return a _FusablesIndex of the atoms_of each chunk in mols, reusing
+        the one we made last time for the same kind of query if it's still
+        valid for mols and self.tol.
+        """
+        if self._fusables_indexes is None:
+            self._fusables_indexes = {}
+        index = self._fusables_indexes.get(kind)
+        if index is None or not index.is_valid_for(mols, self.tol):
+            index = _FusablesIndex(mols, atoms_of, self.tol)
+            self._fusables_indexes[kind] = index
+        return index
+
+    def _forget_fusables_indexes(self):
+        """
+        Discard our cached spatial indexes (and the chunks they refer to).
+        """
+        self._fusables_indexes = None
+
+    def _count_way_of_bonding(self, s1, s2):
+        """
+        Record that bondpoints s1 and s2 could bond.
+        """
+        self.bondable_pairs.append( (s1,s2) ) # Add this pair to the list
+
+        # Now increment ways_of_bonding for each of the two singlets.
+        if s1.key in self.ways_of_bonding:
+            self.ways_of_bonding[s1.key] += 1
+        else:
+            self.ways_of_bonding[s1.key] = 1
+        if s2.key in self.ways_of_bonding:
+            self.ways_of_bonding[s2.key] += 1
+        else:
+            self.ways_of_bonding[s2.key] = 1
+        return
+
     def find_bondable_pairs(self,
                             chunk_list = None,
                             selmols_list = None,
@@ -97,7 +230,62 @@ class fusechunksBase:
         if not selmols_list:
             selmols_list = self.o.assy.selmols
 
+        if debug_pref_fuse_with_spatial_index():
+            self._find_bondable_pairs_using_index(chunk_list,
+                                                  selmols_list,
+                                                  ignore_chunk_picked_state)
+        else:
+            self._find_bondable_pairs_using_bboxes(chunk_list,
+                                                   selmols_list,
+                                                   ignore_chunk_picked_state)
+
+        # Update tolerance label and status bar msgs.
+        nbonds = len(self.bondable_pairs)
+        mbonds, singlets_not_bonded, singlet_pairs = self.multibonds()
+        tol_str = fusechunks_lambda_tol_nbonds(self.tol, nbonds, mbonds, singlet_pairs)
+        return tol_str
+
+    def _find_bondable_pairs_using_index(self,
+                                         chunk_list,
+                                         selmols_list,
+                                         ignore_chunk_picked_state):
+        """
+        [private helper for find_bondable_pairs]
+
+        Find the same bondable pairs (in the same order) as
+        _find_bondable_pairs_using_bboxes, using a spatial index of the
+        bondpoints of all the chunks a selected chunk might bond to. That
+        index is kept between calls while those chunks don't change, so
+        dragging the selected chunks or moving the tolerance slider only
+        costs one batched query per selected chunk.
+        """
+        mols = [mol for mol in chunk_list
+                if not (mol.hidden or mol.display == diINVISIBLE)
+                and (ignore_chunk_picked_state or not mol.picked)]
+        index = self._get_fusables_index('bondpoints',
+                                         mols,
+                                         lambda mol: mol.singlets)
+        for chunk in selmols_list:
+            if chunk.hidden or chunk.display == diINVISIBLE:
+                # Skip selected chunk if hidden or invisible. Fixes bug 970. mark 060404
+                continue
+            singlets = chunk.singlets
+            for molindex, i, s2 in index.pairs_near(chunk.singlpos, self.tol):
+                if index.mols[molindex] is chunk:
+                    continue # Skip itself
+                self._count_way_of_bonding(singlets[i], s2)
+        return
+
+    def _find_bondable_pairs_using_bboxes(self,
+                                          chunk_list,
+                                          selmols_list,
+                                          ignore_chunk_picked_state):
+        """
+        [private helper for find_bondable_pairs]
 
+        Find bondable pairs by comparing every bondpoint of each selected
+        chunk to every bondpoint of each nearby chunk (the old way).
+        """
         for chunk in selmols_list:
             if chunk.hidden or chunk.display == diINVISIBLE:
                 # Skip selected chunk if hidden or invisible. Fixes bug 970. mark 060404
@@ -136,23 +324,8 @@ class fusechunksBase:
                             # if ok:
                             # we can ignore ideal and err, we know s1, s2 can bond at this tol
 
-                                self.bondable_pairs.append( (s1,s2) ) # Add this pair to the list
-
-                                # Now increment ways_of_bonding for each of the two singlets.
-                                if s1.key in self.ways_of_bonding:
-                                    self.ways_of_bonding[s1.key] += 1
-                                else:
-                                    self.ways_of_bonding[s1.key] = 1
-                                if s2.key in self.ways_of_bonding:
-                                    self.ways_of_bonding[s2.key] += 1
-                                else:
-                                    self.ways_of_bonding[s2.key] = 1
-
-        # Update tolerance label and status bar msgs.
-        nbonds = len(self.bondable_pairs)
-        mbonds, singlets_not_bonded, singlet_pairs = self.multibonds()
-        tol_str = fusechunks_lambda_tol_nbonds(self.tol, nbonds, mbonds, singlet_pairs)
-        return tol_str
+                                self._count_way_of_bonding(s1, s2)
+        return
 
     def find_bondable_pairs_in_given_atompairs(self, atomPairs):
         """
@@ -23,7 +23,7 @@ from utilities.prefs_constants import joinStrandsCommand_clickToJoinDnaStrands_p
 from utilities.debug import print_compact_stack
 from utilities.constants import CL_SUBCOMMAND
 from model.bonds import bond_at_singlets
-from geometry.NeighborhoodGenerator import NeighborhoodGenerator
+from geometry.CellListIndex import AtomCellListIndex
 from utilities.prefs_constants import joinStrandsCommand_recursive_clickToJoinDnaStrands_prefs_key
 from geometry.VQT import vlen
 # == Command part
@@ -143,7 +143,7 @@ class ClickToJoinStrands_Command(Select_Command):
                 #Max radius within which to search for the 'neighborhood' atoms
                 #(five prime ends)
                 maxBondLength = 10.0
-                neighborHood = NeighborhoodGenerator(five_prime_ends, maxBondLength)
+                neighborHood = AtomCellListIndex(five_prime_ends, maxBondLength)
 
                 pos = endAtom.posn()
                 region_atoms = neighborHood.region(pos)
@@ -37,8 +37,9 @@ import time
 from utilities.constants import black, banana
 from dna.commands.MakeCrossovers.MakeCrossovers_Handle import MakeCrossovers_Handle
 
-from geometry.VQT import orthodist, norm, vlen, angleBetween
-from Numeric import dot
+from geometry.VQT import orthodist, norm, vlen, angleBetween, A
+import Numeric
+from Numeric import dot, Int
 from model.bonds import bond_direction
 
 
@@ -48,15 +49,131 @@ from exprs.Arrow           import Arrow
 from exprs.Highlightable    import Highlightable
 
 from utilities.prefs_constants import makeCrossoversCommand_crossoverSearch_bet_given_segments_only_prefs_key
+from utilities.prefs_constants import dnaBaseIndicatorsAngle_prefs_key
+from utilities.debug_prefs import debug_pref, Choice_boolean_True
+
+from dna.commands.MakeCrossovers.CrossoverSite_Search import MAX_DISTANCE_BETWEEN_CROSSOVER_SITES
+from dna.commands.MakeCrossovers.CrossoverSite_Search import MAX_PERPENDICULAR_DISTANCE_BET_SEGMENT_AXES
+from dna.commands.MakeCrossovers.CrossoverSite_Search import MAX_ANGLE_BET_PLANE_NORMAL_AND_AVG_CENTER_VECTOR_OF_CROSSOVER_PAIRS
+from dna.commands.MakeCrossovers.CrossoverSite_Search import SegmentCapsuleIndex
+from dna.commands.MakeCrossovers.CrossoverSite_Search import capsule_radius
+from dna.commands.MakeCrossovers.CrossoverSite_Search import base_orientation_indicator_mask
+from dna.commands.MakeCrossovers.CrossoverSite_Search import crossover_site_matches
+
+
+def debug_pref_crossover_search_with_segment_index():
+    res = debug_pref("Make Crossovers: use segment index (faster)?",
+                     Choice_boolean_True, # use False for the old nested loops
+                     prefs_key = True
+                 )
+    return res
+
+class _SegmentCrossoverData:
+    """
+    The geometry of one DnaSegment which the crossover site search needs,
+    as Numeric arrays: the positions of its strand base atoms, the unit
+    vectors to them from their axis atoms (for the base orientation
+    indicator test), and the bonded pairs of those atoms (candidate halves
+    of crossover sites) with their centers.
+
+    This only depends on the segment's strand chunks (and their ladders)
+    and the positions of their atoms and axis atoms, so it's kept between
+    updates until one of those changes. (Chunk.atpos is replaced, not
+    modified, whenever a chunk's atoms move or change, so its identity
+    tells us whether they did.)
+    """
+    def __init__(self, segment, strand_chunks):
+        self.segment = segment
+        self.strand_chunks = strand_chunks
+        self._strand_stamps = []
+        axis_stamps = {}
+        atoms = []
+        axis_atoms = []
+        for chunk in strand_chunks:
+            ladder = chunk.ladder
+            self._strand_stamps.append((chunk, chunk.atpos, ladder))
+            if not ladder.axis_rail:
+                continue
+            # as in get_all_available_dna_base_orientation_indicators
+            n_bases = ladder.baselength()
+            if chunk == ladder.strand_rails[0].baseatoms[0].molecule:
+                chunk_strand = 0
+            else:
+                chunk_strand = 1
+            atoms.extend(ladder.strand_rails[chunk_strand].baseatoms[:n_bases])
+            axis_atoms.extend(ladder.axis_rail.baseatoms[:n_bases])
+        atom_index = {}
+        for i in range(len(atoms)):
+            atm = atoms[i]
+            atom_index.setdefault(id(atm), i)
+            axis_chunk = axis_atoms[i].molecule
+            axis_stamps[id(axis_chunk)] = (axis_chunk, axis_chunk.atpos)
+        self._axis_stamps = axis_stamps.values()
+        self.atoms = atoms
+        if atoms:
+            self.positions = A([atm.posn() for atm in atoms])
+            directions = self.positions - A([atm.posn() for atm in axis_atoms])
+            lengths = Numeric.sqrt(Numeric.add.reduce(directions * directions,
+                                                      -1))
+            lengths = Numeric.where(lengths, lengths, 1.0)
+            self.directions = directions / Numeric.reshape(lengths, (-1, 1))
+        else:
+            self.positions = self.directions = Numeric.zeros((0, 3), Numeric.Float)
+        # bonded pairs of these atoms, ordered by bond_direction
+        # (as in CrossoverSite_Marker._filter_neighbor_atompairs)
+        pairs = []
+        seen = {}
+        for i in range(len(atoms)):
+            atm = atoms[i]
+            if atom_index[id(atm)] != i:
+                continue
+            for neighbor in atm.neighbors():
+                j = atom_index.get(id(neighbor))
+                if j is None:
+                    continue
+                if bond_direction(atm, neighbor) == - 1:
+                    pair = (j, i)
+                else:
+                    pair = (i, j)
+                if not seen.has_key(pair):
+                    seen[pair] = pair
+                    pairs.append(pair)
+        self.pair_first = Numeric.array([i for i, j in pairs], Int)
+        self.pair_second = Numeric.array([j for i, j in pairs], Int)
+        self.pair_centers = (
+            Numeric.take(self.positions, self.pair_first, axis = 0) +
+            Numeric.take(self.positions, self.pair_second, axis = 0)) / 2.0
+        return
+
+    def is_valid_for(self, segment, strand_chunks):
+        """
+        Is self still correct for segment, whose current strand chunks
+        are strand_chunks?
+        """
+        if segment is not self.segment or \
+           len(strand_chunks) != len(self.strand_chunks):
+            return False
+        for chunk, (old_chunk, atpos, ladder) in zip(strand_chunks,
+                                                     self._strand_stamps):
+            if chunk is not old_chunk or chunk.atpos is not atpos or \
+               chunk.ladder is not ladder:
+                return False
+        for chunk, atpos in self._axis_stamps:
+            if chunk.atpos is not atpos:
+                return False
+        return True
+
+    def capsule(self, end1, end2):
+        """
+        Return a capsule (end1, end2, radius) around the segment axis from
+        end1 to end2 which contains all our strand base atoms,
+        or None if we have none.
+        """
+        if not len(self.positions):
+            return None
+        return (end1, end2, capsule_radius(end1, end2, self.positions))
 
-
-MAX_DISTANCE_BETWEEN_CROSSOVER_SITES = 17
-#Following is used by the algoritm that searches for neighboring dna segments
-#(to a given dnaSegment) to mark crossover sites (atom pairs that will be
-#involved in a crossover)
-MAX_PERPENDICULAR_DISTANCE_BET_SEGMENT_AXES = 34
-
-MAX_ANGLE_BET_PLANE_NORMAL_AND_AVG_CENTER_VECTOR_OF_CROSSOVER_PAIRS = 32
+    pass
 
 
 class CrossoverSite_Marker:
@@ -89,6 +206,12 @@ class CrossoverSite_Marker:
         self._raw_crossover_atoms_with_neighbors_dict = {}
         self._final_crossover_atoms_dict = {}
 
+        #Per-segment geometry used by the crossover site search, kept between
+        #updates while it stays valid. Maps id(segment) to
+        #_SegmentCrossoverData. (Unlike the dicts above, this is not reset
+        #by self.clearDictionaries().)
+        self._segment_data_dict = {}
+
     def update(self):
         """
         Does a full update (including exprs handle creation
@@ -212,6 +335,152 @@ class CrossoverSite_Marker:
                 self._allDnaSegmentDict[id(segment)] = segment
 
     def _updateCrossoverSites(self):
+        if debug_pref_crossover_search_with_segment_index():
+            self._updateCrossoverSites_using_segment_index()
+        else:
+            self._updateCrossoverSites_using_nested_loops()
+
+    def _updateCrossoverSites_using_segment_index(self):
+        """
+        Does the same search as self._updateCrossoverSites_using_nested_loops,
+        except that neighbor segments of each listed segment are found using
+        an index of segment axis capsules (rather than by trying all segments),
+        and the atom-level tests are done using Numeric on cached
+        per-segment data.
+
+        @note: neighbor segments whose strand atoms are too far away to
+               have crossover sites are skipped entirely, so they no longer
+               contribute to the DEBUG_DRAW_PLANE_NORMALS drawing.
+        """
+        allSegments = self._allDnaSegmentDict.values()
+        old_segment_data_dict = self._segment_data_dict
+        self._segment_data_dict = {}
+
+        def segment_data(segment):
+            data = self._segment_data_dict.get(id(segment))
+            if data is not None:
+                return data
+            strand_chunks = segment.get_content_strand_chunks()
+            data = old_segment_data_dict.get(id(segment))
+            if data is None or not data.is_valid_for(segment, strand_chunks):
+                data = _SegmentCrossoverData(segment, strand_chunks)
+            self._segment_data_dict[id(segment)] = data
+            return data
+
+        capsules = []
+        for segment in allSegments:
+            end1, end2 = segment.getAxisEndPoints()
+            if end1 is None:
+                # (such segments are never approved as neighbors; see
+                #  _neighborSegment_ok_for_crossover_search)
+                capsules.append(None)
+                continue
+            if end2 is None:
+                end2 = end1
+            capsules.append(segment_data(segment).capsule(end1, end2))
+
+        index = SegmentCapsuleIndex(capsules,
+                                    MAX_DISTANCE_BETWEEN_CROSSOVER_SITES)
+
+        indicators_angle = env.prefs[dnaBaseIndicatorsAngle_prefs_key]
+
+        #dict segments_searched_for_neighbors is used as in
+        #_mark_crossoverSites_bet_segment_and_its_neighbors
+        segments_searched_for_neighbors = {}
+
+        segments_to_be_searched = self.command.getSegmentList()
+
+        for dnaSegment in segments_to_be_searched:
+            segments_searched_for_neighbors[id(dnaSegment)] = dnaSegment
+            end1, end2 = dnaSegment.getAxisEndPoints()
+            axisVector = norm(end2 - end1)
+            data = segment_data(dnaSegment)
+            capsule = data.capsule(end1, end2)
+            if capsule is None:
+                continue
+            for i in index.neighbors(capsule):
+                neighbor = allSegments[i]
+                if neighbor is dnaSegment or \
+                   segments_searched_for_neighbors.has_key(id(neighbor)):
+                    continue
+                ok_to_search, orthogonal_vector = \
+                            self._neighborSegment_ok_for_crossover_search(neighbor,
+                                                                          end1,
+                                                                          axisVector)
+                if ok_to_search:
+                    self._find_crossover_atompairs_between_segment_data(
+                        data,
+                        segment_data(neighbor),
+                        orthogonal_vector,
+                        indicators_angle)
+        return
+
+    def _find_crossover_atompairs_between_segment_data(self,
+                                                       data_1,
+                                                       data_2,
+                                                       orthogonal_vector,
+                                                       indicators_angle):
+        """
+        Does what self._find_raw_crossover_atoms and
+        self._find_crossover_atompairs_between_atom_dicts do, for the
+        strand atoms of two segments (given as _SegmentCrossoverData).
+        """
+        atomPairsList_1, centers_1 = self._indicator_atompairs_of_segment_data(
+            data_1, orthogonal_vector, indicators_angle)
+        atomPairsList_2, centers_2 = self._indicator_atompairs_of_segment_data(
+            data_2, orthogonal_vector, indicators_angle)
+
+        i1, i2, near1, near2 = crossover_site_matches(centers_1,
+                                                      centers_2,
+                                                      orthogonal_vector)
+
+        if self.graphicsMode.DEBUG_DRAW_AVERAGE_CENTER_PAIRS_OF_POTENTIAL_CROSSOVERS:
+            for a, b in zip(near1, near2):
+                self._DEBUG_avg_center_pairs_of_potential_crossovers.append(
+                    (+ centers_1[a], + centers_2[b]))
+
+        for a, b in zip(i1, i2):
+            self._add_crossover_site(atomPairsList_1[a],
+                                     atomPairsList_2[b],
+                                     + centers_1[a],
+                                     + centers_2[b])
+        return
+
+    def _indicator_atompairs_of_segment_data(self,
+                                             data,
+                                             orthogonal_vector,
+                                             indicators_angle):
+        """
+        Return a list of the bonded pairs of base orientation indicator atoms
+        (for orthogonal_vector) in the given _SegmentCrossoverData, and a
+        Numeric array of their centers, skipping pairs whose atoms are both
+        already in final crossover sites.
+        (The same pairs self._filter_neighbor_atompairs would find.)
+        """
+        mask = base_orientation_indicator_mask(data.directions,
+                                               orthogonal_vector,
+                                               indicators_angle)
+        keep = Numeric.logical_and(Numeric.take(mask, data.pair_first),
+                                   Numeric.take(mask, data.pair_second))
+        debug_all = self.graphicsMode.DEBUG_DRAW_ALL_POTENTIAL_CROSSOVER_SITES
+        atoms = data.atoms
+        atomPairsList = []
+        rows = []
+        for k in Numeric.nonzero(keep):
+            atm = atoms[data.pair_first[k]]
+            neighbor = atoms[data.pair_second[k]]
+            if self._final_crossover_atoms_dict.has_key(id(atm)) and \
+               self._final_crossover_atoms_dict.has_key(id(neighbor)):
+                continue #skip this iteration
+            if debug_all:
+                self._base_orientation_indicator_dict[id(atm)] = atm
+                self._base_orientation_indicator_dict[id(neighbor)] = neighbor
+            atomPairsList.append((atm, neighbor))
+            rows.append(k)
+        centers = Numeric.take(data.pair_centers, rows, axis = 0)
+        return atomPairsList, centers
+
+    def _updateCrossoverSites_using_nested_loops(self):
         allSegments = self._allDnaSegmentDict.values()
         #dict segments_searched_for_neighbors is a dictionary object that
         #maintains all the dna segments that have been gone trorugh a
@@ -458,6 +727,18 @@ class CrossoverSite_Marker:
         if abs(theta) > MAX_ANGLE_BET_PLANE_NORMAL_AND_AVG_CENTER_VECTOR_OF_CROSSOVER_PAIRS:
             return False, distance, ()
 
+        crossoverPairs = self._add_crossover_site(atomPair1, atomPair2,
+                                                  center_1, center_2)
+
+        return True, distance, crossoverPairs
+
+    def _add_crossover_site(self, atomPair1, atomPair2, center_1, center_2):
+        """
+        Record the crossover site between atomPair1 and atomPair2 (whose
+        centers are center_1 and center_2), and return its crossoverPairs.
+        """
+        atm1, neighbor1 = atomPair1
+        atm2, neighbor2 = atomPair2
         crossoverPairs = (atm1, neighbor1, atm2, neighbor2)
 
         for a in crossoverPairs:
@@ -472,7 +753,7 @@ class CrossoverSite_Marker:
             self._final_avg_center_pairs_for_crossovers_dict[crossoverPairs_id] = (center_1, center_2)
             self.final_crossover_pairs_dict[crossoverPairs_id] = crossoverPairs
 
-        return True, distance, crossoverPairs
+        return crossoverPairs
 
     def _create_crossoverPairs_id(self, crossoverPairs):
         #important to sort this to create a unique id. Makes sure that same
@@ -0,0 +1,438 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+CrossoverSite_Search.py -- array-based helpers used by CrossoverSite_Marker
+to find the potential crossover sites between DnaSegments quickly.
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+The original search in CrossoverSite_Marker compared every listed segment
+with every segment in the part (an orthodist per pair of segments), then,
+for each pair of neighboring segments, tested every strand base atom with
+angleBetween and every pair of candidate atom pairs with vlen and
+angleBetween, all in Python. On an origami with a few hundred helices,
+this stalls the Make Crossovers command for many seconds per update.
+
+This module provides the pieces which replace those loops:
+
+- SegmentCapsuleIndex finds the segments which could possibly have
+  crossover sites with a given segment, using a BoxTree over the segments'
+  axis capsules (the axis line segment plus a radius which contains all
+  of the segment's strand base atoms). Crossover sites need atom pair
+  centers at most MAX_DISTANCE_BETWEEN_CROSSOVER_SITES apart, so segments
+  whose capsules are further apart than that can't have any.
+
+- base_orientation_indicator_mask does the base orientation indicator test
+  of get_all_available_dna_base_orientation_indicators for all of a
+  segment's strand base atoms at once.
+
+- crossover_site_matches does the distance and angle tests of
+  CrossoverSite_Marker._are_crossover_atompairs for all pairs of candidate
+  atom pairs of two segments at once.
+
+They work on Numeric arrays (not atoms), so the search can be tested and
+benchmarked without a model; run this file (as
+./ExecSubDir.py dna/commands/MakeCrossovers/CrossoverSite_Search.py)
+for a self-test and a benchmark on synthetic helix bundles.
+"""
+
+import math
+
+import Numeric
+from Numeric import Float, Int
+
+from geometry.VQT import A, vlen
+from geometry.BoxTree import BoxTree
+from geometry.CellListIndex import CellListIndex
+
+MAX_DISTANCE_BETWEEN_CROSSOVER_SITES = 17
+#Following is used by the algoritm that searches for neighboring dna segments
+#(to a given dnaSegment) to mark crossover sites (atom pairs that will be
+#involved in a crossover)
+MAX_PERPENDICULAR_DISTANCE_BET_SEGMENT_AXES = 34
+
+MAX_ANGLE_BET_PLANE_NORMAL_AND_AVG_CENTER_VECTOR_OF_CROSSOVER_PAIRS = 32
+
+# same as in geometry.VQT.angleBetween
+_TEENY = 1.0e-10
+
+# crossover_site_matches compares all pairs of centers directly when there
+# are at most this many of them, and uses a CellListIndex otherwise
+_DENSE_MATCH_LIMIT = 250000
+
+# ==
+
+def segment_distance(p1, q1, p2, q2):
+    """
+    Return the distance between the closest points of the line segments
+    p1-q1 and p2-q2 (either of which can have zero length).
+    """
+    d1 = q1 - p1
+    d2 = q2 - p2
+    r = p1 - p2
+    a = Numeric.dot(d1, d1)
+    e = Numeric.dot(d2, d2)
+    f = Numeric.dot(d2, r)
+    if a <= _TEENY and e <= _TEENY:
+        return vlen(r)
+    if a <= _TEENY:
+        s = 0.0
+        t = min(max(f / e, 0.0), 1.0)
+    else:
+        c = Numeric.dot(d1, r)
+        if e <= _TEENY:
+            t = 0.0
+            s = min(max(- c / a, 0.0), 1.0)
+        else:
+            b = Numeric.dot(d1, d2)
+            denom = a * e - b * b
+            if denom > _TEENY * a * e:
+                s = min(max((b * f - c * e) / denom, 0.0), 1.0)
+            else:
+                # parallel segments; any s will do
+                s = 0.0
+            t = (b * s + f) / e
+            if t < 0.0:
+                t = 0.0
+                s = min(max(- c / a, 0.0), 1.0)
+            elif t > 1.0:
+                t = 1.0
+                s = min(max((b - c) / a, 0.0), 1.0)
+    return vlen((p1 + s * d1) - (p2 + t * d2))
+
+def capsule_radius(end1, end2, positions):
+    """
+    Return the smallest radius of a capsule around the line segment
+    end1-end2 which contains all the given positions
+    (an (N,3) Numeric array), or 0.0 if there are none.
+    """
+    if not len(positions):
+        return 0.0
+    d = end2 - end1
+    rel = positions - end1
+    dd = Numeric.dot(d, d)
+    if dd > _TEENY:
+        t = Numeric.clip(Numeric.dot(rel, d) / dd, 0.0, 1.0)
+        rel = rel - Numeric.reshape(t, (-1, 1)) * d
+    return math.sqrt(max(Numeric.add.reduce(rel * rel, -1)))
+
+class SegmentCapsuleIndex:
+    """
+    An index of segment axis capsules which finds the capsules within
+    a given margin of a query capsule.
+    """
+    def __init__(self, capsules, margin):
+        """
+        @param capsules: a list of capsules (end1, end2, radius), or None
+                         for segments which should never be found.
+        @param margin: how far apart two capsules can be and still be
+                       found as neighbors.
+        """
+        self._capsules = capsules
+        self._margin = margin
+        lows = []
+        highs = []
+        ids = []
+        for i in range(len(capsules)):
+            capsule = capsules[i]
+            if capsule is None:
+                continue
+            end1, end2, radius = capsule
+            lows.append(Numeric.minimum(end1, end2) - radius)
+            highs.append(Numeric.maximum(end1, end2) + radius)
+            ids.append(i)
+        self._tree = BoxTree(lows, highs, ids)
+        return
+
+    def neighbors(self, capsule):
+        """
+        Return a sorted list of the indices (in the list of capsules
+        given to our constructor) of all capsules within our margin
+        of the given capsule (end1, end2, radius).
+        """
+        end1, end2, radius = capsule
+        pad = radius + self._margin
+        lo = Numeric.minimum(end1, end2) - pad
+        hi = Numeric.maximum(end1, end2) + pad
+        res = []
+        for i in self._tree.overlapping(lo, hi):
+            end1_i, end2_i, radius_i = self._capsules[i]
+            if segment_distance(end1, end2, end1_i, end2_i) <= pad + radius_i:
+                res.append(i)
+        res.sort()
+        return res
+
+    pass
+
+# ==
+
+def _angles_from(normal, vectors):
+    """
+    Return a Numeric array of angleBetween(normal, vector) (in degrees)
+    for each row of the (N,3) Numeric array vectors, treating very short
+    vectors the same way as angleBetween does.
+    """
+    n = len(vectors)
+    lensq1 = Numeric.dot(normal, normal)
+    if lensq1 < _TEENY or not n:
+        return Numeric.zeros(n, Float)
+    lensq2 = Numeric.add.reduce(vectors * vectors, -1)
+    ok = Numeric.greater_equal(lensq2, _TEENY)
+    lens = Numeric.sqrt(Numeric.where(ok, lensq2, 1.0))
+    dprod = Numeric.dot(vectors, normal / lensq1 ** .5) / lens
+    angles = Numeric.arccos(Numeric.clip(dprod, -1.0, 1.0)) * (180 / math.pi)
+    return Numeric.where(ok, angles, 0.0)
+
+def base_orientation_indicator_mask(directions, normal, indicators_angle):
+    """
+    Return a Numeric array which is true for each base whose direction
+    (a row of the (N,3) array directions, from the axis atom to the strand
+    atom) is within indicators_angle degrees of being parallel or
+    antiparallel to normal. (This is the test done per base by
+    get_all_available_dna_base_orientation_indicators.)
+    """
+    angles = _angles_from(normal, directions)
+    return Numeric.logical_or(Numeric.less(angles, indicators_angle),
+                              Numeric.greater(angles,
+                                              180.0 - indicators_angle))
+
+def _empty_matches():
+    empty = Numeric.zeros(0, Int)
+    return empty, empty, empty, empty
+
+def crossover_site_matches(centers1, centers2, orthogonal_vector):
+    """
+    Find the crossover sites between two lists of candidate atom pairs,
+    given the centers of the atom pairs, as (N,3) Numeric arrays
+    centers1 and centers2. This does the tests of
+    CrossoverSite_Marker._are_crossover_atompairs for all pairs of them
+    at once.
+
+    @return: a tuple (i1, i2, near1, near2) of Numeric index arrays.
+             Each centers1[i1[k]], centers2[i2[k]] is a crossover site,
+             and each centers1[near1[k]], centers2[near2[k]] passed the
+             distance test (whether or not it passed the angle test).
+             Both are sorted by (first index, second index), which is
+             the order in which the original loops found them.
+    """
+    n1 = len(centers1)
+    n2 = len(centers2)
+    if not n1 or not n2:
+        return _empty_matches()
+    if n1 * n2 <= _DENSE_MATCH_LIMIT:
+        diff = Numeric.reshape(centers1, (n1, 1, 3)) - \
+               Numeric.reshape(centers2, (1, n2, 3))
+        dist2 = Numeric.ravel(Numeric.add.reduce(diff * diff, -1))
+        near = Numeric.nonzero(
+            Numeric.less_equal(Numeric.sqrt(dist2),
+                               MAX_DISTANCE_BETWEEN_CROSSOVER_SITES))
+        near1 = near // n2
+        near2 = near % n2
+    else:
+        # (the index uses a strict radius, so make it a bit larger, then
+        #  apply the exact test used by _are_crossover_atompairs)
+        index = CellListIndex(centers2,
+                              MAX_DISTANCE_BETWEEN_CROSSOVER_SITES + 1e-6)
+        near1, near2, dist2 = index.neighbors_of(centers1, return_dist2 = True)
+        keep = Numeric.less_equal(Numeric.sqrt(dist2),
+                                  MAX_DISTANCE_BETWEEN_CROSSOVER_SITES)
+        near1 = Numeric.compress(keep, near1)
+        near2 = Numeric.compress(keep, near2)
+        order = Numeric.argsort(near1 * n2 + near2)
+        near1 = Numeric.take(near1, order)
+        near2 = Numeric.take(near2, order)
+    if not len(near1):
+        return _empty_matches()
+    centerVecs = Numeric.take(centers1, near1, axis = 0) - \
+                 Numeric.take(centers2, near2, axis = 0)
+    theta = _angles_from(orthogonal_vector, centerVecs)
+    # (the comparison with 1 rather than 0 is what _are_crossover_atompairs
+    #  has always done)
+    theta = Numeric.where(
+        Numeric.less(Numeric.dot(centerVecs, orthogonal_vector), 1),
+        180.0 - theta,
+        theta)
+    ok = Numeric.less_equal(
+        abs(theta),
+        MAX_ANGLE_BET_PLANE_NORMAL_AND_AVG_CENTER_VECTOR_OF_CROSSOVER_PAIRS)
+    return Numeric.compress(ok, near1), Numeric.compress(ok, near2), \
+           near1, near2
+
+# ==
+
+if __name__ == '__main__':
+    # self-test and benchmark; run from cad/src as
+    # ./ExecSubDir.py dna/commands/MakeCrossovers/CrossoverSite_Search.py
+    import time
+    from geometry.VQT import V, norm, orthodist, angleBetween
+
+    INDICATORS_ANGLE = 30.0
+    RISE = 3.18
+    TWIST = 34.3 * math.pi / 180
+    STRAND_RADIUS = 8.8
+    GROOVE = 150.0 * math.pi / 180
+    SPACING = 22.0
+
+    class _FakeSegment:
+        """
+        One synthetic helix, with its strand base atoms numbered from
+        first_atom, and candidate atom pairs (ordered by bond direction)
+        between neighboring bases of each strand.
+        """
+        def __init__(self, x, y, nbases, first_atom):
+            positions = []
+            directions = []
+            for strand in (0, 1):
+                for k in range(nbases):
+                    angle = k * TWIST + strand * GROOVE
+                    d = V(math.cos(angle), math.sin(angle), 0.0)
+                    directions.append(d)
+                    positions.append(V(x, y, k * RISE) + STRAND_RADIUS * d)
+            self.positions = A(positions)
+            self.directions = A(directions)
+            self.atoms = range(first_atom, first_atom + 2 * nbases)
+            first = range(nbases - 1) + range(nbases + 1, 2 * nbases)
+            second = range(1, nbases) + range(nbases, 2 * nbases - 1)
+            self.pairs = Numeric.array(first, Int), Numeric.array(second, Int)
+            self.centers = (Numeric.take(self.positions, first, axis = 0) +
+                            Numeric.take(self.positions, second, axis = 0)) / 2.0
+            self.end1 = V(x, y, 0.0)
+            self.end2 = V(x, y, (nbases - 1) * RISE)
+        pass
+
+    def _bundle(nhelices, nbases):
+        ncols = int(math.ceil(math.sqrt(nhelices)))
+        return [_FakeSegment((i % ncols) * SPACING, (i // ncols) * SPACING,
+                             nbases, i * 2 * nbases)
+                for i in range(nhelices)]
+
+    def _orthogonal_vector(segment, neighbor):
+        # as in CrossoverSite_Marker._neighborSegment_ok_for_crossover_search
+        end1 = segment.end1
+        axisVector = norm(segment.end2 - end1)
+        dist, orthogonal_dist = orthodist(end1, axisVector, neighbor.end1)
+        if orthogonal_dist > MAX_PERPENDICULAR_DISTANCE_BET_SEGMENT_AXES:
+            return None
+        vec = end1 + dist * axisVector - neighbor.end1
+        return orthogonal_dist * norm(vec)
+
+    def _add_site(atoms, final_atoms, sites):
+        for atm in atoms:
+            final_atoms[atm] = atm
+        key = list(atoms)
+        key.sort()
+        sites[tuple(key)] = 1
+
+    def _search_old(segments):
+        # the original algorithm: all pairs of segments, per-atom loops
+        final_atoms = {}
+        sites = {}
+        for s1 in range(len(segments)):
+            for s2 in range(s1 + 1, len(segments)):
+                ov = _orthogonal_vector(segments[s1], segments[s2])
+                if ov is None:
+                    continue
+                atompairs = []
+                for seg in (segments[s1], segments[s2]):
+                    chosen = {}
+                    for i in range(len(seg.atoms)):
+                        a = angleBetween(ov, seg.directions[i])
+                        if a < INDICATORS_ANGLE or a > 180.0 - INDICATORS_ANGLE:
+                            chosen[i] = 1
+                    pairs = []
+                    for i, j in zip(seg.pairs[0], seg.pairs[1]):
+                        if chosen.has_key(i) and chosen.has_key(j):
+                            atm, neighbor = seg.atoms[i], seg.atoms[j]
+                            if final_atoms.has_key(atm) and \
+                               final_atoms.has_key(neighbor):
+                                continue
+                            center = (seg.positions[i] + seg.positions[j]) / 2.0
+                            pairs.append(((atm, neighbor), center))
+                    atompairs.append(pairs)
+                for pair1, center_1 in atompairs[0]:
+                    for pair2, center_2 in atompairs[1]:
+                        centerVec = center_1 - center_2
+                        if vlen(centerVec) > MAX_DISTANCE_BETWEEN_CROSSOVER_SITES:
+                            continue
+                        theta = angleBetween(ov, centerVec)
+                        if Numeric.dot(centerVec, ov) < 1:
+                            theta = 180.0 - theta
+                        if abs(theta) > MAX_ANGLE_BET_PLANE_NORMAL_AND_AVG_CENTER_VECTOR_OF_CROSSOVER_PAIRS:
+                            continue
+                        _add_site(pair1 + pair2, final_atoms, sites)
+        return sites
+
+    def _search_new(segments):
+        # the algorithm used by CrossoverSite_Marker
+        final_atoms = {}
+        sites = {}
+        capsules = [(seg.end1, seg.end2,
+                     capsule_radius(seg.end1, seg.end2, seg.positions))
+                    for seg in segments]
+        index = SegmentCapsuleIndex(capsules,
+                                    MAX_DISTANCE_BETWEEN_CROSSOVER_SITES)
+        for s1 in range(len(segments)):
+            for s2 in index.neighbors(capsules[s1]):
+                if s2 <= s1:
+                    continue
+                ov = _orthogonal_vector(segments[s1], segments[s2])
+                if ov is None:
+                    continue
+                atompairs = []
+                for seg in (segments[s1], segments[s2]):
+                    mask = base_orientation_indicator_mask(
+                        seg.directions, ov, INDICATORS_ANGLE)
+                    first, second = seg.pairs
+                    keep = Numeric.logical_and(Numeric.take(mask, first),
+                                               Numeric.take(mask, second))
+                    pairs = []
+                    rows = []
+                    for k in Numeric.nonzero(keep):
+                        atm = seg.atoms[first[k]]
+                        neighbor = seg.atoms[second[k]]
+                        if final_atoms.has_key(atm) and \
+                           final_atoms.has_key(neighbor):
+                            continue
+                        pairs.append((atm, neighbor))
+                        rows.append(k)
+                    atompairs.append(
+                        (pairs, Numeric.take(seg.centers, rows, axis = 0)))
+                (pairs1, centers1), (pairs2, centers2) = atompairs
+                i1, i2, near1, near2 = crossover_site_matches(centers1,
+                                                              centers2, ov)
+                for a, b in zip(i1, i2):
+                    _add_site(pairs1[a] + pairs2[b], final_atoms, sites)
+        return sites
+
+    print "tests started"
+    p = V(0.0, 0.0, 0.0)
+    q = V(10.0, 0.0, 0.0)
+    assert abs(segment_distance(p, q, V(5.0, 3.0, -4.0), V(5.0, 3.0, 4.0)) - 3.0) < 1e-9
+    assert abs(segment_distance(p, q, V(13.0, 4.0, 0.0), V(20.0, 4.0, 0.0)) - 5.0) < 1e-9
+    assert abs(segment_distance(p, q, V(2.0, 1.0, 0.0), V(8.0, 1.0, 0.0)) - 1.0) < 1e-9
+    assert abs(segment_distance(p, p, q, q) - 10.0) < 1e-9
+    for nhelices in (1, 2, 9, 30):
+        segments = _bundle(nhelices, 40)
+        sites_old = _search_old(segments)
+        sites_new = _search_new(segments)
+        assert sites_old == sites_new, "site mismatch for %d helices" % nhelices
+        assert nhelices == 1 or sites_new
+    print "tests done"
+
+    print "benchmark: crossover sites in square-lattice bundles of 64 bp helices"
+    for nhelices in (50, 100, 200, 500):
+        segments = _bundle(nhelices, 64)
+        t0 = time.time()
+        sites = _search_new(segments)
+        t1 = time.time()
+        print "%4d helices: new search %.2f sec (%d sites)" % \
+              (nhelices, t1 - t0, len(sites)),
+        if nhelices <= 100:
+            sites_old = _search_old(segments)
+            t2 = time.time()
+            assert sites_old == sites
+            print "; old search %.2f sec" % (t2 - t1),
+        print
+
+# end
@@ -36,7 +36,11 @@ from simulation.sim_commandruns import adjustSinglet
 from model.elements import PeriodicTable
 from model.Line import Line
 
+from model.chem import Atom
 from model.chem import Atom_prekill_prep
+from model.chunk import Chunk
+from model.bonds import bond_atoms
+from foundation.state_utils import copy_val
 Element_Ae3 = PeriodicTable.getElement('Ae3')
 
 from dna.model.Dna_Constants import basesDict, dnaDict
@@ -52,11 +56,162 @@ LEFT_HANDED  =  1
 
 from geometry.VQT import V, Q, norm, cross
 from geometry.VQT import  vlen
+from geometry.VQT import A
 from Numeric import dot
+import Numeric
 
 from utilities.debug import print_compact_stack
+from utilities.debug import register_debug_menu_command
+from utilities.debug_prefs import debug_pref, Choice_boolean_True
 from model.bonds import bond_at_singlets
 
+def debug_pref_build_duplex_directly():
+    res = debug_pref("DNA: build duplexes directly (faster)?",
+                     Choice_boolean_True, # use False for the old fusing code
+                     prefs_key = True
+                 )
+    return res
+
+
+# ==
+
+class _DnaBaseTemplate:
+    """
+    The atoms, bonds and chunks read from one base (or base-pair) mmp file,
+    kept in a compact form so that transformed copies can be made without
+    reading the file again.
+    """
+    def __init__(self, chunks):
+        """
+        @param chunks: the chunks read from the template file
+                       (they are not modified or retained).
+        """
+        atoms = []
+        self.chunks = [] # (display, color, start, end), atom index range
+        for chunk in chunks:
+            chunkatoms = chunk.atoms.values()
+            chunkatoms.sort(lambda a1, a2: cmp(a1.key, a2.key))
+                # (atom keys are increasing, so this is file order)
+            self.chunks.append( (chunk.display, chunk.color,
+                                 len(atoms), len(atoms) + len(chunkatoms)) )
+            atoms.extend(chunkatoms)
+        index = dict([(atom.key, i) for i, atom in enumerate(atoms)])
+        self.positions = A([atom.posn() for atom in atoms])
+        # For each atom, what to pass to Atom() (an atomtype if the file
+        # specified one, else an element symbol, for which the atomtype is
+        # left unset, as when reading mmp files), and its other attributes
+        # that can be set from mmp files (as in Atom.copy)
+        self.atomtypes = []
+        self.attrs = []
+        for atom in atoms:
+            atomtype = atom.atomtype_iff_set()
+            if atomtype is None:
+                self.atomtypes.append(atom.element.symbol)
+            else:
+                self.atomtypes.append(atomtype)
+            attrs = {}
+            for attr in ('display', 'info', '_dnaBaseName', 'ghost',
+                         '_PAM3plus5_Pl_Gv_data'):
+                val = getattr(atom, attr)
+                if val:
+                    attrs[attr] = val
+            # (not a class attribute, so not set by getattr)
+            strandId = atom.__dict__.get('_dnaStrandId_for_generators')
+            if strandId:
+                attrs['_dnaStrandId_for_generators'] = strandId
+            self.attrs.append(attrs)
+        # each bond as (i, j, v6, direction from atom i), with i < j
+        self.bonds = []
+        for j, atom in enumerate(atoms):
+            for bond in atom.bonds:
+                other = bond.other(atom)
+                i = index[other.key]
+                if i < j:
+                    self.bonds.append( (i, j, bond.v6,
+                                        bond.bond_direction_from(other)) )
+        return
+
+    def new_chunk(self, assy, i = 0):
+        """
+        Make and return a new chunk in assy (not yet added to any group)
+        with the same display settings as our ith chunk.
+        """
+        display, color, start, end = self.chunks[i]
+        chunk = Chunk(assy, "BasePairChunk")
+        chunk.display = display
+        chunk.color = color
+        return chunk
+
+    def make_chunks(self, assy, positions):
+        """
+        Make and return a new list of chunks in assy (not yet added to any
+        group) like the ones we were made from, but with the given atom
+        positions (a Numeric array like self.positions).
+        """
+        res = [self.new_chunk(assy, i) for i in range(len(self.chunks))]
+        self.make_atoms(res, positions)
+        return res
+
+    def make_atoms(self, chunks, positions):
+        """
+        Make and return a new list of atoms like the ones we were made from
+        (with the same bonds), but with the given positions (a Numeric array
+        like self.positions). Atoms from our ith chunk are added to chunks[i]
+        (which needn't all be different).
+        """
+        newatoms = []
+        for chunk, (display, color, start, end) in zip(chunks, self.chunks):
+            for i in range(start, end):
+                atom = Atom(self.atomtypes[i], positions[i], chunk)
+                if type(self.atomtypes[i]) == type(""):
+                    atom.unset_atomtype()
+                for attr, val in self.attrs[i].iteritems():
+                    if attr == '_PAM3plus5_Pl_Gv_data':
+                        val = copy_val(val)
+                    setattr(atom, attr, val)
+                newatoms.append(atom)
+        for i, j, v6, direction in self.bonds:
+            bond = bond_atoms(newatoms[j], newatoms[i], v6,
+                              no_corrections = True)
+            if direction:
+                bond.set_bond_direction_from(newatoms[i], direction)
+        return newatoms
+
+    pass
+
+# maps base (or base-pair) mmp filename to (file modification time,
+# _DnaBaseTemplate read from that file)
+_base_templates = {}
+
+def _get_base_template(assy, filename):
+    """
+    Return a _DnaBaseTemplate for the given mmp file, reading the file
+    (into assy, temporarily) only if it wasn't read before or has been
+    modified since then.
+    """
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        raise PluginBug("Cannot read file: " + filename)
+    cached = _base_templates.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    try:
+        ok, grouplist = readmmp(assy, filename, isInsert = True)
+    except IOError:
+        raise PluginBug("Cannot read file: " + filename)
+    if not grouplist:
+        raise PluginBug("No atoms in DNA base? " + filename)
+    viewdata, mainpart, shelf = grouplist
+    template = _DnaBaseTemplate(mainpart.members)
+    # Clean up.
+    del viewdata
+    mainpart.kill()
+    shelf.kill()
+    _base_templates[filename] = (mtime, template)
+    return template
+
+# ==
 
 class Dna_Generator:
     """
@@ -78,6 +233,13 @@ class Dna_Generator:
     @ivar numberOfBasePairs: The number of base-pairs in the duplex.
     @type numberOfBasePairs: int
 
+    @ivar build_duplex_directly: whether _create_raw_duplex should use
+                                 _create_raw_duplex_directly, or the older
+                                 code which fuses one chunk per base-pair.
+                                 None (the default) means use the value of
+                                 a debug_pref (normally True).
+    @type build_duplex_directly: boolean or None
+
     @note: Atomistic models are not supported.
     @TODO: This classe's attribute 'assy' (self.assy) is determined in self.make
            Its okay because callers only call dna.make() first. If assy object
@@ -95,6 +257,8 @@ class Dna_Generator:
 
     strandA_atom_end1 = None
 
+    build_duplex_directly = None
+
     def modify(self,
                group,
                resizeEndAxisAtom,
@@ -989,8 +1153,21 @@ class Dna_Generator:
 
         @return: A group object containing the 'raw dna duplex'
         @see: self.make()
-
+        @see: self._create_raw_duplex_directly(), used instead of the code
+              here unless self.build_duplex_directly or a debug_pref
+              says not to
         """
+        directly = self.build_duplex_directly
+        if directly is None:
+            directly = debug_pref_build_duplex_directly()
+        if directly:
+            self._create_raw_duplex_directly(group,
+                                             numberOfBasePairs,
+                                             basesPerTurn,
+                                             duplexRise,
+                                             position = position)
+            return
+
         # Make the duplex.
         subgroup = group
         subgroup.open = False
@@ -1005,8 +1182,8 @@ class Dna_Generator:
         for i in range(numberOfBasePairs):
             basefile, zoffset, thetaOffset = self._strandAinfo(i)
 
-            def tfm(v, theta = theta + thetaOffset, z1 = z + zoffset):
-                return self._rotateTranslateXYZ(v, theta, z1)
+            def tfm(positions, theta = theta + thetaOffset, z1 = z + zoffset):
+                return self._rotateTranslateXYZ(positions, theta, z1)
 
             #Note that self.baseList gets updated in the the following method
             self._insertBaseFromMmp(basefile,
@@ -1058,6 +1235,127 @@ class Dna_Generator:
 
 
 
+    def _create_raw_duplex_directly(self,
+                                    group,
+                                    numberOfBasePairs,
+                                    basesPerTurn,
+                                    duplexRise,
+                                    position = V(0, 0, 0)):
+        """
+        Create the same raw dna duplex as the older code in
+        _create_raw_duplex, but faster, by computing the atom positions
+        for all base-pairs at once and creating their atoms and bonds
+        directly, without making (and then fusing) one chunk per base-pair.
+
+        The atoms of the first and last base-pairs are put into their own
+        chunks (which _postProcess and other methods depend on); all other
+        atoms go into a single chunk. These chunks make up self.baseList,
+        and are later regrouped into strand and axis chunks by _regroup,
+        as usual.
+        """
+        subgroup = group
+        subgroup.open = False
+
+        # Compute the twist and rise of each base-pair in the same way
+        # (including the same floating point roundoff) as the older code.
+        twistPerBase = (self.handedness * 2 * pi) / basesPerTurn
+        theta = 0.0
+        z     = 0.5 * duplexRise * (numberOfBasePairs - 1)
+        basefiles = []
+        thetas = []
+        zs = []
+        for i in range(numberOfBasePairs):
+            basefile, zoffset, thetaOffset = self._strandAinfo(i)
+            basefiles.append(basefile)
+            thetas.append(theta + thetaOffset)
+            zs.append(z + zoffset)
+            theta -= twistPerBase
+            z     -= duplexRise
+
+        # Compute all atom positions, for each template at once.
+        templates = {} # basefile -> template
+        positions = [None] * numberOfBasePairs # per base-pair positions
+        indices_of_basefile = {}
+        for i, basefile in enumerate(basefiles):
+            indices_of_basefile.setdefault(basefile, []).append(i)
+        for basefile, indices in indices_of_basefile.iteritems():
+            template = templates[basefile] = \
+                       _get_base_template(self.assy, basefile)
+            allpositions = self._rotateTranslateXYZ_many(
+                template.positions,
+                [thetas[i] for i in indices],
+                [zs[i] for i in indices] )
+            for i, bp_positions in zip(indices, allpositions):
+                positions[i] = bp_positions + position
+
+        fuseTolerance = 1.5 # same as default in self.fuseBasePairChunks
+
+        chunk = None
+        prior_atoms = None
+        for i in range(numberOfBasePairs):
+            template = templates[basefiles[i]]
+            if i == 0 or i == 1 or i == numberOfBasePairs - 1:
+                chunk = template.new_chunk(self.assy)
+                subgroup.addchild(chunk)
+                self.baseList.append(chunk)
+            atoms = template.make_atoms([chunk] * len(template.chunks),
+                                        positions[i])
+            if i == 0:
+                # see comments in _create_raw_duplex
+                self._determine_axis_and_strandA_endAtoms_at_end_1(
+                    self.baseList[0])
+            else:
+                self._fuse_base_pair_atoms(prior_atoms, atoms, fuseTolerance)
+            prior_atoms = atoms
+            continue
+
+        try:
+            self._postProcess(self.baseList)
+        except:
+            if env.debug():
+                print_compact_traceback(
+                    "debug: exception in %r._postProcess(self.baseList = %r) " \
+                    "(reraising): " % (self, self.baseList,))
+            raise
+        return
+
+    def _fuse_base_pair_atoms(self, atoms1, atoms2, fuseTolerance):
+        """
+        Bond the bondpoints of atoms2 (the atoms of one base-pair)
+        to those of atoms1 (the atoms of the prior base-pair) which are close
+        enough, exactly as fuseBasePairChunks would do for the chunks
+        containing them, but without looking at any other atoms.
+        """
+        singlets1 = [atom for atom in atoms1
+                     if atom.is_singlet() and not atom.killed()]
+        singlets2 = [atom for atom in atoms2
+                     if atom.is_singlet() and not atom.killed()]
+        if not singlets1 or not singlets2:
+            return
+        # As in fusechunksBase.find_bondable_pairs (called with atoms2's
+        # chunk as the selected chunk), a pair (s2, s1) is bondable if its
+        # bondpoints are within fuseTolerance, and it's bonded only if
+        # neither bondpoint has another way of bonding.
+        pos1 = A([s.posn() for s in singlets1])
+        pos2 = A([s.posn() for s in singlets2])
+        delta = Numeric.reshape(pos2, (len(singlets2), 1, 3)) - \
+                Numeric.reshape(pos1, (1, len(singlets1), 3))
+        dist = Numeric.sqrt(Numeric.sum(delta * delta, 2))
+        bondable = Numeric.less_equal(dist, fuseTolerance)
+        ways2 = Numeric.sum(bondable, 1)
+        ways1 = Numeric.sum(bondable, 0)
+        bonded = False
+        for j in range(len(singlets2)):
+            if ways2[j] != 1:
+                continue
+            i = Numeric.nonzero(bondable[j])[0]
+            if ways1[i] == 1:
+                bond_at_singlets(singlets2[j], singlets1[i], move = False)
+                bonded = True
+        if bonded:
+            self.assy.changed()
+        return
+
     def _insertBaseFromMmp(self,
                            filename,
                            subgroup,
@@ -1078,8 +1376,9 @@ class Dna_Generator:
         @param subgroup: The part group to add the atoms to.
         @type  subgroup: L{Group}
 
-        @param tfm: Transform applied to all new base atoms.
-        @type  tfm: V
+        @param tfm: Transform applied to all new base atoms (a function
+                    from an array of atom positions to transformed ones).
+        @type  tfm: function
 
         @param baseList: A list that maintains the bases inserted into the
                          model Example self.baseList
@@ -1093,40 +1392,31 @@ class Dna_Generator:
         #@TODO: The argument baselist ACTUALLY MODIFIES self.baseList. Should we
         #directly use self.baseList instead? Only comments are added for
         #now. See also self.make()(the caller)
-        try:
-            ok, grouplist = readmmp(self.assy, filename, isInsert = True)
-        except IOError:
-            raise PluginBug("Cannot read file: " + filename)
-        if not grouplist:
-            raise PluginBug("No atoms in DNA base? " + filename)
 
-        viewdata, mainpart, shelf = grouplist
+        # The file is only parsed the first time it's used (see
+        # _get_base_template); after that, we just make transformed copies
+        # of its atoms, so duplex size doesn't affect file I/O.
+        template = _get_base_template(self.assy, filename)
+        positions = tfm(template.positions) + position
 
-        for member in mainpart.members:
+        for member in template.make_chunks(self.assy, positions):
             # 'member' is a chunk containing a full set of
             # base-pair pseudo atoms.
-
-            for atm in member.atoms.values():
-                atm._posn = tfm(atm._posn) + position
-
-            member.name = "BasePairChunk"
             subgroup.addchild(member)
 
             #Append the 'member' to the baseList. Note that this actually
             #modifies self.baseList. Should self.baseList be directly used here?
             baseList.append(member)
 
-        # Clean up.
-        del viewdata
-        shelf.kill()
-
     def _rotateTranslateXYZ(self, inXYZ, theta, z):
         """
         Returns the new XYZ coordinate rotated by I{theta} and
-        translated by I{z}.
+        translated by I{z}. (Also works for an array of coordinates,
+        transforming each one.)
 
-        @param inXYZ: The original XYZ coordinate.
-        @type  inXYZ: V
+        @param inXYZ: The original XYZ coordinate, or an array of them
+                      (of shape (n, 3)).
+        @type  inXYZ: V or Numeric array
 
         @param theta: The base twist angle.
         @type  theta: float
@@ -1134,14 +1424,40 @@ class Dna_Generator:
         @param z: The base rise.
         @type  z: float
 
-        @return: The new XYZ coordinate.
-        @rtype:  V
+        @return: The new XYZ coordinate (or array of them).
+        @rtype:  V or Numeric array
         """
         c, s = cos(theta), sin(theta)
-        x = c * inXYZ[0] + s * inXYZ[1]
-        y = -s * inXYZ[0] + c * inXYZ[1]
-        return V(x, y, inXYZ[2] + z)
+        # (x, y, z1) -> (c * x + s * y, -s * x + c * y, z1 + z)
+        rotation = A([[c, -s, 0.0],
+                      [s,  c, 0.0],
+                      [0.0, 0.0, 1.0]])
+        return dot(inXYZ, rotation) + V(0, 0, z)
+
+
+    def _rotateTranslateXYZ_many(self, inXYZ, thetas, zs):
+        """
+        Return an array of shape (len(thetas), n, 3), whose ith element is
+        self._rotateTranslateXYZ(inXYZ, thetas[i], zs[i]).
 
+        @param inXYZ: The original XYZ coordinates, of shape (n, 3).
+        @type  inXYZ: Numeric array
+
+        @param thetas: The base twist angles.
+        @type  thetas: list of floats
+
+        @param zs: The base rises.
+        @type  zs: list of floats
+        """
+        c = Numeric.cos(A(thetas))
+        s = Numeric.sin(A(thetas))
+        x = inXYZ[:, 0]
+        y = inXYZ[:, 1]
+        res = Numeric.zeros((len(thetas), len(inXYZ), 3), Numeric.Float)
+        res[:, :, 0] = Numeric.outerproduct(c, x) + Numeric.outerproduct(s, y)
+        res[:, :, 1] = Numeric.outerproduct(-s, x) + Numeric.outerproduct(c, y)
+        res[:, :, 2] = Numeric.add.outer(A(zs), inXYZ[:, 2])
+        return res
 
     def fuseBasePairChunks(self, baseList, fuseTolerance = 1.5):
         """
@@ -1417,3 +1733,86 @@ class Dna_Generator:
 
     pass
 
+
+# ==
+
+def _duplex_structure(group):
+    """
+    Return a summary of the atoms and bonds in group (as made by
+    Dna_Generator.make), for comparing two duplexes: a list of the element
+    symbols of its atoms in creation order, an array of their positions,
+    and a sorted list of (index1, index2, v6, bond direction) for its bonds.
+    """
+    atoms = []
+    for m in group.members:
+        if isinstance(m, group.assy.Chunk):
+            atoms.extend(m.atoms.values())
+    atoms.sort(lambda a1, a2: cmp(a1.key, a2.key))
+    index = dict([(atom.key, i) for i, atom in enumerate(atoms)])
+    bonds = []
+    for j, atom in enumerate(atoms):
+        for bond in atom.bonds:
+            other = bond.other(atom)
+            i = index[other.key]
+            if i < j:
+                bonds.append( (i, j, bond.v6, bond.bond_direction_from(other)) )
+    bonds.sort()
+    return ( [atom.element.symbol for atom in atoms],
+             A([atom.posn() for atom in atoms]),
+             bonds )
+
+def _benchmark_duplex_generation(glpane, sizes = (1000, 10000, 50000)):
+    """
+    Generate PAM3 duplexes of the given sizes (in base-pairs) with the older
+    code (which fuses one chunk per base-pair) and with
+    _create_raw_duplex_directly, print the times and whether the structures
+    are identical (up to roundoff in atom positions), and discard the
+    results.
+    """
+    import time
+    from foundation.Group import Group
+    from dna.generators.B_Dna_PAM3_Generator import B_Dna_PAM3_Generator
+    assy = glpane.assy
+    duplexRise = 3.18
+    basesPerTurn = 10.0
+    for numberOfBasePairs in sizes:
+        structures = []
+        for directly in (False, True):
+            dna = B_Dna_PAM3_Generator()
+            dna.build_duplex_directly = directly
+            group = Group("DNA benchmark", assy, None)
+            t0 = time.time()
+            dna.make(group,
+                     numberOfBasePairs,
+                     basesPerTurn,
+                     duplexRise,
+                     V(0, 0, 0),
+                     V(0, 0, duplexRise * (numberOfBasePairs - 1)) )
+            t1 = time.time()
+            structures.append( _duplex_structure(group) )
+            print "generated %d base-pairs (%d atoms) with %s code " \
+                  "in %.2f sec" % \
+                  (numberOfBasePairs, len(structures[-1][0]),
+                   directly and "direct" or "fusing", t1 - t0)
+            group.kill()
+        (symbols1, positions1, bonds1), (symbols2, positions2, bonds2) = \
+                                        structures
+        # (positions can differ by roundoff, since the chunks are moved
+        #  into place about their own centers)
+        identical = (symbols1 == symbols2 and bonds1 == bonds2 and
+                     max(Numeric.ravel(abs(positions1 - positions2))) < 1e-6)
+        print "structures are identical:", not not identical
+    env.history.message("DNA generation benchmark done (see console)")
+    return
+
+def _benchmark_duplex_generation_cmd(glpane):
+    try:
+        _benchmark_duplex_generation(glpane)
+    except:
+        print_compact_traceback("exception in DNA generation benchmark: ")
+    return
+
+register_debug_menu_command("benchmark DNA duplex generation (slow)",
+                            _benchmark_duplex_generation_cmd)
+
+# end
@@ -16,6 +16,10 @@ from dna.model.DnaMarker import DnaMarker # for isinstance
 from dna.model.DnaMarker import DnaSegmentMarker # constructor
 from dna.model.DnaMarker import DnaStrandMarker # constructor
 
+from dna.updater.dna_updater_stats import note_dna_updater_count
+
+from utilities import debug_flags
+
 from utilities.debug import print_compact_traceback
 from utilities.debug import print_compact_stack
 
@@ -107,8 +111,12 @@ class WholeChain(object):
     _num_bases = -1 # unknown, to start with (used in __repr__ and __len__)
     _all_markers = () # in instances, will be a mutable dict
         # (len is used in __repr__; could be needed before __init__ done)
+    _rail_marker_entries = {} # in instances, will be a mutable dict
+        # from id(chunk) to (rail, entries) for the chunk of each rail
+        # whose marker entries are known (see _scan_rail_for_markers)
 
-    def __init__(self, dict_of_rails): # fyi: called by update_PAM_chunks
+    def __init__(self, dict_of_rails, chunks_with_moved_markers = None):
+        # fyi: called by update_PAM_chunks
         """
         Construct self, own our chunks (and therefore our atoms).
 
@@ -117,6 +125,14 @@ class WholeChain(object):
 
         @param dict_of_rails: maps id(rail) -> rail for all rails in wholechain
 
+        @param chunks_with_moved_markers: if not None, a dict whose keys are
+               the ids of all the chunks which DnaMarkers moved onto (or within)
+               during this dna updater run. For our other rails, if they're
+               unchanged since the old wholechain which owned their chunks
+               was made, we take their markers from what that wholechain found
+               on them, rather than rescanning their atoms. If None, we
+               rescan all our atoms.
+
         @note: we can assume that rail._f_update_neighbor_baseatoms() has
                already been called (during this run of the dna updater)
                for every rail (preexisting or new) in dict_of_rails.
@@ -140,8 +156,10 @@ class WholeChain(object):
         markers_1 = {} # collects markers from all our atoms during loop, maps them to (rail, baseindex) for their marked_atom
         markers_2 = {} # same, but for their next_atom (helps check whether they're still valid, and compute new position)
         num_bases = 0
+        num_bases_scanned = 0
         end0_baseatoms = self._end0_baseatoms = {} # end0 atom key -> rail (aka chain)
         end1_baseatoms = self._end1_baseatoms = {}
+        rail_marker_entries = self._rail_marker_entries = {}
         for rail in dict_of_rails.itervalues():
             baseatoms = rail.baseatoms
             assert baseatoms
@@ -149,29 +167,33 @@ class WholeChain(object):
             end0_baseatoms[baseatoms[0].key] = rail
             end1_baseatoms[baseatoms[-1].key] = rail
             chunk = baseatoms[0].molecule
+            entries = None
+            if chunks_with_moved_markers is not None and \
+               not chunks_with_moved_markers.has_key(id(chunk)):
+                entries = self._old_marker_entries(rail, chunk)
             chunk.set_wholechain(self)
-            for baseindex in range(len(baseatoms)):
-                atom = baseatoms[baseindex]
-                for jig in atom.jigs:
-                    # note: this is only correct because marker move step1 has
-                    # found new atoms for them (or reconfirmed old ones), and
-                    # has called marker.setAtoms to ensure they are recorded
-                    # on those atoms.
-                    if isinstance(jig, DnaMarker):
-                        marker = jig
-                        assert not marker.killed(), "marker %r is killed" % ( marker, )
-                            # might fail if they're not yet all in the model @@@
-                            # someday: possible optim: cache the set of markers on each rail
-                            # (and maintain it as markers move)?
-                            # might matter when lots of old rails.
-                        if marker.marked_atom is atom:
-                            markers_1[marker] = (rail, baseindex)
-                        if marker.next_atom is atom: # not elif, both can be true
-                            markers_2[marker] = (rail, baseindex)
+            if entries is None:
+                entries = self._scan_rail_for_markers(rail)
+                num_bases_scanned += len(baseatoms)
+            elif debug_flags.DNA_UPDATER_SLOW_ASSERTS:
+                scanned = self._scan_rail_for_markers(rail)
+                assert _sorted(entries) == _sorted(scanned), \
+                       "%r reused wrong markers %r for %r, should be %r" % \
+                       (self, entries, rail, scanned)
+            rail_marker_entries[id(chunk)] = (rail, entries)
+            for marker, baseindex, which in entries:
+                if which == 1:
+                    markers_1[marker] = (rail, baseindex)
+                else:
+                    markers_2[marker] = (rail, baseindex)
             continue
 
         self._num_bases = num_bases
 
+        note_dna_updater_count("wholechain rails", len(dict_of_rails))
+        note_dna_updater_count("wholechain bases", num_bases)
+        note_dna_updater_count("bases scanned for markers", num_bases_scanned)
+
         # kill markers we only found on one of their atoms
         # or that are not on adjacent atoms in self,
         # and determine and record position for the others
@@ -211,6 +233,73 @@ class WholeChain(object):
 
         return # from __init__
 
+    def _scan_rail_for_markers(self, rail):
+        """
+        [private helper for __init__]
+
+        Return a list of the marker entries of rail, found by scanning
+        all its atoms. A marker entry is a tuple (marker, baseindex, which)
+        which says that rail.baseatoms[baseindex] is the marker's
+        marked_atom (if which is 1) or next_atom (if which is 2).
+        A marker with both atoms on rail has two entries.
+        """
+        res = []
+        baseatoms = rail.baseatoms
+        for baseindex in range(len(baseatoms)):
+            atom = baseatoms[baseindex]
+            for jig in atom.jigs:
+                # note: this is only correct because marker move step1 has
+                # found new atoms for them (or reconfirmed old ones), and
+                # has called marker.setAtoms to ensure they are recorded
+                # on those atoms.
+                if isinstance(jig, DnaMarker):
+                    marker = jig
+                    assert not marker.killed(), "marker %r is killed" % ( marker, )
+                        # might fail if they're not yet all in the model @@@
+                    if marker.marked_atom is atom:
+                        res.append( (marker, baseindex, 1) )
+                    if marker.next_atom is atom: # not elif, both can be true
+                        res.append( (marker, baseindex, 2) )
+        return res
+
+    def _old_marker_entries(self, rail, chunk):
+        """
+        [private helper for __init__]
+
+        If the old wholechain which owned chunk (the chunk of rail)
+        recorded the marker entries of the same rail object, and they are
+        all still correct (except for markers killed since then, which we
+        leave out), return them as a new list. Otherwise return None
+        (meaning the caller has to scan rail).
+
+        @note: this doesn't find markers added to rail's atoms since the old
+               wholechain was made. Our caller only calls it for rails on
+               which no markers were moved during this dna updater run, and
+               markers added in other ways change the structure of their
+               atoms, which makes their rails be replaced by new ones.
+        """
+        old_wholechain = chunk.wholechain
+        if old_wholechain is None or old_wholechain is self or \
+           old_wholechain.destroyed:
+            return None
+        rail_and_entries = old_wholechain._rail_marker_entries.get(id(chunk))
+        if rail_and_entries is None or rail_and_entries[0] is not rail:
+            return None
+        baseatoms = rail.baseatoms
+        res = []
+        for entry in rail_and_entries[1]:
+            marker, baseindex, which = entry
+            if marker.killed():
+                continue
+            if which == 1:
+                atom = marker.marked_atom
+            else:
+                atom = marker.next_atom
+            if baseindex >= len(baseatoms) or baseatoms[baseindex] is not atom:
+                return None # marker moved in some way we didn't expect
+            res.append(entry)
+        return res
+
     def __len__(self):
         if self._num_bases == -1:
             # We're being called too early during init to know the value.
@@ -244,6 +333,7 @@ class WholeChain(object):
         for marker in self.all_markers():
             marker.forget_wholechain(self)
         self._all_markers = {}
+        self._rail_marker_entries = {}
         self._controlling_marker = None
         self._strand_or_segment = None # review: need to tell it to forget us, too? @@@
         for rail in self.rails():
@@ -600,6 +690,10 @@ class WholeChain(object):
     def _append_marker(self, marker, rail, baseindex, direction): # 080306
         assert not marker in self._all_markers
         self._all_markers[marker] = PositionInWholeChain(self, rail, baseindex, direction)
+        # the marker entries of its rails are now incomplete,
+        # so make sure the next wholechains rescan those rails
+        for atom in (marker.marked_atom, marker.next_atom):
+            self._rail_marker_entries.pop(id(atom.molecule), None)
         return
 
     def _find_end_atom_chain_and_index(self, atom, next_atom = None):
@@ -731,6 +825,49 @@ class WholeChain(object):
         assert 0 # not reached
         pass
 
+    def yield_rail_entry_positions(self,  # in class WholeChain
+                                   pos,
+                                   counter = 0,
+                                   countby = 1,
+                                   relative_direction = 1):
+        """
+        Like yield_rail_index_direction_counter, but yield only the first
+        position reached in each rail (starting with pos itself), so the
+        time taken is proportional to the number of rails passed rather
+        than the number of bases. The counter values are the same as
+        yield_rail_index_direction_counter would yield for those positions.
+
+        If we're a ring, the last position yielded is where we reenter
+        the rail of pos (if that's not pos itself, the remaining positions
+        in that rail are skipped).
+        """
+        rail, index, direction = pos
+        start_rail = rail
+        assert direction in (-1, 1)
+        while 1:
+            yield rail, index, direction, counter
+            # move past the end of rail, in our direction of motion
+            if direction * relative_direction == 1:
+                end = LADDER_END1
+                counter += countby * (len(rail) - index)
+            else:
+                end = LADDER_END0
+                counter += countby * (index + 1)
+            neighbor_atom = rail.neighbor_baseatoms[end]
+            assert neighbor_atom != -1
+            if neighbor_atom is None:
+                return
+            this_atom = rail.end_baseatoms()[end]
+            rail, index, direction = self._find_end_atom_chain_and_index(neighbor_atom, this_atom)
+            direction *= relative_direction
+            if rail is start_rail:
+                # we wrapped around a ring
+                yield rail, index, direction, counter
+                return
+            continue
+        assert 0 # not reached
+        pass
+
     _rail_to_wholechain_baseindex_data = None
     _wholechain_baseindex_range = None
 
@@ -835,40 +972,25 @@ class WholeChain(object):
                 break
             pos_holder = marker._position_holder ### kluge
             assert pos_holder.wholechain is self
-            pos_generator = pos_holder.yield_rail_index_direction_counter(
+            pos_generator = pos_holder.yield_rail_entry_positions(
                                 relative_direction = direction_of_slide,
                                 counter = 0,
                                 countby = direction_of_slide,
                              )
-                # TODO: optimization: pass a new option to skip from each
-                # position returned to a position in the next rail.
-                # (implem note: be sure to still return the precise initial
-                #  pos at the end, for a ring.)
-            old_atom1, old_atom2 = marker.marked_atom, marker.next_atom
-            if direction_of_slide == 1:
-                _check_atoms = [old_atom1, old_atom2]
-                    # for assertions only -- make sure we hit these atoms first,
-                    # in this order
-            else:
-                _check_atoms = [old_atom1] # if we knew pos of atom2 we could
-                    # start there, and we could save it from when we go to the
-                    # right, but there's no need.
+                # (this yields one position per rail, but the same rails
+                #  and counters as yield_rail_index_direction_counter
+                #  would, at those positions)
+            atom = pos_holder.rail.baseatoms[pos_holder.index]
+            if not (atom is marker.marked_atom):
+                print "\n*** BUG: not (atom %r is marked_atom %r), other data %r" % \
+                      (atom, marker.marked_atom, (marker, pos_holder))
             last_rail = None
             for pos in pos_generator:
                 rail, index, direction, counter = pos
-                atom = rail.baseatoms[index]
-                if _check_atoms:
-                    popped = _check_atoms.pop(0)
-                    if not (atom is popped):
-                        # FIX: remove this code once it works, and certainly
-                        # before implementing the optim in pos_generator
-                        # to return each rail only once.
-                        print "\n*** BUG: not (atom %r is _check_atoms.pop(0) %r), remaining _check_atoms %r, other data %r" % \
-                              (atom, popped, _check_atoms, (marker, pos_holder))
                 # define the wholechain_baseindex of pos to be counter;
                 # from this and direction, infer the index range for rail
                 # and record it, also tracking min and max wholechain indices.
-                if rail is not last_rail: # optim, until pos_generator can return each rail only once
+                if rail is not last_rail: # (only false for a ring of one rail)
                     last_rail = rail
                     def rail_index_to_whole_index(baseindex):
                         return (baseindex - index) * direction + counter
@@ -893,6 +1015,15 @@ class WholeChain(object):
 
 # ==
 
+def _sorted(entries):
+    # for comparing lists of marker entries in assertions
+    res = [(id(marker), baseindex, which)
+           for (marker, baseindex, which) in entries]
+    res.sort()
+    return res
+
+# ==
+
 class PositionInWholeChain(object):
     """
     A mutable position (and direction) along a WholeChain.
@@ -912,6 +1043,9 @@ class PositionInWholeChain(object):
     def yield_rail_index_direction_counter(self, **options): # in class PositionInWholeChain
         return self.wholechain.yield_rail_index_direction_counter( self.pos, **options )
 
+    def yield_rail_entry_positions(self, **options): # in class PositionInWholeChain
+        return self.wholechain.yield_rail_entry_positions( self.pos, **options )
+
     # maybe: method to scan in both directions
     # (for now, our main caller does that itself)
 
@@ -35,6 +35,10 @@ from dna.updater.dna_updater_ladders import dissolve_or_fragment_invalid_ladders
 from dna.updater.dna_updater_ladders import make_new_ladders, merge_and_split_ladders
 
 from dna.updater.dna_updater_prefs import pref_dna_updater_convert_to_PAM3plus5
+from dna.updater.dna_updater_prefs import pref_dna_updater_reuse_rail_markers
+
+from dna.updater.dna_updater_stats import note_dna_updater_phase_done
+from dna.updater.dna_updater_stats import note_dna_updater_count
 
 from utilities.constants import MODEL_PAM3, MODEL_PAM5
 
@@ -117,9 +121,28 @@ def update_PAM_chunks( changed_atoms, homeless_markers):
                 print "dna updater: moved marker %r, still alive after step1" % (marker,)
             else:
                 print "dna updater: killed marker %r (couldn't move it)" % (marker,)
+    note_dna_updater_count("moved markers", len(homeless_markers))
     del homeless_markers
 
     ignore_new_changes("from moving DnaMarkers")
+
+    # Record the chunks the live moved markers are now on. New wholechains
+    # rescan the rails of those chunks for markers; for their other old
+    # (unchanged) rails, they can reuse the markers found there by the old
+    # wholechains, since any other change to a rail's markers (made outside
+    # the updater) changes the structure of its atoms, which makes its
+    # ladder invalid, so it's replaced by new rails in this run.
+    # (See WholeChain.__init__.)
+    if pref_dna_updater_reuse_rail_markers():
+        chunks_with_moved_markers = {} # id(chunk) -> chunk
+        for marker in live_markers:
+            for atom in (marker.marked_atom, marker.next_atom):
+                if atom is not None:
+                    chunks_with_moved_markers[id(atom.molecule)] = atom.molecule
+    else:
+        chunks_with_moved_markers = None # rescan all rails
+
+    note_dna_updater_phase_done("move markers")
         # ignore changes caused by adding/removing marker jigs
         # to their atoms, when the jigs die/move/areborn
 
@@ -160,10 +183,17 @@ def update_PAM_chunks( changed_atoms, homeless_markers):
 
     ignore_new_changes("from dissolve_or_fragment_invalid_ladders", changes_ok = False)
 
+    note_dna_updater_count("atoms in changed ladders", len(changed_atoms))
+    note_dna_updater_phase_done("dissolve ladders")
+
     axis_chains, strand_chains = find_axis_and_strand_chains_or_rings( changed_atoms)
 
     ignore_new_changes("from find_axis_and_strand_chains_or_rings", changes_ok = False )
 
+    note_dna_updater_count("new axis chains", len(axis_chains))
+    note_dna_updater_count("new strand chains", len(strand_chains))
+    note_dna_updater_phase_done("find chains")
+
     if debug_flags.DNA_UPDATER_SLOW_ASSERTS:
         assert_unique_chain_baseatoms(axis_chains + strand_chains)
 
@@ -194,6 +224,9 @@ def update_PAM_chunks( changed_atoms, homeless_markers):
     if debug_flags.DNA_UPDATER_SLOW_ASSERTS:
         assert_unique_ladder_baseatoms( all_new_unmerged_ladders)
 
+    note_dna_updater_count("new ladders", len(all_new_unmerged_ladders))
+    note_dna_updater_phase_done("make ladders")
+
     # convert pam model of ladders that want to be converted
     # (assume all old ladders that want this were invalidated
     #  and therefore got remade above; do this before merging
@@ -214,6 +247,7 @@ def update_PAM_chunks( changed_atoms, homeless_markers):
     if default_pam or _f_baseatom_wants_pam:
         #bruce 080523 optim: don't always call this
         _do_pam_conversions( default_pam, all_new_unmerged_ladders )
+        note_dna_updater_phase_done("PAM conversions")
 
     if _f_invalid_dna_ladders:
         #bruce 080413
@@ -261,6 +295,9 @@ def update_PAM_chunks( changed_atoms, homeless_markers):
     if debug_flags.DNA_UPDATER_SLOW_ASSERTS:
         assert_unique_ladder_baseatoms( merged_ladders)
 
+    note_dna_updater_count("merged ladders", len(merged_ladders))
+    note_dna_updater_phase_done("merge ladders")
+
     # Now make or remake chunks as needed, so that each ladder-rail is a chunk.
     # This must be done to all newly made or merged ladders (even if parts are old).
 
@@ -283,6 +320,9 @@ def update_PAM_chunks( changed_atoms, homeless_markers):
         # (changes are from parent chunk of atoms changing;
         #  _f_reposition_baggage shouldn't cause any [#test, using separate loop])
 
+    note_dna_updater_count("new chunks", len(all_new_chunks))
+    note_dna_updater_phase_done("remake chunks")
+
     # Now make new wholechains on all merged_ladders,
     # let them own their atoms and markers (validating any markers found,
     # moved or not, since they may no longer be on adjacent atoms on same wholechain),
@@ -365,20 +405,29 @@ def update_PAM_chunks( changed_atoms, homeless_markers):
     # markers found on those wholechains; those methods can kill some of the
     # markers.
 
+    axis_rail_sets = algorithm( merged_axis_ladders,
+                                lambda ladder: ladder.axis_rails() )
+    strand_rail_sets = algorithm( merged_ladders, # must do both kinds at once!
+                                  lambda ladder: ladder.strand_rails )
+
+    note_dna_updater_phase_done("find wholechain rails")
+
     new_wholechains = (
-        map( Axis_WholeChain,
-             algorithm( merged_axis_ladders,
-                        lambda ladder: ladder.axis_rails() ) ) +
-        map( Strand_WholeChain,
-             algorithm( merged_ladders, # must do both kinds at once!
-                        lambda ladder: ladder.strand_rails ) )
+        [Axis_WholeChain( dict_of_rails, chunks_with_moved_markers)
+         for dict_of_rails in axis_rail_sets] +
+        [Strand_WholeChain( dict_of_rails, chunks_with_moved_markers)
+         for dict_of_rails in strand_rail_sets]
      )
+    del axis_rail_sets, strand_rail_sets
     if debug_flags.DEBUG_DNA_UPDATER:
         print "dna updater: made %d new or changed wholechains..." % len(new_wholechains)
 
     if debug_flags.DNA_UPDATER_SLOW_ASSERTS:
         assert_unique_wholechain_baseatoms(new_wholechains)
 
+    note_dna_updater_count("new wholechains", len(new_wholechains))
+    note_dna_updater_phase_done("make wholechains")
+
     # The new WholeChains should have found and fully updated (or killed)
     # all markers we had to worry about. Assert this -- but only with a
     # debug print, since I might be wrong (e.g. for markers on oldchains
@@ -406,6 +455,8 @@ def update_PAM_chunks( changed_atoms, homeless_markers):
 
     ignore_new_changes("from making wholechains and owning/validating/choosing/making markers",
                        changes_ok = True)
+
+    note_dna_updater_phase_done("own markers")
         # ignore changes caused by adding/removing marker jigs
         # to their atoms, when the jigs die/move/areborn
         # (in this case, they don't move, but they can die or be born)
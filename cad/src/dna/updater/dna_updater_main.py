@@ -29,6 +29,11 @@ from dna.updater.dna_updater_groups import update_DNA_groups
 from dna.updater.dna_updater_debug import debug_prints_as_dna_updater_starts
 from dna.updater.dna_updater_debug import debug_prints_as_dna_updater_ends
 
+from dna.updater.dna_updater_stats import begin_dna_updater_stats
+from dna.updater.dna_updater_stats import note_dna_updater_phase_done
+from dna.updater.dna_updater_stats import note_dna_updater_count
+from dna.updater.dna_updater_stats import end_dna_updater_stats
+
 from dna.model.DnaMarker import _f_are_there_any_homeless_dna_markers
 from dna.model.DnaMarker import _f_get_homeless_dna_markers
 
@@ -64,6 +69,7 @@ def full_dna_update():
     try:
         _full_dna_update_0( _runcount) # includes debug_prints_as_dna_updater_starts
     finally:
+        end_dna_updater_stats()
         debug_prints_as_dna_updater_ends( _runcount)
         clear_updater_run_globals()
     return
@@ -92,6 +98,8 @@ def _full_dna_update_0( _runcount):
         # note: adding marker check (2 places) fixed bug 2673 [bruce 080317]
         return # optimization (might not be redundant with caller)
 
+    begin_dna_updater_stats( _runcount) # see dna_updater_stats for phase names
+
     # print debug info about the set of changed_atoms (and markers needing update)
     if debug_flags.DEBUG_DNA_UPDATER_MINIMAL:
         print "\ndna updater: %d changed atoms to scan%s" % \
@@ -134,6 +142,9 @@ def _full_dna_update_0( _runcount):
             #  might be enough reason to not be able to change the policy yet.
             #  [bruce 080529 addendum/Q])
 
+    note_dna_updater_count("changed atoms", len(changed_atoms))
+    note_dna_updater_phase_done("atoms and bonds")
+
     if not changed_atoms and not _f_are_there_any_homeless_dna_markers() and not _f_invalid_dna_ladders:
         return # optimization
 
@@ -161,6 +172,8 @@ def _full_dna_update_0( _runcount):
         # so we need a list of new or moved ones... chunks got made in update_PAM_chunks; jigs, in update_PAM_atoms_and_bonds...
         # maybe pass some dicts into these for them to add things to?
 
+    note_dna_updater_phase_done("groups")
+
     ignore_new_changes("as full_dna_update returns", changes_ok = False )
 
     if debug_flags.DEBUG_DNA_UPDATER_MINIMAL:
@@ -48,6 +48,9 @@ def initialize_prefs():
     pref_fix_after_readmmp_before_updaters()
     pref_fix_after_readmmp_after_updaters()
 
+    pref_dna_updater_reuse_rail_markers()
+    pref_print_dna_updater_stats()
+
     _update_our_debug_flags('arbitrary value')
         # makes them appear in the menu,
         # and also sets their debug flags
@@ -222,6 +225,25 @@ def pref_fix_after_readmmp_after_updaters():
 
 # ==
 
+def pref_dna_updater_reuse_rail_markers():
+    # When true, new wholechains take the DnaMarkers on each unchanged rail
+    # from the old wholechain which owned it, rather than rescanning all
+    # the rail's atoms; see WholeChain.__init__.
+    res = debug_pref("DNA: updater: only rescan changed rails for markers?",
+                      Choice_boolean_True, # use False to always rescan them all
+                      prefs_key = True )
+    return res
+
+def pref_print_dna_updater_stats():
+    # print a summary of dna_updater_stats after each updater run which
+    # had something to do
+    res = debug_pref("DNA: updater: print timing and counts?",
+                      Choice_boolean_False,
+                      prefs_key = True )
+    return res
+
+# ==
+
 def pref_debug_dna_updater(): # 080228; note: accessed using flags matching debug_flags.DEBUG_DNA_UPDATER*
     res = debug_pref("DNA: updater debug prints",
                      Choice(["off", "minimal", "on", "verbose"],
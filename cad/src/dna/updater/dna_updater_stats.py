@@ -0,0 +1,188 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+dna_updater_stats.py - timing and object counts for dna updater runs
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+Each run of the dna updater which has something to do records how long
+each of its phases took, and how many objects of various kinds it
+scanned, made or reused (e.g. changed atoms, new ladders, new chunks,
+rails of new wholechains, and how many of those rails were rescanned
+for markers). This shows whether a small edit to a big model does a
+small amount of work.
+
+External code can query the last run's stats with
+get_last_dna_updater_stats(), or the totals since the last call of
+reset_dna_updater_stats() with get_total_dna_updater_stats(). When
+pref_print_dna_updater_stats() is set, each run's stats are printed
+as it ends.
+
+The updater records them by calling (in order)
+begin_dna_updater_stats, note_dna_updater_phase_done after each phase,
+note_dna_updater_count when it knows a count, and
+end_dna_updater_stats. The note functions do nothing outside of an
+updater run.
+"""
+
+import time
+
+from dna.updater.dna_updater_prefs import pref_print_dna_updater_stats
+
+# ==
+
+class DnaUpdaterStats(object):
+    """
+    The time spent in each phase, and the object counts, of one
+    dna updater run or a sum of several runs.
+    """
+    def __init__(self, runcount = None):
+        self.runcount = runcount # of the (last) run included
+        self.nruns = 0 # number of runs included
+        self.phase_names = [] # phase names, in order first seen
+        self.phase_times = {} # phase name -> seconds
+        self.counts = {} # count name -> int
+        return
+
+    def add_phase_time(self, phase, seconds):
+        if not self.phase_times.has_key(phase):
+            self.phase_names.append(phase)
+            self.phase_times[phase] = 0.0
+        self.phase_times[phase] += seconds
+        return
+
+    def add_count(self, name, n = 1):
+        self.counts[name] = self.counts.get(name, 0) + n
+        return
+
+    def add_stats(self, other):
+        """
+        Add the times and counts of other (another DnaUpdaterStats)
+        into self.
+        """
+        for phase in other.phase_names:
+            self.add_phase_time(phase, other.phase_times[phase])
+        for name, n in other.counts.iteritems():
+            self.add_count(name, n)
+        self.nruns += other.nruns
+        if other.runcount is not None:
+            self.runcount = other.runcount
+        return
+
+    def get_phase_time(self, phase):
+        """
+        Return the seconds spent in the named phase (0.0 if none).
+        """
+        return self.phase_times.get(phase, 0.0)
+
+    def get_count(self, name):
+        """
+        Return the named count (0 if it was never recorded).
+        """
+        return self.counts.get(name, 0)
+
+    def total_time(self):
+        return sum(self.phase_times.values())
+
+    def describe(self):
+        """
+        Return a multi-line description of self, for debug prints.
+        """
+        if self.nruns == 1:
+            title = "dna updater run %r" % (self.runcount,)
+        else:
+            title = "%d dna updater runs" % self.nruns
+        lines = ["%s: %.4f sec" % (title, self.total_time())]
+        for phase in self.phase_names:
+            lines.append("  %-24s %.4f sec" % (phase, self.phase_times[phase]))
+        names = self.counts.keys()
+        names.sort()
+        for name in names:
+            lines.append("  %-24s %d" % (name, self.counts[name]))
+        return "\n".join(lines)
+
+    pass
+
+# ==
+
+_current_stats = None # stats of the current updater run, if any
+_last_phase_end = 0.0 # when the last phase of the current run ended
+
+_last_stats = None
+_total_stats = DnaUpdaterStats()
+
+def begin_dna_updater_stats(runcount):
+    """
+    [called by the dna updater when a run has something to do]
+    """
+    global _current_stats, _last_phase_end
+    _current_stats = DnaUpdaterStats(runcount)
+    _current_stats.nruns = 1
+    _last_phase_end = time.time()
+    return
+
+def note_dna_updater_phase_done(phase):
+    """
+    [called by the dna updater after each phase]
+
+    Charge the time since the last phase ended (or the run began)
+    to the named phase.
+    """
+    global _last_phase_end
+    if _current_stats is not None:
+        now = time.time()
+        _current_stats.add_phase_time(phase, now - _last_phase_end)
+        _last_phase_end = now
+    return
+
+def note_dna_updater_count(name, n = 1):
+    """
+    [called by the dna updater and its helpers]
+
+    Add n to the named count of the current updater run.
+    """
+    if _current_stats is not None:
+        _current_stats.add_count(name, n)
+    return
+
+def end_dna_updater_stats():
+    """
+    [called by the dna updater as each run ends, even after an exception;
+     does nothing if begin_dna_updater_stats wasn't called for this run]
+    """
+    global _current_stats, _last_stats
+    if _current_stats is None:
+        return
+    stats = _current_stats
+    _current_stats = None
+    _last_stats = stats
+    _total_stats.add_stats(stats)
+    if pref_print_dna_updater_stats():
+        print stats.describe()
+    return
+
+def get_last_dna_updater_stats():
+    """
+    Return a DnaUpdaterStats for the last dna updater run which had
+    something to do, or None if there was none.
+    """
+    return _last_stats
+
+def get_total_dna_updater_stats():
+    """
+    Return a DnaUpdaterStats (which the caller must not modify) for all
+    the dna updater runs since the last call of reset_dna_updater_stats.
+    """
+    return _total_stats
+
+def reset_dna_updater_stats():
+    """
+    Forget the stats of all prior dna updater runs.
+    """
+    global _last_stats, _total_stats
+    _last_stats = None
+    _total_stats = DnaUpdaterStats()
+    return
+
+# end
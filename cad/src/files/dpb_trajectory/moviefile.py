@@ -14,14 +14,28 @@ moviefile.py -- classes and other code for interpreting movie files
 # so the external code should rarely know the actual classnames in this file!
 
 # these imports are anticipated, perhaps not all needed
-import os, sys
+import os, sys, mmap
+from bisect import bisect_left
 from struct import unpack # fyi: used for old-format header, no longer for delta frames
 ## from VQT import A
-from Numeric import array, Int8
+import Numeric
+from Numeric import array, Int8, Int, Float
 from utilities import debug_flags
 from utilities.debug import print_compact_stack, print_compact_traceback
 import foundation.env as env
 
+# Sizes for the keyframe index and frame cache of OldFormatMovieFile
+# (see its copy_of_frame method). These are memory budgets, in bytes;
+# the number of keyframes or cached frames they allow depends on natoms.
+_KEYFRAME_MEMORY_BUDGET = 256 * 1024 * 1024
+_FRAME_CACHE_MEMORY_BUDGET = 64 * 1024 * 1024
+
+_MIN_KEYFRAME_SPACING = 32 # frames
+_MIN_CACHED_FRAMES = 4
+
+# Largest number of bytes of delta frames to read and sum at once.
+_DELTA_BLOCK_BYTES = 4 * 1024 * 1024
+
 def MovieFile(filename): #bruce 050913 removed history arg, since all callers passed env.history
     """
     Given the name of an existing old-format movie file,
@@ -49,6 +63,7 @@ class OldFormatMovieFile_startup:
     def __init__(self, filename): #bruce 050913 removed history arg
         self.filename = filename
         self.fileobj = None
+        self.filemap = None
         self.errcode = None
     def open_and_read_header_errQ(self):
         # because we assume file is fully written, we can do all this stuff immediately for now:
@@ -59,6 +74,21 @@ class OldFormatMovieFile_startup:
     def open_file(self):
         assert not self.fileobj #e if we relax this, then worry about whether we should seek to start of file
         self.fileobj = open(self.filename,'rb') ###@@@ missing file is possible when we reopen after closing; this is caught below
+        # Also map the file into memory if we can, so reading any range of
+        # delta frames is just a slice (no seek, read, or system call).
+        # (Numeric can't make an array that shares memory with the map,
+        #  so each slice still copies the bytes of the frames it covers.)
+        self.filemap = None
+        try:
+            size = os.path.getsize(self.filename)
+            if size:
+                self.filemap = mmap.mmap(self.fileobj.fileno(), size, access = mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError, OverflowError):
+            # e.g. not enough address space for a huge file on a 32-bit system;
+            # delta_frames_bytes will use ordinary reads instead
+            if debug_flags.atom_debug:
+                print_compact_traceback( "atom_debug: can't mmap %r, will read it instead: " % (self.filename,))
+            self.filemap = None
     def read_header(self):
         # assume we're at start of file
         # Read header (4 bytes) from file containing the number of frames in the moviefile.
@@ -85,25 +115,68 @@ class OldFormatMovieFile_startup:
         return the bytes of the delta frame which has index n (assuming our file is open and n is within legal range)
         """
         # note: the first one has index 1 (since it gives delta from time 0 to time 1).
-        assert n > 0
-        nbytes = self.natoms * 3 # number of bytes in frame (if complete) -- no relation to frame index n
-        filepos = ((n-1) * nbytes) + 4
+        return self.delta_frames_bytes(n, n)
+    def delta_frames_bytes(self, n1, n2):
+        """
+        return the bytes of the consecutive delta frames with indices n1 through n2 inclusive
+        (assuming our file is open and both are within legal range)
+        """
+        assert 0 < n1 <= n2
+        nbytes = self.natoms * 3 * (n2 - n1 + 1) # number of bytes in frames (if complete) -- no relation to frame index n
+        filepos = ((n1-1) * self.natoms * 3) + 4
         try:
             # several things here can fail if file is changing on disk in various ways
             if not self.fileobj:
                 # this might not yet ever happen, not sure.
                 self.open_file() #e check for error? check length still the same, etc?
-            self.fileobj.seek( filepos) ####@@@@ failure here might be possible if file got shorter after size measured -- not sure
-            res = self.fileobj.read(nbytes)
+            if self.filemap is not None:
+                res = self.filemap[filepos:filepos + nbytes]
+            else:
+                self.fileobj.seek( filepos) ####@@@@ failure here might be possible if file got shorter after size measured -- not sure
+                res = self.fileobj.read(nbytes)
             assert len(res) == nbytes # this can fail, if file got shorter after we measured its size...
         except:
             # might be good to detect, warn, set flag, return 0s.... ####@@@@ test this
             if debug_flags.atom_debug: # if this happens at all it might happen a lot...
-                print_compact_traceback( "atom_debug: ignoring exception reading delta_frame %d, returning all 00s: " % n)
+                print_compact_traceback( "atom_debug: ignoring exception reading delta_frames %d-%d, returning all 00s: " % (n1, n2))
             res = "\x00" * nbytes
             assert len(res) == nbytes, "mistake in python zero-byte syntax" # but I checked it, should be ok
         return res
+    def delta_frames_array(self, n1, n2):
+        """
+        Return the delta frames with indices n1 through n2 inclusive,
+        as a Numeric Int8 array of shape (n2 - n1 + 1, natoms, 3)
+        in the file's units (0.01 Angstroms).
+        """
+        res = Numeric.fromstring(self.delta_frames_bytes(n1, n2), Int8)
+        res.shape = (n2 - n1 + 1, self.natoms, 3)
+        return res
+    def delta_frames_sum(self, n1, n2):
+        """
+        Return the sum of the delta frames with indices n1 through n2 inclusive,
+        as an (natoms,3) Numeric Int array in the file's units (0.01 Angstroms),
+        or None if n1 > n2 (meaning an empty range).
+
+        The frames are read and summed in blocks (one read and one Numeric
+        reduction per block), which is much faster than one frame at a time.
+        """
+        if n1 > n2:
+            return None
+        frame_nbytes = self.natoms * 3
+        block_nframes = max(1, _DELTA_BLOCK_BYTES / max(1, frame_nbytes))
+        res = Numeric.zeros((frame_nbytes,), Int)
+        for start in range(n1, n2 + 1, block_nframes):
+            end = min(n2, start + block_nframes - 1)
+            block = self.delta_frames_array(start, end)
+            block.shape = (end - start + 1, frame_nbytes)
+            # (convert to Int before summing, since Int8 sums would overflow)
+            res += Numeric.add.reduce(block.astype(Int), 0)
+        res.shape = (-1, 3)
+        return res
     def close(self):
+        if self.filemap is not None:
+            self.filemap.close()
+        self.filemap = None
         if self.fileobj:
             self.fileobj.close()
         self.fileobj = None
@@ -113,6 +186,40 @@ class OldFormatMovieFile_startup:
         return # no other large state in this object
     pass
 
+class _FrameCache:
+    """
+    A bounded cache of frames (arrays of absolute atom positions) by frame
+    index, which discards the least recently used frame when it's full.
+    Frames in it must never be modified.
+    """
+    def __init__(self, maxframes):
+        self.maxframes = maxframes
+        self._frames = {} # maps frame index to frame
+        self._last_used = {} # maps frame index to value of self._counter when last used
+        self._counter = 0
+    def get(self, n):
+        """
+        Return the cached frame n (which caller must not modify), or None.
+        """
+        frame = self._frames.get(n)
+        if frame is not None:
+            self._counter += 1
+            self._last_used[n] = self._counter
+        return frame
+    def add(self, n, frame):
+        if n not in self._frames and len(self._frames) >= self.maxframes:
+            # (a linear search is ok, since maxframes is small)
+            junk, oldest = min([(used, n0) for (n0, used) in self._last_used.items()])
+            del self._frames[oldest]
+            del self._last_used[oldest]
+        self._counter += 1
+        self._frames[n] = frame
+        self._last_used[n] = self._counter
+    def clear(self):
+        self._frames = {}
+        self._last_used = {}
+    pass
+
 class OldFormatMovieFile: #bruce 050426
     """
     Know the filename and format of an existing moviefile, and enough about it to read requested frames from it
@@ -161,6 +268,27 @@ class OldFormatMovieFile: #bruce 050426
         self.temp_mutable_frames = {}
         self.cached_immutable_frames = {} #e for some callers, store a cached frame 0 here
 
+        # Keyframe index: for the first immutable frame our client donates
+        # (the "reference frame"), and for every keyframe_spacing'th frame
+        # we have reached from it so far, the sum of the delta frames from
+        # the reference frame to that frame (as a Numeric Int32 array in the
+        # file's units of 0.01 Angstroms, so it's exact). Any frame can then
+        # be computed from the reference frame, the nearest keyframe, and at
+        # most keyframe_spacing/2 delta frames. See copy_of_frame.
+        self._ref_frame_index = None
+        self._ref_frame = None
+        self._keyframe_offsets = {} # maps frame index to Int32 array
+        self._keyframe_indices = [] # sorted keys of _keyframe_offsets
+        keyframe_nbytes = max(1, self.natoms * 3 * 4)
+        self.keyframe_spacing = max( _MIN_KEYFRAME_SPACING,
+                                     - ((- self.totalFramesActual * keyframe_nbytes) / _KEYFRAME_MEMORY_BUDGET) )
+            # (the second arg is ceil(totalFramesActual / number of keyframes the budget allows))
+
+        # recently computed frames, so scrubbing back and forth is fast
+        frame_nbytes = max(1, self.natoms * 3 * 8)
+        self._frame_cache = _FrameCache( max( _MIN_CACHED_FRAMES,
+                                              _FRAME_CACHE_MEMORY_BUDGET / frame_nbytes ))
+
     def get_totalFramesActual(self):
         return self.totalFramesActual
     def matches_alist(self, alist):
@@ -169,6 +297,8 @@ class OldFormatMovieFile: #bruce 050426
         return self.matches_alist(alist) ###@@@ stub, fails to recheck the file! should verify same header and same or larger nframes.
     def destroy(self):
         self.cached_immutable_frames = self.temp_mutable_frames = None
+        self._ref_frame = self._keyframe_offsets = None
+        self._frame_cache.clear()
         self.filereader.destroy()
         self.filereader = None
 
@@ -211,41 +341,134 @@ class OldFormatMovieFile: #bruce 050426
         in order to figure this out.
         """
         assert self.frame_index_in_range(n)
+        frame = self._frame_cache.get(n)
+        if frame is not None:
+            return + frame # the unary "+" makes a copy
         n0 = self.nearest_knownposns_frame_index(n)
-        frame0 = self.copy_of_known_frame_or_None(n0) # an array of absposns we're allowed to modify, valid for n0
-        assert frame0 is not None # don't test it as a boolean -- it might be all 0.0 which in Numeric means it's false!
-        while n0 < n:
-            # move forwards using a delta frame (which is never cached, tho this code doesn't need to know that)
-            # (##e btw it might be faster to read several at once and combine them into one, or add all at once, using Numeric ops!
-            #  I'm not sure, since intermediate states would use 4x the memory, so we might do smaller pieces at a time...)
-            n0 += 1
-            df = self.delta_frame(n0) # array of differences to add to frame n0-1 to get frame n0
+        if abs(n - n0) <= self._keyframe_distance(n):
+            # (this is the usual case when playing the movie sequentially,
+            #  since the frame we last returned is one frame away)
+            frame0 = self.copy_of_known_frame_or_None(n0) # an array of absposns we're allowed to modify, valid for n0
+            assert frame0 is not None # don't test it as a boolean -- it might be all 0.0 which in Numeric means it's false!
             try:
-                frame0 += df # note: += modifies frame0 in place (if it's a Numeric array, as we hope); that's desired
+                if n0 < n:
+                    # move forwards using the sum of the delta frames n0+1 through n
+                    frame0 += self.filereader.delta_frames_sum(n0 + 1, n) * 0.01
+                        # note: += modifies frame0 in place (if it's a Numeric array, as we hope); that's desired
+                elif n0 > n:
+                    # move backwards by subtracting the delta frames n+1 through n0
+                    frame0 -= self.filereader.delta_frames_sum(n + 1, n0) * 0.01
             except ValueError: # frames are not aligned -- happens when slider reaches right end
-                print "frames not aligned; shapes:",frame0.shape, df.shape
+                print "frames not aligned; shapes:", frame0.shape, (self.natoms, 3)
                 raise
-        while n0 > n:
-            # (this never happens if we just moved forwards, but there's no need to "confirm" or "enforce" that fact)
-            # move backwards using a delta frame
-            # (btw it might be faster to read all dfs forwards to make one big one to subtract all at once...
-            #  or perhaps even to read them all at once into a single Numeric 2d array, and turn them into
-            #  one big one using Numeric ops! ###e)
-            df = self.delta_frame(n0)
-            n0 -= 1 # note: we did this after grabbing the frame, not beforehand as above
-            frame0 -= df
-        #e future:
-        #e   If we'd especially like to keep a cached copy for future speed, make one now...
-        #e   Or do this inside forward-going loop?
-        #e   Or in caller, having it stop for breath every so many frames, perhaps also to process user events?
-##        if 0: #bruce 060111 debug code (two places), safe but could be removed when not needed (tiny bit slow) [bruce 060111] ###@@@
-##            # maybe print coords for one atom
-##            import runSim
-##            if runSim.debug_all_frames:
-##                ii = runSim.debug_all_frames_atom_index
-##                print "copy_of_frame %d[%d] is" % (n, ii), frame0[ii]
+        else:
+            # we're jumping far from any frame we know (e.g. the user is
+            # dragging the movie slider) -- start from the nearest keyframe
+            frame0 = self._ref_frame + self._keyframe_offset_of_frame(n) * 0.01
+        self._frame_cache.add(n, + frame0)
         return frame0
 
+    def frames_to_read(self, n):
+        """
+        Return roughly how many delta frames copy_of_frame(n) would need to read,
+        for callers who want to warn the user before a slow jump.
+        """
+        if self._frame_cache.get(n) is not None:
+            return 0
+        res = abs(n - self.nearest_knownposns_frame_index(n))
+        indices = self._keyframe_indices
+        if indices:
+            # include the cost of extending the keyframe index, if it doesn't yet reach n
+            extend = max(0, indices[0] - n, n - indices[-1])
+            res = min(res, extend + self._keyframe_distance(n))
+        return res
+
+    def copy_of_frames(self, n1, n2):
+        """
+        Return a new Numeric Float array of shape (n2 - n1 + 1, natoms, 3)
+        holding the absolute atom positions of frames n1 through n2 inclusive.
+
+        This is meant for analysis and export of whole ranges of frames.
+        Frame n1 is found as by copy_of_frame; each later frame is frame n1
+        plus a cumulative sum (Numeric add.accumulate) of the delta frames,
+        computed a block of frames at a time.
+        """
+        assert self.frame_index_in_range(n1) and self.frame_index_in_range(n2)
+        assert n1 <= n2
+        first = self.copy_of_frame(n1)
+        res = Numeric.zeros((n2 - n1 + 1, self.natoms, 3), Float)
+        res[0] = first
+        reader = self.filereader
+        block_nframes = max(1, _DELTA_BLOCK_BYTES / max(1, self.natoms * 3))
+        total = None # sum of the delta frames before the current block
+        for start in range(n1 + 1, n2 + 1, block_nframes):
+            end = min(n2, start + block_nframes - 1)
+            sums = Numeric.add.accumulate(reader.delta_frames_array(start, end).astype(Int), 0)
+                # (convert to Int before summing, since Int8 sums would overflow)
+            if total is not None:
+                sums += total
+            res[start - n1 : end - n1 + 1] = first + sums * 0.01
+            total = sums[-1]
+        return res
+
+    def _keyframe_distance(self, n):
+        """
+        Return the number of delta frames we'd have to read to compute
+        frame n using our keyframe index (not counting the one-time cost of
+        extending it to reach n, if that's needed), or a huge number if we
+        have no reference frame to base it on.
+        """
+        indices = self._keyframe_indices
+        if not indices:
+            return sys.maxint
+        if not (indices[0] < n < indices[-1]):
+            # after extending the index, the nearest keyframe will be about this far away:
+            spacing = self.keyframe_spacing
+            return min(n % spacing, spacing - n % spacing, abs(n - self._ref_frame_index))
+        i = bisect_left(indices, n)
+        return min(indices[i] - n, n - indices[i - 1])
+
+    def _keyframe_offset_of_frame(self, n):
+        """
+        Return the sum of the delta frames from our reference frame to frame n,
+        as a Numeric Int array (which the caller can modify).
+        """
+        self._extend_keyframes(n)
+        indices = self._keyframe_indices
+        i = bisect_left(indices, n)
+        if i < len(indices) and (i == 0 or indices[i] - n < n - indices[i - 1]):
+            k = indices[i] # nearest keyframe is after n
+            res = self._keyframe_offsets[k].astype(Int)
+            if k > n:
+                res -= self.filereader.delta_frames_sum(n + 1, k)
+        else:
+            k = indices[i - 1] # nearest keyframe is before n
+            res = self._keyframe_offsets[k].astype(Int)
+            res += self.filereader.delta_frames_sum(k + 1, n)
+        return res
+
+    def _extend_keyframes(self, n):
+        """
+        Add keyframes to our index (reading delta frames from the file)
+        until frame n lies between two keyframes, or within keyframe_spacing
+        of the first or last frame.
+        """
+        spacing = self.keyframe_spacing
+        indices = self._keyframe_indices
+        offsets = self._keyframe_offsets
+        reader = self.filereader
+        while (indices[-1] / spacing + 1) * spacing <= min(n, self.totalFramesActual):
+            k0 = indices[-1]
+            k = (k0 / spacing + 1) * spacing
+            offsets[k] = (offsets[k0] + reader.delta_frames_sum(k0 + 1, k)).astype(Numeric.Int32)
+            indices.append(k)
+        while indices[0] > 0 and ((indices[0] - 1) / spacing) * spacing >= n:
+            k0 = indices[0]
+            k = ((k0 - 1) / spacing) * spacing
+            offsets[k] = (offsets[k0] - reader.delta_frames_sum(k + 1, k0)).astype(Numeric.Int32)
+            indices.insert(0, k)
+        return
+
     def donate_mutable_known_frame(self, n, frame):
         """
         Caller has a frame of absolute atom positions it no longer needs --
@@ -275,6 +498,12 @@ class OldFormatMovieFile: #bruce 050426
         """
         self.cached_immutable_frames[n] = frame
             # note: we only need one per n! so don't worry if this replaces an older one.
+        if self._ref_frame_index is None:
+            # use it as the base of our keyframe index
+            self._ref_frame_index = n
+            self._ref_frame = frame
+            self._keyframe_offsets[n] = Numeric.zeros((self.natoms, 3), Numeric.Int32)
+            self._keyframe_indices = [n]
         ###e do something to affect the retval of nearest_knownposns_frame_index??
         return
 
@@ -382,3 +611,36 @@ class OldFormatMovieFile: #bruce 050426
 
     pass # end of class MovieFile
 
+# ==
+
+def read_movie_frames(filename, positions, n1, n2, ref_frame_index = 0):
+    """
+    Return the absolute atom positions of frames n1 through n2 inclusive
+    of the old-format movie file filename, as a Numeric Float array of shape
+    (n2 - n1 + 1, natoms, 3), given the (natoms,3) array of positions
+    of frame ref_frame_index (usually 0, the initial positions).
+
+    This is meant for analysis scripts, which can use it to load a long
+    run in pieces without reading frames one at a time.
+
+    @raise ValueError: if the file can't be read, or has a different number
+                       of atoms than positions, or the frames are out of range.
+    """
+    mf = MovieFile(filename)
+    if mf is None:
+        raise ValueError, "can't read movie file %r" % (filename,)
+    try:
+        if mf.natoms != len(positions):
+            raise ValueError, "movie file %r has %d atoms, not %d" % \
+                  (filename, mf.natoms, len(positions))
+        for n in (n1, n2, ref_frame_index):
+            if not mf.frame_index_in_range(n):
+                raise ValueError, "frame %d is not in movie file %r (which has %d frames)" % \
+                      (n, filename, mf.get_totalFramesActual())
+        mf.donate_immutable_cached_frame(ref_frame_index, array(positions, Float))
+        return mf.copy_of_frames(n1, n2)
+    finally:
+        mf.destroy()
+    pass
+
+# end
@@ -27,7 +27,7 @@ for constructing them (since not everything uses the registration scheme
 or should have to).
 """
 
-import re, time
+import re, os, time
 
 import foundation.env as env
 from utilities import debug_flags
@@ -72,6 +72,13 @@ from model.Plane import Plane
 from files.mmp.files_mmp_registration import find_registered_parser_class
 from files.mmp.mmpformat_versions import parse_mmpformat, mmp_date_newer
 from files.mmp.mmp_dispnames import interpret_dispName
+from files.mmp.files_mmp_bulk_reading import bulk_atom_and_bond_reader
+from files.mmp.files_mmp_bulk_reading import debug_pref_read_atoms_in_bulk
+from files.mmp.files_mmp_bulk_reading import BulkReadError
+from files.mmp.files_mmpb import is_mmpb_file
+from files.mmp.files_mmpb import MMPBFile
+from files.mmp.files_mmpb import MMPBAtomLoader
+from files.mmp.files_mmpb import MMPBFormatError
 
 # the following imports and the assignment they're used in
 # should be replaced by some registration scheme
@@ -294,6 +301,8 @@ class _readmmp_state:
     prevcard = None # used in reading atoms and bonds [TODO: doc, make private]
     prevchunk = None # the current Chunk being built, if any [renamed from self.mol, bruce 071023]
     prevmotor = None # the last motor jig read, if any (used by shaft record)
+    _bulk_reader = None # optional bulk_atom_and_bond_reader, see enable_bulk_reading
+    _mmpb_loader = None # MMPBAtomLoader, when reading an mmpb file; see set_mmpb_file
 
     def __init__(self, assy, isInsert):
         self.assy = assy
@@ -317,8 +326,43 @@ class _readmmp_state:
         self.listOfAtomsInFileOrder = []
         return
 
+    def enable_bulk_reading(self):
+        """
+        Let atom and bond records be accumulated and materialized in batches
+        by a bulk_atom_and_bond_reader, rather than interpreted one at a time.
+
+        @note: if this is called, our caller must call flush_bulk_records
+               after the last call of readmmp_line.
+        """
+        self._bulk_reader = bulk_atom_and_bond_reader(self)
+        return
+
+    def flush_bulk_records(self):
+        """
+        Create any atoms and bonds whose records were accumulated
+        by our bulk reader (if we have one).
+
+        @raise BulkReadError: if that fails (see bulk_atom_and_bond_reader.flush)
+        """
+        if self._bulk_reader:
+            self._bulk_reader.flush()
+        return
+
+    def set_mmpb_file(self, mmpb_file):
+        """
+        Tell self that the records we'll be given come from the given
+        files_mmpb.MMPBFile, whose mmpb_atoms records refer to runs of
+        atoms and bonds stored in it.
+        """
+        self._mmpb_loader = MMPBAtomLoader(mmpb_file, self)
+        return
+
     def destroy(self):
         self.assy = self.ndix = self.groupstack = self.markers = None
+        self._bulk_reader = None
+        if self._mmpb_loader:
+            self._mmpb_loader.destroy()
+            self._mmpb_loader = None
         self.prevatom = None
         self.prevcard = None
         self.prevchunk = None
@@ -372,6 +416,17 @@ class _readmmp_state:
         recordname = key_m.group(0)
         # recordname should now be the mmp record type, e.g. "group" or "mol"
 
+        bulk_reader = self._bulk_reader
+        if bulk_reader:
+            if bulk_reader.read_record(recordname, card):
+                if bulk_reader.batch_is_full():
+                    bulk_reader.flush()
+                return None
+            # records read in the general way must see the effects of
+            # all prior records
+            bulk_reader.flush()
+            bulk_reader.note_general_record()
+
         linemethod, errmsg = self._find_linemethod(recordname)
 
         if errmsg or not linemethod:
@@ -628,6 +683,19 @@ class _readmmp_state:
         self.prevcard = card
         return
 
+    def _read_mmpb_atoms(self, card):
+        """
+        Read an mmpb_atoms record, which only occurs in the records section
+        of an mmpb file, and stands for a run of atom-related records stored
+        in binary form in that file.
+        """
+        if self._mmpb_loader is None:
+            return "mmpb_atoms record is only allowed in mmpb files"
+        run = int(card.split()[1])
+        self._mmpb_loader.load_run(run)
+        self.prevcard = card
+        return
+
     def _read_bond1(self, card):
         return self.read_bond_record(card, V_SINGLE)
 
@@ -1511,7 +1579,8 @@ _readmmp_aborted = False
 
 _reference_to_readmmp_abort_function = None #bruce 080606 precaution
 
-def _readmmp(assy, filename, isInsert = False, showProgressDialog = False):
+def _readmmp(assy, filename, isInsert = False, showProgressDialog = False,
+             bulk = None):
     """
     Read an mmp file, print errors and warnings to history,
     modify assy in various ways (a bad design, see comment in insertmmp)
@@ -1543,6 +1612,11 @@ def _readmmp(assy, filename, isInsert = False, showProgressDialog = False):
                                a file. Default is False.
     @type  showProgressDialog: boolean
 
+    @param bulk: whether to read atom and bond records in bulk (see
+                 files_mmp_bulk_reading.py). Default (None) means use the
+                 value of a debug_pref (normally True).
+    @type bulk: boolean or None
+
     @return: the tuple (ok, grouplist or None, listOfAtomsInFileOrder), where
              ok is one of the string constants named (in utilities.constants)
              SUCCESS, ABORTED, or READ_ERROR. (If ok is not SUCCESS, grouplist
@@ -1555,6 +1629,10 @@ def _readmmp(assy, filename, isInsert = False, showProgressDialog = False):
     #bruce 080502 documented return value; fixed it when file is empty
 
     state = _readmmp_state( assy, isInsert)
+    if bulk is None:
+        bulk = debug_pref_read_atoms_in_bulk()
+    if bulk:
+        state.enable_bulk_reading()
 
     # The following code is experimental. It reads an mmp file that is contained
     # within a ZIP file. To test, create a zipfile (i.e. "part.zip") which
@@ -1564,6 +1642,8 @@ def _readmmp(assy, filename, isInsert = False, showProgressDialog = False):
     # Mark 2008-02-03
     READ_MAINMMP_FROM_ZIPFILE = False # Don't commit with True.
 
+    mmpb_file = None
+
     if READ_MAINMMP_FROM_ZIPFILE:
         # Experimental. Read "main.mmp", a standard mmp file contained within
         # a zipfile opened via "File > Open...".
@@ -1571,11 +1651,26 @@ def _readmmp(assy, filename, isInsert = False, showProgressDialog = False):
         _zipfile = ZipFile(filename, 'r')
         _bytes = _zipfile.read("main.mmp")
         lines = _bytes.splitlines()
+        _filesize = len(_bytes)
+    elif is_mmpb_file(filename):
+        # Binary mmpb file (see files_mmpb.py). Its records section is read
+        # like an mmp file, and its atoms are made from its mapped columns.
+        try:
+            mmpb_file = MMPBFile(filename)
+        except (IOError, MMPBFormatError):
+            print_compact_traceback("error opening mmpb file %r: " % (filename,))
+            return READ_ERROR, None, []
+        state.set_mmpb_file(mmpb_file)
+        lines = mmpb_file.records()
+        _filesize = len(lines.getvalue())
     else:
         # The normal way to read an MMP file.
+        # Iterate over the open file rather than using readlines(),
+        # so we never hold the text of a huge file in memory at once.
         try:
-            lines = open(filename,"rU").readlines()
+            lines = open(filename,"rU")
             # 'U' in filemode is for universal newline support
+            _filesize = os.path.getsize(filename)
         except:
             return READ_ERROR, None, []
 
@@ -1599,8 +1694,13 @@ def _readmmp(assy, filename, isInsert = False, showProgressDialog = False):
             # see comment about kluge_main_assy elsewhere in this file
             # [bruce 080319]
         assert not kluge_main_assy.assy_valid #bruce 080117
+        # progress is measured in kilobytes read, since we don't know
+        # the number of lines in advance (it's only approximate,
+        # since newline translation can change the length of a line)
+        _bytesRead = 0
         _progressValue = 0
-        _progressFinishValue = len(lines)
+        _progressFinishValue = max(1, _filesize // 1024)
+        _linesSinceProgressUpdate = 0
         win = env.mainwindow()
         win.progressDialog.setLabelText("Reading file...")
         win.progressDialog.setRange(0, _progressFinishValue)
@@ -1637,13 +1737,25 @@ def _readmmp(assy, filename, isInsert = False, showProgressDialog = False):
 
         pass
 
+    bulk_read_error = False
+
     for card in lines:
         if _readmmp_aborted: # User aborted while reading the MMP file.
             _readmmp_aborted = False # (precaution, not really needed, since not
                 # sufficient to replace the reset earlier in this function)
+            state.destroy() # discards any accumulated bulk records
+            if hasattr(lines, 'close'):
+                lines.close()
+            if mmpb_file is not None:
+                mmpb_file.close()
             return ABORTED, None, []
         try:
             errmsg = state.readmmp_line( card) # None or an error message
+        except BulkReadError, e:
+            # making the atoms or bonds of an earlier line failed
+            # (already printed, with that line)
+            errmsg = str(e)
+            bulk_read_error = True
         except:
             # note: the following two error messages are similar but not identical
             errmsg = "bug while reading this mmp line: %s" % (card,) #e include line number; note, two lines might be identical
@@ -1655,7 +1767,13 @@ def _readmmp(assy, filename, isInsert = False, showProgressDialog = False):
             break
 
         if showProgressDialog: # Update the progress dialog.
-            _progressValue += 1
+            _bytesRead += len(card)
+            _linesSinceProgressUpdate += 1
+            if _linesSinceProgressUpdate < 1000:
+                # updating the dialog is slow compared to reading a line
+                continue
+            _linesSinceProgressUpdate = 0
+            _progressValue = _bytesRead // 1024
             if _progressValue >= _progressFinishValue:
                 win.progressDialog.setLabelText("Building model...")
             elif _progressDialogDisplayed:
@@ -1675,6 +1793,28 @@ def _readmmp(assy, filename, isInsert = False, showProgressDialog = False):
                     win.progressDialog.setValue(_progressValue)
                     _progressDialogDisplayed = True
 
+    if hasattr(lines, 'close'):
+        lines.close()
+    if mmpb_file is not None:
+        # (safe, since state no longer needs it)
+        mmpb_file.close()
+
+    if showProgressDialog:
+        win.progressDialog.setLabelText("Building model...")
+
+    if not bulk_read_error:
+        try:
+            state.flush_bulk_records()
+        except BulkReadError, e:
+            errmsg = str(e)
+            bulk_read_error = True
+
+    if bulk_read_error:
+        # Some atoms or bonds in the file were never made. Report that, but
+        # keep the ones that were, as we do after an error in a record
+        # read by the general code.
+        state.format_error(errmsg)
+
     grouplist = state.extract_toplevel_items() # for a normal mmp file this has 3 Groups, whose roles are viewdata, tree, shelf
 
     # now fix up sim input files and other nonstandardly-structured files;
@@ -0,0 +1,593 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+files_mmp_bulk_reading.py -- fast path for reading the atom and bond
+records of an mmp file, used by files_mmp._readmmp
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+The general mmp reading code in files_mmp.py dispatches each line through
+_readmmp_state.readmmp_line and _find_linemethod, and parses atom and bond
+records with regexps, creating each Atom and bond as its record is read.
+For files with millions of atoms that per-record overhead dominates.
+
+Class bulk_atom_and_bond_reader (used by _readmmp_state when enabled)
+handles the most common records -- atom, bond1/2/3/a/g/c, bond_chain and
+dna_rung_bonds -- by splitting them into fields and appending the numbers
+to typed arrays. When some other kind of record is read (or a batch gets
+large), the accumulated records are "flushed": all their atoms are created
+(with positions decoded by one Numeric operation), and then all their bonds
+are made, in file order. Since any other record causes a flush before it's
+interpreted, records like "info atom" or "mol" see exactly the same state
+as they would if every record had been interpreted as soon as it was read.
+
+Lines which don't have the exact format the fast path expects are left
+for the general code to handle (after a flush), so unusual or erroneous
+files are read (and reported) just as before. If making the atoms or bonds
+of a batch fails, flush raises BulkReadError, naming the record whose atom
+or bond couldn't be made; _readmmp reports that and stops reading, keeping
+the atoms and bonds made so far, as it does when the general code fails
+to read a record.
+"""
+
+from array import array
+import os, time
+
+import Numeric
+from Numeric import Float
+
+import foundation.env as env
+
+from model.chem import Atom
+from model.elements import PeriodicTable
+from model.elements import Pl5
+from model.bonds import bond_atoms
+
+from model.bond_constants import V_SINGLE
+from model.bond_constants import V_DOUBLE
+from model.bond_constants import V_TRIPLE
+from model.bond_constants import V_AROMATIC
+from model.bond_constants import V_GRAPHITE
+from model.bond_constants import V_CARBOMERIC
+
+from files.mmp.mmp_dispnames import interpret_dispName
+
+from utilities.GlobalPreferences import debug_pref_read_bonds_compactly
+from utilities.debug_prefs import debug_pref, Choice_boolean_True
+from utilities.debug import register_debug_menu_command
+from utilities.debug import print_compact_traceback
+
+# ==
+
+_BOND_RECORD_VALENCES = {
+    'bond1': V_SINGLE,
+    'bond2': V_DOUBLE,
+    'bond3': V_TRIPLE,
+    'bonda': V_AROMATIC,
+    'bondg': V_GRAPHITE,
+    'bondc': V_CARBOMERIC,
+ }
+
+# flush after this many atoms even if no other record requires it,
+# to bound the memory used for pending records
+_MAX_ATOMS_PER_BATCH = 50000
+
+# kinds of entries in the pending-bond-ops list
+_BOND_CHAIN = 'bond_chain'
+_DNA_RUNG_BONDS = 'dna_rung_bonds'
+
+class BulkReadError(Exception):
+    """
+    Raised by bulk_atom_and_bond_reader.flush when making the atom or bonds
+    of one of its pending records failed (after printing a traceback).
+    The exception's message includes that record.
+    """
+    pass
+
+def debug_pref_read_atoms_in_bulk():
+    res = debug_pref("mmp format: read atoms and bonds in bulk?",
+                     Choice_boolean_True, # use False to use the old reading code
+                     prefs_key = True
+                 )
+    return res
+
+# exercise it, to put it in the menu
+debug_pref_read_atoms_in_bulk()
+
+# ==
+
+class bulk_atom_and_bond_reader:
+    """
+    Accumulate atom and bond records read by one _readmmp_state into
+    typed arrays, and create the corresponding atoms and bonds in batches.
+    """
+    def __init__(self, readmmp_state):
+        self._state = readmmp_state
+        self._read_bonds_compactly = debug_pref_read_bonds_compactly()
+        self._symbols = {} # maps element number to element symbol
+        self._dispnames = {} # maps display name string to display style
+        self._prevcode = 0
+            # atom code of the last atom we read, or 0 if it's unknown
+            # (i.e. if the last atom was read by the general code, or none
+            #  was read yet), which means "state.prevatom" at the time the
+            #  bond record is read (see _read_bond)
+        self._last_atom_card = None # the record of that atom
+        self._reset()
+        return
+
+    def _reset(self):
+        # pending atom records
+        self._atomcodes = array('l')
+        self._eltnums = array('l')
+        self._coords = array('d') # x, y, z for each atom, as in the file
+        self._atom_dispnames = [] # one display name string or None per atom
+        self._atom_cards = [] # the record of each atom (for error messages)
+        # pending bond records, as (atom code, atom code, valence) triples,
+        # in file order, and the index of the record each one came from
+        self._bond_codes1 = array('l')
+        self._bond_codes2 = array('l')
+        self._bond_valences = array('l')
+        self._bond_records = array('l')
+        self._nrecords = 0
+        # for each bond record, (record of its previous atom, record)
+        self._bond_cards = []
+        # maps the index of each bond record read when self._prevcode was 0
+        # to the atom it bonds from (state.prevatom when it was read)
+        self._prevatoms = {}
+        # pending bond_chain and dna_rung_bonds records, as tuples
+        # (index into the pending bond arrays where they occurred,
+        #  kind, tuple of atom code ints, card)
+        self._bond_ops = []
+        return
+
+    def natoms_pending(self):
+        return len(self._atomcodes)
+
+    def batch_is_full(self):
+        """
+        Return True if self should be flushed before reading more records,
+        to bound the memory used by pending records.
+        """
+        return len(self._atomcodes) >= _MAX_ATOMS_PER_BATCH
+
+    def read_record(self, recordname, card):
+        """
+        If card (an entire mmp record line whose first word is recordname)
+        is one we can accumulate, do so and return True; otherwise return
+        False without changing anything (the caller should then flush self
+        and read card in the general way).
+        """
+        try:
+            if recordname == 'atom':
+                return self._read_atom(card)
+            valence = _BOND_RECORD_VALENCES.get(recordname)
+            if valence is not None:
+                return self._read_bond(card, valence)
+            if recordname == 'bond_chain' or recordname == 'dna_rung_bonds':
+                return self._read_bond_op(recordname, card)
+        except ValueError:
+            # unexpected format; caller will use the general code, which
+            # will report the error (we have not changed anything, since
+            # all field conversions happen before any array is modified)
+            pass
+        return False
+
+    def _read_atom(self, card):
+        # atom 1 (6) (-3029, -3696, 1935) def
+        fields = card.split()
+        if len(fields) < 6:
+            return False
+        eltfield, xfield, yfield, zfield = fields[2:6]
+        if eltfield[0] != '(' or eltfield[-1] != ')' or \
+           xfield[0] != '(' or xfield[-1] != ',' or \
+           yfield[-1] != ',' or zfield[-1] != ')':
+            return False
+        code = int(fields[1])
+        eltnum = int(eltfield[1:-1])
+        # (int, not float, so we accept the same files as the general code)
+        x = int(xfield[1:-1])
+        y = int(yfield[:-1])
+        z = int(zfield[:-1])
+        if not self._symbols.has_key(eltnum):
+            try:
+                self._symbols[eltnum] = PeriodicTable.getElement(eltnum).symbol
+            except:
+                # unsupported element -- let the general code report it
+                return False
+        if len(fields) > 6 and fields[6].replace('_', '').isalnum():
+            dispname = fields[6]
+        else:
+            dispname = None
+        self._atomcodes.append(code)
+        self._eltnums.append(eltnum)
+        self._coords.extend((x, y, z))
+        self._atom_dispnames.append(dispname)
+        self._atom_cards.append(card)
+        self._last_atom_card = card
+        self._prevcode = code
+        return True
+
+    def _read_bond(self, card, valence):
+        # bond1 1 2 3 (the previous atom is bonded to each listed atom)
+        codes = map(int, card.split()[1:])
+        prevcode = self._prevcode
+        record = self._nrecords
+        self._nrecords += 1
+        if prevcode:
+            self._bond_cards.append( (self._last_atom_card, card) )
+        else:
+            # the previous atom was read by the general code; it can't be
+            # looked up later, since pending atoms change state.prevatom
+            state = self._state
+            self._prevatoms[record] = state.prevatom
+            self._bond_cards.append( (state.prevcard, card) )
+        for code in codes:
+            self._bond_codes1.append(prevcode)
+            self._bond_codes2.append(code)
+            self._bond_valences.append(valence)
+            self._bond_records.append(record)
+        return True
+
+    def _read_bond_op(self, recordname, card):
+        if not self._read_bonds_compactly:
+            return False # let the general code report that we can't read it
+        fields = card.split()[1:]
+        if recordname == 'bond_chain':
+            if len(fields) < 2:
+                return False
+            codes = (int(fields[0]), int(fields[1]))
+        else:
+            if len(fields) < 4:
+                return False
+            codes = tuple(map(int, fields[:4]))
+        self._bond_ops.append( (len(self._bond_codes1), recordname, codes, card) )
+        return True
+
+    def flush(self):
+        """
+        Create all pending atoms, then all pending bonds (in file order),
+        and update our readmmp_state as if each record had been read
+        by its general-purpose reading method.
+
+        @raise BulkReadError: if making an atom or bond failed. (The atoms
+                              and bonds made before that are kept, and
+                              the remaining pending records are discarded.)
+        """
+        try:
+            if self._atomcodes:
+                self._make_atoms()
+            if self._bond_codes1 or self._bond_ops:
+                self._make_bonds()
+        finally:
+            self._reset()
+        return
+
+    def _error_in_record(self, card):
+        """
+        [private]
+        Call this inside an exception handler for the exception caused by
+        the given record.
+        """
+        msg = "error while reading this mmp line: %s" % (card,)
+        print_compact_traceback(msg + "\n")
+        raise BulkReadError(msg)
+
+    def _make_atoms(self):
+        state = self._state
+        n = len(self._atomcodes)
+        positions = Numeric.fromstring(self._coords.tostring(), Float)
+        positions = Numeric.reshape(positions, (n, 3)) / 1000.0
+            # (see decode_atom_coordinates in files_mmp.py)
+        if state.prevchunk is None:
+            # same as in _readmmp_state._read_atom
+            state.guess_sim_input('missing_group_or_chunk')
+            from model.chunk import Chunk
+            state.prevchunk = Chunk(state.assy, "sim chunk")
+            state.addmember(state.prevchunk)
+        chunk = state.prevchunk
+        symbols = self._symbols
+        dispnames = self._dispnames
+        ndix = state.ndix
+        newatoms = []
+        try:
+            for code, eltnum, pos, dispname in zip(self._atomcodes,
+                                                   self._eltnums,
+                                                   positions,
+                                                   self._atom_dispnames):
+                a = Atom(symbols[eltnum], pos, chunk)
+                a.unset_atomtype()
+                if dispname is not None:
+                    try:
+                        disp = dispnames[dispname]
+                    except KeyError:
+                        disp = dispnames[dispname] = interpret_dispName(dispname)
+                    a.setDisplayStyle(disp)
+                ndix[code] = a
+                newatoms.append(a)
+        except:
+            self._note_new_atoms(newatoms)
+            self._error_in_record(self._atom_cards[len(newatoms)])
+        self._note_new_atoms(newatoms)
+        return
+
+    def _note_new_atoms(self, newatoms):
+        """
+        [private]
+        Update our readmmp_state for the first len(newatoms) pending atoms,
+        which were made as newatoms.
+        """
+        if newatoms:
+            state = self._state
+            state.listOfAtomsInFileOrder.extend(newatoms)
+            state.prevatom = newatoms[-1]
+            state.prevcard = self._atom_cards[len(newatoms) - 1]
+        return
+
+    def _make_bonds(self):
+        state = self._state
+        ndix = state.ndix
+        ops = self._bond_ops
+        nextop = 0
+        prevatoms = self._prevatoms
+        failed_record = None
+        for i, code1, code2, valence, record in zip(
+                range(len(self._bond_codes1)),
+                self._bond_codes1,
+                self._bond_codes2,
+                self._bond_valences,
+                self._bond_records):
+            while nextop < len(ops) and ops[nextop][0] <= i:
+                self._do_bond_op(ops[nextop])
+                nextop += 1
+            if record == failed_record:
+                # as in read_bond_record, skip the rest of a bond record
+                # after its first unknown atom code
+                continue
+            try:
+                if code1:
+                    atom1 = ndix[code1]
+                else:
+                    atom1 = prevatoms[record]
+                bond_atoms( atom1, ndix[code2], valence, no_corrections = True)
+            except KeyError:
+                prevcard, card = self._bond_cards[record]
+                print "error in MMP file: atom ", prevcard
+                print card
+                failed_record = record
+            except:
+                self._error_in_record(self._bond_cards[record][1])
+            continue
+        for op in ops[nextop:]:
+            self._do_bond_op(op)
+        return
+
+    def _do_bond_op(self, op):
+        try:
+            self._do_bond_op_1(op)
+        except:
+            self._error_in_record(op[3])
+        return
+
+    def _do_bond_op_1(self, op):
+        index_junk, kind, codes, card = op
+        state = self._state
+        if kind == _BOND_CHAIN:
+            atoms = state.atoms_in_range(codes[0], codes[1])
+            for atom1, atom2 in zip( atoms[:-1], atoms[1:] ):
+                bond_atoms( atom1, atom2, V_SINGLE, no_corrections = True)
+        else:
+            assert kind == _DNA_RUNG_BONDS
+            def ok(atom):
+                return atom.element.role == 'axis' or \
+                       (atom.element.role == 'strand' and not atom.element is Pl5)
+            atoms1 = filter(ok, state.atoms_in_range(codes[0], codes[1]))
+            atoms2 = filter(ok, state.atoms_in_range(codes[2], codes[3]))
+            assert len(atoms1) == len(atoms2), \
+                   "qualifying atom counts %d and %d don't match in %r" % \
+                   (len(atoms1), len(atoms2), card)
+            for atom1, atom2 in zip(atoms1, atoms2):
+                bond_atoms( atom1, atom2, V_SINGLE, no_corrections = True)
+        return
+
+    def note_general_record(self):
+        """
+        Tell self that a record was read by the general code
+        (after flushing self), so any atom it read makes our notion
+        of the previous atom code unknown. (Bond records read next
+        will bond from state.prevatom.)
+        """
+        self._prevcode = 0
+        self._last_atom_card = None
+        return
+
+    pass # end of class bulk_atom_and_bond_reader
+
+# ==
+
+def write_synthetic_mmp_file(filename, natoms, atoms_per_chunk = 1000,
+                             info_records = False):
+    """
+    Write an mmp file containing natoms carbon atoms in chains
+    (one chain per chunk, with one bond1 record per atom after the first),
+    for benchmarking the mmp reading code.
+
+    @param info_records: if True, write an "info atom" record between each
+                         atom record and its bond record (as NE1 does for
+                         atoms whose atomtype isn't the default), so bulk
+                         reading has to flush at each atom
+    @type info_records: boolean
+    """
+    f = open(filename, "w")
+    f.write("mmpformat 050920 required; 080529 preferred\n")
+    f.write("kelvin 300\n")
+    f.write("group (View Data)\n")
+    f.write("egroup (View Data)\n")
+    f.write("group (Synthetic)\n")
+    code = 0
+    while code < natoms:
+        f.write("mol (Chunk-%d) def\n" % (code // atoms_per_chunk + 1))
+        first = code + 1
+        for i in range(min(atoms_per_chunk, natoms - code)):
+            code += 1
+            f.write("atom %d (6) (%d, %d, %d) def\n" %
+                    (code, 1540 * i, 1000 * (code // atoms_per_chunk), 0))
+            if info_records:
+                f.write("info atom atomtype = sp3\n")
+            if code > first:
+                f.write("bond1 %d\n" % (code - 1))
+    f.write("egroup (Synthetic)\n")
+    f.write("end1\n")
+    f.write("group (Clipboard)\n")
+    f.write("egroup (Clipboard)\n")
+    f.write("end molecular machine part Synthetic\n")
+    f.close()
+    return
+
+def _read_mmp_both_ways(assy, filename):
+    """
+    Read filename with the general and the bulk reading code, and return
+    the two lists of atoms in file order and the two grouplists
+    (as returned by _readmmp).
+    """
+    from files.mmp.files_mmp import _readmmp
+    from utilities.constants import SUCCESS
+    atomlists = []
+    grouplists = []
+    for bulk in (False, True):
+        assy.assy_valid = False # disable updaters during _readmmp
+        try:
+            ok, grouplist, atoms = _readmmp(assy, filename, True, bulk = bulk)
+        finally:
+            assy.assy_valid = True
+        assert ok == SUCCESS, "reading %r failed (bulk = %r)" % \
+               (filename, bulk)
+        atomlists.append(atoms)
+        grouplists.append(grouplist)
+    return atomlists, grouplists
+
+def _atoms_and_bonds(atoms):
+    """
+    Return a list describing the given atoms (in order) and a dict
+    describing their bonds, both independent of the atoms' keys.
+    """
+    index = {}
+    descs = []
+    for i, atom in zip(range(len(atoms)), atoms):
+        index[atom.key] = i
+        descs.append( (atom.element.symbol, atom.atomtype.name,
+                       tuple(atom.posn())) )
+    bonds = {}
+    for atom in atoms:
+        for bond in atom.bonds:
+            i1 = index.get(bond.atom1.key)
+            i2 = index.get(bond.atom2.key)
+            if i1 is not None and i2 is not None:
+                bonds[(min(i1, i2), max(i1, i2))] = bond.v6
+    return descs, bonds
+
+def check_bulk_reading(assy, filename):
+    """
+    Read filename with the general and bulk reading code, and raise
+    AssertionError unless they made the same atoms and bonds.
+    """
+    (atoms1, atoms2), grouplists = _read_mmp_both_ways(assy, filename)
+    descs1, bonds1 = _atoms_and_bonds(atoms1)
+    descs2, bonds2 = _atoms_and_bonds(atoms2)
+    for grouplist in grouplists:
+        for group in grouplist:
+            group.kill()
+    assert descs1 == descs2, "atoms differ in %r" % (filename,)
+    assert bonds1 == bonds2, \
+           "bonds differ in %r: %d only from general reading, " \
+           "%d only from bulk reading" % \
+           (filename,
+            len([b for b in bonds1 if bonds2.get(b) != bonds1[b]]),
+            len([b for b in bonds2 if bonds1.get(b) != bonds2[b]]))
+    return
+
+def _test_bulk_reading(glpane):
+    """
+    Check that the bulk reading code makes the same atoms and bonds as the
+    general code, on synthetic mmp files with and without "info atom"
+    records, and on the current file if it's an mmp file.
+    """
+    import tempfile
+    assy = glpane.assy
+    tmpdir = tempfile.mkdtemp()
+    filenames = []
+    for info_records in (False, True):
+        filename = os.path.join(tmpdir, "synthetic-%d.mmp" % info_records)
+        # (more atoms than fit in one batch)
+        write_synthetic_mmp_file(filename, _MAX_ATOMS_PER_BATCH + 1500,
+                                 info_records = info_records)
+        filenames.append(filename)
+    try:
+        for filename in filenames:
+            check_bulk_reading(assy, filename)
+        if assy.filename and assy.filename.endswith(".mmp"):
+            check_bulk_reading(assy, assy.filename)
+    finally:
+        for filename in filenames:
+            os.remove(filename)
+        os.rmdir(tmpdir)
+    env.history.message("mmp bulk reading test passed")
+    return
+
+def _test_bulk_reading_cmd(glpane):
+    try:
+        _test_bulk_reading(glpane)
+    except:
+        print_compact_traceback("mmp bulk reading test failed: ")
+        env.history.message("mmp bulk reading test failed (see console)")
+    return
+
+register_debug_menu_command("test mmp bulk reading",
+                            _test_bulk_reading_cmd)
+
+def _benchmark_mmp_reading(glpane, sizes = (100000, 1000000)):
+    """
+    Write synthetic mmp files of the given sizes (in atoms) into a temporary
+    directory, read each one with the general and bulk reading code, print
+    the times, and discard the results.
+    """
+    import tempfile
+    from files.mmp.files_mmp import _readmmp
+    from utilities.constants import SUCCESS
+    assy = glpane.assy
+    tmpdir = tempfile.mkdtemp()
+    for natoms in sizes:
+        filename = os.path.join(tmpdir, "synthetic-%d.mmp" % natoms)
+        write_synthetic_mmp_file(filename, natoms)
+        for bulk in (False, True):
+            assy.assy_valid = False # disable updaters during _readmmp
+            try:
+                t0 = time.time()
+                ok, grouplist, atoms = _readmmp(assy, filename, True,
+                                                bulk = bulk)
+                t1 = time.time()
+            finally:
+                assy.assy_valid = True
+            assert ok == SUCCESS
+            print "read %d atoms with %s code in %.2f sec" % \
+                  (len(atoms), bulk and "bulk" or "general", t1 - t0)
+            del atoms
+            for group in grouplist:
+                group.kill()
+            del grouplist
+        os.remove(filename)
+    os.rmdir(tmpdir)
+    env.history.message("mmp reading benchmark done (see console)")
+    return
+
+def _benchmark_mmp_reading_cmd(glpane):
+    try:
+        _benchmark_mmp_reading(glpane)
+    except:
+        print_compact_traceback("exception in mmp reading benchmark: ")
+    return
+
+register_debug_menu_command("benchmark mmp reading (1M atoms, slow)",
+                            _benchmark_mmp_reading_cmd)
+
+# end
@@ -94,11 +94,18 @@ class writemmp_mapping: #bruce 050322, to help with minimize selection and other
         self.forwarded_nodes_after_child = {}
         return
 
+    atom_columns = None
+        # if not None, an object (e.g. files_mmpb.MMPBWriter) which can
+        # store atoms and bonds directly, rather than from their mmp records
+        # (see Chunk_mmp_methods.writemmp); set by set_fp
+
     def set_fp(self, fp):
         """
         set file pointer to write to (don't forget to call write_header after this!)
         """
         self.fp = fp
+        if hasattr(fp, 'write_atoms'):
+            self.atom_columns = fp
         return
 
     def write(self, lines):
@@ -210,6 +217,24 @@ class writemmp_mapping: #bruce 050322, to help with minimize selection and other
         assert str(num) == self.encode_atom(atom)
         return str(num)
 
+    def encode_next_atoms(self, atoms):
+        """
+        Like encode_next_atom for each of the given atoms (in order),
+        but return a list of the assigned numbers, as ints.
+        """
+        atnums = self.atnums
+        num = atnums['NUM']
+        res = range(num + 1, num + 1 + len(atoms))
+        for atom, num in zip(atoms, res):
+            assert atom.key not in atnums, \
+                   "bug: %r encoded twice in %r" % (atom, self)
+            atnums[atom.key] = num
+        atnums['NUM'] += len(atoms)
+        if self.add_atomids_to_dict is not None:
+            for atom, num in zip(atoms, res):
+                self.add_atomids_to_dict[atom.key] = num
+        return res
+
     def encode_atom(self, atom):
         """
         Return an encoded reference to this atom (a short string, actually
@@ -416,6 +441,17 @@ def writemmpfile_assy(assy, filename, addshelf = True, **mapping_options):
 
     fp = open(filename, "w")
 
+    writemmp_assy_to_fp(assy, fp, addshelf, **mapping_options)
+    return # from writemmpfile_assy
+
+def writemmp_assy_to_fp(assy, fp, addshelf = True, **mapping_options):
+    """
+    Write everything in this assy, as mmp text, to the file-like object fp
+    (which needs write and close methods, and is closed when we're done).
+    This is the guts of writemmpfile_assy (which opens a new file for fp);
+    it can also be used to write other formats derived from mmp
+    (see files_mmpb.writemmpbfile_assy).
+    """
     mapping = writemmp_mapping(assy, **mapping_options)
         ###e should pass sim or min options when used that way...
     mapping.set_fp(fp)
@@ -437,7 +473,7 @@ def writemmpfile_assy(assy, filename, addshelf = True, **mapping_options):
         raise
     else:
         mapping.close()
-    return # from writemmpfile_assy
+    return # from writemmp_assy_to_fp
 
 # ==
 
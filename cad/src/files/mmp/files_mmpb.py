@@ -0,0 +1,909 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+files_mmpb.py -- binary, memory-mappable variant of the mmp file format
+(".mmpb" files), and lossless conversion between it and mmp.
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+Format:
+
+An mmpb file holds the same information as an mmp file, but stores the
+atom and bond records (which make up nearly all of a large mmp file)
+in binary columns instead of text. Everything else (groups, chunks, jigs,
+views, info records about anything but atoms) is kept as mmp text.
+
+  offset 0: magic string MMPB_MAGIC (8 bytes)
+  offset 8: format version, number of sections (little-endian uint32 each)
+  offset 16: section directory -- for each section, its name (16 bytes,
+             NUL-padded), byte offset and byte length (uint64 each)
+  then the sections, each starting at a multiple of 8 bytes.
+
+All numbers are little-endian. The sections are:
+
+  records   -- mmp text of all records except atom-related ones
+               (atom, bond*, bond_direction, bond_chain,
+                directional_bond_chain, dna_rung_bonds, info atom).
+               Each maximal run of atom-related records is replaced by one
+               "mmpb_atoms <run index>" record; a run's atoms belong to the
+               chunk made by the preceding mol record, so these records
+               (along with the group/egroup/mol records) define the node tree
+               and chunk membership.
+  runstart  -- int32[nruns + 1]: index of the first atom of each run
+  runbonds  -- int32[nruns + 1]: index of the first bond of each run
+  atomcode  -- int32[natoms]: atom number used in the mmp records
+  element   -- int16[natoms]: element number (PAM pseudoatoms are > 255)
+  position  -- int32[natoms * 3]: coordinates in mmp units (0.001 Angstrom),
+               so the conversion from mmp is exact
+  atomtype  -- uint8[natoms]: index into atomtypes (0 means none recorded)
+  atomtypes -- text: newline-separated atomtype names (first one empty)
+  display   -- uint8[natoms]: index into dispnames (0 means none recorded)
+  dispnames -- text: newline-separated display names (first one empty)
+  bondatoms -- int32[nbonds * 2]: atom indices (earlier, later) of each bond,
+               in the order the bonds were made
+  bondorder -- uint8[nbonds]: bond valence (e.g. V_SINGLE)
+  bonddir   -- int8[nbonds]: bond direction from earlier to later atom
+  atominfo  -- text: "<atom index> <key> = <value>" for every other
+               info atom record (e.g. dnaBaseName, ghost, +5data), in order
+
+Reading an mmpb file (see class MMPBFile) maps it with mmap and only
+decodes the columns for one run of atoms at a time; _readmmp feeds the
+records section through the usual mmp record readers, and each
+mmpb_atoms record makes that run's atoms and bonds directly from the
+columns (see class MMPBAtomLoader), so no atom or bond text is ever
+parsed. (A run's atoms are made when its record is read, i.e. when its
+chunk is read, since the chunk needs them; nothing is deferred beyond
+that.)
+
+Writing (see class MMPBWriter) accepts mmp text, from an existing mmp
+file (convert_mmp_to_mmpb) or from the mmp writing code
+(writemmpbfile_assy). When saving, chunks give their atoms to it directly
+(see MMPBWriter.write_atoms), so atom and bond records are only made and
+parsed for chunks it can't take atoms from that way (e.g. ones being
+converted to PAM5).
+"""
+
+import os, sys, mmap, struct
+from array import array
+from cStringIO import StringIO
+
+import Numeric
+from Numeric import Float
+
+from model.chem import Atom
+from model.elements import PeriodicTable
+from model.elements import Pl5
+from model.bonds import bond_atoms
+from model.bonds import bonds_mmprecord
+
+from model.bond_constants import V_SINGLE
+from model.bond_constants import V_DOUBLE
+from model.bond_constants import V_TRIPLE
+from model.bond_constants import V_AROMATIC
+from model.bond_constants import V_GRAPHITE
+from model.bond_constants import V_CARBOMERIC
+
+from files.mmp.mmp_dispnames import interpret_dispName
+
+MMPB_MAGIC = "NE1MMPB\n"
+
+MMPB_FORMAT_VERSION = 1
+
+_HEADER_FORMAT = "<8sII"
+_DIRECTORY_ENTRY_FORMAT = "<16sQQ"
+
+_SECTION_TYPES = {
+    # section name -> array typecode for its items (None for text)
+    'records': None,
+    'runstart': 'i',
+    'runbonds': 'i',
+    'atomcode': 'i',
+    'element': 'h',
+    'position': 'i',
+    'atomtype': 'B',
+    'atomtypes': None,
+    'display': 'B',
+    'dispnames': None,
+    'bondatoms': 'i',
+    'bondorder': 'B',
+    'bonddir': 'b',
+    'atominfo': None,
+ }
+
+_SECTION_ORDER = ['records', 'runstart', 'runbonds',
+                  'atomcode', 'element', 'position',
+                  'atomtype', 'atomtypes', 'display', 'dispnames',
+                  'bondatoms', 'bondorder', 'bonddir', 'atominfo']
+
+# corresponding Numeric typecodes, for decoding slices of the mapped file
+_NUMERIC_TYPECODES = {
+    'i': Numeric.Int32,
+    'h': Numeric.Int16,
+    'B': Numeric.UnsignedInt8,
+    'b': Numeric.Int8,
+ }
+
+_BOND_RECORD_VALENCES = {
+    'bond1': V_SINGLE,
+    'bond2': V_DOUBLE,
+    'bond3': V_TRIPLE,
+    'bonda': V_AROMATIC,
+    'bondg': V_GRAPHITE,
+    'bondc': V_CARBOMERIC,
+ }
+
+_ATOM_RELATED_RECORDS = ['atom', 'bond_direction', 'bond_chain',
+                         'directional_bond_chain', 'dna_rung_bonds'] + \
+                        _BOND_RECORD_VALENCES.keys()
+
+_MMPB_ATOMS_RECORD = "mmpb_atoms"
+
+_LITTLE_ENDIAN = (sys.byteorder == 'little')
+
+class MMPBFormatError(Exception):
+    """
+    Raised for a malformed mmpb file, or for mmp text which can't be
+    converted to mmpb format.
+    """
+    pass
+
+def is_mmpb_file(filename):
+    """
+    Return True if filename names an existing file which starts
+    with the mmpb magic string.
+    """
+    try:
+        f = open(filename, "rb")
+        try:
+            return f.read(len(MMPB_MAGIC)) == MMPB_MAGIC
+        finally:
+            f.close()
+    except IOError:
+        return False
+    pass
+
+def _is_rung_bond_atom(eltnum):
+    # see _readmmp_state._read_dna_rung_bonds
+    element = PeriodicTable.getElement(eltnum)
+    return element.role == 'axis' or \
+           (element.role == 'strand' and not element is Pl5)
+
+def _is_strand_sugar(eltnum):
+    # see _readmmp_state._read_directional_bond_chain
+    element = PeriodicTable.getElement(eltnum)
+    return element.role == 'strand' and not element is Pl5
+
+# ==
+
+class MMPBWriter:
+    """
+    Accept the text of an mmp file (in pieces of one or more complete lines,
+    via write), and chunks' atoms given directly (via write_atoms) in place
+    of their atom and bond records, and on close, write an equivalent mmpb
+    file.
+
+    Has the file-like interface needed by writemmp_mapping.set_fp.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._records = [] # mmp text of non-atom-related records
+        self._partial_line = ""
+        self._in_run = False
+        self._runstart = array('i')
+        self._runbonds = array('i')
+        self._atomcode = array('i')
+        self._element = array('h')
+        self._position = array('i')
+        self._atomtype = array('B')
+        self._atomtypes = {'': 0}
+        self._display = array('B')
+        self._dispnames = {'': 0}
+        self._bondatoms = array('i')
+        self._bondorder = array('B')
+        self._bonddir = array('b')
+        self._atominfo = []
+        self._index_of_code = {} # maps atom code to atom index
+        self._bond_index = {} # maps (earlier, later) atom indices to bond index
+        self._prevatom = -1 # index of previous atom
+        self._lineno = 0
+        self._failed = False
+        return
+
+    # file-like interface
+
+    def write(self, text):
+        lines = (self._partial_line + text).split('\n')
+        self._partial_line = lines.pop()
+        for line in lines:
+            self._lineno += 1
+            self._read_line(line)
+        return
+
+    def close(self):
+        if self._failed:
+            # don't write a file we know is wrong
+            return
+        if self._partial_line:
+            self._lineno += 1
+            self._read_line(self._partial_line)
+            self._partial_line = ""
+        self._end_run()
+        self._write_file()
+        return
+
+    # parsing mmp records
+
+    def _error(self, msg):
+        self._failed = True
+        raise MMPBFormatError("line %d: %s" % (self._lineno, msg))
+
+    def _atom_index(self, code):
+        try:
+            return self._index_of_code[int(code)]
+        except KeyError:
+            self._error("reference to unknown atom %s" % (code,))
+        pass
+
+    def _atoms_in_range(self, start, end):
+        return [self._atom_index(code)
+                for code in range(int(start), int(end) + 1)]
+
+    def _read_line(self, line):
+        fields = line.split()
+        if not fields:
+            self._end_run()
+            self._records.append(line + "\n")
+            return
+        recordname = fields[0]
+        if recordname in _ATOM_RELATED_RECORDS or \
+           (recordname == 'info' and len(fields) > 1 and fields[1] == 'atom'):
+            self._start_run()
+            try:
+                self._read_atom_related_record(recordname, fields, line)
+            except (ValueError, IndexError):
+                self._error("can't parse %r" % (line,))
+            return
+        if recordname == _MMPB_ATOMS_RECORD:
+            self._error("%s record in mmp text" % _MMPB_ATOMS_RECORD)
+        self._end_run()
+        self._records.append(line + "\n")
+        return
+
+    def _start_run(self):
+        if not self._in_run:
+            self._records.append("%s %d\n" % (_MMPB_ATOMS_RECORD,
+                                              len(self._runstart)))
+            self._runstart.append(len(self._atomcode))
+            self._runbonds.append(len(self._bondorder))
+            self._in_run = True
+        return
+
+    def _end_run(self):
+        self._in_run = False
+        return
+
+    def _read_atom_related_record(self, recordname, fields, line):
+        if recordname == 'atom':
+            # atom 1 (6) (-3029, -3696, 1935) def
+            code = int(fields[1])
+            eltnum = int(fields[2].strip('()'))
+            x = int(fields[3].strip('(,'))
+            y = int(fields[4].strip(','))
+            z = int(fields[5].strip(',)'))
+            if len(fields) > 6:
+                dispname = fields[6]
+            else:
+                dispname = ''
+            index = len(self._atomcode)
+            self._index_of_code[code] = index
+            self._atomcode.append(code)
+            self._element.append(eltnum)
+            self._position.extend((x, y, z))
+            self._atomtype.append(0)
+            self._display.append(self._string_index(self._dispnames, dispname))
+            self._prevatom = index
+        elif recordname in _BOND_RECORD_VALENCES:
+            valence = _BOND_RECORD_VALENCES[recordname]
+            for code in fields[1:]:
+                self._add_bond(self._atom_index(code), self._prevatom, valence)
+        elif recordname == 'bond_direction':
+            atoms = map(self._atom_index, fields[1:])
+            for atom1, atom2 in zip(atoms[:-1], atoms[1:]):
+                self._set_bond_direction(atom1, atom2, 1)
+        elif recordname == 'bond_chain':
+            atoms = self._atoms_in_range(fields[1], fields[2])
+            for atom1, atom2 in zip(atoms[:-1], atoms[1:]):
+                self._add_bond(atom1, atom2, V_SINGLE)
+        elif recordname == 'directional_bond_chain':
+            atoms = self._atoms_in_range(fields[1], fields[2])
+            bond_dir = int(fields[3])
+            for atom1, atom2 in zip(atoms[:-1], atoms[1:]):
+                self._add_bond(atom1, atom2, V_SINGLE)
+                self._set_bond_direction(atom1, atom2, bond_dir)
+            if len(fields) > 4:
+                sequence = list(fields[4])
+                for atom in atoms:
+                    if not sequence:
+                        break
+                    if _is_strand_sugar(self._element[atom]):
+                        letter = sequence.pop(0)
+                        if letter != 'X':
+                            self._atominfo.append(
+                                "%d dnaBaseName = %s\n" % (atom, letter))
+                    continue
+        elif recordname == 'dna_rung_bonds':
+            atoms1 = filter(lambda atom: _is_rung_bond_atom(self._element[atom]),
+                            self._atoms_in_range(fields[1], fields[2]))
+            atoms2 = filter(lambda atom: _is_rung_bond_atom(self._element[atom]),
+                            self._atoms_in_range(fields[3], fields[4]))
+            if len(atoms1) != len(atoms2):
+                self._error("qualifying atom counts don't match in %r" % line)
+            for atom1, atom2 in zip(atoms1, atoms2):
+                self._add_bond(atom1, atom2, V_SINGLE)
+        else:
+            # info atom <key> = <value>
+            assert recordname == 'info'
+            if self._prevatom < 0:
+                self._error("info atom record before any atom")
+            rest = line.split(None, 2)[2].strip()
+            key, val = [s.strip() for s in rest.split('=', 1)]
+            if key == 'atomtype':
+                self._atomtype[self._prevatom] = \
+                    self._string_index(self._atomtypes, val)
+            else:
+                self._atominfo.append("%d %s\n" % (self._prevatom, rest))
+        return
+
+    def _string_index(self, table, string):
+        try:
+            return table[string]
+        except KeyError:
+            if len(table) >= 256:
+                self._error("too many different atomtypes or display names")
+            table[string] = res = len(table)
+            return res
+        pass
+
+    def _add_bond(self, atom1, atom2, valence):
+        """
+        Record a bond between the atoms with the given indices
+        (made by bond_atoms(atom1, atom2, valence) when reading mmp).
+        """
+        # we store (earlier, later), and make the bond from later to earlier
+        # when reading, as for bond records (the usual case); the bond's
+        # atom order doesn't matter except for its direction
+        earlier, later = min(atom1, atom2), max(atom1, atom2)
+        self._bond_index[(earlier, later)] = len(self._bondorder)
+        self._bondatoms.extend((earlier, later))
+        self._bondorder.append(valence)
+        self._bonddir.append(0)
+        return
+
+    def _set_bond_direction(self, atom1, atom2, direction):
+        """
+        Set the direction (from atom1 to atom2) of the bond between them.
+        """
+        try:
+            if atom1 < atom2:
+                self._bonddir[self._bond_index[(atom1, atom2)]] = direction
+            else:
+                self._bonddir[self._bond_index[(atom2, atom1)]] = - direction
+        except KeyError:
+            self._error("bond direction for nonexistent bond")
+        return
+
+    # adding atoms directly (see Chunk_mmp_methods.writemmp)
+
+    def can_write_atoms(self, atoms, mapping):
+        """
+        Return True if self.write_atoms can store the given atoms
+        (to be written by the given writemmp_mapping).
+        """
+        if mapping.sim or mapping.for_undo:
+            # bondpoints and display names are written specially
+            return False
+        for atom in atoms:
+            if atom.__class__ is not Atom:
+                # e.g. Fake_Pl, made when converting to PAM5
+                return False
+        return True
+
+    def write_atoms(self, chunk, atoms, mapping):
+        """
+        Store the given atoms of chunk (as returned by
+        chunk.atoms_in_mmp_file_order(mapping)), and their bonds to atoms
+        already written, exactly as if atom.writemmp(mapping) had been
+        called for each one (so mapping assigns their atom codes), but
+        without making their mmp records.
+
+        @note: only call this if self.can_write_atoms(atoms, mapping).
+        """
+        assert not self._partial_line
+        if not atoms:
+            return
+        self._start_run()
+        start = len(self._atomcode)
+        codes = mapping.encode_next_atoms(atoms)
+        index_of_code = self._index_of_code
+        for code, index in zip(codes, range(start, start + len(atoms))):
+            index_of_code[code] = index
+        self._atomcode.extend(codes)
+        self._element.extend([atom.element.eltnum for atom in atoms])
+        self._position.extend(self._atom_coordinates(chunk, atoms))
+        dispindex = {} # display style -> index in self._dispnames
+        atomtypes = self._atomtypes
+        atominfo = self._atominfo
+        atnums = mapping.atnums
+        for index, atom in zip(range(start, start + len(atoms)), atoms):
+            display = atom.display
+            try:
+                self._display.append(dispindex[display])
+            except KeyError:
+                dispindex[display] = i = \
+                    self._string_index(self._dispnames,
+                                       mapping.dispname(display))
+                self._display.append(i)
+            # see Atom.writemmp for the info atom records it writes
+            atype = atom.atomtype_iff_set()
+            if atype is not None and atype is not atom.element.atomtypes[0]:
+                self._atomtype.append(self._string_index(atomtypes, atype.name))
+            else:
+                self._atomtype.append(0)
+            dnaBaseName = atom.getDnaBaseName()
+            if dnaBaseName and dnaBaseName != 'X':
+                atominfo.append("%d dnaBaseName = %s\n" % (index, dnaBaseName))
+            if atom.ghost:
+                atominfo.append("%d ghost = True\n" % index)
+            strandId = atom.getDnaStrandId_for_generators()
+            if strandId:
+                atominfo.append("%d dnaStrandId_for_generators = %s\n" %
+                                (index, strandId))
+            if atom._PAM3plus5_Pl_Gv_data is not None:
+                atominfo.append("%d %s\n" %
+                                (index,
+                                 atom._f_PAM3plus5_Pl_Gv_data_text(mapping)))
+            # bonds whose other atom was already written, in the order
+            # Atom.writemmp writes them (grouped by valence)
+            bonds = {} # valence -> list of (other atom index, bond)
+            for bond in atom.bonds:
+                other_code = atnums.get(bond.other(atom).key)
+                if other_code is not None:
+                    other = index_of_code[other_code]
+                    if other < index:
+                        bonds.setdefault(bond.v6, []).append( (other, bond) )
+            if bonds:
+                valences = bonds.keys()
+                valences.sort()
+                for valence in valences:
+                    for other, bond in bonds[valence]:
+                        self._add_bond(other, index, valence)
+                for valence in valences:
+                    for other, bond in bonds[valence]:
+                        if bond._direction:
+                            self._set_bond_direction(
+                                index, other, bond.bond_direction_from(atom))
+            continue
+        self._prevatom = start + len(atoms) - 1
+        return
+
+    def _atom_coordinates(self, chunk, atoms):
+        """
+        Return a list of the mmp coordinates (ints, in units of 0.001
+        Angstrom, rounded as by writemmp_mapping.encode_atom_coordinate)
+        of the given atoms of chunk, x, y, z for each atom.
+        """
+        atpos = chunk.__dict__.get('atpos') # only if it's valid
+        if atpos is not None:
+            positions = Numeric.take(atpos, [atom.index for atom in atoms], 0)
+        else:
+            positions = Numeric.array([atom.posn() for atom in atoms], Float)
+        coords = Numeric.ravel(positions) * 1000.0
+        # round halfway cases away from zero, like intRound
+        rounded = Numeric.floor(Numeric.absolute(coords) + 0.5)
+        rounded = Numeric.where(Numeric.less(coords, 0.0), - rounded, rounded)
+        return Numeric.array(rounded, Numeric.Int32).tolist()
+
+    # writing the file
+
+    def _sections(self):
+        def table_text(table):
+            items = [(index, string) for string, index in table.items()]
+            items.sort()
+            return "\n".join([string for index, string in items])
+        runstart = array('i', self._runstart)
+        runstart.append(len(self._atomcode))
+        runbonds = array('i', self._runbonds)
+        runbonds.append(len(self._bondorder))
+        return {
+            'records': "".join(self._records),
+            'runstart': runstart,
+            'runbonds': runbonds,
+            'atomcode': self._atomcode,
+            'element': self._element,
+            'position': self._position,
+            'atomtype': self._atomtype,
+            'atomtypes': table_text(self._atomtypes),
+            'display': self._display,
+            'dispnames': table_text(self._dispnames),
+            'bondatoms': self._bondatoms,
+            'bondorder': self._bondorder,
+            'bonddir': self._bonddir,
+            'atominfo': "".join(self._atominfo),
+         }
+
+    def _write_file(self):
+        sections = self._sections()
+        datas = []
+        for name in _SECTION_ORDER:
+            data = sections[name]
+            if not isinstance(data, str):
+                if not _LITTLE_ENDIAN:
+                    data = array(data.typecode, data)
+                    data.byteswap()
+                data = data.tostring()
+            datas.append(data)
+        offset = struct.calcsize(_HEADER_FORMAT) + \
+                 len(_SECTION_ORDER) * struct.calcsize(_DIRECTORY_ENTRY_FORMAT)
+        directory = []
+        for name, data in zip(_SECTION_ORDER, datas):
+            offset = (offset + 7) & ~7
+            directory.append(struct.pack(_DIRECTORY_ENTRY_FORMAT,
+                                         name, offset, len(data)))
+            offset += len(data)
+        f = open(self.filename, "wb")
+        try:
+            f.write(struct.pack(_HEADER_FORMAT, MMPB_MAGIC,
+                                MMPB_FORMAT_VERSION, len(_SECTION_ORDER)))
+            f.write("".join(directory))
+            for data in datas:
+                f.write("\0" * ((- f.tell()) & 7))
+                f.write(data)
+        finally:
+            f.close()
+        return
+
+    pass # end of class MMPBWriter
+
+# ==
+
+class MMPBFile:
+    """
+    An open mmpb file, mapped into memory. Each column can be decoded
+    for one run of atoms at a time (so clients can load one chunk's atoms
+    at a time), or as a whole.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        f = open(filename, "rb")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < struct.calcsize(_HEADER_FORMAT):
+                raise MMPBFormatError("file too short: %r" % filename)
+            self._map = mmap.mmap(f.fileno(), size, access = mmap.ACCESS_READ)
+        finally:
+            f.close() # the map stays valid
+        magic, version, nsections = struct.unpack(
+            _HEADER_FORMAT, self._map[:struct.calcsize(_HEADER_FORMAT)])
+        if magic != MMPB_MAGIC:
+            raise MMPBFormatError("not an mmpb file: %r" % filename)
+        if version > MMPB_FORMAT_VERSION:
+            raise MMPBFormatError("mmpb format version %d is newer than %d, "
+                                  "which is the newest this code can read" %
+                                  (version, MMPB_FORMAT_VERSION))
+        self._sections = {} # section name -> (offset, nbytes)
+        pos = struct.calcsize(_HEADER_FORMAT)
+        entrysize = struct.calcsize(_DIRECTORY_ENTRY_FORMAT)
+        for i in range(nsections):
+            name, offset, nbytes = struct.unpack(_DIRECTORY_ENTRY_FORMAT,
+                                                 self._map[pos:pos + entrysize])
+            self._sections[name.rstrip("\0")] = (offset, nbytes)
+            pos += entrysize
+        for name in _SECTION_ORDER:
+            if not self._sections.has_key(name):
+                raise MMPBFormatError("mmpb file %r has no %s section" %
+                                      (filename, name))
+        self.runstart = self.column('runstart').tolist()
+        self.runbonds = self.column('runbonds').tolist()
+        self.nruns = len(self.runstart) - 1
+        self.natoms = self.runstart[-1]
+        self.nbonds = self.runbonds[-1]
+        self.atomtypes = self.text('atomtypes').split("\n")
+        self.dispnames = self.text('dispnames').split("\n")
+        self._atominfo = None
+        self._atomcodes = None
+        return
+
+    def close(self):
+        self._map.close()
+        self._map = None
+
+    def text(self, name):
+        offset, nbytes = self._sections[name]
+        return self._map[offset:offset + nbytes]
+
+    def column(self, name, start = 0, end = None, itemsper = 1):
+        """
+        Return a Numeric array of items start through end - 1 of the named
+        column (with itemsper numbers per item; default end is all items),
+        decoded from only those bytes of the file.
+        """
+        typecode = _SECTION_TYPES[name]
+        itemsize = array(typecode).itemsize * itemsper
+        offset, nbytes = self._sections[name]
+        if end is None:
+            end = nbytes // itemsize
+        data = self._map[offset + start * itemsize : offset + end * itemsize]
+        res = Numeric.fromstring(data, _NUMERIC_TYPECODES[typecode])
+        if not _LITTLE_ENDIAN:
+            res = res.byteswapped()
+        return res
+
+    def records(self):
+        """
+        Return a file-like object for the mmp text in our records section.
+        """
+        return StringIO(self.text('records'))
+
+    def run_arrays(self, run):
+        """
+        Return a dict of Numeric arrays for the atoms and bonds of the given
+        run (as described in the module docstring), with keys 'atomcode',
+        'element', 'position' (in Angstroms, shape (n,3)), 'atomtype',
+        'display', 'bondatoms' (shape (nbonds,2)), 'bondorder', 'bonddir'.
+        """
+        start, end = self.runstart[run], self.runstart[run + 1]
+        bstart, bend = self.runbonds[run], self.runbonds[run + 1]
+        positions = self.column('position', start, end, 3)
+        positions = Numeric.reshape(positions, (end - start, 3)) / 1000.0
+        return dict(
+            atomcode = self.column('atomcode', start, end),
+            element = self.column('element', start, end),
+            position = positions,
+            atomtype = self.column('atomtype', start, end),
+            display = self.column('display', start, end),
+            bondatoms = Numeric.reshape(self.column('bondatoms', bstart, bend, 2),
+                                        (bend - bstart, 2)),
+            bondorder = self.column('bondorder', bstart, bend),
+            bonddir = self.column('bonddir', bstart, bend),
+         )
+
+    def atom_codes(self):
+        """
+        Return a list of the atom codes of all the atoms
+        (decoded once, when first needed).
+        """
+        if self._atomcodes is None:
+            self._atomcodes = self.column('atomcode').tolist()
+        return self._atomcodes
+
+    def atominfo(self):
+        """
+        Return a dict from atom index to the list of "<key> = <value>"
+        strings from other info atom records for that atom.
+        """
+        if self._atominfo is None:
+            self._atominfo = {}
+            for line in self.text('atominfo').splitlines():
+                index, rest = line.split(None, 1)
+                self._atominfo.setdefault(int(index), []).append(rest)
+        return self._atominfo
+
+    def atom_run_records(self, run):
+        """
+        Return the mmp text (a list of lines) equivalent to the given run:
+        its atom records, each followed by its info atom records, then the
+        records for bonds (and bond directions) whose later atom it is.
+        (Each bond is written with the later of its atoms, which is the
+        only place a bond record can be.)
+        """
+        arrays = self.run_arrays(run)
+        start, end = self.runstart[run], self.runstart[run + 1]
+        # exact mmp coordinates, rather than arrays['position']
+        positions = Numeric.reshape(self.column('position', start, end, 3),
+                                    (end - start, 3))
+        codes = self.atom_codes() # all of them, for bond partners
+        atominfo = self.atominfo()
+        bonds_of_later_atom = {}
+        for (earlier, later), order, direction in zip(
+                arrays['bondatoms'].tolist(),
+                arrays['bondorder'].tolist(),
+                arrays['bonddir'].tolist()):
+            bonds_of_later_atom.setdefault(later, []).append(
+                (earlier, order, direction))
+        lines = []
+        for i, code, eltnum, (x, y, z), atomtype, display in zip(
+                range(start, end),
+                arrays['atomcode'].tolist(),
+                arrays['element'].tolist(),
+                positions.tolist(),
+                arrays['atomtype'].tolist(),
+                arrays['display'].tolist()):
+            dispname = self.dispnames[display]
+            if dispname:
+                dispname = " " + dispname
+            lines.append("atom %d (%d) (%d, %d, %d)%s\n" %
+                         (code, eltnum, x, y, z, dispname))
+            if atomtype:
+                lines.append("info atom atomtype = %s\n" %
+                             self.atomtypes[atomtype])
+            for rest in atominfo.get(i, ()):
+                lines.append("info atom %s\n" % rest)
+            for earlier, order, direction in bonds_of_later_atom.pop(i, ()):
+                lines.append(bonds_mmprecord(order, [str(codes[earlier])]) +
+                             "\n")
+                if direction:
+                    pair = (codes[earlier], code)
+                    if direction < 0:
+                        pair = (code, codes[earlier])
+                    lines.append("bond_direction %d %d\n" % pair)
+            continue
+        if bonds_of_later_atom:
+            raise MMPBFormatError("bonds in run %d whose later atom "
+                                  "is not in that run" % run)
+        return lines
+
+    pass # end of class MMPBFile
+
+class MMPBAtomLoader:
+    """
+    Make the atoms and bonds of an MMPBFile's runs, one run at a time,
+    as the mmpb_atoms records in its records section are read by a
+    files_mmp._readmmp_state.
+
+    @ivar atoms: the Atom made for each atom index in the file (its index
+                 in the atom columns), or None if its run wasn't loaded yet
+    """
+    def __init__(self, mmpb_file, readmmp_state):
+        self.mmpb_file = mmpb_file
+        self._state = readmmp_state
+        self.atoms = [None] * mmpb_file.natoms
+        self._symbols = {} # element number -> element symbol
+        self._disps = {} # index in dispnames -> display style
+        return
+
+    def destroy(self):
+        self.mmpb_file = self._state = self.atoms = None
+        return
+
+    def load_run(self, run):
+        """
+        Create the atoms and bonds of the given run, as if their mmp records
+        had been read by our readmmp_state. (Its bonds only refer to atoms
+        in it or in earlier runs.)
+        """
+        mmpb = self.mmpb_file
+        state = self._state
+        atoms = self.atoms
+        arrays = mmpb.run_arrays(run)
+        start = mmpb.runstart[run]
+        n = len(arrays['atomcode'])
+        if n:
+            if state.prevchunk is None:
+                # same as in _readmmp_state._read_atom
+                state.guess_sim_input('missing_group_or_chunk')
+                from model.chunk import Chunk
+                state.prevchunk = Chunk(state.assy, "sim chunk")
+                state.addmember(state.prevchunk)
+            chunk = state.prevchunk
+            symbols = self._symbols
+            disps = self._disps
+            ndix = state.ndix
+            for i, code, eltnum, pos, display in zip(
+                    range(start, start + n),
+                    arrays['atomcode'].tolist(),
+                    arrays['element'].tolist(),
+                    arrays['position'],
+                    arrays['display'].tolist()):
+                try:
+                    sym = symbols[eltnum]
+                except KeyError:
+                    sym = symbols[eltnum] = \
+                          PeriodicTable.getElement(eltnum).symbol
+                a = Atom(sym, pos, chunk)
+                a.unset_atomtype()
+                if display:
+                    try:
+                        disp = disps[display]
+                    except KeyError:
+                        disp = disps[display] = \
+                               interpret_dispName(mmpb.dispnames[display])
+                    a.setDisplayStyle(disp)
+                ndix[code] = a
+                atoms[i] = a
+            state.listOfAtomsInFileOrder.extend(atoms[start:start + n])
+            # atomtypes and other atom info, read by the usual code
+            atominfo = mmpb.atominfo()
+            for i, atomtype in zip(range(start, start + n),
+                                   arrays['atomtype'].tolist()):
+                if atomtype or atominfo.has_key(i):
+                    state.prevatom = atoms[i]
+                    if atomtype:
+                        state.readmmp_line("info atom atomtype = %s" %
+                                           mmpb.atomtypes[atomtype])
+                    for rest in atominfo.get(i, ()):
+                        state.readmmp_line("info atom %s" % rest)
+            state.prevatom = atoms[start + n - 1]
+        for (earlier, later), order, direction in zip(
+                arrays['bondatoms'].tolist(),
+                arrays['bondorder'].tolist(),
+                arrays['bonddir'].tolist()):
+            atom1 = atoms[later]
+            atom2 = atoms[earlier]
+            if atom1 is None or atom2 is None:
+                raise MMPBFormatError("bond in run %d to an atom "
+                                      "in a later run" % run)
+            bond = bond_atoms( atom1, atom2, order, no_corrections = True)
+            if direction:
+                bond.set_bond_direction_from(atom2, direction)
+        return
+
+    pass # end of class MMPBAtomLoader
+
+# ==
+
+def convert_mmp_to_mmpb(mmpfilename, mmpbfilename):
+    """
+    Write an mmpb file equivalent to the given mmp file.
+    Raise MMPBFormatError if the mmp file can't be converted.
+    """
+    writer = MMPBWriter(mmpbfilename)
+    f = open(mmpfilename, "rU")
+    try:
+        for line in f:
+            writer.write(line)
+    finally:
+        f.close()
+    writer.close()
+    return
+
+def convert_mmpb_to_mmp(mmpbfilename, mmpfilename):
+    """
+    Write an mmp file equivalent to the given mmpb file.
+    Atom and bond records are written in their simplest forms
+    (e.g. bond chains become bond1 and bond_direction records).
+    """
+    mmpb = MMPBFile(mmpbfilename)
+    f = open(mmpfilename, "w")
+    try:
+        for line in mmpb.records():
+            fields = line.split()
+            if fields and fields[0] == _MMPB_ATOMS_RECORD:
+                f.writelines(mmpb.atom_run_records(int(fields[1])))
+            else:
+                f.write(line)
+    finally:
+        f.close()
+        mmpb.close()
+    return
+
+def writemmpbfile_assy(assy, filename, addshelf = True, **mapping_options):
+    """
+    Like writemmpfile_assy, but write an mmpb file.
+    """
+    from files.mmp.files_mmp_writing import writemmp_assy_to_fp
+    assy.o.saveLastView()
+    assy.update_parts()
+    # (the writer stores bonds as atom pairs, so compact bond records
+    #  would only make it do more work)
+    mapping_options['write_bonds_compactly'] = False
+    writemmp_assy_to_fp(assy, MMPBWriter(filename), addshelf,
+                        **mapping_options)
+    return
+
+# ==
+
+if __name__ == '__main__':
+    # convert files from the command line; run from cad/src as
+    # ./ExecSubDir.py files/mmp/files_mmpb.py infile outfile
+    # (the direction of conversion depends on whether infile is mmpb)
+    if len(sys.argv) != 3:
+        print "usage: files_mmpb.py infile outfile"
+        sys.exit(1)
+    infile, outfile = sys.argv[1:]
+    if is_mmpb_file(infile):
+        convert_mmpb_to_mmp(infile, outfile)
+    else:
+        convert_mmp_to_mmpb(infile, outfile)
+
+# end
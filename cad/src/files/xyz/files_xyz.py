@@ -0,0 +1,137 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+files_xyz.py -- fast parsing of XYZ files (as written by the simulator)
+into Numeric arrays, including a streaming reader for multi-frame files.
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+An XYZ frame is a line with the number of atoms, a comment line, and one
+line per atom of the form "<element symbol> <x> <y> <z>" (in Angstroms).
+A multi-frame file is just several frames in a row.
+
+The parsing here avoids per-atom Python work where it can: all of a frame's
+atom lines are split at once and their coordinates converted by one map()
+into a Numeric array, and per-line checks are only done (to find the line
+to complain about) when something is wrong. The element checks done by
+runSim.readxyz are a single list comparison in the usual case.
+"""
+
+import Numeric
+from Numeric import Float
+
+class XYZFormatError(Exception):
+    """
+    Exception for a malformed XYZ file or atom line.
+
+    @ivar kind: 'fields' (an atom line doesn't have 4 fields),
+                'number' (a coordinate is not a number),
+                or 'header' (bad or truncated frame header).
+    @ivar index: the index of the bad atom line in the lines passed to
+                 parse_xyz_atom_lines (counting from 0), or None.
+    @ivar lineno: for iter_xyz_frames, the line number in the file
+                  (counting from 1) of the bad line, or None.
+    """
+    def __init__(self, kind, index = None, lineno = None, msg = None):
+        self.kind = kind
+        self.index = index
+        self.lineno = lineno
+        if msg is None:
+            msg = "XYZ format error (%s)" % (kind,)
+            if lineno is not None:
+                msg += " in line %d" % (lineno,)
+            elif index is not None:
+                msg += " in atom line %d" % (index + 1,)
+        Exception.__init__(self, msg)
+    pass
+
+def parse_xyz_atom_lines(lines):
+    """
+    Parse XYZ atom lines (each of the form "<symbol> <x> <y> <z>").
+
+    @param lines: a list of strings, one per atom (line endings are ok).
+
+    @return: a tuple (symbols, positions), where symbols is a list of the
+             element symbols (strings) and positions is an (N,3) Numeric
+             Float array.
+
+    @raise XYZFormatError: if any line doesn't have exactly 4 fields,
+                           or has a coordinate which is not a number.
+                           The exception's index is the index of the
+                           first such line.
+    """
+    n = len(lines)
+    counts = [len(line.split()) for line in lines]
+    if counts != [4] * n:
+        for i in range(n):
+            if counts[i] != 4:
+                raise XYZFormatError('fields', index = i)
+        assert 0 # not reached
+    words = " ".join(lines).split() # (lines might lack their newlines)
+    symbols = words[0::4]
+    del words[0::4]
+    try:
+        coords = map(float, words)
+    except ValueError:
+        for i in range(n):
+            try:
+                map(float, lines[i].split()[1:])
+            except ValueError:
+                raise XYZFormatError('number', index = i)
+        raise # not reached
+    positions = Numeric.array(coords, Float)
+    positions.shape = (n, 3)
+    return symbols, positions
+
+def iter_xyz_frames(filename):
+    """
+    Generate the frames of a single- or multi-frame XYZ file, in order,
+    as tuples (comment, symbols, positions), where comment is the frame's
+    comment line (without its line ending), and symbols and positions are
+    as returned by parse_xyz_atom_lines.
+
+    Only one frame's lines are in memory at a time, so this works for
+    trajectories too big to read all at once. (Blank lines between frames,
+    or at the end of the file, are ignored.)
+
+    @raise XYZFormatError: if the file is malformed (with lineno set).
+    @raise IOError: if the file can't be opened or read.
+    """
+    f = open(filename, "rU")
+    try:
+        lineno = 0 # number of lines read so far
+        while 1:
+            line = f.readline()
+            if not line:
+                return
+            lineno += 1
+            if not line.strip():
+                continue
+            try:
+                natoms = int(line)
+            except ValueError:
+                raise XYZFormatError('header', lineno = lineno,
+                    msg = "%s: line %d: expected a number of atoms" % (filename, lineno))
+            comment = f.readline()
+            readline = f.readline
+            lines = [readline() for i in xrange(natoms)]
+                # (not islice(f, natoms), since in Python 2 file iteration
+                #  reads ahead, so it can't be mixed with readline)
+            if not comment or (lines and not lines[-1]):
+                raise XYZFormatError('header', lineno = lineno,
+                    msg = "%s: frame at line %d is truncated" % (filename, lineno))
+            try:
+                symbols, positions = parse_xyz_atom_lines(lines)
+            except XYZFormatError, e:
+                e.lineno = lineno + 2 + e.index
+                raise XYZFormatError(e.kind, e.index, e.lineno,
+                    msg = "%s: line %d: bad atom line" % (filename, e.lineno))
+            lineno += 1 + natoms
+            yield comment.rstrip("\r\n"), symbols, positions
+            continue
+    finally:
+        f.close()
+    pass
+
+# end
@@ -250,6 +250,8 @@ class Group(NodeWithAtomContents):
         this rule, but I think it does. ##k]
         """
         self.invalidate_atom_content() #bruce 080306
+        self._changed_undoable_state() # since self.members might have been
+            # modified in place
         if self.part:
             self.part.changed() # does assy.changed too
         elif self.assy:
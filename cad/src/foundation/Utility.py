@@ -33,6 +33,7 @@ from utilities import debug_flags
 import foundation.env as env
 from utilities.constants import genKey
 from foundation.state_utils import copy_val, StateMixin
+from foundation.undo_childobj_tracker import ChildobjChangeTrackingMixin
 from utilities.Log import redmsg, orangemsg
 from foundation.state_constants import S_PARENT, S_DATA, S_CHILD
 
@@ -86,7 +87,7 @@ _will_kill_count = 1
 
 # ==
 
-class Node( StateMixin):
+class Node( ChildobjChangeTrackingMixin, StateMixin):
     """
     Superclass for model components which can be displayed in the Model Tree.
     This is inherited by Groups, molecules (Chunks), Jigs, and some more
@@ -0,0 +1,495 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+posn_diff_blocks.py -- compact Undo diffs for atom positions
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+An Undo diff (state_utils.DiffObj) has one attrdict per attrcode, which
+maps objkeys to the values needed to turn one state into another.
+For Atom._posn, that means one dict item and one small Numeric array per
+moved atom, and the checkpoint, apply_and_reverse_diff and mash_attrs
+code all handle them one atom at a time -- which is slow and uses a lot
+of RAM when a command moves 10^5 atoms or more.
+
+When debug_pref_undo_posn_blocks() is true, the diff attrdict for Atom._posn
+is a PosnDiffBlocks instead, which stores the old positions of the atoms
+of each chunk as one block: a Numeric array of objkeys and an (n,3) array
+of positions. The changed atoms are found by comparing whole arrays, and
+Undo or Redo applies a block by storing rows of one array (after which
+undo_archive does the invalidations for each chunk, not for each atom).
+
+The StateSnapshot attrdict for Atom._posn is still an ordinary dict (from
+objkey to position), so the rest of the Undo code doesn't need to know
+about this, except for the few places which handle diff attrdicts
+(which check for PosnDiffBlocks).
+
+Running this file does a self-test, and a benchmark of checkpoint and
+undo of a 500k-atom move, done both ways.
+"""
+
+import Numeric
+from Numeric import Float, Int
+
+from foundation.state_constants import _UNSET_
+from utilities.debug_prefs import debug_pref, Choice_boolean_True
+
+def debug_pref_undo_posn_blocks():
+    res = debug_pref("Undo: record atom moves as array blocks?",
+                     Choice_boolean_True, # use False for one dict item per atom
+                     prefs_key = True
+                 )
+    return res
+
+def _posn_array(posns):
+    """
+    Return a new (n,3) Float array with the given n positions as rows.
+    """
+    res = Numeric.array(posns, Float)
+    assert res.shape == (len(posns), 3), \
+           "atom positions should be 3-vectors, not %r" % (res.shape,)
+    return res
+
+class PosnDiffBlocks:
+    """
+    A diff attrdict for an Atom position attrcode, which stores its values
+    in blocks of Numeric arrays rather than one dict item per atom.
+
+    Logically this is a dict from objkey to a position or _UNSET_.
+    It consists of a list of blocks (keys, posns), where keys is an Int
+    array of objkeys and posns is an (n,3) Float array of their positions,
+    or None if all their values are _UNSET_. A key in more than one block
+    (which only happens after update) has the value from the last one.
+
+    Items can also be stored one at a time, like in an ordinary diff
+    attrdict; they are made into blocks when the blocks are next needed.
+
+    The arrays in blocks are never modified, so blocks can be shared
+    between PosnDiffBlocks.
+    """
+    def __init__(self):
+        self._blocks = []
+        self._len = 0 # number of keys in self._blocks (with repeats)
+        self._items = {} # items stored since the last block was made
+
+    def __len__(self):
+        return self._len + len(self._items)
+
+    def __setitem__(self, key, val):
+        self._items[key] = val
+
+    def add_block(self, keys, posns):
+        """
+        Add a block which changes the keys in the Int array keys to the
+        positions in the (n,3) Float array posns (or to _UNSET_ if posns
+        is None). The arrays become owned by self and must not be modified.
+        """
+        if len(keys):
+            self._flush_items() # so they come before this block
+            self._blocks.append( (keys, posns) )
+            self._len += len(keys)
+        return
+
+    def _add_items(self, items):
+        """
+        Add a block (or two) for a list of (key, val) pairs, with distinct
+        keys, where each val is a position or _UNSET_.
+        """
+        posn_keys = []
+        posns = []
+        unset_keys = []
+        for key, val in items:
+            if val is _UNSET_:
+                unset_keys.append(key)
+            else:
+                posn_keys.append(key)
+                posns.append(val)
+        if posn_keys:
+            self._blocks.append( (Numeric.array(posn_keys, Int),
+                                  _posn_array(posns)) )
+        if unset_keys:
+            self._blocks.append( (Numeric.array(unset_keys, Int), None) )
+        self._len += len(items)
+        return
+
+    def _flush_items(self):
+        items = self._items
+        if items:
+            self._items = {}
+            self._add_items(items.items())
+        return
+
+    def blocks(self):
+        """
+        Return our list of blocks (for immediate use only; don't modify it).
+        """
+        self._flush_items()
+        return self._blocks
+
+    def update(self, other):
+        """
+        Add the items of other (a PosnDiffBlocks or an ordinary diff
+        attrdict) to self, replacing the values of keys we already have.
+        (Used by DiffObj.accumulate_diffs.)
+        """
+        if isinstance(other, PosnDiffBlocks):
+            self._flush_items()
+            for keys, posns in other.blocks():
+                self._blocks.append( (keys, posns) )
+                self._len += len(keys)
+        else:
+            self._items.update(other)
+        return
+
+    def as_dict(self):
+        """
+        Return an ordinary dict with the same items as self.
+        (This is slow, so it's only meant for debugging.)
+        """
+        res = {}
+        for keys, posns in self.blocks():
+            if posns is None:
+                res.update( dict.fromkeys(keys.tolist(), _UNSET_) )
+            else:
+                res.update( zip(keys.tolist(), posns) )
+        return res
+
+    def has_key(self, key):
+        return self.as_dict().has_key(key)
+
+    def __getitem__(self, key):
+        return self.as_dict()[key]
+
+    def iteritems(self):
+        return self.as_dict().iteritems()
+
+    def RAM_usage_guess(self):
+        """
+        Return a rough guess of our RAM consumption, in bytes.
+        """
+        res = 0
+        for keys, posns in self.blocks():
+            res += 100 + len(keys) * 8
+            if posns is not None:
+                res += 100 + len(posns) * 24
+        return res
+
+    def resolved(self):
+        """
+        Return (keys, posns), where keys is a list of the keys whose value
+        is a position (not _UNSET_), and posns is an array of those
+        positions, in the same order.
+
+        The posns array may be shared with self; the caller must copy it
+        before letting anything else own its rows.
+        """
+        blocks = self.blocks()
+        if len(blocks) == 1 and blocks[0][1] is not None:
+            # the usual case -- no need to look for repeated keys
+            keys, posns = blocks[0]
+            return keys.tolist(), posns
+        if not blocks:
+            return [], Numeric.zeros((0, 3), Float)
+        allkeys = []
+        allposns = []
+        isposn = []
+        for keys, posns in blocks:
+            n = len(keys)
+            allkeys.append(keys)
+            if posns is None:
+                allposns.append(Numeric.zeros((n, 3), Float))
+                isposn.append(Numeric.zeros(n, Int))
+            else:
+                allposns.append(posns)
+                isposn.append(Numeric.ones(n, Int))
+        allkeys = Numeric.concatenate(allkeys)
+        # for each key, the index of its last occurrence
+        # (a dict made from a sequence keeps the last value for each key)
+        last = dict(zip(allkeys.tolist(), xrange(len(allkeys))))
+        inds = last.values()
+        inds.sort() # not needed, but keeps the result in block order
+        inds = Numeric.array(inds, Int)
+        inds = Numeric.compress(Numeric.take(Numeric.concatenate(isposn), inds),
+                                inds)
+        return Numeric.take(allkeys, inds).tolist(), \
+               Numeric.take(Numeric.concatenate(allposns), inds, 0)
+
+    def apply_and_reverse(self, dictsnap):
+        """
+        Do what state_utils.apply_and_reverse_diff does for one attrdict:
+        store our values into dictsnap (a StateSnapshot attrdict, which
+        maps objkeys to positions, with no item meaning _UNSET_), and make
+        self hold the values they replaced, so that doing this again undoes
+        its effect.
+        """
+        reversed_blocks = []
+        get = dictsnap.get
+        for keys, posns in self.blocks():
+            keys_list = keys.tolist()
+            oldvals = [get(key, _UNSET_) for key in keys_list]
+            if posns is None:
+                pop = dictsnap.pop
+                for key in keys_list:
+                    pop(key, None)
+            else:
+                dictsnap.update( zip(keys_list, posns) )
+            rev = PosnDiffBlocks()
+            rev._add_items( zip(keys_list, oldvals) )
+            reversed_blocks.append(rev._blocks)
+        # if a key is in more than one block, the reversed blocks need to
+        # be applied in the reverse order to undo this
+        reversed_blocks.reverse()
+        self._blocks = []
+        self._len = 0
+        for blocks in reversed_blocks:
+            for keys, posns in blocks:
+                self._blocks.append( (keys, posns) )
+                self._len += len(keys)
+        return
+
+    pass # end of class PosnDiffBlocks
+
+def diff_posns_into_blocks(keys, posns, state_attrdict, diff):
+    """
+    Compare the current positions of some atoms (typically the changed
+    atoms of one chunk) to their positions in a StateSnapshot attrdict.
+    For the atoms whose positions differ, store copies of their current
+    positions into state_attrdict, and add a block of their old positions
+    (or of _UNSET_, for atoms not in state_attrdict) to diff.
+
+    This does for all these atoms at once what
+    state_utils.modify_and_diff_snap_for_changed_objects does (for each
+    attrcode) for one object.
+
+    @param keys: the objkeys of the atoms.
+    @type keys: list of ints
+
+    @param posns: their current positions (in the same order as keys).
+    @type posns: list of 3-vectors
+
+    @param state_attrdict: maps objkeys to positions (as copies not shared
+                           with the atoms), with no item meaning _UNSET_;
+                           modified by this function.
+
+    @param diff: where to record the old values.
+    @type diff: PosnDiffBlocks
+    """
+    n = len(keys)
+    if not n:
+        return
+    new = _posn_array(posns) # a copy; its rows become the stored values
+    get = state_attrdict.get
+    olds = [get(key, _UNSET_) for key in keys]
+    isnew = [old is _UNSET_ for old in olds]
+    anynew = True in isnew
+    if anynew:
+        # compare those atoms' positions to themselves; they're marked
+        # as changed below
+        for i in xrange(n):
+            if isnew[i]:
+                olds[i] = new[i]
+    old = _posn_array(olds)
+    changed = Numeric.sometrue(Numeric.not_equal(old, new), 1)
+    if anynew:
+        changed = Numeric.logical_or(changed, Numeric.array(isnew, Int))
+    inds = Numeric.nonzero(changed)
+    if not len(inds):
+        return
+    keys = Numeric.take(Numeric.array(keys, Int), inds)
+    state_attrdict.update( zip(keys.tolist(), Numeric.take(new, inds, 0)) )
+    if not anynew:
+        diff.add_block(keys, Numeric.take(old, inds, 0))
+    else:
+        isnew = Numeric.take(Numeric.array(isnew, Int), inds)
+        wasold = Numeric.logical_not(isnew)
+        diff.add_block( Numeric.compress(wasold, keys),
+                        Numeric.compress(wasold, Numeric.take(old, inds, 0), 0) )
+        diff.add_block( Numeric.compress(isnew, keys), None)
+    return
+
+# ==
+
+if __name__ == '__main__':
+    # self-test, and benchmark of checkpoint and undo of a big move
+    import random
+    import sys
+    import time
+    from foundation.state_utils import same_vals, copy_val
+    from geometry.VQT import V
+
+    class _Atom:
+        pass
+
+    def _dict_diff(state, items):
+        # like the per-object code in modify_and_diff_snap_for_changed_objects
+        diff = {}
+        for key, atom in items:
+            val = atom._posn
+            oldval = state.get(key, _UNSET_)
+            if not same_vals(oldval, val):
+                state[key] = copy_val(val)
+                diff[key] = oldval
+        return diff
+
+    def _dict_apply_and_reverse(diff, state):
+        # like apply_and_reverse_diff
+        for key, val in diff.iteritems():
+            oldval = state.get(key, _UNSET_)
+            if val is _UNSET_:
+                del state[key]
+            else:
+                state[key] = val
+            diff[key] = oldval
+        return
+
+    def _dict_mash(diff, obj4key):
+        # like differential mash_attrs
+        for key, val in diff.iteritems():
+            if val is not _UNSET_:
+                obj4key[key]._posn = copy_val(val)
+        return
+
+    def _blocks_diff(state, chunks):
+        diff = PosnDiffBlocks()
+        for items in chunks:
+            diff_posns_into_blocks([key for key, atom in items],
+                                   [atom._posn for key, atom in items],
+                                   state, diff)
+        return diff
+
+    def _blocks_mash(diff, obj4key):
+        # like undo_archive._mash_posn_blocks
+        keys, posns = diff.resolved()
+        posns = Numeric.array(posns)
+        for key, posn in zip(keys, posns):
+            obj4key[key]._posn = posn
+        return
+
+    def _make_atoms(nchunks, natoms):
+        obj4key = {}
+        chunks = []
+        key = 0
+        for i in range(nchunks):
+            items = []
+            for j in range(natoms):
+                key += 1
+                atom = _Atom()
+                atom._posn = V(random.random(), random.random(), i)
+                obj4key[key] = atom
+                items.append((key, atom))
+            chunks.append(items)
+        return obj4key, chunks
+
+    def _same_state(state1, state2):
+        assert state1.keys() == state2.keys() or \
+               sorted(state1.keys()) == sorted(state2.keys())
+        for key, val in state1.iteritems():
+            assert same_vals(val, state2[key]), (key, val, state2[key])
+        return
+
+    def _posns_of(chunks):
+        return [(key, tuple(atom._posn)) for items in chunks
+                for key, atom in items]
+
+    # self-test: random moves, new atoms and dead atoms, checked against
+    # the dict version, including accumulating diffs over several undos
+    random.seed(1)
+    obj4key, chunks = _make_atoms(10, 20)
+    state1 = {}
+    state2 = {}
+    _dict_diff(state1, [item for items in chunks for item in items])
+    _blocks_diff(state2, chunks)
+    _same_state(state1, state2)
+    history = [] # (dictdiff, blockdiff, posns before the change)
+    for step in range(20):
+        before = _posns_of(chunks)
+        for items in chunks:
+            for key, atom in random.sample(items, random.randint(0, 5)):
+                atom._posn = atom._posn + V(1, 0, random.random())
+        d1 = _dict_diff(state1, [item for items in chunks for item in items])
+        d2 = _blocks_diff(state2, chunks)
+        # some atoms die (their state becomes _UNSET_) ...
+        key = random.choice(chunks[0])[0]
+        if state1.has_key(key) and not d1.has_key(key):
+            d1[key] = state1.pop(key)
+            d2[key] = state2.pop(key)
+        _same_state(state1, state2)
+        assert len(d1) == len(d2)
+        assert sorted(d1.keys()) == sorted(d2.as_dict().keys())
+        history.append((d1, d2, before))
+    # undo several steps, in one accumulated mash and in single steps
+    for nsteps in (3, 1, 2):
+        acc1 = {}
+        acc2 = PosnDiffBlocks()
+        for i in range(nsteps):
+            d1, d2, before = history.pop()
+            acc1.update(d1)
+            acc2.update(d2)
+            _dict_apply_and_reverse(d1, state1)
+            d2.apply_and_reverse(state2)
+            _same_state(state1, state2)
+            assert sorted(d1.keys()) == sorted(d2.as_dict().keys())
+        keys, posns = acc2.resolved()
+        assert sorted(keys) == sorted([key for key, val in acc1.iteritems()
+                                       if val is not _UNSET_])
+        _blocks_mash(acc2, obj4key)
+        for key, val in acc1.iteritems():
+            if val is not _UNSET_:
+                assert same_vals(obj4key[key]._posn, val)
+        # redo the last of those steps and undo it again
+        _dict_apply_and_reverse(d1, state1)
+        d2.apply_and_reverse(state2)
+        _same_state(state1, state2)
+        _dict_apply_and_reverse(d1, state1)
+        d2.apply_and_reverse(state2)
+        _same_state(state1, state2)
+    print "self-test ok"
+
+    # benchmark: move 500k atoms (in 500 chunks), checkpoint, undo.
+    nchunks, natoms = 500, 1000
+    for label, make_diff, apply_and_reverse, mash in [
+        ("one dict item per atom:", _dict_diff,
+         _dict_apply_and_reverse, _dict_mash),
+        ("array blocks per chunk:", _blocks_diff,
+         lambda diff, state: diff.apply_and_reverse(state), _blocks_mash),
+     ]:
+        random.seed(2)
+        obj4key, chunks = _make_atoms(nchunks, natoms)
+        items = [item for items in chunks for item in items]
+        if make_diff is _dict_diff:
+            arg = items
+        else:
+            arg = chunks
+        state = {}
+        make_diff(state, arg) # initial checkpoint
+        offset = V(1.0, 2.0, 3.0)
+        for key, atom in items:
+            atom._posn = atom._posn + offset # the move
+        t0 = time.time()
+        diff = make_diff(state, arg)
+        t1 = time.time()
+        mash(diff, obj4key) # (undo mashes a copy made before the next line)
+        apply_and_reverse(diff, state)
+        t2 = time.time()
+        assert len(diff) == nchunks * natoms
+        assert same_vals(obj4key[1]._posn, state[1])
+        msg = "%s checkpoint %.2f sec, undo %.2f sec" % \
+              (label, t1 - t0, t2 - t1)
+        # Estimate the diff's RAM usage: for the dict, sys.getsizeof of
+        # the dict and its values; for the blocks, that of their arrays
+        # plus their data (which getsizeof might or might not include).
+        if make_diff is _dict_diff:
+            ram = sys.getsizeof(diff)
+            for val in diff.itervalues():
+                ram += sys.getsizeof(val)
+        else:
+            ram = 0
+            for keys, posns in diff.blocks():
+                ram += sys.getsizeof(keys) + sys.getsizeof(posns) + \
+                       len(keys) * (8 + 24)
+        msg += ", diff RAM about %.1f MB" % (ram / 1e6)
+        print msg
+    pass
+
+# end
@@ -83,6 +83,8 @@ UNDO_SPECIALCASE_BOND = 'UNDO_SPECIALCASE_BOND'
 
 ATOM_CHUNK_ATTRIBUTE_NAME = 'molecule' # must match the Atom.molecule attrname
 
+ATOM_POSN_ATTRIBUTE_NAME = '_posn' # must match the Atom._posn attrname
+
 # ==
 
 # Note: _UNSET_class should inherit from IdentityCopyMixin, but that would
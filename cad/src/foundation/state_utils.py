@@ -166,16 +166,23 @@ from foundation.state_constants import S_REF, S_REFS
 from foundation.state_constants import S_PARENT, S_PARENTS
 from foundation.state_constants import UNDO_SPECIALCASE_ATOM, UNDO_SPECIALCASE_BOND
 from foundation.state_constants import ATOM_CHUNK_ATTRIBUTE_NAME
+from foundation.state_constants import ATOM_POSN_ATTRIBUTE_NAME
 from foundation.state_constants import _UNSET_, _Bugval
 
 import foundation.env as env
-from utilities.debug import print_compact_stack
+from utilities.debug import print_compact_stack, safe_repr
 from utilities import debug_flags
 from utilities.Comparison import same_vals, SAMEVALS_SPEEDUP
 from utilities.constants import remove_prefix
 
 from utilities.GlobalPreferences import debug_pyrex_atoms
 
+from foundation.posn_diff_blocks import PosnDiffBlocks
+from foundation.posn_diff_blocks import diff_posns_into_blocks
+from foundation.posn_diff_blocks import debug_pref_undo_posn_blocks
+from foundation.undo_childobj_tracker import debug_pref_undo_track_childobj_changes
+from foundation.undo_childobj_tracker import debug_pref_undo_verify_childobj_changes
+
 DEBUG_PYREX_ATOMS = debug_pyrex_atoms()
 
 ### TODO:
@@ -481,6 +488,7 @@ class InstanceClassification(Classification): #k used to be called StateHolderIn
             # attrcode will be distinct whenever dflt value differs (and maybe more often) [as of 060330]
         self.dict_of_all_state_attrcodes = {}
         self.dict_of_all_Atom_chunk_attrcodes = {} #bruce 071104 kluge
+        self.dict_of_all_Atom_posn_attrcodes = {} # similar, for Atom._posn
         self.attrcodes_with_undo_setattr = {} #060404, maps the attrcodes to an arbitrary value (only the keys are currently used)
         self.categories = {} # (public) categories (e.g. 'selection', 'view') for attrs which declare them using _s_categorize_xxx
         self.attrlayers = {} # (public) similar [060404]
@@ -611,6 +619,9 @@ class InstanceClassification(Classification): #k used to be called StateHolderIn
                     if specialcase_type == UNDO_SPECIALCASE_ATOM and \
                        attr_its_about == ATOM_CHUNK_ATTRIBUTE_NAME:
                         self.dict_of_all_Atom_chunk_attrcodes[ attrcode ] = None #071114
+                    if specialcase_type == UNDO_SPECIALCASE_ATOM and \
+                       attr_its_about == ATOM_POSN_ATTRIBUTE_NAME:
+                        self.dict_of_all_Atom_posn_attrcodes[ attrcode ] = None
                 pass
             elif name == '_s_isPureData': # note: exact name (not a prefix), and doesn't end with '_'
                 self.warn = False # enough to be legitimate data
@@ -1461,13 +1472,57 @@ class DiffObj:
         # and we also need to include the overhead of the entire dict item in our attrdict),
         # and the guesses ought to come from the attr decls anyway, not be
         # hardcoded here (or in future we could measure them in a C-coded copy_val).
+    _packed = None # a PackedDiff (see undo_diff_store.py) while we're packed
     def __init__(self, attrdicts = None):
         self.attrdicts = attrdicts or {}
+    def __getattr__(self, attr):
+        # self.attrdicts is absent only while we're packed;
+        # unpack when anything asks for it
+        if attr == 'attrdicts' and self._packed is not None:
+            self.unpack()
+            return self.attrdicts
+        raise AttributeError, attr
+    def pack(self, store):
+        """
+        Replace our attrdicts with a compressed copy in store
+        (an undo_diff_store.DiffStore); they will be unpacked when next
+        needed. Do nothing if we're already packed or can't be packed.
+        """
+        if self._packed is None:
+            packed = store.pack(self.attrdicts, self.size())
+            if packed is not None:
+                self._packed = packed
+                del self.attrdicts
+        return
+    def spill(self):
+        """
+        If we're packed, move our packed data into our store's file.
+        """
+        if self._packed is not None:
+            self._packed.spill()
+        return
+    def unpack(self):
+        if self._packed is not None:
+            self.attrdicts = self._packed.unpack()
+            self._packed = None
+        return
+    def storage_desc(self):
+        """
+        Return "" if our attrdicts are in RAM as usual,
+        or "compressed" or "on disk" if we're packed.
+        """
+        if self._packed is None:
+            return ""
+        elif self._packed.on_disk():
+            return "on disk"
+        return "compressed"
     def size(self): ### shares code with StateSnapshot; use common superclass?
         """
         return the total number of attribute value differences we're
         storing (over all objects and all attrnames)
         """
+        if self._packed is not None:
+            return self._packed.size
         res = 0
         for d in self.attrdicts.itervalues():
             res += len(d)
@@ -1476,8 +1531,13 @@ class DiffObj:
         """
         return a rough guess of our RAM consumption
         """
+        if self._packed is not None:
+            return self._packed.RAM_usage_guess()
         res = 0
         for attrcode, d in self.attrdicts.iteritems():
+            if isinstance(d, PosnDiffBlocks):
+                res += d.RAM_usage_guess()
+                continue
             attr, acode_unused = attrcode
             valsize = self.attrname_valsizes.get(attr, 24) # it's a kluge to use attr rather than attrcode here
                 # 24 is a guess, and is conservative: 2 pointers in dict item == 8, 2 small pyobjects (8 each??)
@@ -1506,7 +1566,13 @@ class DiffObj:
         dicts1 = self.attrdicts
         for attrcode, d2 in dicts2.iteritems():
             d1 = dicts1.setdefault(attrcode, {})
+            if isinstance(d2, PosnDiffBlocks) and not isinstance(d1, PosnDiffBlocks):
+                # (PosnDiffBlocks.update can also add a dict's items)
+                d0 = d1
+                d1 = dicts1[attrcode] = PosnDiffBlocks()
+                d1.update(d0)
             d1.update(d2) # even if d1 starts out {}, it's important to copy d2 here, not share it
+                # (PosnDiffBlocks shares d2's blocks, but they're never modified)
         return
     pass
 
@@ -1617,14 +1683,31 @@ def diff_and_copy_state(archive, assy, priorstate): #060228 (#e maybe this is re
     assert isinstance(lastsnap, StateSnapshot) # remove when works, eventually ###@@@
     # now we own lastsnap, and we'll modify it to agree with actual current state, and record the changes required to undo this...
     # 060329: this (to end of function) is where we have to do things differently when we only want to scan changed objects.
-    # So we do the old full scan for most kinds of things, but not for the 'atoms layer' (atoms, bonds, Chunk.atoms attr).
-    import foundation.undo_archive as undo_archive #e later, we'll inline this until we reach a function in this file
-    cursnap = undo_archive.current_state(archive, assy, use_060213_format = True, exclude_layers = ('atoms',)) # cur state of child objs
+    # The 'atoms layer' (atoms, bonds, Chunk.atoms attr) is always change-tracked. The other child objects are too,
+    # if our archive's childobj_tracker is valid; otherwise we do the old full scan for them, which makes it valid.
     lastsnap_diffscan_layers = lastsnap.extract_layers( ('atoms',) ) # prior state of atoms & bonds, leaving only childobjs in lastsnap
-    diffobj = diff_snapshots_oneway( cursnap, lastsnap ) # valid for everything except the 'atoms layer' (atoms & bonds)
-    ## lastsnap.become_copy_of(cursnap) -- nevermind, just use cursnap
-    lastsnap = cursnap
-    del cursnap
+    tracker = archive.childobj_tracker
+    if tracker.valid and debug_pref_undo_track_childobj_changes():
+        diffobj = DiffObj()
+        try:
+            modify_and_diff_snap_for_changed_childobjs( archive, lastsnap, diffobj )
+        except:
+            tracker.invalidate()
+            raise
+        if debug_pref_undo_verify_childobj_changes():
+            lastsnap = _verify_changed_childobjs( archive, assy, lastsnap, diffobj )
+        lastsnap._childobj_dict = tracker.live # valid until we next steal lastsnap
+    else:
+        archive.get_and_clear_changed_childobjs(want_retval = False) # the scan will see those changes
+        cursnap = _scan_childobjs_state(archive, assy) # cur state of child objs
+        diffobj = diff_snapshots_oneway( cursnap, lastsnap ) # valid for everything except the 'atoms layer' (atoms & bonds)
+        ## lastsnap.become_copy_of(cursnap) -- nevermind, just use cursnap
+        lastsnap = cursnap
+        del cursnap
+        if debug_pref_undo_track_childobj_changes():
+            tracker.rebuild( assy, lastsnap._childobj_dict )
+        else:
+            tracker.invalidate()
 
     modify_and_diff_snap_for_changed_objects( archive, lastsnap_diffscan_layers, ('atoms',), diffobj, lastsnap._childobj_dict ) #060404
 
@@ -1634,6 +1717,106 @@ def diff_and_copy_state(archive, assy, priorstate): #060228 (#e maybe this is re
     new.really_changed = not not diffobj.nonempty() # remains correct even when new's definitional content changes
     return new
 
+def _scan_childobjs_state(archive, assy):
+    """
+    Return a StateSnapshot of the current state of all child objects
+    reachable from assy, excluding the 'atoms layer', found by a full scan.
+    """
+    import foundation.undo_archive as undo_archive #e later, we'll inline this until we reach a function in this file
+    return undo_archive.current_state(archive, assy, use_060213_format = True, exclude_layers = ('atoms',))
+
+def modify_and_diff_snap_for_changed_childobjs( archive, lastsnap, diffobj ):
+    """
+    Get the set of changed child objects from (our sub to) their changedict,
+    and clear it. Use it (via archive.childobj_tracker) to find the child
+    objects which became live or dead, and modify lastsnap (which must not
+    contain the 'atoms layer') to agree with the current state of all the
+    changed, new and dead objects, recording the diffs from that into
+    diffobj. (For each changed value, like diff_snapshots_oneway, we record
+    the value it had in lastsnap, or _UNSET_.)
+    """
+    chgd_objs = archive.get_and_clear_changed_childobjs()
+    changed_live, new, dead = archive.childobj_tracker.update( chgd_objs )
+    if env.debug():
+        print "\nchanged child objects: %d (of %d changed, %d new, %d dead)" % \
+              (len(changed_live), len(chgd_objs), len(new), len(dead))
+    keyknower = archive.objkey_allocator
+    classify_instance = archive.obj_classifier.classify_instance
+    attrdicts = lastsnap.attrdicts
+    diff_attrdicts = diffobj.attrdicts
+    exclude_layers = ('atoms',)
+    def store(attrcode, key, val): # val is _UNSET_ when no value should be stored
+        attrdict = attrdicts.get(attrcode)
+        if attrdict is None:
+            attrdict = attrdicts[attrcode] = {}
+        oldval = attrdict.get(key, _UNSET_)
+        if not same_vals(val, oldval):
+            diff_attrdicts.setdefault(attrcode, {})[key] = oldval
+            if val is _UNSET_:
+                del attrdict[key]
+            else:
+                attrdict[key] = copy_val(val)
+        return
+    # this loop does what collect_state does for a full snapshot
+    key4obj = keyknower.key4obj_maybe_new
+    for objs in (changed_live, new):
+        for obj in objs.itervalues():
+            key = key4obj(obj)
+            clas = classify_instance(obj)
+            for attrcode, dflt in clas.attrcode_dflt_pairs:
+                attr, acode_unused = attrcode
+                if clas.exclude(attr, exclude_layers):
+                    continue
+                val = getattr(obj, attr, dflt)
+                if val is dflt:
+                    val = _UNSET_ # collect_state wouldn't store it
+                store(attrcode, key, val)
+            for attrcode in clas.attrcodes_with_no_dflt:
+                attr, acode_unused = attrcode
+                if clas.exclude(attr, exclude_layers):
+                    continue
+                store(attrcode, key, getattr(obj, attr, _Bugval))
+    # dead objects' values are absent from a full snapshot
+    key4obj = keyknower.key4obj
+    for obj in dead.itervalues():
+        key = key4obj(obj)
+        if key is None:
+            continue # can't happen, since it was in lastsnap
+        clas = classify_instance(obj)
+        for attrcode, dflt_unused in clas.attrcode_dflt_pairs:
+            store(attrcode, key, _UNSET_)
+        for attrcode in clas.attrcodes_with_no_dflt:
+            store(attrcode, key, _UNSET_)
+    return
+
+def _verify_changed_childobjs( archive, assy, lastsnap, diffobj ):
+    """
+    [debugging aid]
+    Compare lastsnap, as just modified by
+    modify_and_diff_snap_for_changed_childobjs, with a full scan of the
+    current state, and print a bug message for each difference (which means
+    some code changed undoable state without telling Undo). Then fix
+    diffobj, rebuild archive.childobj_tracker, and return the full scan's
+    snapshot, to use in place of lastsnap.
+    """
+    cursnap = _scan_childobjs_state(archive, assy)
+    missed = diff_snapshots(cursnap, lastsnap, whatret = 2)
+    live = archive.childobj_tracker.live
+    obj4key = archive.objkey_allocator.obj4key
+    for attrcode, attrdict in missed.iteritems():
+        diffdict = diffobj.attrdicts.setdefault(attrcode, {})
+        for key, oldval in attrdict.iteritems():
+            print "bug: undo missed a change to %r of %s" % \
+                  (attrcode[0], safe_repr(obj4key.get(key)))
+            diffdict.setdefault(key, oldval)
+    childobj_dict = cursnap._childobj_dict
+    if len(childobj_dict) != len(live) or \
+       [id1 for id1 in childobj_dict if not live.has_key(id1)]:
+        print "bug: undo's childobj_tracker had %d live objects, should " \
+              "have %d" % (len(live), len(childobj_dict))
+    archive.childobj_tracker.rebuild( assy, childobj_dict )
+    return cursnap
+
 def modify_and_diff_snap_for_changed_objects( archive, lastsnap_diffscan_layers, layers, diffobj, childobj_dict ): #060404
     #e rename lastsnap_diffscan_layers
     """
@@ -1688,12 +1871,24 @@ def modify_and_diff_snap_for_changed_objects( archive, lastsnap_diffscan_layers,
     ## print "changed_live = %s, changed_dead = %s" % (changed_live,changed_dead)
     key4obj = keyknower.key4obj_maybe_new
     diff_attrdicts = diffobj.attrdicts
+    # If posn_attrcodes is not empty, we diff the values of those attrcodes
+    # (Atom._posn) in blocks for each chunk, and record their diffs as
+    # PosnDiffBlocks rather than as dicts.
+    posn_attrcodes = {}
+    if debug_pref_undo_posn_blocks():
+        posn_attrcodes = archive.obj_classifier.dict_of_all_Atom_posn_attrcodes
     for attrcode in archive.obj_classifier.dict_of_all_state_attrcodes.iterkeys():
         acode = attrcode[1]
         ## if acode in ('Atom', 'Bond'):
         if _KLUGE_acode_is_special_for_extract_layers(acode):
+            if posn_attrcodes.has_key(attrcode):
+                diff_attrdicts.setdefault(attrcode, PosnDiffBlocks())
+                continue
             diff_attrdicts.setdefault(attrcode, {}) # this makes some diffs too big, but speeds up our loops ###k is it ok??
             # if this turns out to cause trouble, just remove these dicts at the end if they're still empty
+    posns_by_chunk = {}
+        # maps (attrcode, id(chunk)) to (attrcode, keys, posns) for the atoms
+        # of that chunk whose posn attrcode values are diffed as a block
     state_attrdicts = lastsnap_diffscan_layers.attrdicts
     objclsfr = archive.obj_classifier
     ci = objclsfr.classify_instance
@@ -1725,6 +1920,14 @@ def modify_and_diff_snap_for_changed_objects( archive, lastsnap_diffscan_layers,
         del dflt
         for attrcode in clas.attrcodes_with_no_dflt:
             attr, acode_unused = attrcode
+            if posn_attrcodes.has_key(attrcode):
+                chunk = getattr(obj, ATOM_CHUNK_ATTRIBUTE_NAME, None)
+                block = posns_by_chunk.get( (attrcode, id(chunk)) )
+                if block is None:
+                    block = posns_by_chunk[ (attrcode, id(chunk)) ] = (attrcode, [], [])
+                block[1].append(key)
+                block[2].append(getattr(obj, attr))
+                continue
             state_attrdict = state_attrdicts[attrcode]
             val = getattr(obj, attr, _Bugval)
             oldval = state_attrdict.get(key, _UNSET_) # not sure if _UNSET_ can happen, in this no-dflt case
@@ -1740,6 +1943,10 @@ def modify_and_diff_snap_for_changed_objects( archive, lastsnap_diffscan_layers,
                 diff_attrdict[key] = oldval #k if this fails, just use setdefault with {}
         attrcode = None
         del attrcode
+    for attrcode, keys, posns in posns_by_chunk.itervalues():
+        diff_posns_into_blocks( keys, posns, state_attrdicts[attrcode],
+                                diff_attrdicts[attrcode] )
+    posns_by_chunk = None
     for idobj, obj in changed_dead.iteritems():
         #e if we assumed these all have same clas, we could invert loop order and heavily optimize
         key = key4obj(obj)
@@ -1858,13 +2065,27 @@ class StatePlace:
         self.get_snap_back_to_self(accum_diffobj = accum_diffobj)
         return accum_diffobj.attrdicts #e might be better to get more methods into diffobj and then return diffobj here
 
+    def diff_to_or_from(self, otherplace):
+        """
+        If self is defined by a diff from otherplace, or vice versa,
+        return that DiffObj; otherwise return None.
+        (Either way, that diff is what converts between our states.)
+        """
+        if self.diff_and_place is not None and self.diff_and_place[1] is otherplace:
+            return self.diff_and_place[0]
+        if otherplace.diff_and_place is not None and otherplace.diff_and_place[1] is self:
+            return otherplace.diff_and_place[0]
+        return None
     def _relative_RAM(self, priorplace): #060323
         """
         Return a guess about the RAM requirement of retaining the diff data to let this state
         be converted (by Undo) into the state represented by priorplace, also a StatePlace (??).
-        Temporary kluge: this must only be called at certain times, soon after self finalized... not sure of details.
+        (This is 0 when the diff is not direct, e.g. when priorplace is self.)
         """
-        return 18 # stub
+        diff = self.diff_to_or_from(priorplace)
+        if diff is None:
+            return 0
+        return diff.RAM_usage_guess()
     pass # end of class StatePlace
 
 def apply_and_reverse_diff(diff, snap):
@@ -1877,7 +2098,7 @@ def apply_and_reverse_diff(diff, snap):
     """
     for attrcode, dict1 in diff.attrdicts.items():
         dictsnap = snap.attrdicts.setdefault(attrcode, {})
-        if 1:
+        if not isinstance(dict1, PosnDiffBlocks):
             # if no special diff restoring func for this attrcode:
             for key, val in dict1.iteritems():
                 # iteritems is ok, though we modify dict1, since we don't add or remove items (though we do in dictsnap)
@@ -1891,7 +2112,11 @@ def apply_and_reverse_diff(diff, snap):
                     # whether or not oldval is _UNSET_, it indicates a diff, so we have to retain the item
                     # in dict1 or we'd think it was a non-diff at that key!
         else:
-            pass # use some specialized diff restoring func for this attrcode...
+            # a diff attrdict for Atom._posn, stored as blocks of arrays
+            # (see posn_diff_blocks.py), knows how to do this itself
+            dict1.apply_and_reverse(dictsnap)
+            # older comments about doing this in general:
+            # use some specialized diff restoring func for this attrcode...
             # this was WHERE I AM 060309 3:39pm.
             # [note, 060407: the feature of attrcodes with specialized diff-finding or restoring functions
             #  might still be useful someday, but turned out to be not needed for A7 and is unfinished
@@ -1939,6 +2164,7 @@ class obj_classifier:
             #  InstanceType/InstanceLike, for now) to Classifications
         self.dict_of_all_state_attrcodes = {} # maps attrcodes to arbitrary values, for all state-holding attrs ever declared to us
         self.dict_of_all_Atom_chunk_attrcodes = {} # same, only for attrcodes for .molecule attribute of UNDO_SPECIALCASE_ATOM classes
+        self.dict_of_all_Atom_posn_attrcodes = {} # same, only for attrcodes for ._posn attribute of UNDO_SPECIALCASE_ATOM classes
         self.attrcodes_with_undo_setattr = {} # see doc in clas
         return
 
@@ -1982,6 +2208,7 @@ class obj_classifier:
             clas = self._clas_for_class[class1] = InstanceClassification(class1)
             self.dict_of_all_state_attrcodes.update( clas.dict_of_all_state_attrcodes )
             self.dict_of_all_Atom_chunk_attrcodes.update( clas.dict_of_all_Atom_chunk_attrcodes )
+            self.dict_of_all_Atom_posn_attrcodes.update( clas.dict_of_all_Atom_posn_attrcodes )
             self.attrcodes_with_undo_setattr.update( clas.attrcodes_with_undo_setattr )
 #bruce 060330 not sure if the following can be fully zapped, though most of it can. Not sure how "cats" are used yet...
 # wondering if acode should be classname. ###@@@
@@ -14,6 +14,7 @@ providing undo/redo ops which apply those diffs to the model state.
 """
 
 import time
+import Numeric
 from utilities import debug_flags
 from utilities.debug import print_compact_traceback, print_compact_stack, safe_repr
 from utilities.debug_prefs import debug_pref, Choice_boolean_False, Choice_boolean_True
@@ -26,6 +27,11 @@ from foundation.state_utils import transclose, StatePlace, StateSnapshot
 from foundation.state_constants import _UNSET_
 from foundation.state_constants import UNDO_SPECIALCASE_ATOM, UNDO_SPECIALCASE_BOND
 from foundation.state_constants import ATOM_CHUNK_ATTRIBUTE_NAME
+from foundation.posn_diff_blocks import PosnDiffBlocks
+from foundation.undo_diff_store import DiffStore, debug_pref_undo_memory_budget
+from foundation.undo_diff_store import describe_nbytes
+from foundation.undo_childobj_tracker import ChildobjTracker
+from foundation.undo_childobj_tracker import _changed_childobjs
 
 from utilities.prefs_constants import historyMsgSerialNumber_prefs_key
 from foundation.changes import register_postinit_object
@@ -306,17 +312,20 @@ def assy_become_scanned_state(archive, assy, stateplace):
             #  or to its being commented out!],
             # described elsewhere -- search for 'oldmols' and this date 060409
         invalmols = {}
+        moved_atoms = {}
         mash_attrs( archive, attrdicts, modified, invalmols,
-                    differential = True )
+                    differential = True, moved_atoms = moved_atoms )
         _fix_all_chunk_atomsets_differential( invalmols)
         _call_undo_update( modified)
             # it needs to only call it for live objects! so we only pass them.
+        _call_undo_update_moved_atoms( moved_atoms, modified)
         call_registered_undo_updaters( archive)
         final_post_undo_updates( archive)
 
     return # from assy_become_scanned_state
 
-def mash_attrs( archive, attrdicts, modified, invalmols, differential = False ):
+def mash_attrs( archive, attrdicts, modified, invalmols, differential = False,
+                moved_atoms = None ):
     #060409 added differential = True support
     """
     [private helper for assy_become_scanned_state:]
@@ -339,6 +348,12 @@ def mash_attrs( archive, attrdicts, modified, invalmols, differential = False ):
     @type invalmols: a mutable dictionary which maps id(mol) -> mol, where
                      mol can be any object found or stored as atom.molecule,
                      which has an .atoms dict (i.e. a Chunk).
+
+    @param moved_atoms: if provided, a dictionary to which we should add
+                        (objkey -> atom) the atoms whose positions we set
+                        from a PosnDiffBlocks in attrdicts, rather than
+                        adding them to modified (see
+                        _call_undo_update_moved_atoms).
     """
     # use undotted localvars, for faster access in inner loop:
     modified_get = modified.get
@@ -356,6 +371,15 @@ def mash_attrs( archive, attrdicts, modified, invalmols, differential = False ):
     for attrcode, dict1 in attrdicts.items():
         ##e review: items might need to be processed in a specific order
         attr, acode = attrcode
+        if isinstance(dict1, PosnDiffBlocks):
+            # atom positions (only in differential diffs); record the
+            # atoms in moved_atoms (if provided) rather than modified,
+            # so their updates can be done once for each chunk
+            if moved_atoms is None:
+                _mash_posn_blocks( archive, attr, dict1, modified)
+            else:
+                _mash_posn_blocks( archive, attr, dict1, moved_atoms)
+            continue
         might_have_undo_setattr = attrcodes_with_undo_setattr.has_key(attrcode)
             #060404; this matters now (for hotspot)
         for key, val in dict1.iteritems(): # maps objkey to attrval
@@ -466,6 +490,27 @@ def mash_attrs( archive, attrdicts, modified, invalmols, differential = False ):
 
 # ==
 
+def _mash_posn_blocks(archive, attr, posn_blocks, modified):
+    """
+    Private helper for mash_attrs: set attr (the position attribute of
+    atoms) from the values in posn_blocks, a PosnDiffBlocks (with values
+    relative to the current state, as for differential mash_attrs),
+    and record the atoms we set in modified (objkey -> atom).
+    """
+    obj4key = archive.obj4key
+    keys, posns = posn_blocks.resolved()
+    posns = Numeric.array(posns)
+        # a copy, so the atoms can own its rows (in one vectorized copy,
+        # rather than one copy_val per atom)
+    for key, posn in zip(keys, posns):
+        obj = obj4key[key]
+        setattr(obj, attr, posn)
+        modified[key] = obj
+        if obj is _undo_debug_obj:
+            _undo_debug_message("undo/redo: %r.%s = %r (from a block)" %
+                                (obj, attr, posn))
+    return
+
 def _mash_attrs_Atom_chunk(key, obj, attrname, val, modified, invalmols):
     """
     Special case for differential mash_attrs when changing an
@@ -754,6 +799,42 @@ def _fix_all_chunk_atomsets_differential(invalmols):
                     # testing. [060409]
     return
 
+def _call_undo_update_moved_atoms(moved_atoms, modified):
+    """
+    [private helper for assy_become_scanned_state:]
+    Do the updates needed for the atoms whose positions were set from
+    a PosnDiffBlocks by mash_attrs (passed in the <moved_atoms> arg).
+    Atoms which are also in <modified> are skipped, since their
+    _undo_update method (which _call_undo_update has already called)
+    does those updates. For the others, only their positions changed,
+    so we let each of their chunks do the updates for all of its moved
+    atoms at once, using its _f_undo_update_atom_posns method (if it has
+    one; if not, we call their _undo_update methods).
+    """
+    atoms_by_chunk = {} # id(chunk) -> (chunk, list of its moved atoms)
+    for key, atom in moved_atoms.iteritems():
+        if modified.has_key(key):
+            continue
+        chunk = getattr(atom, ATOM_CHUNK_ATTRIBUTE_NAME)
+        chunk_atoms = atoms_by_chunk.get(id(chunk))
+        if chunk_atoms is None:
+            chunk_atoms = atoms_by_chunk[id(chunk)] = (chunk, [])
+        chunk_atoms[1].append(atom)
+    for chunk, atoms in atoms_by_chunk.itervalues():
+        try:
+            method = chunk._f_undo_update_atom_posns
+        except AttributeError:
+            _call_undo_update( dict([(id(atom), atom) for atom in atoms]) )
+        else:
+            try:
+                method(atoms)
+            except:
+                msg = "exception in _f_undo_update_atom_posns for %s; " \
+                      "skipping it: " % safe_repr(chunk)
+                print_compact_traceback( msg)
+                pass
+    return
+
 def _call_undo_update(modified):
     #060409 for differential mash_attrs, it's safe, but are the objs it's
     # called on enough? #####@@@@@
@@ -1019,6 +1100,34 @@ class SimpleDiff:
         s1 = self.cps[1].state
         s0 = self.cps[0].state
         return s0._relative_RAM(s1)
+    def diffobj(self):
+        """
+        Return the DiffObj which converts between our checkpoints' states,
+        or None if there isn't one (e.g. if we're destroyed, or our
+        checkpoints are not yet complete).
+        """
+        if self.destroyed:
+            return None
+        cp0, cp1 = self.cps
+        if not (cp0.complete and cp1.complete):
+            return None
+        return cp0.state.diff_to_or_from(cp1.state)
+    def memory_desc(self):
+        """
+        Describe the memory used to keep this undoable step,
+        e.g. "undo data: 12 KB", or "undo data: 3 KB compressed",
+        or return "" if we don't know.
+        """
+        diff = self.diffobj()
+        if diff is None:
+            return ""
+        storage = diff.storage_desc()
+        if storage == "on disk":
+            return "undo data: on disk"
+        res = "undo data: %s" % describe_nbytes(diff.RAM_usage_guess())
+        if storage:
+            res += " " + storage
+        return res
     def reverse_order(self):#####@@@@@ what if merged??
         return self.__class__(self.cps[1], self.cps[0], - self.direction, **self.options)
     def you_have_been_offered(self): #bruce 060326 re bug 1733
@@ -1464,6 +1573,10 @@ class AssyUndoArchive: # modified from UndoArchive_older and AssyUndoArchive_old
 
         self.obj_classifier = obj_classifier()
 
+        self.childobj_tracker = ChildobjTracker(self.obj_classifier)
+            # knows the live child objects and their child links, between
+            # checkpoints which don't need to scan for them
+
         self.objkey_allocator = oka = objkey_allocator()
         self.obj4key = oka.obj4key # public attr, maps keys -> objects
             ####@@@@ does this need to be the same as atom keys? not for now, but maybe yes someday... [060216]
@@ -1482,7 +1595,11 @@ class AssyUndoArchive: # modified from UndoArchive_older and AssyUndoArchive_old
         ## self.all_changed_objs = {} # this one dict subscribes to all changes on all attrs of all classes of object (for now)
         self.all_changed_Atoms = {} # atom.key -> atom, for all changed Atoms (all attrs lumped together; this could be changed)
         self.all_changed_Bonds = {} # id(bond) -> bond, for all changed Bonds (all attrs)
-        self.ourdicts = (self.all_changed_Atoms, self.all_changed_Bonds,) #e use this more
+        self.all_changed_Childobjs = {} # id(obj) -> obj, for all changed child objects
+            # which track their own changes (see undo_childobj_tracker.py)
+        self.ourdicts = (self.all_changed_Atoms, self.all_changed_Bonds,
+                         self.all_changed_Childobjs) #e use this more
+        self._diff_store = DiffStore() # for diffs packed to keep within the undo memory budget
         # rest of init is done later, by self.initial_checkpoint, when caller is more ready [060223]
         ###e not sure were really initialized enough to return... we'll see
         return
@@ -1535,6 +1652,8 @@ class AssyUndoArchive: # modified from UndoArchive_older and AssyUndoArchive_old
         self.current_diff = None
         self.next_cp = None
         self.stored_ops = {}
+        self._diff_store.close()
+        self._diff_store = DiffStore()
         self.objkey_allocator.clear() # after this, all existing keys (in diffs or checkpoints) are nonsense...
         # ... so we'd better get rid of them (above and here):
         self._undo_archive_initialized = False
@@ -1580,6 +1699,7 @@ class AssyUndoArchive: # modified from UndoArchive_older and AssyUndoArchive_old
             #e note, self.last_cp will be augmented by a desc of varid_vers pairs about cur state;
             # but for out of order redo, we get to old varid_vers pairs but new cp's; maybe there's a map from one to the other...
             ###k was this part of UndoManager in old code scheme? i think it was grabbed out of actual model objects in UndoManager.
+        self.childobj_tracker.invalidate() # the next checkpoint will rebuild it
         self.sub_or_unsub_changedicts(False) # in case we've been called before (kluge)
         self._changedicts = [] # ditto
         self.sub_or_unsub_changedicts(True)
@@ -1592,6 +1712,12 @@ class AssyUndoArchive: # modified from UndoArchive_older and AssyUndoArchive_old
     def setup_changedicts(self):
         assert not self._changedicts, "somehow setup_changedicts got called twice, since we already have some, "\
                "and calling code didn't kluge this to be ok like it does in initial_checkpoint in case it's called from self._clear"
+        # child objects (Nodes etc) all use one changedict, which doesn't
+        # depend on their class
+        self._changedicts.append( (_changed_childobjs, self.all_changed_Childobjs) )
+        if self.subbing_to_changedicts_now:
+            self.sub_or_unsub_to_one_changedict(True, _changed_childobjs,
+                                                self.all_changed_Childobjs)
         register_postinit_object( '_archive_meet_class', self )
             # this means we are ready to receive callbacks (now and later) on self._archive_meet_class,
             # telling us about new classes whose instances we might want to changetrack
@@ -1823,6 +1949,22 @@ class AssyUndoArchive: # modified from UndoArchive_older and AssyUndoArchive_old
         self.all_changed_Bonds.clear()
         return res
 
+    def get_and_clear_changed_childobjs(self, want_retval = True):
+        """
+        Clear, and (unless want_retval is false) return a copy of,
+        the dict (id -> obj) of changed child objects (those which track
+        their own changes, like Nodes).
+        """
+        for changedict, ourdict_junk in self._changedicts:
+            cdp = changedicts._cdproc_for_dictid[id(changedict)]
+            cdp.process_changes()
+        if want_retval:
+            res = dict(self.all_changed_Childobjs)
+        else:
+            res = None
+        self.all_changed_Childobjs.clear()
+        return res
+
     def destroy(self): #060126 precaution
         """
         free storage, make doing of our ops illegal
@@ -1840,6 +1982,8 @@ class AssyUndoArchive: # modified from UndoArchive_older and AssyUndoArchive_old
         self.assy = None
         self.stored_ops = {} #e more, if it can contain any cycles -- design was that it wouldn't, but true situation not reviewed lately [060301]
         self.current_diff = None #e destroy it first?
+        self._diff_store.close()
+        self.childobj_tracker.invalidate()
         self.objkey_allocator.destroy()
         self.objkey_allocator = None
         return
@@ -1900,6 +2044,11 @@ class AssyUndoArchive: # modified from UndoArchive_older and AssyUndoArchive_old
 
     def clear_changed_object_sets(self): #060407
         self.get_and_clear_changed_objs(want_retval = False)
+        self.get_and_clear_changed_childobjs(want_retval = False)
+        # our childobj_tracker doesn't know how the objects Undo or Redo
+        # just changed relate to the last snapshot, so the next checkpoint
+        # needs to scan them all
+        self.childobj_tracker.invalidate()
 
     def clear_undo_stack(self): #bruce 060126 to help fix bug 1398 (open file left something on Undo stack) [060304 removed *args, **kws]
         # note: see also: comments in self.initial_checkpoint,
@@ -2181,6 +2330,7 @@ class AssyUndoArchive: # modified from UndoArchive_older and AssyUndoArchive_old
                 undo_diff = redo_diff.reverse_order()
                 self.store_op(redo_diff)
                 self.store_op(undo_diff)
+                self.enforce_memory_budget()
                 # note, we stored those whether or not this was a begin or end checkpoint;
                 # figuring out which ones to offer, merging them, etc, might take care of that, or we might change this policy
                 # and only store them in certain cases, probably if this diff is begin-to-end or the like;
@@ -2411,6 +2561,48 @@ class AssyUndoArchive: # modified from UndoArchive_older and AssyUndoArchive_old
             ops.append(op)
         return
 
+    def enforce_memory_budget(self, budget = None):
+        """
+        Pack the diffs of the undoable steps farthest from the current
+        state, so the unpacked ones (and the packed ones still in RAM)
+        fit within budget bytes (by default, the undo memory budget pref).
+
+        Diffs are compressed first, and then (if they still don't fit)
+        spilled to disk; the diff between the current state and its
+        nearest neighbor (which Undo or Redo would use next) is never
+        packed. Packed diffs are unpacked automatically when needed.
+        """
+        if budget is None:
+            budget = debug_pref_undo_memory_budget()
+            if budget is None:
+                return
+        # collect the diffs of all stored (undo) ops, nearest first
+        # (by distance in checkpoint creation order from self.last_cp)
+        here = self.last_cp.cp_counter
+        diffs = {}
+        for ops in self.stored_ops.itervalues():
+            for op in ops:
+                if op.direction == -1:
+                    diff = op.diffobj()
+                    if diff is not None:
+                        cp0, cp1 = op.cps
+                        distance = max( abs(cp0.cp_counter - here),
+                                        abs(cp1.cp_counter - here) )
+                        diffs[id(diff)] = (distance, id(diff), diff)
+        items = diffs.values()
+        items.sort()
+        total = 0
+        for i, (distance, id_unused, diff) in enumerate(items):
+            cost = diff.RAM_usage_guess()
+            if i and total + cost > budget:
+                diff.pack(self._diff_store)
+                cost = diff.RAM_usage_guess()
+                if total + cost > budget:
+                    diff.spill()
+                    cost = diff.RAM_usage_guess()
+            total += cost
+        return
+
     def _n_stored_vals(self): #060309, unfinished, CALL IT as primitive ram estimate #e add args for variants of what it measures ####@@@@
         res = 0
         for oplist in self.stored_ops.itervalues():
@@ -0,0 +1,367 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+undo_childobj_tracker.py -- change tracking for Undo's child-scanned
+objects (Nodes and the objects reachable from them), so that undo
+checkpoints don't have to rescan the whole model tree.
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+Undo's state is in two layers. The 'atoms' layer (Atoms, Bonds, and
+Chunk.atoms) has long been change-tracked: Atoms and Bonds record
+themselves in changedicts when they change, and each checkpoint only
+looks at those (see modify_and_diff_snap_for_changed_objects in
+state_utils.py). The other layer -- the "child objects" reachable from
+the assy through attributes declared S_CHILD or S_CHILDREN (the model
+tree's Nodes, Parts, and a few others) -- used to be found by scanning
+from the assy at every checkpoint, and all their state was copied and
+compared, so every checkpoint took time proportional to the size of the
+model tree.
+
+With this module (when debug_pref_undo_track_childobj_changes() is
+true), that layer is change-tracked too:
+
+- Classes which inherit ChildobjChangeTrackingMixin (Node and so all its
+  subclasses) record each instance in the changedict _changed_childobjs
+  whenever one of its undoable attributes is set, and their methods
+  which modify the (mutable) value of an undoable attribute in place
+  call self._changed_undoable_state() (e.g. Group.changed_members,
+  which is already required after any change to Group.members).
+
+- Each undo archive has a ChildobjTracker, which keeps the set of live
+  child objects and the child links between them, as found by the last
+  full scan and updated since then. At each checkpoint it rescans the
+  children of the changed objects (and of the few live objects of
+  classes without change tracking), finds the new objects which are
+  reachable through them, and finds the objects which are no longer
+  reachable from the assy (by searching upwards through their parents).
+  Only the changed, new and dead objects' state is then compared with
+  the last snapshot (see modify_and_diff_snap_for_changed_childobjs in
+  state_utils.py).
+
+The tracker doesn't know how the model state relates to the snapshot
+after Undo or Redo changes it, or after the undo stack is cleared, so
+then it's invalidated, and the next checkpoint does a full scan (which
+rebuilds it).
+"""
+
+from foundation.changedicts import register_changedict
+from foundation.state_constants import S_CACHE, S_IGNORE
+from utilities.debug_prefs import debug_pref
+from utilities.debug_prefs import Choice_boolean_True, Choice_boolean_False
+
+def debug_pref_undo_track_childobj_changes():
+    res = debug_pref("Undo: only rescan changed model tree objects?",
+                     Choice_boolean_True, # use False to always scan all
+                     prefs_key = True
+                 )
+    return res
+
+def debug_pref_undo_verify_childobj_changes():
+    """
+    Whether to compare each change-tracked checkpoint of child objects
+    with a full scan, printing bug messages for any changes it missed.
+    """
+    res = debug_pref("Undo: verify changed model tree objects (slow)?",
+                     Choice_boolean_False,
+                     prefs_key = True
+                 )
+    return res
+
+# ==
+
+_changed_childobjs = {} # maps id(obj) -> obj, for instances of
+    # ChildobjChangeTrackingMixin whose undoable state might have changed
+
+register_changedict( _changed_childobjs, '_changed_childobjs', () )
+
+_undoable_attrs_for_class = {} # maps class to dict whose keys are the
+    # names of the undoable attrs of its instances (see _undoable_attrs)
+
+def _undoable_attrs(class1):
+    """
+    Return a dict whose keys are the names of the attributes of instances
+    of class1 which might hold undoable state, as declared by _s_attr_xxx
+    decls or listed in copyable_attrs (which Node.__init__ turns into
+    _s_attr decls, perhaps after some of them are set).
+    """
+    try:
+        return _undoable_attrs_for_class[class1]
+    except KeyError:
+        pass
+    res = {}
+    for name in dir(class1):
+        if name.startswith('_s_attr_') and \
+           getattr(class1, name) not in (S_CACHE, S_IGNORE):
+            res[name[len('_s_attr_'):]] = True
+    for attr in getattr(class1, 'copyable_attrs', ()):
+        res[attr] = True
+    _undoable_attrs_for_class[class1] = res
+    return res
+
+class ChildobjChangeTrackingMixin(object):
+    """
+    Mixin for classes of child-scanned undoable objects, which records
+    their instances in _changed_childobjs when their undoable state
+    might have changed.
+
+    Setting an undoable attribute (any attribute with an _s_attr decl
+    other than S_CACHE or S_IGNORE, or listed in copyable_attrs) does that
+    automatically. Code which modifies the value of an undoable attribute
+    in place must call self._changed_undoable_state() after doing so.
+    """
+    def __setattr__(self, attr, value):
+        object.__setattr__(self, attr, value)
+        try:
+            attrs = _undoable_attrs_for_class[self.__class__]
+        except KeyError:
+            attrs = _undoable_attrs(self.__class__)
+        if attrs.has_key(attr):
+            _changed_childobjs[id(self)] = self
+        return
+
+    def __delattr__(self, attr):
+        object.__delattr__(self, attr)
+        if _undoable_attrs(self.__class__).has_key(attr):
+            _changed_childobjs[id(self)] = self
+        return
+
+    def _changed_undoable_state(self):
+        """
+        Tell Undo that our undoable state might have changed
+        other than by setting one of our undoable attributes
+        (e.g. by modifying a list which is the value of one).
+        """
+        _changed_childobjs[id(self)] = self
+        return
+
+    pass
+
+# ==
+
+class ChildobjTracker:
+    """
+    Keep track of the live child objects of one undo archive's assy,
+    and the child links between them, so they can be updated from the
+    objects which changed since the last update (see module docstring).
+    """
+    # the arguments we pass to InstanceClassification.scan_children,
+    # which must be equivalent to those passed to
+    # obj_classifier.collect_s_children by undo_archive.mmp_state_by_scan
+    # (where objects reached only through 'view' attrs are discarded)
+    _exclude_layers = ('atoms',)
+    _deferred_categories = ('view',)
+
+    def __init__(self, scanner):
+        """
+        @param scanner: the archive's obj_classifier
+        """
+        self.scanner = scanner
+        self.valid = False # whether the rest of our attrs are meaningful
+        self._clear()
+        return
+
+    def _clear(self):
+        self.live = {} # id(obj) -> obj, for all live child objects
+            # (public, for use as the childobj_dict of a StateSnapshot;
+            #  modified in place by self.update)
+        self._children = {} # id(obj) -> dict from id(child) to child,
+            # for each live obj (data objects found in obj's child attrs
+            # are not included, but the objects inside them are)
+        self._parents = {} # id(obj) -> dict from id(parent) to True,
+            # for each live obj (inverse of _children)
+        self._untracked = {} # id(obj) -> obj, for live objs which are
+            # not instances of ChildobjChangeTrackingMixin
+        self._root_id = None
+        return
+
+    def invalidate(self):
+        """
+        Forget everything, since the model state and the last snapshot
+        might no longer correspond. (Our next use must be self.rebuild.)
+        """
+        self.valid = False
+        self._clear()
+        return
+
+    def rebuild(self, root, childobj_dict):
+        """
+        Remember childobj_dict as the live child objects
+        (found by a full scan starting at root),
+        and find all the child links between them.
+        """
+        self._clear()
+        self._root_id = id(root)
+        assert childobj_dict.has_key(self._root_id)
+        self.live = dict(childobj_dict)
+        for id1, obj in childobj_dict.iteritems():
+            self._parents.setdefault(id1, {})
+            self._note_new_live_obj(id1, obj)
+            kids = self._scan_children(obj)
+            self._children[id1] = kids
+            for id2 in kids.iterkeys():
+                self._parents.setdefault(id2, {})[id1] = True
+        for id2 in self._parents.keys():
+            if not self.live.has_key(id2):
+                # can't happen unless our scan and collect_s_children differ
+                print "bug: ChildobjTracker.rebuild finds child not in " \
+                      "childobj_dict, ignoring it: id", id2
+                del self._parents[id2]
+        self.valid = True
+        return
+
+    def _note_new_live_obj(self, id1, obj):
+        if not isinstance(obj, ChildobjChangeTrackingMixin):
+            self._untracked[id1] = obj
+        return
+
+    def _scan_children(self, obj):
+        """
+        Return a dict from id(child) to child for the child objects
+        of obj (including those inside data objects in its attributes,
+        but not the data objects themselves).
+        """
+        res = {}
+        classify_instance = self.scanner.classify_instance
+        deferred = {}
+        for category in self._deferred_categories:
+            deferred[category] = {} # (we discard what's found there)
+        data_seen = {}
+        todo = [obj]
+        def func(child):
+            if classify_instance(child).obj_is_data(child):
+                if not data_seen.has_key(id(child)):
+                    data_seen[id(child)] = True
+                    todo.append(child)
+            else:
+                res[id(child)] = child
+        while todo:
+            obj1 = todo.pop()
+            classify_instance(obj1).scan_children(
+                obj1, func,
+                deferred_category_collectors = deferred,
+                exclude_layers = self._exclude_layers )
+        return res
+
+    def update(self, changed):
+        """
+        Update our records of live objects and their child links,
+        given a dict (from id(obj) to obj) of all the objects which might
+        have changed since the last update (including non-live or foreign
+        ones, which are ignored unless they became live).
+
+        @return: (changed_live, new, dead), three dicts from id(obj) to obj:
+                 objects which were and still are live and might have changed
+                 (including all those not change-tracked), objects which
+                 became live, and objects which are no longer live.
+        """
+        assert self.valid
+        live = self.live
+        children = self._children
+        parents = self._parents
+        changed_live = dict(self._untracked)
+        for id1, obj in changed.iteritems():
+            if live.has_key(id1):
+                changed_live[id1] = obj
+        new = {}
+        rescanned = [(id1, self._scan_children(obj))
+                     for id1, obj in changed_live.iteritems()]
+        # add new links first, then remove old ones, so objects which
+        # moved from one parent to another never look dead
+        for id1, kids in rescanned:
+            oldkids = children[id1]
+            for id2, kid in kids.iteritems():
+                if not oldkids.has_key(id2):
+                    self._add_link(id1, id2, kid, new)
+        candidates = [] # objects which lost a parent
+        for id1, kids in rescanned:
+            oldkids = children[id1]
+            for id2 in oldkids.iterkeys():
+                if not kids.has_key(id2):
+                    del parents[id2][id1]
+                    candidates.append(id2)
+            children[id1] = kids
+        dead = {}
+        while candidates:
+            id2 = candidates.pop()
+            if not live.has_key(id2):
+                continue # already found dead
+            region = self._unreachable_region(id2)
+            if region is None:
+                continue
+            # everything in region is dead; its children might be too
+            for id3 in region:
+                dead[id3] = live.pop(id3)
+                self._untracked.pop(id3, None)
+                del parents[id3]
+            for id3 in region:
+                for id4 in children.pop(id3).iterkeys():
+                    if not region.has_key(id4):
+                        del parents[id4][id3]
+                        candidates.append(id4)
+        for id2 in dead.keys():
+            changed_live.pop(id2, None)
+            # an object can be found new and dead in one update, if it was
+            # added and removed before we heard about either change
+            if new.has_key(id2):
+                del new[id2]
+                del dead[id2]
+        return changed_live, new, dead
+
+    def _add_link(self, id1, id2, kid, new):
+        """
+        Record that live object id1 has kid (whose id is id2) as a child.
+        If kid is not yet live, it and the objects it reaches become live
+        (and are added to new).
+        """
+        parents = self._parents
+        if self.live.has_key(id2):
+            parents[id2][id1] = True
+            return
+        todo = [(id1, id2, kid)]
+        while todo:
+            id1, id2, kid = todo.pop()
+            if self.live.has_key(id2):
+                parents[id2][id1] = True
+                continue
+            self.live[id2] = new[id2] = kid
+            self._note_new_live_obj(id2, kid)
+            parents[id2] = {id1: True}
+            kids = self._scan_children(kid)
+            self._children[id2] = kids
+            for id3, kid3 in kids.iteritems():
+                todo.append((id2, id3, kid3))
+        return
+
+    def _unreachable_region(self, id1):
+        """
+        If the live object with id1 can still be reached from the root
+        through child links, return None. Otherwise return a dict whose
+        keys are the ids of the objects which can reach it (including
+        itself), none of which can be reached from the root.
+        """
+        root_id = self._root_id
+        if id1 == root_id:
+            return None
+        parents = self._parents
+        seen = {id1: True}
+        # depth-first search upwards, taking the first unseen parent of
+        # each object, so a path to the root is usually found quickly
+        # even when an object (e.g. a Part) has many parents
+        stack = [iter(parents[id1])]
+        while stack:
+            for id2 in stack[-1]:
+                if id2 == root_id:
+                    return None
+                if not seen.has_key(id2):
+                    seen[id2] = True
+                    stack.append(iter(parents[id2]))
+                    break
+            else:
+                stack.pop()
+        return seen
+
+    pass
+
+# end
@@ -0,0 +1,348 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+undo_diff_store.py -- compressed and disk-spilled storage for Undo diffs
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+Each undoable step is kept as a state_utils.DiffObj, and undo_archive
+used to keep all of them in RAM in their working form (dicts of values,
+or PosnDiffBlocks). On long sessions with big models that can use more
+RAM than the machine has.
+
+When debug_pref_undo_memory_budget() is not None, the AssyUndoArchive
+keeps the diffs of the undoable steps nearest the current state in their
+working form, up to that many bytes (as estimated by
+DiffObj.RAM_usage_guess), and packs the others into a DiffStore:
+first compressed in RAM, and then (if they still don't fit) spilled into
+a temporary file. A packed diff is unpacked (rehydrated) automatically
+the next time its attrdicts are needed, e.g. when Undo or Redo passes
+over it.
+
+A packed diff is a pickle of its attrdicts, compressed with zlib.
+Values which are not plain data (model objects, _UNSET_, etc) are not
+pickled; they are kept in a list in RAM and referred to by index from
+the pickle, so unpacking gives back the same objects (not copies), and
+the diff means exactly what it meant before it was packed.
+"""
+
+import cPickle
+import tempfile
+import zlib
+from cStringIO import StringIO
+from types import NoneType
+
+import Numeric
+
+from foundation.posn_diff_blocks import PosnDiffBlocks
+from utilities.debug_prefs import debug_pref, Choice
+
+# zlib compression level -- packing happens at checkpoint time,
+# so we favor speed
+_COMPRESSION_LEVEL = 1
+
+# our guess of the RAM used by one object reference we keep in RAM
+# for a packed diff
+_REF_SIZE = 8
+
+_KB = 1024
+_MB = 1024 * _KB
+
+def debug_pref_undo_memory_budget():
+    """
+    Return the number of bytes of unpacked diffs the Undo history
+    should keep in RAM, or None for no limit.
+    """
+    values = [None, 500, 200, 100, 50, 20, 5]
+    names = ["no limit"] + map(str, values[1:])
+    res = debug_pref("Undo: memory budget for history (MB)",
+                     Choice(values, names = names, defaultValue = 200),
+                     prefs_key = True
+                 )
+    if res is not None:
+        res = res * _MB
+    return res
+
+# types whose values are pickled as data; values of all other types
+# (notably all class instances other than PosnDiffBlocks) are kept by
+# reference
+_DATA_TYPES = {}
+for _type in (int, long, float, complex, bool, str, unicode,
+              tuple, list, dict, NoneType,
+              type(Numeric.zeros(0))):
+    _DATA_TYPES[_type] = True
+del _type
+
+def pack_attrdicts(attrdicts):
+    """
+    Return (data, refs), where data is a compressed pickle of the
+    given attrdicts (a dict from attrcode to attrdict), and refs is
+    the list of non-data values it refers to (by index).
+
+    If attrdicts can't be pickled, return None.
+    """
+    refs = []
+    ref_index = {} # maps id(val) to its index in refs
+    def persistent_id(val, _DATA_TYPES = _DATA_TYPES):
+        if _DATA_TYPES.has_key(type(val)) or isinstance(val, PosnDiffBlocks):
+            return None
+        index = ref_index.get(id(val))
+        if index is None:
+            index = ref_index[id(val)] = len(refs)
+            refs.append(val)
+        return index
+    file = StringIO()
+    pickler = cPickle.Pickler(file, cPickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    try:
+        pickler.dump(attrdicts)
+    except (cPickle.PicklingError, TypeError):
+        return None
+    return zlib.compress(file.getvalue(), _COMPRESSION_LEVEL), refs
+
+def unpack_attrdicts(data, refs):
+    """
+    Inverse of pack_attrdicts.
+    """
+    unpickler = cPickle.Unpickler(StringIO(zlib.decompress(data)))
+    unpickler.persistent_load = refs.__getitem__
+    return unpickler.load()
+
+class PackedDiff:
+    """
+    The packed form of a DiffObj's attrdicts, in RAM or in a DiffStore's
+    file.
+    """
+    def __init__(self, store, data, refs, size):
+        self.store = store
+        self.data = data # compressed pickle, or None when spilled
+        self.refs = refs
+        self.size = size # DiffObj.size() of the unpacked diff
+        self.nbytes = len(data) # length of the compressed pickle
+        self.offset = None # position in store's file, when spilled
+        return
+
+    def on_disk(self):
+        return self.data is None
+
+    def RAM_usage_guess(self):
+        res = _REF_SIZE * len(self.refs)
+        if self.data is not None:
+            res += self.nbytes
+        return res
+
+    def spill(self):
+        """
+        Move our compressed data from RAM into our store's file.
+        """
+        if self.data is not None:
+            self.offset = self.store._write(self.data)
+            self.data = None
+        return
+
+    def unpack(self):
+        """
+        Return the attrdicts we represent. (We're not usable after this.)
+        """
+        data = self.data
+        if data is None:
+            data = self.store._read(self.offset, self.nbytes)
+            self.store._forget(self.nbytes)
+        res = unpack_attrdicts(data, self.refs)
+        self.data = self.refs = self.store = None
+        return res
+
+    pass
+
+class DiffStore:
+    """
+    Storage for the packed diffs of one undo archive, including the
+    temporary file they are spilled into.
+
+    Space in the file is not reused, but the file is emptied whenever all
+    the diffs spilled into it have been read back, and deleted by
+    self.close() (or when it's garbage collected).
+    """
+    def __init__(self):
+        self._file = None
+        self._end = 0 # where the next spilled diff will be written
+        self._nbytes_on_disk = 0 # total length of live spilled diffs
+
+    def pack(self, attrdicts, size):
+        """
+        Return a PackedDiff for the given attrdicts (which the caller
+        should then discard), or None if they can't be packed.
+        """
+        res = pack_attrdicts(attrdicts)
+        if res is None:
+            return None
+        data, refs = res
+        return PackedDiff(self, data, refs, size)
+
+    def nbytes_on_disk(self):
+        return self._nbytes_on_disk
+
+    def _write(self, data):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix = "undo-")
+        offset = self._end
+        self._file.seek(offset)
+        self._file.write(data)
+        self._end += len(data)
+        self._nbytes_on_disk += len(data)
+        return offset
+
+    def _read(self, offset, nbytes):
+        self._file.seek(offset)
+        res = self._file.read(nbytes)
+        assert len(res) == nbytes, \
+               "undo data file is truncated (%d of %d bytes at %d)" % \
+               (len(res), nbytes, offset)
+        return res
+
+    def _forget(self, nbytes):
+        """
+        Record that a spilled diff of nbytes was read back into RAM.
+        """
+        self._nbytes_on_disk -= nbytes
+        if not self._nbytes_on_disk:
+            self._file.truncate(0)
+            self._end = 0
+        return
+
+    def close(self):
+        """
+        Delete our file. Diffs still spilled into it can't be unpacked
+        after this.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return
+
+    pass
+
+def describe_nbytes(nbytes):
+    """
+    Return a short description of nbytes, like "12 KB" or "1.5 MB".
+    """
+    if nbytes < _KB:
+        return "%d bytes" % nbytes
+    if nbytes < _MB:
+        return "%d KB" % ((nbytes + _KB // 2) // _KB)
+    return "%.1f MB" % (float(nbytes) / _MB)
+
+# ==
+
+if __name__ == '__main__':
+    # self-test: make a chain of states (as diff_and_copy_state does),
+    # pack and spill some of its diffs, then visit every state in random
+    # order (as Undo and Redo do) and check it
+    import random
+    from foundation.state_constants import _UNSET_
+    from foundation.state_utils import StatePlace, StateSnapshot, DiffObj
+    from foundation.state_utils import same_vals, copy_val
+    from foundation.posn_diff_blocks import diff_posns_into_blocks
+    from geometry.VQT import V
+
+    class _ModelObj:
+        pass
+
+    OBJ, DATA, POSN = ('obj', 1), ('data', 2), ('_posn', 3) # attrcodes
+    objs = [_ModelObj() for i in range(10)]
+    NKEYS = 300
+    random.seed(1)
+
+    def _random_change(state):
+        # return a changed copy of state (a dict from attrcode to attrdict)
+        state = copy_val(state)
+        for key in random.sample(range(NKEYS), 40):
+            if random.random() < 0.2:
+                state[OBJ].pop(key, None)
+            else:
+                state[OBJ][key] = random.choice(objs)
+            state[DATA][key] = (random.random(), "x" * random.randint(0, 9))
+        for key in random.sample(range(NKEYS), 60):
+            state[POSN][key] = V(random.random(), random.random(), key)
+        return state
+
+    def _diff_and_copy(place, state):
+        # like diff_and_copy_state, for states made by _random_change
+        new = StatePlace()
+        lastsnap = place.steal_lastsnap()
+        diff = DiffObj()
+        for attrcode in (OBJ, DATA):
+            d = diff.attrdicts[attrcode] = {}
+            old = lastsnap.attrdicts[attrcode]
+            cur = state[attrcode]
+            for key in dict(old, **cur).keys():
+                val = cur.get(key, _UNSET_)
+                oldval = old.get(key, _UNSET_)
+                if not same_vals(val, oldval):
+                    d[key] = oldval
+            lastsnap.attrdicts[attrcode] = copy_val(cur)
+        d = diff.attrdicts[POSN] = PosnDiffBlocks()
+        keys = state[POSN].keys()
+        diff_posns_into_blocks(keys, [state[POSN][key] for key in keys],
+                               lastsnap.attrdicts[POSN], d)
+        new.own_this_lastsnap(lastsnap)
+        place.define_by_diff_from_stateplace(diff, new)
+        return new, diff
+
+    def _check(place, state):
+        place.get_snap_back_to_self()
+        attrdicts = place.lastsnap.attrdicts
+        assert attrdicts[OBJ] == state[OBJ] # (compares objs by identity)
+        assert same_vals(attrdicts[DATA], state[DATA])
+        assert same_vals(attrdicts[POSN], state[POSN])
+        return
+
+    state = {OBJ: {}, DATA: {}, POSN: {}}
+    snap = StateSnapshot()
+    snap.attrdicts = copy_val(state)
+    places = [StatePlace(snap)]
+    states = [state]
+    diffs = []
+    for i in range(30):
+        state = _random_change(state)
+        place, diff = _diff_and_copy(places[-1], state)
+        places.append(place)
+        states.append(state)
+        diffs.append(diff)
+
+    store = DiffStore()
+    for step in range(200):
+        for diff in random.sample(diffs, 10):
+            diff.pack(store)
+            if random.random() < 0.5:
+                diff.spill()
+        assert [diff for diff in diffs if diff.storage_desc()]
+        i = random.randrange(len(places))
+        _check(places[i], states[i])
+    store.close()
+    print "self-test ok (%d states, %d diffs)" % (len(states), len(diffs))
+
+    # compression of a big diff of atom moves
+    keys = range(100000)
+    diff = DiffObj({POSN: PosnDiffBlocks(),
+                    OBJ: dict([(key, objs[key % 10]) for key in keys]),
+                    DATA: dict([(key, (key * 0.5, "C")) for key in keys])})
+    snap = dict([(key, V(0, 0, key)) for key in keys])
+    diff_posns_into_blocks(keys, [V(1, 0, key) for key in keys], snap,
+                           diff.attrdicts[POSN])
+    before = diff.RAM_usage_guess()
+    store = DiffStore()
+    diff.pack(store)
+    print "100k-atom diff: %s unpacked, %s compressed" % \
+          (describe_nbytes(before), describe_nbytes(diff.RAM_usage_guess()))
+    diff.spill()
+    print "  spilled: %s in RAM, %s on disk" % \
+          (describe_nbytes(diff.RAM_usage_guess()),
+           describe_nbytes(store.nbytes_on_disk()))
+    diff.unpack()
+    assert store.nbytes_on_disk() == 0
+    assert diff.attrdicts[OBJ][7] is objs[7]
+    store.close()
+
+# end
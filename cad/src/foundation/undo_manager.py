@@ -427,7 +427,11 @@ class AssyUndoManager(UndoManager):
                 op = self.wrap_op_with_merging_flags(op) #060127
                 text = op.menu_desc() + extra #060126
                 action.setText(text)
-                fix_tooltip(action, text) # replace description, leave (accelkeys) alone (they contain unicode chars on Mac)
+                tooltip = text
+                memory_desc = op.memory_desc() # e.g. "undo data: 12 KB"
+                if memory_desc:
+                    tooltip += " [%s]" % memory_desc
+                fix_tooltip(action, tooltip) # replace description, leave (accelkeys) alone (they contain unicode chars on Mac)
                 self._current_main_menu_ops[optype] = op #e should store it into menu item if we can, I suppose
                 op.you_have_been_offered()
                     # make sure it doesn't change its mind about being a visible undoable op, even if it gets merged_with_future
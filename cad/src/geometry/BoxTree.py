@@ -0,0 +1,413 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+BoxTree.py -- a bounding volume hierarchy over axis-aligned boxes,
+for finding which of many boxes overlap a query box.
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+CellListIndex is the right tool for many small items of roughly equal
+size (like atoms). It is the wrong tool for a few hundred or thousand
+items which are large and of very different sizes or shapes, like the
+axis capsules of DnaSegments (which can be hundreds of Angstroms long,
+and not aligned with any coordinate axis). For those, this module
+provides a simple static BVH: items are split recursively at the median
+of their box centers along the longest extent, and each node stores the
+bounding box of its items. A query visits only the nodes whose boxes
+overlap the query box, so it takes O(log N + k) time for k results.
+
+Queries can ask for the boxes overlapping a box (overlapping) or hit by
+a line (along_line). Boxes can be moved, added or removed after the tree
+is built (see the BoxTree docstring for how); clients rebuild the tree
+(in O(N log N) time) after many changes.
+
+Run this file (as ./ExecSubDir.py geometry/BoxTree.py) for a self-test
+and a benchmark.
+"""
+
+import Numeric
+from Numeric import Float
+
+# maximum number of items in a leaf node
+_LEAFSIZE = 8
+
+_INFINITY = 1.0e300
+
+# low and high corners for removed items, which overlap nothing
+_EMPTY_LO = (_INFINITY, _INFINITY, _INFINITY)
+_EMPTY_HI = (- _INFINITY, - _INFINITY, - _INFINITY)
+
+def _boxes_overlap(lo1, hi1, lo2, hi2):
+    """
+    Do the closed boxes (lo1, hi1) and (lo2, hi2) overlap?
+    (All args are 3-tuples of floats.)
+    """
+    return lo1[0] <= hi2[0] and lo2[0] <= hi1[0] and \
+           lo1[1] <= hi2[1] and lo2[1] <= hi1[1] and \
+           lo1[2] <= hi2[2] and lo2[2] <= hi1[2]
+
+def line_box_interval(point, direction, lo, hi, margin = 0.0):
+    """
+    Return the interval (t1, t2) of the parameter t for which the line
+    point + t * direction is inside the closed box (lo, hi) expanded by
+    margin on all sides, or None if it never is.
+    (All args except margin are 3-tuples of floats.)
+    """
+    t1 = - _INFINITY
+    t2 = _INFINITY
+    for k in (0, 1, 2):
+        p = point[k]
+        d = direction[k]
+        low = lo[k] - margin
+        high = hi[k] + margin
+        if low > high:
+            return None
+        if d == 0.0:
+            if p < low or p > high:
+                return None
+            continue
+        a = (low - p) / d
+        b = (high - p) / d
+        if a > b:
+            a, b = b, a
+        if a > t1:
+            t1 = a
+        if b < t2:
+            t2 = b
+        if t1 > t2:
+            return None
+    return t1, t2
+
+class BoxTree:
+    """
+    A bounding volume hierarchy over a set of axis-aligned boxes,
+    each identified by a client-chosen (hashable) id.
+
+    Boxes can be moved or removed after the tree is built; the nodes
+    above them are refit, but the tree is not rebalanced. Added boxes are
+    kept in a separate list which every query scans. Clients should build
+    a new tree when many boxes have been added or have moved far.
+    """
+    def __init__(self, lows, highs, ids = None, leafsize = _LEAFSIZE):
+        """
+        @param lows: sequence or (N,3) Numeric array of the boxes'
+                     low corners.
+
+        @param highs: sequence or (N,3) Numeric array of the boxes'
+                      high corners.
+
+        @param ids: optional sequence of N ids for the boxes
+                    (default range(N)).
+        """
+        n = len(lows)
+        assert len(highs) == n
+        if ids is None:
+            ids = range(n)
+        assert len(ids) == n
+        self._ids = list(ids)
+        self._index_of_id = dict([(self._ids[i], i) for i in range(n)])
+        assert len(self._index_of_id) == n, "ids must be unique"
+        # per-node data, indexed by node number (the root is node 0):
+        self._node_lo = [] # low corner of the node's box, as a tuple
+        self._node_hi = [] # high corner of the node's box, as a tuple
+        self._node_children = [] # list of child node numbers, or None
+        self._node_items = [] # for leaves, list of item indices
+        self._node_parent = [] # parent node number, or None for the root
+        # per-item data:
+        self._item_lo = []
+        self._item_hi = []
+        self._item_leaf = [None] * n
+        # boxes added after the tree was built, as a dict from id to (lo, hi)
+        self._added = {}
+        self._nremoved = 0
+        if n:
+            lows = Numeric.reshape(Numeric.array(lows, Float), (n, 3))
+            highs = Numeric.reshape(Numeric.array(highs, Float), (n, 3))
+            self._item_lo = map(tuple, lows.tolist())
+            self._item_hi = map(tuple, highs.tolist())
+            self._build(lows, highs, leafsize)
+        return
+
+    def __len__(self):
+        return len(self._ids) - self._nremoved + len(self._added)
+
+    def nadded(self):
+        """
+        Return the number of boxes added (and not removed) since
+        self was built.
+        """
+        return len(self._added)
+
+    def _new_node(self, lows, highs, items, parent):
+        """
+        [private helper for _build]
+        """
+        sublo = Numeric.take(lows, items, axis = 0)
+        subhi = Numeric.take(highs, items, axis = 0)
+        self._node_lo.append(tuple(Numeric.minimum.reduce(sublo).tolist()))
+        self._node_hi.append(tuple(Numeric.maximum.reduce(subhi).tolist()))
+        self._node_children.append(None)
+        self._node_items.append(None)
+        self._node_parent.append(parent)
+        return len(self._node_lo) - 1
+
+    def _build(self, lows, highs, leafsize):
+        """
+        [private helper for __init__]
+        """
+        centers = (lows + highs) * 0.5
+        todo = [(self._new_node(lows, highs, Numeric.arange(len(lows)), None),
+                 Numeric.arange(len(lows)))]
+        while todo:
+            node, items = todo.pop()
+            if len(items) <= leafsize:
+                items = items.tolist()
+                self._node_items[node] = items
+                for i in items:
+                    self._item_leaf[i] = node
+                continue
+            subcenters = Numeric.take(centers, items, axis = 0)
+            extent = Numeric.maximum.reduce(subcenters) - \
+                     Numeric.minimum.reduce(subcenters)
+            axis = Numeric.argmax(extent)
+            order = Numeric.argsort(subcenters[:, axis])
+            items = Numeric.take(items, order)
+            half = len(items) // 2
+            children = []
+            for part in (items[:half], items[half:]):
+                child = self._new_node(lows, highs, part, node)
+                children.append(child)
+                todo.append((child, part))
+            self._node_children[node] = children
+            continue
+        return
+
+    # == incremental changes
+
+    def move(self, id, lo, hi):
+        """
+        Change the box with the given id to (lo, hi), adding it if it's
+        not present.
+        """
+        lo = tuple(map(float, lo))
+        hi = tuple(map(float, hi))
+        i = self._index_of_id.get(id)
+        if i is None:
+            self._added[id] = (lo, hi)
+            return
+        if self._item_lo[i] is _EMPTY_LO:
+            self._nremoved -= 1
+        self._item_lo[i] = lo
+        self._item_hi[i] = hi
+        self._refit(self._item_leaf[i])
+        return
+
+    def remove(self, id):
+        """
+        Remove the box with the given id (if present).
+        """
+        if self._added.has_key(id):
+            del self._added[id]
+            return
+        i = self._index_of_id.get(id)
+        if i is None or self._item_lo[i] is _EMPTY_LO:
+            return
+        self._item_lo[i] = _EMPTY_LO
+        self._item_hi[i] = _EMPTY_HI
+        self._nremoved += 1
+        self._refit(self._item_leaf[i])
+        return
+
+    def _refit(self, node):
+        """
+        Recompute the boxes of node and its ancestors from their contents.
+        """
+        while node is not None:
+            children = self._node_children[node]
+            if children is not None:
+                los = [self._node_lo[c] for c in children]
+                his = [self._node_hi[c] for c in children]
+            else:
+                items = self._node_items[node]
+                los = [self._item_lo[i] for i in items]
+                his = [self._item_hi[i] for i in items]
+            lo = (min([b[0] for b in los]),
+                  min([b[1] for b in los]),
+                  min([b[2] for b in los]))
+            hi = (max([b[0] for b in his]),
+                  max([b[1] for b in his]),
+                  max([b[2] for b in his]))
+            if lo == self._node_lo[node] and hi == self._node_hi[node]:
+                break
+            self._node_lo[node] = lo
+            self._node_hi[node] = hi
+            node = self._node_parent[node]
+        return
+
+    # == queries
+
+    def overlapping(self, lo, hi):
+        """
+        Return a list of the ids of all boxes which overlap the closed
+        box (lo, hi) (in no particular order).
+        """
+        lo = tuple(map(float, lo))
+        hi = tuple(map(float, hi))
+        res = [self._ids[i]
+               for i in self._items_passing(_boxes_overlap, lo, hi)]
+        for id, (lo2, hi2) in self._added.iteritems():
+            if _boxes_overlap(lo, hi, lo2, hi2):
+                res.append(id)
+        return res
+
+    def along_line(self, point, direction, margin = 0.0):
+        """
+        Return a list of the ids of all boxes which (when expanded by
+        margin on all sides) are hit by the infinite line
+        point + t * direction (in no particular order).
+        """
+        point = tuple(map(float, point))
+        direction = tuple(map(float, direction))
+        def test(point, direction, lo, hi):
+            return line_box_interval(point, direction, lo, hi,
+                                     margin) is not None
+        res = [self._ids[i]
+               for i in self._items_passing(test, point, direction)]
+        for id, (lo, hi) in self._added.iteritems():
+            if test(point, direction, lo, hi):
+                res.append(id)
+        return res
+
+    def _items_passing(self, test, arg1, arg2):
+        """
+        Return a list of the indices of the built items whose boxes
+        pass test(arg1, arg2, lo, hi), visiting only nodes whose boxes
+        pass it. (The test must pass for a box if it passes for any box
+        contained in it.)
+        """
+        res = []
+        if not self._ids:
+            return res
+        node_lo = self._node_lo
+        node_hi = self._node_hi
+        item_lo = self._item_lo
+        item_hi = self._item_hi
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if not test(arg1, arg2, node_lo[node], node_hi[node]):
+                continue
+            children = self._node_children[node]
+            if children is not None:
+                stack.extend(children)
+                continue
+            for i in self._node_items[node]:
+                if test(arg1, arg2, item_lo[i], item_hi[i]):
+                    res.append(i)
+        return res
+
+    pass
+
+# ==
+
+if __name__ == '__main__':
+    # self-test and benchmark; run from cad/src as
+    # ./ExecSubDir.py geometry/BoxTree.py
+    import random, time
+
+    def _random_boxes(n, side, maxsize):
+        lows = []
+        highs = []
+        for i in xrange(n):
+            lo = [random.uniform(0, side) for k in range(3)]
+            lows.append(lo)
+            highs.append([c + random.uniform(0, maxsize) for c in lo])
+        return lows, highs
+
+    def _brute_force(lows, highs, lo, hi):
+        return [i for i in range(len(lows))
+                if _boxes_overlap(lo, hi, lows[i], highs[i])]
+
+    def _brute_force_line(lows, highs, point, direction, margin):
+        return [i for i in range(len(lows))
+                if line_box_interval(point, direction, lows[i], highs[i],
+                                     margin) is not None]
+
+    def _random_line():
+        point = [random.uniform(0, 100.0) for k in range(3)]
+        direction = [random.uniform(-1, 1) for k in range(3)]
+        if random.random() < 0.2:
+            direction[random.randrange(3)] = 0.0
+        return point, direction
+
+    print "tests started"
+    random.seed(1)
+    for n in (0, 1, 7, 100, 1000):
+        lows, highs = _random_boxes(n, 100.0, 30.0)
+        tree = BoxTree(lows, highs)
+        assert len(tree) == n
+        for k in range(100):
+            qlo, qhi = _random_boxes(1, 100.0, 20.0)
+            expected = _brute_force(lows, highs, qlo[0], qhi[0])
+            got = tree.overlapping(qlo[0], qhi[0])
+            got.sort()
+            assert expected == got, "mismatch for n = %d" % n
+            point, direction = _random_line()
+            margin = random.choice((0.0, 5.0))
+            expected = _brute_force_line(lows, highs, point, direction, margin)
+            got = tree.along_line(point, direction, margin)
+            got.sort()
+            assert expected == got, "line mismatch for n = %d" % n
+        # move, remove and add boxes, and compare again
+        lows = map(tuple, lows)
+        highs = map(tuple, highs)
+        for k in range(n):
+            i = random.randrange(n + 10)
+            choice = random.random()
+            if choice < 0.2 and i < len(lows):
+                lows[i] = _EMPTY_LO
+                highs[i] = _EMPTY_HI
+                tree.remove(i)
+            else:
+                lo, hi = _random_boxes(1, 100.0, 30.0)
+                while len(lows) <= i:
+                    lows.append(_EMPTY_LO)
+                    highs.append(_EMPTY_HI)
+                lows[i] = tuple(lo[0])
+                highs[i] = tuple(hi[0])
+                tree.move(i, lo[0], hi[0])
+        assert len(tree) == len([lo for lo in lows if lo is not _EMPTY_LO])
+        for k in range(100):
+            qlo, qhi = _random_boxes(1, 100.0, 20.0)
+            expected = _brute_force(lows, highs, qlo[0], qhi[0])
+            got = tree.overlapping(qlo[0], qhi[0])
+            got.sort()
+            assert expected == got, "mismatch after changes for n = %d" % n
+            point, direction = _random_line()
+            expected = _brute_force_line(lows, highs, point, direction, 0.0)
+            got = tree.along_line(point, direction)
+            got.sort()
+            assert expected == got, "line mismatch after changes for n = %d" % n
+    print "tests done"
+
+    print "benchmark: build + one query per box, at constant box density"
+    for n in (1000, 10000, 100000):
+        lows, highs = _random_boxes(n, 100.0 * (n / 1000.0) ** (1 / 3.0), 10.0)
+        t0 = time.time()
+        tree = BoxTree(lows, highs)
+        t1 = time.time()
+        count = 0
+        for i in xrange(n):
+            count += len(tree.overlapping(lows[i], highs[i]))
+        t2 = time.time()
+        nhits = 0
+        for i in xrange(1000):
+            point, direction = _random_line()
+            nhits += len(tree.along_line(point, direction))
+        t3 = time.time()
+        print "%7d boxes: build %.2f sec, box queries %.2f sec (%d overlaps), " \
+              "1000 line queries %.2f sec (%d hits)" % \
+              (n, t1 - t0, t2 - t1, count, t3 - t2, nhits)
+
+# end
@@ -0,0 +1,543 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+CellListIndex.py -- array-backed spatial index for finding nearby points
+and atoms, meant to replace NeighborhoodGenerator for large inputs.
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+NeighborhoodGenerator buckets atoms one at a time (with struct.pack keys)
+and filters every region() query with a Python-level vlen per atom. That is
+fine for a few thousand atoms, but it dominates bond inference on large PDB
+imports and the overlapping-atom indicators.
+
+The index in this module quantizes an (N,3) Numeric array of positions into
+cubic cells in one pass, sorts the integer cell keys, and answers queries
+for whole batches of points at once, returning Numeric index arrays:
+
+- neighbors_of(points, radius) -- all (query, item) pairs within radius
+- pairs_within(radius) -- all item pairs (i < j) within radius
+
+Incremental changes (adding points, moving or removing items) don't
+re-sort the whole index. Each batch of additions becomes a new sorted
+"level", and levels are merged (rebuilt) when a newer level grows as big
+as the one before it, so the amortized cost of building an index one
+batch at a time stays O(N log N). Moved or removed items are just marked
+dead in the level that holds them.
+
+AtomCellListIndex wraps all this with the same interface as
+NeighborhoodGenerator (add, atom_moved, region, remove), so existing
+callers can switch to it without other changes, and adds batch methods
+which work on atoms.
+
+Run this file (as ./ExecSubDir.py geometry/CellListIndex.py) for a
+self-test and a scaling benchmark.
+"""
+
+import Numeric
+from Numeric import Float, Int
+
+from geometry.VQT import A
+
+# Number of query points processed per vectorized step. This bounds the
+# size of the temporary candidate arrays (roughly 27 * density * cellsize**3
+# entries per query point).
+_QUERY_BLOCKSIZE = 20000
+
+# offsets (in cells) to the 27 cells around (and including) a cell
+_NEIGHBOR_CELL_OFFSETS = [(dx, dy, dz)
+                          for dx in (-1, 0, 1)
+                          for dy in (-1, 0, 1)
+                          for dz in (-1, 0, 1)]
+
+# ==
+
+def _as_positions(points):
+    """
+    Return points as an (N,3) Numeric Float array (possibly empty).
+    """
+    if not len(points):
+        return Numeric.zeros((0, 3), Float)
+    return Numeric.reshape(A(points), (-1, 3))
+
+class _CellLevel:
+    """
+    [private helper for CellListIndex]
+
+    A static, sorted-cell index over one batch of points. Items are stored
+    sorted by cell key; each item also has an id (chosen by our client)
+    and an "alive" flag.
+
+    Cell keys are computed in floating point, from cell coordinates
+    relative to the minimum cell of this level, so they are exact integers
+    for any realistic extent and never overflow a C long.
+    """
+    def __init__(self, positions, ids, cellsize):
+        self.cellsize = cellsize
+        n = len(positions)
+        self.n = n
+        cells = Numeric.floor(positions / cellsize)
+        self.origin = Numeric.minimum.reduce(cells)
+        dims = Numeric.maximum.reduce(cells) - self.origin + 1.0
+        self.ny = dims[1]
+        self.nz = dims[2]
+        self.dims = dims
+        keys = self._keys(cells - self.origin)
+        order = Numeric.argsort(keys)
+        self.keys = Numeric.take(keys, order, axis = 0)
+        self.positions = Numeric.take(positions, order, axis = 0)
+        self.ids = Numeric.take(ids, order, axis = 0)
+        self.alive = Numeric.ones((n,), Int)
+        self.nalive = n
+        # map from id to our internal (sorted) index, for kill()
+        self._index_of_id = dict(zip(self.ids.tolist(), range(n)))
+        return
+
+    def _keys(self, relcells):
+        return (relcells[:,0] * self.ny + relcells[:,1]) * self.nz + relcells[:,2]
+
+    def kill(self, id):
+        """
+        Mark the item with the given id as no longer present
+        (if it's present in self; otherwise do nothing).
+        Return True if we found it alive.
+        """
+        i = self._index_of_id.get(id)
+        if i is None or not self.alive[i]:
+            return False
+        self.alive[i] = 0
+        self.nalive -= 1
+        return True
+
+    def live_contents(self):
+        """
+        Return (positions, ids) for our live items.
+        """
+        if self.nalive == self.n:
+            return self.positions, self.ids
+        return (Numeric.compress(self.alive, self.positions, axis = 0),
+                Numeric.compress(self.alive, self.ids, axis = 0))
+
+    def neighbors_of(self, qpos, radius):
+        """
+        Return (qindices, ids, dist2) for all live items of self within
+        radius of any query point in qpos (an (M,3) array), where qindices
+        index qpos. Radius must be no larger than our cellsize.
+        """
+        m = len(qpos)
+        relcells = Numeric.floor(qpos / self.cellsize) - self.origin
+        los = []
+        his = []
+        for offset in _NEIGHBOR_CELL_OFFSETS:
+            c = relcells + A(offset)
+            inrange = Numeric.logical_and(
+                Numeric.logical_and.reduce(Numeric.greater_equal(c, 0.0), 1),
+                Numeric.logical_and.reduce(Numeric.less(c, self.dims), 1))
+            keys = self._keys(c)
+            lo = Numeric.searchsorted(self.keys, keys)
+            # keys are integers, so this finds the end of each key's run:
+            hi = Numeric.searchsorted(self.keys, keys + 0.5)
+            los.append(lo)
+            his.append((hi - lo) * inrange + lo)
+        lo = Numeric.concatenate(los)
+        counts = Numeric.concatenate(his) - lo
+        total = Numeric.sum(counts, axis = 0)
+        if not total:
+            return _EMPTY_RESULT
+        # expand each (query, cell) pair into one entry per candidate item
+        qindex = Numeric.repeat(
+            Numeric.concatenate([Numeric.arange(m)] * len(_NEIGHBOR_CELL_OFFSETS)),
+            counts)
+        starts = Numeric.add.accumulate(counts) - counts
+        local = (Numeric.repeat(lo - starts, counts) +
+                 Numeric.arange(total))
+        delta = (Numeric.take(self.positions, local, axis = 0) -
+                 Numeric.take(qpos, qindex, axis = 0))
+        dist2 = Numeric.sum(delta * delta, axis = 1)
+        keep = Numeric.less(dist2, radius * radius)
+        if self.nalive != self.n:
+            keep = Numeric.logical_and(keep,
+                                       Numeric.take(self.alive, local, axis = 0))
+        return (Numeric.compress(keep, qindex, axis = 0),
+                Numeric.compress(keep, Numeric.take(self.ids, local, axis = 0),
+                                 axis = 0),
+                Numeric.compress(keep, dist2, axis = 0))
+
+    pass
+
+_EMPTY_RESULT = (Numeric.zeros((0,), Int),
+                 Numeric.zeros((0,), Int),
+                 Numeric.zeros((0,), Float))
+
+def _concatenate_results(results):
+    results = [r for r in results if len(r[0])]
+    if not results:
+        return _EMPTY_RESULT
+    if len(results) == 1:
+        return results[0]
+    return tuple([Numeric.concatenate([r[i] for r in results])
+                  for i in range(3)])
+
+# ==
+
+class CellListIndex:
+    """
+    A spatial index over a set of points, each identified by an integer id,
+    which can find all pairs of points closer than some maximum radius.
+
+    Ids are chosen by the client (when not given, they are the indices
+    of the points in the positions array passed to the constructor or
+    to add_positions); each live id must be unique.
+
+    Query results are returned as parallel Numeric arrays, not lists.
+    """
+    def __init__(self, positions = (), maxradius = 1.0, ids = None):
+        """
+        @param positions: sequence or (N,3) Numeric array of positions.
+
+        @param maxradius: the largest radius any query will use
+                          (which is also the size of our cells).
+
+        @param ids: optional sequence of N integer ids for the positions
+                    (default range(N)).
+        """
+        self._maxradius = 1.0 * maxradius
+        self._levels = []
+        self._next_id = 0
+        self.add_positions(positions, ids)
+        return
+
+    def __len__(self):
+        return sum([level.nalive for level in self._levels])
+
+    def add_positions(self, positions, ids = None):
+        """
+        Add the given positions to self, with the given ids
+        (default: consecutive integers after the largest default id
+        assigned so far). Return the ids as a Numeric array.
+        """
+        positions = _as_positions(positions)
+        n = len(positions)
+        if ids is None:
+            ids = Numeric.arange(self._next_id, self._next_id + n)
+            self._next_id += n
+        else:
+            ids = Numeric.array(ids, Int)
+            assert len(ids) == n
+        if n:
+            self._levels.append(_CellLevel(positions, ids, self._maxradius))
+            self._merge_levels()
+        return ids
+
+    def _merge_levels(self):
+        """
+        Merge the newest levels while the newest is at least as big
+        as its predecessor (counting only live items), so we have
+        O(log N) levels and O(N log N) total build cost.
+        """
+        levels = self._levels
+        while len(levels) >= 2 and levels[-1].nalive >= levels[-2].nalive:
+            newer = levels.pop()
+            older = levels.pop()
+            pos1, ids1 = older.live_contents()
+            pos2, ids2 = newer.live_contents()
+            positions = Numeric.concatenate((pos1, pos2))
+            if len(positions):
+                levels.append(
+                    _CellLevel(positions,
+                               Numeric.concatenate((ids1, ids2)),
+                               self._maxradius))
+            continue
+        return
+
+    def remove_id(self, id):
+        """
+        Remove the item with the given id from self (if present).
+        """
+        for level in self._levels:
+            if level.kill(id):
+                break
+        return
+
+    def move_id(self, id, newpos):
+        """
+        Change the position of the item with the given id
+        (adding it if it's not present).
+        """
+        self.remove_id(id)
+        self.add_positions([newpos], [id])
+        return
+
+    def compact(self):
+        """
+        Rebuild self as a single level containing only live items.
+        Not required for correctness, but makes subsequent queries faster
+        after many moves or removals.
+        """
+        contents = [level.live_contents() for level in self._levels]
+        self._levels = []
+        if contents:
+            positions = Numeric.concatenate([c[0] for c in contents])
+            if len(positions):
+                self._levels = [
+                    _CellLevel(positions,
+                               Numeric.concatenate([c[1] for c in contents]),
+                               self._maxradius)]
+        return
+
+    def neighbors_of(self, points, radius = None, return_dist2 = False):
+        """
+        Find all items within radius (default maxradius) of any of the
+        given points (an (M,3) array or sequence of positions).
+
+        @return: tuple (qindices, ids) of equal-length Numeric arrays,
+                 meaning each item ids[k] is within radius of points[qindices[k]],
+                 or (qindices, ids, dist2) if return_dist2 is true.
+                 Results are grouped but not sorted.
+        """
+        if radius is None:
+            radius = self._maxradius
+        assert radius <= self._maxradius, \
+               "radius %r exceeds maxradius %r" % (radius, self._maxradius)
+        qpos = _as_positions(points)
+        results = []
+        for start in range(0, len(qpos), _QUERY_BLOCKSIZE):
+            block = qpos[start:start + _QUERY_BLOCKSIZE]
+            for level in self._levels:
+                if level.nalive:
+                    qi, ids, dist2 = level.neighbors_of(block, radius)
+                    results.append((qi + start, ids, dist2))
+        res = _concatenate_results(results)
+        if return_dist2:
+            return res
+        return res[:2]
+
+    def pairs_within(self, radius = None, return_dist2 = False):
+        """
+        Find all pairs of distinct items of self within radius
+        (default maxradius) of each other.
+
+        @return: tuple (ids1, ids2) of equal-length Numeric arrays,
+                 with ids1[k] < ids2[k] and each pair appearing once,
+                 or (ids1, ids2, dist2) if return_dist2 is true.
+        """
+        results = []
+        for level in self._levels:
+            if not level.nalive:
+                continue
+            positions, ids = level.live_contents()
+            qi, ids2, dist2 = self.neighbors_of(positions, radius,
+                                                return_dist2 = True)
+            ids1 = Numeric.take(ids, qi, axis = 0)
+            # each pair is found twice within a level, and once from each
+            # side between two levels; keep it exactly once:
+            keep = Numeric.less(ids1, ids2)
+            results.append((Numeric.compress(keep, ids1, axis = 0),
+                            Numeric.compress(keep, ids2, axis = 0),
+                            Numeric.compress(keep, dist2, axis = 0)))
+        res = _concatenate_results(results)
+        if return_dist2:
+            return res
+        return res[:2]
+
+    pass
+
+# ==
+
+class AtomCellListIndex(CellListIndex):
+    """
+    A CellListIndex whose items are atoms, with the same interface as
+    NeighborhoodGenerator (add, atom_moved, region, remove), plus batch
+    methods that accept and return lists of atoms.
+
+    As with NeighborhoodGenerator, all that's assumed about atoms is that
+    they have .key, .posn() and .is_singlet().
+    """
+    def __init__(self, atomlist, maxradius, include_singlets = False):
+        self.include_singlets = include_singlets
+        self._atoms = {} # maps atom.key to atom, for atoms in self
+        CellListIndex.__init__(self, (), maxradius)
+        self.add_atoms(atomlist)
+        return
+
+    def _filter(self, atoms):
+        if self.include_singlets:
+            return list(atoms)
+        return [atom for atom in atoms if not atom.is_singlet()]
+
+    def add_atoms(self, atoms, positions = None):
+        """
+        Add the given atoms to self (in one batch).
+
+        @param positions: if provided, an (N,3) array of the atoms' positions,
+                          which saves calling atom.posn() on each one. It
+                          must correspond to atoms, before filtering out
+                          singlets.
+        """
+        atoms = list(atoms)
+        if positions is not None and not self.include_singlets:
+            keep = [not atom.is_singlet() for atom in atoms]
+            positions = Numeric.compress(keep, _as_positions(positions),
+                                         axis = 0)
+        atoms = self._filter(atoms)
+        if positions is None:
+            positions = [atom.posn() for atom in atoms]
+        atoms_dict = self._atoms
+        keys = [atom.key for atom in atoms]
+        for key, atom in zip(keys, atoms):
+            if atoms_dict.has_key(key):
+                self.remove_id(key)
+            atoms_dict[key] = atom
+        self.add_positions(positions, keys)
+        return
+
+    def add(self, atom):
+        self.add_atoms([atom])
+
+    def atom_moved(self, atom):
+        """
+        If an atom has been added to this index and is later moved,
+        this method must be called to refresh its position information.
+        This only needs to be done during the useful lifecycle of the index.
+        (Atoms which aren't in self, including singlets unless
+        include_singlets was passed, are ignored.)
+        """
+        if not self._atoms.has_key(atom.key):
+            return
+        if not self.include_singlets and atom.is_singlet():
+            return
+        self.move_id(atom.key, atom.posn())
+        return
+
+    def remove(self, atom):
+        if self._atoms.has_key(atom.key):
+            del self._atoms[atom.key]
+            self.remove_id(atom.key)
+        return
+
+    def _atoms_for_ids(self, ids):
+        atoms_dict = self._atoms
+        return [atoms_dict[key] for key in ids.tolist()]
+
+    def region(self, center):
+        """
+        Given a position in space, return the list of atoms that
+        are within the neighborhood radius of that position.
+        """
+        qi, ids = self.neighbors_of([center])
+        return self._atoms_for_ids(ids)
+
+    def regions(self, centers, radius = None):
+        """
+        Given a sequence or (M,3) array of positions, return a list
+        of M lists, each containing the atoms within radius
+        (default maxradius) of the corresponding position.
+        """
+        qi, ids = self.neighbors_of(centers, radius)
+        res = [[] for i in range(len(centers))]
+        for i, atom in zip(qi.tolist(), self._atoms_for_ids(ids)):
+            res[i].append(atom)
+        return res
+
+    def atom_pairs_within(self, radius = None):
+        """
+        Return a list of pairs (atom1, atom2) of atoms in self within
+        radius (default maxradius) of each other, each pair listed once,
+        with atom1.key < atom2.key.
+        """
+        ids1, ids2 = self.pairs_within(radius)
+        return zip(self._atoms_for_ids(ids1), self._atoms_for_ids(ids2))
+
+    pass
+
+# ==
+
+if __name__ == '__main__':
+    # self-test and benchmark; run from cad/src as
+    # ./ExecSubDir.py geometry/CellListIndex.py
+    import random, time
+    from geometry.VQT import V, vlen
+    from geometry.NeighborhoodGenerator import NeighborhoodGenerator
+
+    print "tests started"
+
+    class _FakeAtom:
+        def __init__(self, key, pos):
+            self.key = key
+            self._posn = pos
+        def posn(self):
+            return + self._posn
+        def is_singlet(self):
+            return False
+        pass
+
+    def _random_positions(n, density = 0.1):
+        # density in atoms per cubic Angstrom; 0.1 is roughly liquid water
+        side = (n / density) ** (1.0 / 3)
+        return [V(random.uniform(0, side),
+                  random.uniform(0, side),
+                  random.uniform(0, side)) for i in xrange(n)]
+
+    random.seed(1)
+    atoms = [_FakeAtom(i, pos) for i, pos in enumerate(_random_positions(3000))]
+    ngen = NeighborhoodGenerator(atoms, 2.0)
+    index = AtomCellListIndex(atoms, 2.0)
+    for atom in atoms[:300]:
+        expected = [a.key for a in ngen.region(atom.posn())]
+        got = [a.key for a in index.region(atom.posn())]
+        expected.sort()
+        got.sort()
+        assert expected == got, "region mismatch at %r" % atom.key
+    pairs = [(a1.key, a2.key) for a1, a2 in index.atom_pairs_within()]
+    brute = [(a1.key, a2.key)
+             for a1 in atoms for a2 in ngen.region(a1.posn())
+             if a1.key < a2.key]
+    pairs.sort()
+    brute.sort()
+    assert pairs == brute, "pairs_within mismatch"
+    # incremental moves, removals and additions
+    for atom in atoms[:500]:
+        atom._posn = atom._posn + V(0.7, -0.3, 1.1)
+        ngen.atom_moved(atom)
+        index.atom_moved(atom)
+    for atom in atoms[500:600]:
+        index.remove(atom)
+    # moving atoms which aren't in the index mustn't add them
+    strays = [_FakeAtom(i, V(0, 0, 0)) for i in range(5000, 5010)]
+    for atom in strays + atoms[500:510]:
+        index.atom_moved(atom)
+    for atom in atoms[:500]:
+        expected = [a.key for a in ngen.region(atom.posn())
+                    if not (500 <= a.key < 600)]
+        got = [a.key for a in index.region(atom.posn())]
+        expected.sort()
+        got.sort()
+        assert expected == got, "region mismatch after moves at %r" % atom.key
+    print "tests done"
+
+    print "benchmark: build + pairs_within(2.0) at 0.1 atoms/A^3"
+    for n in (10000, 100000, 1000000):
+        positions = A(_random_positions(n))
+        t0 = time.time()
+        index = CellListIndex(positions, 2.0)
+        t1 = time.time()
+        ids1, ids2 = index.pairs_within()
+        t2 = time.time()
+        print "%8d points: build %.2f sec, pairs_within %.2f sec (%d pairs)" % \
+              (n, t1 - t0, t2 - t1, len(ids1))
+        if n <= 10000:
+            atoms = [_FakeAtom(i, positions[i]) for i in xrange(n)]
+            t0 = time.time()
+            ngen = NeighborhoodGenerator(atoms, 2.0)
+            count = 0
+            for atom in atoms:
+                for atom2 in ngen.region(atom.posn()):
+                    if atom.key < atom2.key:
+                        count += 1
+            t1 = time.time()
+            print "%8d atoms: NeighborhoodGenerator %.2f sec (%d pairs)" % \
+                  (n, t1 - t0, count)
+            assert count == len(ids1)
+
+# end
@@ -16,6 +16,9 @@ since it's essentially purely geometric (and could easily
 be generalized to be entirely so) -- all it assumes about
 "atoms" is that they have a few methods like .posn()
 and .is_singlet(), and it needs no imports from model.
+
+See also CellListIndex.py, an array-backed replacement with the same
+interface plus batch queries, which scales much better to large inputs.
 """
 
 import struct
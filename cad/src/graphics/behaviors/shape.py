@@ -26,9 +26,17 @@ simple_shape_2d, shape, SelectionShape. For now, I'll guess
 that I can call all these "graphics_behavior". We'll see.
 (This feels more natural than "operations", though for that
 I'd be more confident that a package import cycle was unlikely.)
+
+SelectionShape tests the atoms of each chunk against its curve all at
+once (using the isin_array methods of rectangle and curve on the chunk's
+atpos array), skipping chunks whose bounding boxes can't overlap the
+curve, and picks or unpicks the atoms it finds in bulk. Run this file
+(as ./ExecSubDir.py graphics/behaviors/shape.py) for a self-test and
+benchmark of isin_array against isin.
 """
 
 from Numeric import array, zeros, maximum, minimum, ceil, dot, floor
+from Numeric import Int, ones, where, clip, take, ravel, nonzero
 
 from geometry.VQT import A, vlen, V
 
@@ -45,6 +53,10 @@ from utilities.constants import red
 
 from utilities.debug import print_compact_traceback
 from utilities import debug_flags
+from utilities.debug_prefs import debug_pref, Choice_boolean_True
+
+from model.global_model_changedicts import _changed_picked_Atoms
+from model.elements import Singlet
 
 import foundation.env as env
 ##from utilities.constants import colors_differ_sufficiently
@@ -53,6 +65,13 @@ from utilities.prefs_constants import LightBackgroundContrastColor_prefs_key
 
 from geometry.BoundingBox import BBox
 
+def debug_pref_select_atoms_in_area_as_arrays():
+    res = debug_pref("Selection: test chunks' atoms in area as arrays?",
+                     Choice_boolean_True, # use False to test one atom at a time
+                     prefs_key = True
+                 )
+    return res
+
 def get_selCurve_color(selSense, bgcolor = white):
     """
     [public]
@@ -235,6 +254,74 @@ class simple_shape_2d:
         return p[0]>=self.bboxlo[0] and p[1]>=self.bboxlo[1] \
             and p[0]<=self.bboxhi[0] and p[1]<=self.bboxhi[1]
 
+    def _project_2d_array(self, points):
+        """
+        Like project_2d, but for an array of points (one per row).
+
+        @return: (px, py, ok), arrays of the x and y coordinates of the
+                 projected points, and of flags which are false for points
+                 which are too close to the eyeball to be projected
+        """
+        px = dot(points, self.right)
+        py = dot(points, self.up)
+        ok = ones(len(points))
+        if self.eyeball:
+            pfix = self.project_2d_noeyeball(self.org)
+            depth = dot(points - self.eyeball, self.normal) / self.eye2Pov
+            ok = (depth != 0.0)
+            depth = where(ok, depth, 1.0)
+            px = (px - pfix[0]) / depth + pfix[0]
+            py = (py - pfix[1]) / depth + pfix[1]
+        return px, py, ok
+
+    def _isin_bbox_array(self, points):
+        """
+        Like isin_bbox, but for an array of points (one per row).
+
+        @return: (flags, px, py), where flags is an array of flags saying
+                 which points are in the slab and 2d bbox, and px and py
+                 are as returned by _project_2d_array
+        """
+        px, py, ok = self._project_2d_array(points)
+        lo, hi = self.bboxlo, self.bboxhi
+        flags = ok * (px >= lo[0]) * (py >= lo[1]) * \
+                (px <= hi[0]) * (py <= hi[1])
+        if self.slab:
+            slab = self.slab
+            d = dot(points - slab.point, slab.normal)
+            flags = flags * (d >= 0) * (d <= slab.thickness)
+        return flags, px, py
+
+    def might_contain_points_in_bbox(self, bbox):
+        """
+        Return False if no point inside bbox (a BBox) can be inside self
+        (according to self.isin), or True if some might be.
+        This is quick and conservative; it only looks at the
+        projections of the corners of bbox.
+        """
+        if bbox.data is None:
+            return False
+        hi, lo = bbox.data
+        corners = array([(x, y, z) for x in (lo[0], hi[0])
+                                   for y in (lo[1], hi[1])
+                                   for z in (lo[2], hi[2])])
+        if self.slab:
+            slab = self.slab
+            d = dot(corners - slab.point, slab.normal)
+            if max(d) < 0 or min(d) > slab.thickness:
+                return False
+        if self.eyeball:
+            # the corners' projections only enclose the box's projection
+            # if the whole box is on the same side of the eyeball as
+            # the center of view
+            side = dot(self.org - self.eyeball, self.normal)
+            if min(dot(corners - self.eyeball, self.normal) * side) <= 0:
+                return True
+        px, py, ok = self._project_2d_array(corners)
+        lo, hi = self.bboxlo, self.bboxhi
+        return not (max(px) < lo[0] or max(py) < lo[1] or
+                    min(px) > hi[0] or min(py) > hi[1])
+
     pass # end of class simple_shape_2d
 
 
@@ -246,6 +333,12 @@ class rectangle(simple_shape_2d): # bruce 041214 factored out simple_shape_2d
         simple_shape_2d.__init__( self, shp, [pt1, pt2], origin, selSense, opts)
     def isin(self, pt):
         return self.isin_bbox(pt)
+    def isin_array(self, points):
+        """
+        Like isin, but for an array of points (one per row);
+        return an array of flags saying which points are inside.
+        """
+        return self._isin_bbox_array(points)[0]
     def draw(self):
         """
         Draw the rectangle
@@ -327,6 +420,25 @@ class curve(simple_shape_2d): # bruce 041214 factored out simple_shape_2d
         ij = map(int, p * 8)-self.matbase
         return not self.matrix[ij]
 
+    def isin_array(self, points):
+        """
+        Like isin, but for an array of points (one per row);
+        return an array of flags saying which points are inside.
+        """
+        flags, px, py = self._isin_bbox_array(points)
+        # look up the points in self.matrix as isin does (astype(Int)
+        # truncates like int() does), after clipping them to the bbox
+        # (so points outside it, whose flags are already false, can't
+        # cause overflow or indexing errors)
+        lo, hi = self.bboxlo, self.bboxhi
+        n0, n1 = self.matrix.shape
+        i = (clip(px, lo[0], hi[0]) * 8).astype(Int) - self.matbase[0]
+        j = (clip(py, lo[1], hi[1]) * 8).astype(Int) - self.matbase[1]
+        i = clip(i, 0, n0 - 1)
+        j = clip(j, 0, n1 - 1)
+        inside = take(ravel(self.matrix), i * n1 + j, 0) == 0
+        return flags * inside
+
     def xdraw(self):
         """
         draw the actual grid of the matrix in 3-space.
@@ -410,6 +522,76 @@ class shape:
 
 # ==
 
+def _pick_atoms(atoms):
+    """
+    Pick (select) the given atoms, as Atom.pick would do to each one,
+    but telling each of their chunks that its selected atoms changed
+    only once.
+    """
+    # this inlines and optimizes Atom.pick and Atom.filtered (as
+    # Part.unpickatoms does for Atom.unpick)
+    if not atoms:
+        return
+    assy = atoms[0].molecule.assy
+    win = assy.w
+    permitted = None # ids of the elements the selection filter permits
+    if win.selection_filter_enabled:
+        permitted = {}
+        for element in win.filtered_elements:
+            permitted[id(element)] = element
+    counter = assy._select_cmd_counter
+    selatoms = assy.selatoms
+    mols = {}
+    for a in atoms:
+        element = a.element
+        if element is Singlet:
+            continue
+        if permitted is not None and not permitted.has_key(id(element)):
+            continue
+        a._picked_time = counter
+        if not a.picked:
+            a.picked = True
+            _changed_picked_Atoms[a.key] = a
+            a._picked_time_2 = counter
+            selatoms[a.key] = a
+            m = a.molecule
+            mols[id(m)] = m
+    for m in mols.itervalues():
+        m.changed_selected_atoms()
+    return
+
+def _unpick_atoms(atoms):
+    """
+    Unpick the given atoms, as Atom.unpick would do to each one,
+    but telling each of their chunks that its selected atoms changed
+    only once.
+    """
+    # this inlines and optimizes Atom.unpick (with filtered = True)
+    if not atoms:
+        return
+    assy = atoms[0].molecule.assy
+    win = assy.w
+    permitted = None
+    if win.selection_filter_enabled:
+        permitted = {id(Singlet): Singlet} # Atom.filtered is false for them
+        for element in win.filtered_elements:
+            permitted[id(element)] = element
+    selatoms = assy.selatoms
+    mols = {}
+    for a in atoms:
+        if not a.picked:
+            continue
+        if permitted is not None and not permitted.has_key(id(a.element)):
+            continue
+        selatoms.pop(a.key, None)
+        a.picked = False
+        _changed_picked_Atoms[a.key] = a
+        m = a.molecule
+        mols[id(m)] = m
+    for m in mols.itervalues():
+        m.changed_selected_atoms()
+    return
+
 class SelectionShape(shape): # review: split this into its own file? [bruce 071215 Q]
     """
     This is used to construct shape for atoms/chunks selection.
@@ -452,6 +634,64 @@ class SelectionShape(shape): # review: split this into its own file? [bruce 0712
 ##                    assy.unpickatoms() # Fixed bug 1598. Mark 060303.
             self._atomsSelect(assy)
 
+    def _atoms_inside(self, mol, disp, first_only = False):
+        """
+        Return a list of the visible atoms of mol which are inside
+        self.curve, ignoring mol.hidden.
+
+        @param disp: mol.get_dispdef() (passed for speed)
+
+        @param first_only: if true, stop after the first atom found
+                           (so the list has at most one atom)
+        """
+        c = self.curve
+        if debug_pref_select_atoms_in_area_as_arrays():
+            if not mol.atoms or not c.might_contain_points_in_bbox(mol.bbox):
+                return []
+            flags = c.isin_array(mol.atpos)
+            atlist = mol.atlist
+            candidates = [atlist[i] for i in nonzero(flags)]
+        else:
+            candidates = [a for a in mol.atoms.itervalues()
+                          if c.isin(a.posn())]
+        res = []
+        for a in candidates:
+            if a.visible(disp):
+                res.append(a)
+                if first_only:
+                    break
+        return res
+
+    def _selatoms_inside(self, assy):
+        """
+        Return a list of the selected atoms of assy (in unhidden chunks)
+        which are inside self.curve.
+        """
+        c = self.curve
+        if not debug_pref_select_atoms_in_area_as_arrays():
+            res = []
+            for a in assy.selatoms.values():
+                if a.molecule.hidden:
+                    continue #bruce 041214
+                if c.isin(a.posn()) and a.visible():
+                    res.append(a)
+            return res
+        atoms_by_mol = {} # id(mol) -> (mol, list of selected atoms)
+        for a in assy.selatoms.itervalues():
+            mol = a.molecule
+            atoms_by_mol.setdefault(id(mol), (mol, []))[1].append(a)
+        res = []
+        for mol, atoms in atoms_by_mol.itervalues():
+            if mol.hidden:
+                continue
+            atpos = mol.atpos # (this also makes sure atom.index is valid)
+            points = take(atpos, [a.index for a in atoms], 0)
+            flags = c.isin_array(points)
+            # (no need to check a.visible(), since it's true for all
+            #  selected atoms)
+            res.extend([atoms[i] for i in nonzero(flags)])
+        return res
+
     def _atomsSelect(self, assy):
         """
         Select all atoms inside the shape according to its selection selSense.
@@ -461,37 +701,32 @@ class SelectionShape(shape): # review: split this into its own file? [bruce 0712
             for mol in assy.molecules:
                 if mol.hidden:
                     continue
-                disp = mol.get_dispdef()
-                for a in mol.atoms.itervalues():
-                    if c.isin(a.posn()) and a.visible(disp):
-                        a.pick()
+                _pick_atoms(self._atoms_inside(mol, mol.get_dispdef()))
         elif c.selSense == START_NEW_SELECTION:
+            inside = {}
             for mol in assy.molecules:
                 if mol.hidden:
                     continue
-                disp = mol.get_dispdef()
-                for a in mol.atoms.itervalues():
-                    if c.isin(a.posn()) and a.visible(disp):
-                        a.pick()
-                    else:
-                        a.unpick()
+                atoms = self._atoms_inside(mol, mol.get_dispdef())
+                _pick_atoms(atoms)
+                for a in atoms:
+                    inside[a.key] = a
+            # unpick the other atoms in unhidden chunks (normally there
+            # are none, since our caller already unpicked all atoms)
+            _unpick_atoms([a for a in assy.selatoms.values()
+                           if not a.molecule.hidden and
+                              not inside.has_key(a.key)])
         elif c.selSense == SUBTRACT_FROM_SELECTION:
-            for a in assy.selatoms.values():
-                if a.molecule.hidden:
-                    continue #bruce 041214
-                if c.isin(a.posn()) and a.visible():
-                    a.unpick()
+            _unpick_atoms(self._selatoms_inside(assy))
         elif c.selSense == DELETE_SELECTION:
             todo = []
             for mol in assy.molecules:
                 if mol.hidden:
                     continue
-                disp = mol.get_dispdef()
-                for a in mol.atoms.itervalues():
-                    if c.isin(a.posn()) and a.visible(disp):
-                        if a.is_singlet():
-                            continue
-                        todo.append(a)
+                for a in self._atoms_inside(mol, mol.get_dispdef()):
+                    if a.is_singlet():
+                        continue
+                    todo.append(a)
             for a in todo[:]:
                 if a.filtered():
                     continue
@@ -519,38 +754,32 @@ class SelectionShape(shape): # review: split this into its own file? [bruce 0712
             for mol in assy.molecules:
                 if mol.hidden:
                     continue
-                disp = mol.get_dispdef()
-                for a in mol.atoms.itervalues():
-                    if c.isin(a.posn()) and a.visible(disp):
-                        a.molecule.pick()
-                        break
+                if self._atoms_inside(mol, mol.get_dispdef(), first_only = True):
+                    mol.pick()
 
         if c.selSense == SUBTRACT_FROM_SELECTION:
             for m in assy.selmols[:]:
                 if m.hidden:
                     continue #bruce 041214
-                disp = m.get_dispdef()
-                for a in m.atoms.itervalues():
-                    if c.isin(a.posn()) and a.visible(disp):
-                        m.unpick()
-                        break
+                if self._atoms_inside(m, m.get_dispdef(), first_only = True):
+                    m.unpick()
 
         if c.selSense == DELETE_SELECTION: # mark 060220.
             todo = []
             for mol in assy.molecules:
                 if mol.hidden:
                     continue
-                disp = mol.get_dispdef()
-                for a in mol.atoms.itervalues():
-                    #bruce 060405 comment/bugfix: this use of itervalues looked dangerous (since mol was killed inside the loop),
-                    # but since the iterator is not continued after that, I suppose it was safe (purely a guess).
-                    # It would be safer (or more obviously safe) to build up a todo list of mols to kill after the loop.
-                    # More importantly, assy.molecules was not copied in the outer loop -- that could be a serious bug,
-                    # if it's incrementally modified. I'm fixing that now, using the todo list.
-                    if c.isin(a.posn()) and a.visible(disp):
-                        ## a.molecule.kill()
-                        todo.append(mol) #bruce 060405 bugfix
-                        break
+                #bruce 060405 comment/bugfix: this use of itervalues looked dangerous (since mol was killed inside the loop),
+                # but since the iterator is not continued after that, I suppose it was safe (purely a guess).
+                # It would be safer (or more obviously safe) to build up a todo list of mols to kill after the loop.
+                # More importantly, assy.molecules was not copied in the outer loop -- that could be a serious bug,
+                # if it's incrementally modified. I'm fixing that now, using the todo list.
+                # (mol's atoms are now tested by _atoms_inside, which finds
+                #  the first visible atom inside the curve, if any; mols are
+                #  still only killed after this loop.)
+                if self._atoms_inside(mol, mol.get_dispdef(), first_only = True):
+                    ## a.molecule.kill()
+                    todo.append(mol) #bruce 060405 bugfix
             for mol in todo:
                 mol.kill()
         return
@@ -560,30 +789,54 @@ class SelectionShape(shape): # review: split this into its own file? [bruce 0712
         Find atoms/chunks that are inside the shape.
         """
         rst = []
-
-        c = self.curve
-
         if assy.selwhat: ##Chunks
-           rstMol = {}
-           for mol in assy.molecules:
+            for mol in assy.molecules:
                 if mol.hidden:
                     continue
-                disp = mol.get_dispdef()
-                for a in mol.atoms.itervalues():
-                    if c.isin(a.posn()) and a.visible(disp):
-                            rstMol[id(a.molecule)] = a.molecule
-                            break
-           rst.extend(rstMol.itervalues())
+                if self._atoms_inside(mol, mol.get_dispdef(), first_only = True):
+                    rst.append(mol)
         else: ##Atoms
-           for mol in assy.molecules:
+            for mol in assy.molecules:
                 if mol.hidden:
                     continue
-                disp = mol.get_dispdef()
-                for a in mol.atoms.itervalues():
-                   if c.isin(a.posn()) and a.visible(disp):
-                     rst += [a]
+                rst.extend(self._atoms_inside(mol, mol.get_dispdef()))
         return rst
 
     pass # end of class SelectionShape
 
+# ==
+
+if __name__ == '__main__':
+    # self-test and benchmark of the array methods of rectangle and curve
+    # against their one-point-at-a-time isin methods (as used by
+    # SelectionShape before they existed); run from cad/src as
+    # ./ExecSubDir.py graphics/behaviors/shape.py
+    import math, random, time
+    random.seed(0)
+    n = 100000
+    points = A([(random.uniform(-50, 50), random.uniform(-50, 50),
+                 random.uniform(-20, 20)) for i in xrange(n)])
+    shp = shape(V(1, 0, 0), V(0, 1, 0), V(0, 0, -1))
+    lasso = [V(30 * math.cos(t), 20 * math.sin(3 * t) + 10 * math.sin(t), 0)
+             for t in [k * 2 * math.pi / 100 for k in range(101)]]
+    for eye in (None, V(0, 0, 100)):
+        for kind in ("rectangle", "curve"):
+            if kind == "rectangle":
+                c = shp.pickrect(V(-20, -10, 0), V(25, 30, 0), V(0, 0, 0),
+                                 START_NEW_SELECTION, eye = eye)
+            else:
+                c = shp.pickline(lasso, V(0, 0, 0), START_NEW_SELECTION,
+                                 eye = eye)
+            t0 = time.time()
+            expected = [i for i in xrange(n) if c.isin(points[i])]
+            t1 = time.time()
+            got = list(nonzero(c.isin_array(points)))
+            t2 = time.time()
+            assert got == expected, "%s mismatch (eye %r)" % (kind, eye)
+            print "%s, %s, %d of %d points inside: " \
+                  "isin %.3f sec, isin_array %.3f sec" % \
+                  (kind, eye is None and "ortho" or "perspective",
+                   len(got), n, t1 - t0, t2 - t1)
+    print "tests done"
+
 # end
@@ -54,6 +54,7 @@ from math import sin, cos, pi
 from Numeric import dot, argmax, argmin, sqrt
 
 from graphics.display_styles.displaymodes import ChunkDisplayMode
+from graphics.display_styles.spline_tubes import tube_samples, interpolate_tube
 
 from geometry.VQT import V, Q, norm, cross, angleBetween
 
@@ -357,32 +358,6 @@ class DnaCylinderChunks(ChunkDisplayMode):
     # Several of the methods below should be split into their own files.
     # piotr 082708
 
-    def _compute_spline(self, data, idx, t):
-        """
-        Implements a Catmull-Rom spline. Interpolates between data[idx]
-        and data[idx+1]. 0.0 <= t <= 1.0.
-
-        @param data: array with at least four values to be used for
-        interpolation. The following values are used: data[idx-1], data[idx],
-        data[idx+1], data[idx+2]
-
-        @param t: position (0 <= t <= 1)
-        @type t: float
-
-        @return: spline value at t
-        """
-        t2 = t * t
-        t3 = t2 * t
-        x0 = data[idx-1]
-        x1 = data[idx]
-        x2 = data[idx+1]
-        x3 = data[idx+2]
-        res = 0.5 * ((2.0 * x1) +
-                     t * (-x0 + x2) +
-                     t2 * (2.0 * x0 - 5.0 * x1 + 4.0 * x2 - x3) +
-                     t3 * (-x0 + 3.0 * x1 - 3.0 * x2 + x3))
-        return res
-
     def _get_rainbow_color(self, hue, saturation, value):
         """
         Gets a color of a hue range limited to 0 - 0.667 (red - blue color range).
@@ -585,39 +560,22 @@ class DnaCylinderChunks(ChunkDisplayMode):
         """
         n = len(points)
         if n > 3:
-            # Create lists for the interpolated positions, colors, and radii.
-            new_points = [ None ] * (4*(n-2)-1)
-            new_colors = [ None ] * (4*(n-2)-1)
-            new_radii = [ 0.0 ] * (4*(n-2)-1)
-            for p in range(0, (4*(n-2)-1)):
-                new_points[p] = [ 0.0 ] * 3
-                new_colors[p] = [ 0.0 ] * 3
-            o = 1
-            # Fill-in the lists by computing spline values at consecutive points.
-            # Assume that the spline resolution equals 4.
-            for p in range (1, n-2):
-                for m in range (0, 4):
-                    t = 0.25 * m
-                    new_points[o] = self._compute_spline(points, p, t)
-                    new_colors[o] = self._compute_spline(colors, p, t)
-                    new_radii[o] = self._compute_spline(radii, p, t)
-                    o += 1
-
-            # Fill-in terminal positions.
-            new_points[o] = self._compute_spline(points, p, 1.0)
-            new_colors[o] = self._compute_spline(colors, p, 1.0)
-            new_radii[o] = self._compute_spline(radii, p, 1.0)
-            o += 1
-            new_points[0] = 3.0 * new_points[1] \
-                      - 3.0 * new_points[2] \
-                      + new_points[3]
-            new_points[o] = 3.0 * new_points[o-1] \
-                      - 3.0 * new_points[o-2] \
-                      + new_points[o-3]
-            new_colors[0] = new_colors[1]
-            new_colors[o] = new_colors[o - 1]
-            new_radii[0] = new_radii[1]
-            new_radii[o] = new_radii[o - 1]
+            # Compute spline values at 4 points per segment, and at the end
+            # of the last segment.
+            indices, t = tube_samples(n, 4)
+            new_points, new_colors, new_radii = interpolate_tube(
+                (points, colors, radii), indices, t)
+            # Add extrapolated terminal positions.
+            new_points.insert(0, 3.0 * new_points[0]
+                                 - 3.0 * new_points[1]
+                                 + new_points[2])
+            new_points.append(3.0 * new_points[-1]
+                              - 3.0 * new_points[-2]
+                              + new_points[-3])
+            new_colors.insert(0, new_colors[0])
+            new_colors.append(new_colors[-1])
+            new_radii.insert(0, new_radii[0])
+            new_radii.append(new_radii[-1])
             return (new_points, new_colors, new_radii)
         else:
             # if not enough points, just return the initial lists
@@ -31,6 +31,7 @@ import foundation.env as env
 from geometry.VQT import V, norm, cross
 
 from graphics.display_styles.displaymodes import ChunkDisplayMode
+from graphics.display_styles.spline_tubes import tube_samples, interpolate_tube
 
 from graphics.drawing.CS_draw_primitives import drawcylinder
 from graphics.drawing.CS_draw_primitives import drawpolycone_multicolor
@@ -197,38 +198,6 @@ AA_COLORS_ACIDITY = {
     "TYR" : green,
     "VAL" : green }
 
-def compute_spline(data, idx, t):
-    """
-    Implements a Catmull-Rom spline. Interpolates between data[idx] and
-    data[idx+1] using data[idx-1], data[idx], data[idx+1] and data[idx+2]
-    points.
-
-    @param data: list of data points to interpolate. it needs to have at least
-    data points, otherwise will cause an exception
-
-    @param idx: index of data points to be interpolated between
-    @type idx: int
-
-    @param t: interpolation ratio (0.0 <= t <= 1.0)
-    @type t: float
-
-    @note: this method is basically identical to the one in DnaCylinderChunks,
-    so it should be splitted out from here and moved to another, more general
-    file
-
-    """
-    t2 = t*t
-    t3 = t2*t
-    x0 = data[idx-1]
-    x1 = data[idx]
-    x2 = data[idx+1]
-    x3 = data[idx+2]
-    res = 0.5 * ((2.0 * x1) +
-                 t * (-x0 + x2) +
-                 t2 * (2.0 * x0 - 5.0 * x1 + 4.0 * x2 - x3) +
-                 t3 * (-x0 + 3.0 * x1 - 3.0 * x2 + x3))
-    return res
-
 def make_tube(points, colors, radii, dpos, resolution=3):
     """
     Converts a polycylinder tube into a smooth, curved tube using spline
@@ -261,41 +230,12 @@ def make_tube(points, colors, radii, dpos, resolution=3):
     """
     n = len(points)
     if n > 3:
-        new_points = []
-        new_colors = []
-        new_radii = []
-        new_dpos = []
-        o = 1
-        ir = 1.0/float(resolution)
-        for p in range (1, n-2):
-            start_spline = 0
-            end_spline = int(resolution) #@@@
-            if p == 1:
-                start_spline = int(resolution / 2 - 1)
-            if p == n-3:
-                end_spline = int(resolution / 2 + 1)
-            for m in range (start_spline, end_spline):
-                t = ir * m
-                sp = compute_spline(points, p, t)
-                sc = compute_spline(colors, p, t)
-                sr = compute_spline(radii, p, t)
-                sd = compute_spline(dpos, p, t)
-                new_points.append(sp)
-                new_colors.append(sc)
-                new_radii.append(sr)
-                new_dpos.append(sd)
-
-        t = ir * (m + 1)
-        sp = compute_spline(points, p, t)
-        sc = compute_spline(colors, p, t)
-        sr = compute_spline(radii, p, t)
-        sd = compute_spline(dpos, p, t)
-
-        new_points.append(sp)
-        new_colors.append(sc)
-        new_radii.append(sr)
-        new_dpos.append(sd)
-        return (new_points, new_colors, new_radii, new_dpos)
+        # Only the second half of the first segment, and the first half
+        # of the last one, are sampled.
+        indices, t = tube_samples(n, resolution,
+                                  first_start = int(resolution / 2 - 1),
+                                  last_end = int(resolution / 2 + 1))
+        return interpolate_tube((points, colors, radii, dpos), indices, t)
     else:
         return (points, colors, radii, dpos)
 
@@ -438,6 +378,75 @@ class ProteinChunks(ChunkDisplayMode):
 
         return color
 
+    def _tube_cache_key(self, chunk, current_sec):
+        """
+        Return a key for the interpolated tube of the current_sec'th
+        secondary structure element of chunk, in the tube cache in its memo,
+        which includes all the display style settings the tube depends on.
+        """
+        return (current_sec,
+                self.proteinStyle,
+                self.proteinStyleQuality,
+                self.proteinStyleSmooth,
+                self.proteinStyleScaling,
+                self.proteinStyleScaleFactor,
+                self.proteinStyleColors,
+                tuple(self.proteinStyleHelixColor),
+                tuple(self.proteinStyleStrandColor),
+                tuple(self.proteinStyleCoilColor),
+                chunk.color and tuple(chunk.color))
+
+    def _smooth_tube(self, secondary, tube_pos, tube_col, tube_rad, tube_dpos):
+        """
+        Return the smooth, interpolated tube (a tuple of lists of points,
+        colors, radii and dpos vectors) through the given tube points of a
+        secondary structure element of the given type,
+        for the current display style.
+        """
+        # For smoothed helices we need to add virtual atoms
+        # located approximately at the centers of peptide bonds
+        # but slightly moved away from the helix axis.
+
+        new_tube_pos = []
+        new_tube_col = []
+        new_tube_rad = []
+        new_tube_dpos = []
+        if self.proteinStyleSmooth and \
+           secondary == 1:
+            for p in range(len(tube_pos)):
+                new_tube_pos.append(tube_pos[p])
+                new_tube_col.append(tube_col[p])
+                new_tube_rad.append(tube_rad[p])
+                new_tube_dpos.append(tube_dpos[p])
+
+                if p > 1 and p < len(tube_pos) - 3:
+                    pv = tube_pos[p-1] - tube_pos[p]
+                    nv = tube_pos[p+2] - tube_pos[p+1]
+                    mi = 0.5 * (tube_pos[p+1] + tube_pos[p])
+                    # The coefficient below was handpicked to make
+                    # the helices approximately round.
+                    mi -= 0.75 * norm(nv+pv)
+                    new_tube_pos.append(mi)
+                    new_tube_col.append(0.5*(tube_col[p]+tube_col[p+1]))
+                    new_tube_rad.append(0.5*(tube_rad[p]+tube_rad[p+1]))
+                    new_tube_dpos.append(0.5*(tube_dpos[p]+tube_dpos[p+1]))
+
+            tube_pos = new_tube_pos
+            tube_col = new_tube_col
+            tube_rad = new_tube_rad
+            tube_dpos = new_tube_dpos
+
+        if secondary != 1 or \
+           self.proteinStyle != PROTEIN_STYLE_SIMPLE_CARTOONS:
+            tube_pos, tube_col, tube_rad, tube_dpos = make_tube(
+                tube_pos,
+                tube_col,
+                tube_rad,
+                tube_dpos,
+                resolution=self.proteinStyleQuality)
+
+        return (tube_pos, tube_col, tube_rad, tube_dpos)
+
     def drawchunk(self, glpane, chunk, memo, highlighted):
         """
         Draws a reduced representation of a protein chunk. This method is called
@@ -452,14 +461,13 @@ class ProteinChunks(ChunkDisplayMode):
         # much changes.
 
         # Retrieve parameters from memo
-        structure, total_length, ca_list, n_sec = memo
+        structure, total_length, ca_list, n_sec, tube_cache = memo
 
         # Get display style settings
         style = self.proteinStyle
         scaleFactor = self.proteinStyleScaleFactor
         resolution = self.proteinStyleQuality
         scaling = self.proteinStyleScaling
-        smooth = self.proteinStyleSmooth
 
         # Set nice joint style for gle Polycone primitives.
         gleSetJoinStyle(TUBE_JN_ANGLE | TUBE_NORM_PATH_EDGE \
@@ -620,48 +628,24 @@ class ProteinChunks(ChunkDisplayMode):
                                 tube_rad.append(rad)
                                 tube_dpos.append(dpos1)
 
-                    # For smoothed helices we need to add virtual atoms
-                    # located approximately at the centers of peptide bonds
-                    # but slightly moved away from the helix axis.
-
-                    new_tube_pos = []
-                    new_tube_col = []
-                    new_tube_rad = []
-                    new_tube_dpos = []
-                    if smooth and \
-                       secondary == 1:
-                        for p in range(len(tube_pos)):
-                            new_tube_pos.append(tube_pos[p])
-                            new_tube_col.append(tube_col[p])
-                            new_tube_rad.append(tube_rad[p])
-                            new_tube_dpos.append(tube_dpos[p])
-
-                            if p > 1 and p < len(tube_pos) - 3:
-                                pv = tube_pos[p-1] - tube_pos[p]
-                                nv = tube_pos[p+2] - tube_pos[p+1]
-                                mi = 0.5 * (tube_pos[p+1] + tube_pos[p])
-                                # The coefficient below was handpicked to make
-                                # the helices approximately round.
-                                mi -= 0.75 * norm(nv+pv)
-                                new_tube_pos.append(mi)
-                                new_tube_col.append(0.5*(tube_col[p]+tube_col[p+1]))
-                                new_tube_rad.append(0.5*(tube_rad[p]+tube_rad[p+1]))
-                                new_tube_dpos.append(0.5*(tube_dpos[p]+tube_dpos[p+1]))
-
-                        tube_pos = new_tube_pos
-                        tube_col = new_tube_col
-                        tube_rad = new_tube_rad
-                        tube_dpos = new_tube_dpos
+                    # The interpolated tube is cached in the memo, since this
+                    # method can be called more than once per memo.
+                    cache_key = self._tube_cache_key(chunk, current_sec)
+                    if tube_cache.has_key(cache_key):
+                        tube_pos, tube_col, tube_rad, tube_dpos = \
+                                  tube_cache[cache_key]
+                    else:
+                        tube_pos, tube_col, tube_rad, tube_dpos = \
+                                  self._smooth_tube(secondary,
+                                                    tube_pos,
+                                                    tube_col,
+                                                    tube_rad,
+                                                    tube_dpos)
+                        tube_cache[cache_key] = \
+                                  (tube_pos, tube_col, tube_rad, tube_dpos)
 
                     if secondary != 1 or \
                        style != PROTEIN_STYLE_SIMPLE_CARTOONS:
-                        tube_pos, tube_col, tube_rad, tube_dpos = make_tube(
-                            tube_pos,
-                            tube_col,
-                            tube_rad,
-                            tube_dpos,
-                            resolution=resolution)
-
                         if style == PROTEIN_STYLE_ZIGZAG or \
                            style == PROTEIN_STYLE_FLAT_RIBBON or \
                            style == PROTEIN_STYLE_SOLID_RIBBON or \
@@ -1465,6 +1449,7 @@ class ProteinChunks(ChunkDisplayMode):
 
                 sec = []
 
-        return (structure, n_ca, ca_list, n_sec)
+        # The last element is a cache of interpolated tubes, for drawchunk.
+        return (structure, n_ca, ca_list, n_sec, {})
 
 ChunkDisplayMode.register_display_mode_class(ProteinChunks)
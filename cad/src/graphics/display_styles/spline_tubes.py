@@ -0,0 +1,111 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+spline_tubes.py -- Catmull-Rom spline interpolation of the points, colors,
+radii (and any other per-point data) of polycylinder tubes, for the display
+styles which draw smooth tubes (ProteinChunks and DnaCylinderChunks).
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+All the samples of a tube are evaluated at once: each sample is a segment
+index idx and a parameter t (0.0 <= t <= 1.0, usually), and its value is a
+weighted sum of data[idx-1], data[idx], data[idx+1] and data[idx+2], with
+weights which only depend on t. So the samples of each kind of data are
+computed by four Numeric.take calls and a few array operations, rather than
+one Python function call per sample.
+"""
+
+import Numeric
+from Numeric import Float, Int
+
+def catmull_rom_weights(t):
+    """
+    Return an array of shape (len(t), 4) whose rows are the weights
+    of data[idx-1], data[idx], data[idx+1] and data[idx+2]
+    in the Catmull-Rom spline between data[idx] and data[idx+1],
+    at each parameter in t.
+
+    @param t: the spline parameters (0.0 at data[idx], 1.0 at data[idx+1])
+    @type t: sequence of floats
+    """
+    t = Numeric.array(t, Float)
+    t2 = t * t
+    t3 = t2 * t
+    return Numeric.transpose(Numeric.array([
+        0.5 * (- t + 2.0 * t2 - t3),
+        0.5 * (2.0 - 5.0 * t2 + 3.0 * t3),
+        0.5 * (t + 4.0 * t2 - 3.0 * t3),
+        0.5 * (- t2 + t3) ]))
+
+def spline_samples(data, indices, t, weights = None):
+    """
+    Evaluate the Catmull-Rom spline through data at the given samples.
+
+    @param data: n data values (floats, or vectors which all have the
+                 same shape), where n >= 4
+    @type data: sequence
+
+    @param indices: the segment of each sample, i.e. the index of the data
+                    value at its start (1 <= idx <= n - 3)
+    @type indices: sequence of ints
+
+    @param t: the spline parameter of each sample
+    @type t: sequence of floats
+
+    @param weights: catmull_rom_weights(t), if the caller has it
+                    (for speed when interpolating several kinds of data)
+
+    @return: array of the values at the samples, of shape
+             (len(indices),) + shape of one data value
+    """
+    data = Numeric.array(data, Float)
+    shape = data.shape
+    size = 1
+    for dim in shape[1:]:
+        size *= dim
+    data = Numeric.reshape(data, (shape[0], size))
+    if weights is None:
+        weights = catmull_rom_weights(t)
+    indices = Numeric.array(indices, Int)
+    res = weights[:, 0:1] * Numeric.take(data, indices - 1, 0)
+    for k in (1, 2, 3):
+        res += weights[:, k:k+1] * Numeric.take(data, indices + k - 1, 0)
+    return Numeric.reshape(res, (len(indices),) + shape[1:])
+
+def tube_samples(n, resolution, first_start = 0, last_end = None):
+    """
+    Return (indices, t) for the samples of a smooth tube through n >= 4
+    points: resolution samples per segment (at t = m / resolution for m
+    in range(resolution)), for each segment from points[1] to points[n-2],
+    except that the first segment's samples start at m = first_start
+    and the last segment's stop after m = last_end (by default, resolution,
+    so the last sample is at points[n-2]).
+    """
+    if last_end is None:
+        last_end = resolution
+    nseg = n - 3
+    counts = Numeric.zeros(nseg, Int) + resolution
+    counts[0] -= first_start
+    counts[-1] += last_end + 1 - resolution
+    indices = Numeric.repeat(Numeric.arange(1, n - 2), counts)
+    # m of each sample: its offset within its segment's samples,
+    # plus the m of the segment's first sample
+    starts = Numeric.zeros(nseg, Int)
+    starts[0] = first_start
+    seg_offsets = Numeric.add.accumulate(counts) - counts
+    m = Numeric.arange(len(indices)) - \
+        Numeric.repeat(seg_offsets - starts, counts)
+    t = m * (1.0 / float(resolution))
+    return indices, t
+
+def interpolate_tube(data_lists, indices, t):
+    """
+    Return a tuple of lists, the samples (as from tube_samples)
+    of the splines through each sequence in data_lists.
+    """
+    weights = catmull_rom_weights(t)
+    return tuple([list(spline_samples(data, indices, t, weights))
+                  for data in data_lists])
+
+# end
@@ -943,13 +943,24 @@ class ChunkDrawer(TransformedDisplayListsDrawer):
         model_draw_frame = self.get_part_drawing_frame()
         if not model_draw_frame:
             return
-        neighborhoodGenerator = model_draw_frame._f_state_for_indicate_overlapping_atoms
-        if not neighborhoodGenerator:
+        neighborhoodIndex = model_draw_frame._f_state_for_indicate_overlapping_atoms
+        if neighborhoodIndex is None:
             # precaution after refactoring, probably can't happen [bruce 090218]
             return
-        for atom in self._chunk.atoms.itervalues():
-            pos = atom.posn()
-            prior_atoms_too_close = neighborhoodGenerator.region(pos)
+        # Add all our atoms to the index in one batch, then find each one's
+        # nearby atoms in one batch query. The atoms which count as "prior"
+        # for an atom are those in other chunks already in the index,
+        # and those earlier in our own list (not including itself).
+        atoms = self._chunk.atoms.values()
+        positions = [atom.posn() for atom in atoms]
+        order = dict([(atom.key, i) for i, atom in enumerate(atoms)])
+        neighborhoodIndex.add_atoms(atoms, positions)
+        nearby_atom_lists = neighborhoodIndex.regions(positions)
+        for i, atom, nearby_atoms in zip(range(len(atoms)),
+                                         atoms,
+                                         nearby_atom_lists):
+            prior_atoms_too_close = [prior_atom for prior_atom in nearby_atoms
+                                     if order.get(prior_atom.key, -1) < i]
             if prior_atoms_too_close:
                 # This atom overlaps the prior atoms.
                 # Draw an indicator around it,
@@ -965,7 +976,6 @@ class ChunkDrawer(TransformedDisplayListsDrawer):
                 for prior_atom in prior_atoms_too_close:
                     prior_atom.draw_overlap_indicator((atom,))
                 atom.draw_overlap_indicator(prior_atoms_too_close)
-            neighborhoodGenerator.add(atom)
             continue
         return
 
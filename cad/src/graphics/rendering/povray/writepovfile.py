@@ -9,9 +9,16 @@ History:
 
 Bruce 080917 split this out of graphics/rendering/fileIO.py.
 For earlier history see that file's repository log.
+
+PovraySeriesWriter writes a series of POV-Ray files (e.g. one per movie
+frame) which share one include file for the parts of the scene which are
+the same in all of them (the macros, camera, background and lighting).
+Each file still has the whole model, so this only saves the size of
+that header (about 7 KB) per file.
 """
 
 import math
+import os
 
 import foundation.env as env
 from geometry.VQT import V, Q, A, vlen
@@ -20,6 +27,15 @@ from graphics.rendering.povray.povheader import povheader, povpoint
 from utilities.prefs_constants import PERSPECTIVE
 from utilities.prefs_constants import material_specular_highlights_prefs_key
 from utilities.prefs_constants import material_specular_finish_prefs_key
+from utilities.debug_prefs import debug_pref, Choice_boolean_False
+
+def debug_pref_povray_series_shares_scene():
+    # (files written this way only render next to their scene include file)
+    res = debug_pref("POV-Ray series: write shared scene include file?",
+                     Choice_boolean_False,
+                     prefs_key = True
+                 )
+    return res
 
 # ==
 
@@ -30,7 +46,25 @@ def writepovfile(part, glpane, filename):
     using glpane for lighting, color, etc
     """
     f = open(filename,"w")
+    _writepov_comments(f, glpane)
+    _writepov_scene(f, glpane)
+    _writepov_model(f, part, glpane)
+    f.close()
+    return # from writepovfile
 
+def _writepov_comments(f, glpane):
+    """
+    Write the comments at the start of a POV-Ray file.
+    """
+    f.write("// Recommended window size: width=%d, height=%d \n"%(glpane.width, glpane.height))
+    f.write("// Suggested command line switches: +A +W%d +H%d\n\n"%(glpane.width, glpane.height))
+    return
+
+def _writepov_scene(f, glpane):
+    """
+    Write the macros, camera, background, lights and finish
+    of a POV-Ray file, which depend only on glpane.
+    """
     # POV-Ray images now look correct when Projection = ORTHOGRAPHIC.  Mark 051104.
     if glpane.ortho == PERSPECTIVE:
         cdist = 6.0 # Camera distance [see also glpane.cdist]
@@ -43,9 +77,6 @@ def writepovfile(part, glpane, filename):
     right = V( aspect * zfactor, 0.0, 0.0) ##1.33
     angle = 2.0*math.atan2(aspect, cdist)*180.0/math.pi
 
-    f.write("// Recommended window size: width=%d, height=%d \n"%(glpane.width, glpane.height))
-    f.write("// Suggested command line switches: +A +W%d +H%d\n\n"%(glpane.width, glpane.height))
-
     f.write(povheader)
 
     # Camera info
@@ -93,7 +124,13 @@ def writepovfile(part, glpane, filename):
 
     # Lights and Atomic finish.
     _writepovlighting(f, glpane)
+    return
 
+def _writepov_model(f, part, glpane):
+    """
+    Write the visible model objects of part into a POV-Ray file,
+    after its scene (see _writepov_scene).
+    """
     # write a union object, which encloses all following objects, so it's
     # easier to set a global modifier like "Clipped_by" for all objects
     # Huaicai 1/6/05
@@ -131,10 +168,49 @@ def writepovfile(part, glpane, filename):
 ##                "    Axis_Rotate_Trans(" + povpoint(V(dt.x, dt.y, dt.z)) + ", " + str(degY) + ")}\n")
 
     f.write("}\n\n")
+    return
 
-    f.close()
+# ==
 
-    return # from writepovfile
+class PovraySeriesWriter:
+    """
+    Write a series of POV-Ray files of one part (e.g. one per movie frame),
+    using glpane for lighting, color, etc. The macros, camera, background
+    and lighting, which are the same for all of them, are written once,
+    into a scene include file; each file has the usual comments, an
+    #include of the scene file, and the model. Rendering one of them
+    (in the directory of the scene file) gives the same image as rendering
+    a file written by writepovfile.
+    """
+    def __init__(self, glpane, scene_filename):
+        """
+        Write the scene include file.
+
+        @param scene_filename: the name of the scene include file, which
+                               must be in the same directory as the files
+                               of the series (they include it by basename)
+        """
+        self.glpane = glpane
+        self.scene_filename = scene_filename
+        f = open(scene_filename, "w")
+        _writepov_scene(f, glpane)
+        f.close()
+        self._include = '#include "%s"\n\n' % os.path.basename(scene_filename)
+        return
+
+    def write(self, part, filename):
+        """
+        Write part, in its current state, into a new POV-Ray file
+        with the given name.
+        """
+        f = open(filename, "w")
+        _writepov_comments(f, self.glpane)
+        f.write(self._include)
+        _writepov_model(f, part, self.glpane)
+        f.close()
+        return
+
+    pass
 
 # _writepovlighting() added by Mark.  Feel free to ask him if you have questions.  051130.
 def _writepovlighting(f, glpane):
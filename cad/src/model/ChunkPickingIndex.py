@@ -0,0 +1,247 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+ChunkPickingIndex.py -- a persistent spatial index over the chunks of a
+Part, used to find the atom under the mouse without examining every chunk.
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+Part.findAtomUnderMouse (in ops_select.py) used to call
+Chunk.findAtomUnderMouse on every visible chunk, and each of those calls
+transforms the chunk's whole atpos array by the view matrix. With tens of
+thousands of chunks, that makes hover highlighting lag badly.
+
+A ChunkPickingIndex keeps a BoxTree over the chunks' bounding boxes
+(Chunk.bbox, expanded by the largest selection radius of the chunk's
+atoms), so a query only visits chunks whose boxes the line of sight hits.
+For chunks with many atoms, it also keeps a CellListIndex of their atom
+positions, so that only the atoms near the line of sight are examined.
+The chunks found are passed to Chunk.findAtomUnderMouse (with the atoms
+found, when there are any), which does the same tests as before on them,
+so the atom found is the same.
+
+The index is kept up to date incrementally. On each query, each chunk's
+entry is checked against the chunk's current atpos and selection radii
+arrays (which are replaced, not modified, when they change), and only the
+entries of chunks which changed are recomputed; their boxes are moved in
+the tree (which is rebuilt only when many chunks have been added).
+"""
+
+import math
+
+import Numeric
+from Numeric import Int
+
+from geometry.VQT import A, vlen
+from geometry.BoxTree import BoxTree, line_box_interval
+from geometry.CellListIndex import CellListIndex
+
+# chunks with fewer atoms than this don't get an atom index
+# (Chunk.findAtomUnderMouse just examines all their atoms)
+_MIN_ATOMS_FOR_ATOM_INDEX = 200
+
+# the maxradius of a chunk's atom index, as a multiple of the largest
+# selection radius of its atoms
+_ATOM_INDEX_RADIUS_FACTOR = 1.5
+
+# rebuild the tree when more than this fraction of its boxes
+# (but at least _MIN_ADDED_FOR_REBUILD) were added since it was built
+_REBUILD_FRACTION = 0.25
+_MIN_ADDED_FOR_REBUILD = 16
+
+# extra padding of boxes and query radii, for roundoff
+_PAD = 0.01
+
+# if the view matrix scales xy distances by less than this,
+# don't use the index (see the candidates method)
+_MIN_SCALE = 0.01
+
+class _ChunkEntry:
+    """
+    What a ChunkPickingIndex knows about one chunk, valid as long as the
+    chunk's atpos and selection radii arrays are the ones recorded here.
+    """
+    def __init__(self, chunk, atpos, radii_2):
+        self.chunk = chunk
+        self.atpos = atpos
+        self.radii_2 = radii_2
+        self.maxradius = None # None means no atom is visible
+        self.lo = self.hi = None
+        self._atom_index = None
+        if len(radii_2):
+            maxradius2 = max(radii_2)
+            if maxradius2 >= 0.0:
+                self.maxradius = math.sqrt(maxradius2)
+                hi, lo = chunk.bbox.data # (encloses all atom centers)
+                self.center_lo = tuple(lo.tolist())
+                self.center_hi = tuple(hi.tolist())
+                pad = self.maxradius + _PAD
+                self.lo = tuple((lo - pad).tolist())
+                self.hi = tuple((hi + pad).tolist())
+        return
+
+    def is_valid(self, chunk, atpos, radii_2):
+        return chunk is self.chunk and atpos is self.atpos and \
+               radii_2 is self.radii_2
+
+    def atom_indices_near_line(self, point, direction, radius):
+        """
+        Return a sorted Numeric array of the indices (in chunk.atlist) of
+        all atoms whose centers might be within radius of the line
+        point + t * direction (direction must be a unit vector),
+        or None if we don't know (so all atoms must be examined).
+        """
+        if len(self.atpos) < _MIN_ATOMS_FOR_ATOM_INDEX:
+            return None
+        maxradius = _ATOM_INDEX_RADIUS_FACTOR * self.maxradius
+        radius += _PAD
+        if radius >= maxradius:
+            return None
+        if self._atom_index is None:
+            ids = Numeric.nonzero(Numeric.greater_equal(self.radii_2, 0.0))
+            self._atom_index = CellListIndex(
+                Numeric.take(self.atpos, ids, 0), maxradius, ids)
+        interval = line_box_interval(point, direction,
+                                     self.center_lo, self.center_hi, radius)
+        if interval is None:
+            return Numeric.zeros(0, Int)
+        # Any atom center within radius of the line is within radius of
+        # some point on the line inside the box, so it's within maxradius
+        # of one of these sample points if they are spaced closely enough.
+        t1, t2 = interval
+        spacing = 2.0 * math.sqrt(maxradius ** 2 - radius ** 2) * 0.99
+        nsamples = int(math.ceil((t2 - t1) / spacing)) + 1
+        t = t1 + spacing * Numeric.arange(nsamples)
+        samples = A(point) + Numeric.reshape(t, (-1, 1)) * A(direction)
+        qi, ids = self._atom_index.neighbors_of(samples, maxradius)
+        if not len(ids):
+            return ids
+        ids = Numeric.sort(ids)
+        keep = Numeric.concatenate(([1], Numeric.not_equal(ids[1:], ids[:-1])))
+        return Numeric.compress(keep, ids)
+
+    pass
+
+class ChunkPickingIndex:
+    """
+    A persistent index over a changing list of chunks, which finds the
+    chunks (and atoms) which the line of sight for Chunk.findAtomUnderMouse
+    might hit.
+    """
+    def __init__(self):
+        self._entries = {} # maps id(chunk) to _ChunkEntry
+        self._tree = None
+        self._maxradius = 0.0 # >= maxradius of all entries in self._tree
+
+    def _update(self, chunks):
+        """
+        Make our entries correspond to the visible chunks among chunks.
+        """
+        entries = self._entries
+        changed = []
+        live = {}
+        for chunk in chunks:
+            if chunk.hidden or not chunk.atoms:
+                continue
+            key = id(chunk)
+            live[key] = 1
+            atpos = chunk.atpos
+            radii_2 = chunk.get_sel_radii_squared()
+            entry = entries.get(key)
+            if entry is None or not entry.is_valid(chunk, atpos, radii_2):
+                changed.append(_ChunkEntry(chunk, atpos, radii_2))
+        removed = [key for key in entries if not live.has_key(key)]
+        if not changed and not removed and self._tree is not None:
+            return
+        tree = self._tree
+        for key in removed:
+            del entries[key]
+            if tree is not None:
+                tree.remove(key)
+        for entry in changed:
+            key = id(entry.chunk)
+            entries[key] = entry
+            if tree is None:
+                continue
+            if entry.lo is None:
+                tree.remove(key)
+            else:
+                tree.move(key, entry.lo, entry.hi)
+                self._maxradius = max(self._maxradius, entry.maxradius)
+        if tree is None or \
+           tree.nadded() > max(_MIN_ADDED_FOR_REBUILD,
+                               _REBUILD_FRACTION * len(tree)):
+            self._rebuild()
+        return
+
+    def _rebuild(self):
+        boxed = [entry for entry in self._entries.itervalues()
+                 if entry.lo is not None]
+        self._tree = BoxTree([entry.lo for entry in boxed],
+                             [entry.hi for entry in boxed],
+                             [id(entry.chunk) for entry in boxed])
+        self._maxradius = max([0.0] + [entry.maxradius for entry in boxed])
+        return
+
+    def candidates(self, chunks, point, matrix, selatom = None):
+        """
+        Find the chunks among chunks which Chunk.findAtomUnderMouse(point,
+        matrix) might find atoms in, and the atoms in them it would need to
+        examine.
+
+        @param chunks: all chunks which might be hit (e.g. part.molecules);
+                       hidden chunks are ignored.
+
+        @param point, matrix: as for Chunk.findAtomUnderMouse.
+
+        @param selatom: the glpane's selatom (whose chunk, if visible,
+                        is always included, with selatom's index).
+
+        @return: a list of pairs (chunk, atom_indices), where atom_indices
+                 is to be passed to chunk.findAtomUnderMouse (it's None
+                 when all the chunk's atoms need to be examined),
+                 or None if this index can't be used for this matrix.
+        """
+        # The line of sight is point + t * z, where (x, y, z) are the columns
+        # of matrix; Chunk.findAtomUnderMouse treats an atom as hit when the
+        # components (along x and y) of its center's offset from that line
+        # are within its selection radius. The offset is perpendicular to z,
+        # as are x and y, and x and y are perpendicular and of equal length
+        # ("scale") but not always unit vectors, so an atom can be hit when
+        # its center is as far as (selection radius / scale) from the line.
+        x = matrix[:, 0]
+        z = matrix[:, 2]
+        scale = vlen(x)
+        if scale < _MIN_SCALE:
+            return None
+        self._update(chunks)
+        direction = z / vlen(z)
+        margin = self._maxradius * (1.0 / scale - 1.0) + _PAD
+        entries = self._entries
+        res = []
+        selatom_chunk = None
+        if selatom is not None and entries.has_key(id(selatom.molecule)):
+            selatom_chunk = selatom.molecule
+        for key in self._tree.along_line(point, direction, margin):
+            entry = entries[key]
+            atom_indices = entry.atom_indices_near_line(
+                point, direction, entry.maxradius / scale)
+            if entry.chunk is selatom_chunk:
+                selatom_chunk = None
+                if atom_indices is not None:
+                    atom_indices = Numeric.sort(Numeric.concatenate(
+                        (Numeric.compress(
+                            Numeric.not_equal(atom_indices, selatom.index),
+                            atom_indices),
+                         [selatom.index])))
+            res.append((entry.chunk, atom_indices))
+        if selatom_chunk is not None:
+            # its box was missed, so only selatom (whose radius is patched
+            # by Chunk.findAtomUnderMouse) might be hit
+            res.append((selatom_chunk, Numeric.array([selatom.index], Int)))
+        return res
+
+    pass
+
+# end
@@ -143,16 +143,24 @@ class Chunk_mmp_methods:
         # their bonds separately, in a more compact form.
         compact_bond_atoms = \
                            self.write_bonds_compactly_for_these_atoms(mapping)
-        for atom in self.atoms_in_mmp_file_order(mapping):
-            atom.writemmp(mapping,
-                          dont_write_bonds_for_these_atoms = compact_bond_atoms)
-                # note: this writes internal and/or external bonds,
-                # after their 2nd atom is written, unless both their
-                # atoms are in compact_bond_atoms. It also writes
-                # bond_directions records as needed for the bonds
-                # it writes.
-        if compact_bond_atoms: # (this test is required)
-            self.write_bonds_compactly(mapping)
+        atoms = self.atoms_in_mmp_file_order(mapping)
+        columns = mapping.atom_columns
+        if columns is not None and not compact_bond_atoms and \
+           columns.can_write_atoms(atoms, mapping):
+            # e.g. saving an mmpb file: give our atoms, and the bonds
+            # atom.writemmp would write, directly to it (with no mmp records)
+            columns.write_atoms(self, atoms, mapping)
+        else:
+            for atom in atoms:
+                atom.writemmp(mapping,
+                              dont_write_bonds_for_these_atoms = compact_bond_atoms)
+                    # note: this writes internal and/or external bonds,
+                    # after their 2nd atom is written, unless both their
+                    # atoms are in compact_bond_atoms. It also writes
+                    # bond_directions records as needed for the bonds
+                    # it writes.
+            if compact_bond_atoms: # (this test is required)
+                self.write_bonds_compactly(mapping)
         self.writemmp_info_chunk_after_atoms(mapping)
         return
 
@@ -751,12 +751,24 @@ class PAM_Atom_methods:
         Write the mmp info record (or similar extra data)
         which represents a non-default value of self._PAM3plus5_Pl_Gv_data.
         """
+        mapping.write( "info atom %s\n" %
+                       self._f_PAM3plus5_Pl_Gv_data_text( mapping))
+        return
+
+    def _f_PAM3plus5_Pl_Gv_data_text( self, mapping):
+        """
+        [friend method for _writemmp_PAM3plus5_Pl_Gv_data and the mmpb
+         file writer (files_mmpb.py)]
+
+        Return the "+5data = ..." part of the info atom record
+        which represents a non-default value of self._PAM3plus5_Pl_Gv_data.
+        """
         vecs = self._PAM3plus5_Pl_Gv_data
         assert vecs is not None
         # should be a list of 3 standard "atom position vectors"
         # (they are relative rather than absolute, but can still
         #  be written in the same manner as atom positions)
-        record = "info atom +5data =" # will be extended below
+        record = "+5data =" # will be extended below
         for vec in vecs:
             if vec is None:
                 vecstring = " ()" # (guessing this is easier to read than None)
@@ -766,9 +778,7 @@ class PAM_Atom_methods:
                     # note: 4 of these chars could be left out if we wanted to
                     # optimize the format
             record += vecstring
-        record += "\n"
-        mapping.write( record)
-        return
+        return record
 
     def _readmmp_3plus5_data(self, key, val, interp): #bruce 080523
         """
@@ -25,7 +25,7 @@ Bruce 090219 moved everything related to DrawingSets elsewhere.
 from utilities.debug import print_compact_stack
 from utilities.prefs_constants import indicateOverlappingAtoms_prefs_key
 
-from geometry.NeighborhoodGenerator import NeighborhoodGenerator
+from geometry.CellListIndex import AtomCellListIndex
 
 import foundation.env as env
 
@@ -86,10 +86,10 @@ class Part_drawing_frame(_Part_drawing_frame_superclass):
                 # (each atom could be asked whether it's too close to each
                 #  other one, and take all this into account). If we do that,
                 # this value should be the largest tolerance for any pair
-                # of atoms, and the code that uses this NeighborhoodGenerator
+                # of atoms, and the code that uses this AtomCellListIndex
                 # should do more filtering on the results. [bruce 080411]
             self._f_state_for_indicate_overlapping_atoms = \
-                NeighborhoodGenerator( [], TOO_CLOSE, include_singlets = True )
+                AtomCellListIndex( [], TOO_CLOSE, include_singlets = True )
             pass
 
         return
@@ -105,6 +105,7 @@ from PyQt4 import QtGui
 from foundation.Assembly_API import Assembly_API
 import foundation.undo_manager as undo_manager
 from files.mmp.files_mmp_writing import writemmpfile_assy
+from files.mmp.files_mmpb import writemmpbfile_assy
 
 # ==
 
@@ -1741,6 +1742,14 @@ class Assembly( StateMixin, Assembly_API):
         _options.update(options)
         writemmpfile_assy( self, filename, **_options)
 
+    def writemmpbfile(self, filename, **options):
+        """
+        Like writemmpfile, but write a binary mmpb file (see files_mmpb.py).
+        """
+        _options = dict(addshelf = True)
+        _options.update(options)
+        writemmpbfile_assy( self, filename, **_options)
+
     def get_cwd(self):
         """
         Returns the current working directory for assy.
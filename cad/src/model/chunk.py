@@ -134,6 +134,7 @@ from model.elements import PeriodicTable
 from model.elements import Singlet
 from model.ExternalBondSet import ExternalBondSet
 from model.global_model_changedicts import _changed_parent_Atoms
+from model.global_model_changedicts import _changed_posn_Atoms
 
 from model.Chunk_Dna_methods import Chunk_Dna_methods
 from graphics.model_drawing.ChunkDrawer import ChunkDrawer
@@ -1331,6 +1332,51 @@ class Chunk(Chunk_Dna_methods, Chunk_mmp_methods,
             ##k verify this also invals basepos, or add that to the arg of this call
         return
 
+    def _f_undo_update_atom_posns(self, atoms):
+        """
+        [friend method for undo_archive]
+
+        Undo or Redo has just set the positions (._posn) of the given atoms
+        of self, and changed nothing else about them (so their _undo_update
+        methods won't be called). Do the updates which Atom.setposn would
+        do for each of them, but only once for self.
+        """
+        for atom in atoms:
+            # inlines the parts of Atom._f_setposn_no_chunk_or_bond_invals
+            # which don't set atom._posn
+            _changed_posn_Atoms[atom.key] = atom
+            if atom.jigs:
+                for jig in atom.jigs[:]:
+                    jig.moved_atom(atom)
+            for bond in atom.bonds:
+                bond.setup_invalidate()
+        self.changed_atom_posn()
+        return
+
+    def _f_move_atoms_to_posns(self, indices, posns):
+        """
+        [friend method for ChunkwiseAtomMover]
+
+        Move the atoms at the given indices in self.atlist (a sequence of
+        ints) to the given absolute positions (an array of the same
+        length), doing the invals which Atom.setposn would do for each of
+        them, but only once for self.
+
+        This works like mol.stretch: it sets the new basepos, and lets
+        _changed_basepos_basecenter_or_quat_to_move_atoms recompute atpos
+        and set our atoms' positions from it.
+        """
+        if not len(indices):
+            return
+        basepos = array(self.basepos) # copy (and recompute if necessary)
+        flat_indices = Numeric.ravel(add.outer(3 * array(indices), (0, 1, 2)))
+        # (like self.abs_to_base, but for an array of points)
+        newbasepos = self.quat.vunrot(posns - self.basecenter)
+        Numeric.put(basepos, flat_indices, Numeric.ravel(newbasepos))
+        self.basepos = basepos
+        self._changed_basepos_basecenter_or_quat_to_move_atoms()
+        return
+
     # for __getattr__, validate_attr, invalidate_attr, etc, see InvalMixin
 
     # [bruce 041111 says:]
@@ -2455,7 +2501,7 @@ class Chunk(Chunk_Dna_methods, Chunk_mmp_methods,
     # and many other bugs (mostly never reported). [bruce 041214]
     # (We should use this in extrude, too! #e)
 
-    def findAtomUnderMouse( self, point, matrix, **kws):
+    def findAtomUnderMouse( self, point, matrix, atom_indices = None, **kws):
         """
         [Public method, but for a more convenient interface see its caller:]
         For each visible atom or singlet (using current display modes and radii,
@@ -2480,12 +2526,21 @@ class Chunk(Chunk_Dna_methods, Chunk_mmp_methods,
         do for individual molecules (it would make them fail to obscure atoms in
         other molecules for selection, even when they are drawn over them).
         See our caller in assembly for that.
+           If atom_indices is passed, it must be a sorted Numeric array of
+        indices into self.atlist which includes all atoms the line might hit
+        (and selatom, if it's in self), e.g. as found by a ChunkPickingIndex;
+        then only those atoms are examined (with the same result).
         """
         if not self.atoms:
             return []
         #e Someday also check self.bbox as a speedup -- but that might be slower
         #  when there are only a few atoms.
+        #  (ChunkPickingIndex now does that for our caller in ops_select.)
         atpos = self.atpos # a Numeric array; might be recomputed here
+        if atom_indices is not None:
+            if not len(atom_indices):
+                return []
+            atpos = take(atpos, atom_indices, 0)
 
         # assume line of sight hits water surface (parallel to screen) at point
         # (though the docstring doesn't mention this assumption since it is
@@ -2520,10 +2575,22 @@ class Chunk(Chunk_Dna_methods, Chunk_mmp_methods,
         radii_2 = self.get_sel_radii_squared() # might be recomputed now
         assert len(radii_2) == len(self.atoms)
         selatom = self.assy.o.selatom
-        unpatched_seli_radius2 = None
+        seli = None
         if selatom is not None and selatom.molecule is self:
-            # need to patch for selatom, and warn subr of its smaller radii too
             seli = selatom.index
+        if atom_indices is not None:
+            radii_2 = take(radii_2, atom_indices) # (a copy)
+            if seli is not None:
+                # index of selatom in atom_indices, if it's there
+                where = nonzero(atom_indices == seli)
+                if len(where):
+                    seli = where[0]
+                else:
+                    seli = None
+            kws['atom_indices'] = atom_indices
+        unpatched_seli_radius2 = None
+        if seli is not None:
+            # need to patch for selatom, and warn subr of its smaller radii too
             unpatched_seli_radius2 = radii_2[seli]
             radii_2[seli] = selatom.highlighting_radius() ** 2
             # (note: selatom is drawn even if "invisible")
@@ -2542,7 +2609,8 @@ class Chunk(Chunk_Dna_methods, Chunk_mmp_methods,
     def _findAtomUnderMouse_Numeric_stuff(self, v, r_xy_2, radii_2,
                                           far_cutoff = None,
                                           near_cutoff = None,
-                                          alt_radii = ()
+                                          alt_radii = (),
+                                          atom_indices = None
                                          ):
         """
         private helper routine for findAtomUnderMouse
@@ -2623,6 +2691,10 @@ class Chunk(Chunk_Dna_methods, Chunk_mmp_methods,
             if closest_z < far_cutoff:
                 return []
 
+        if atom_indices is not None:
+            # our arrays only cover these atoms
+            closest_z_ind = atom_indices[ closest_z_ind ]
+
         atom = self.atlist[ closest_z_ind ]
 
         return [(closest_z, atom)] # from _findAtomUnderMouse_Numeric_stuff
@@ -453,6 +453,7 @@ class Jig(NodeWith3DContents, Selobj_API):
         """
         #bruce 071127 renamed this Jig API method, rematom -> remove_atom
         self.atoms.remove(atom)
+        self._changed_undoable_state() # since we modified self.atoms in place
         # also remove self from atom's list of jigs
         atom._f_jigs_remove(self,
                             changed_structure = self._affects_atom_structure )
@@ -22,9 +22,11 @@ TODO: make this directly accessible as one or more user operations.
 # Translation into Python of Lisp code contributed by Dr. K. Eric Drexler.
 # Some comments are from contributed code, perhaps paraphrased.
 
-#e Plans: for efficiency, we'll further translate this into Pyrex or C, and/or combine
-# with atom-position hashtable rather than scanning all pairs of atoms.
-# This implem is just for testing and experimentation.
+#e Plans: for efficiency, we'll further translate this into Pyrex or C.
+# (Candidate pairs are now found with a cell-list spatial index, filtered
+#  by distance in one batched Numeric pass, and made in cost order using a
+#  heap whose entries are only re-costed when one of their atoms has gained
+#  a bond since they were last costed -- see make_bonds.)
 
 # This code does not yet consider the possibility of non-sp3 atomtypes,
 # and will need changes to properly handle those.
@@ -32,6 +34,9 @@ TODO: make this directly accessible as one or more user operations.
 # perhaps plus some extra too-long bonds at the end, if permitted by valence.
 
 import math
+from heapq import heapify, heappop, heappush
+
+import Numeric
 
 from geometry.VQT import vlen
 from geometry.VQT import atom_angle_radians
@@ -39,7 +44,8 @@ from geometry.VQT import atom_angle_radians
 import foundation.env as env
 
 from model.bonds import bond_atoms_faster
-from geometry.NeighborhoodGenerator import NeighborhoodGenerator
+from geometry.CellListIndex import AtomCellListIndex
+from geometry.CellListIndex import CellListIndex
 
 from model.bond_constants import atoms_are_bonded # was: from bonds import bonded
 from model.bond_constants import V_SINGLE
@@ -321,31 +327,177 @@ def bond_cost(atm1, atm2):
     ec = bond_element_cost(atm1, atm2)
     return ac + dc + ec
 
-def list_potential_bonds(atmlist0):
+class _BondInferenceTables:
+    """
+    Values used by bond_cost which depend only on elements (max and min
+    bonds, ideal single bond lengths for each pair of elements), computed
+    once per element (or pair) rather than once per potential bond, and
+    each atom's number of real neighbors, kept up to date by make_bonds
+    as it bonds them (instead of calling realNeighbors on every cost
+    evaluation).
+
+    All these values are computed by the same functions bond_cost uses, so
+    _bond_cost below returns exactly what bond_cost would.
+    """
+    def __init__(self):
+        self._element_bonds = {} # maps element to (min bonds, max bonds)
+        self._ideal_lengths = {} # maps (element1, element2) to idealBondLength
+        # the following map atom.key to values for atoms passed to add_atom:
+        self.nbonds = {} # number of real neighbors
+        self.minbonds = {} # min_atom_bonds
+        self.maxbonds = {} # max_atom_bonds
+        return
+
+    def add_atom(self, atom):
+        """
+        Record atom's values, if we haven't already.
+        """
+        key = atom.key
+        if self.nbonds.has_key(key):
+            return
+        elt = atom.element
+        try:
+            minb, maxb = self._element_bonds[elt]
+        except KeyError:
+            minb, maxb = self._element_bonds[elt] = (min_atom_bonds(atom),
+                                                     max_atom_bonds(atom))
+        self.nbonds[key] = len(atom.realNeighbors())
+        self.minbonds[key] = minb
+        self.maxbonds[key] = maxb
+        return
+
+    def ideal_length(self, atm1, atm2):
+        elts = (atm1.element, atm2.element)
+        try:
+            return self._ideal_lengths[elts]
+        except KeyError:
+            res = self._ideal_lengths[elts] = idealBondLength(atm1, atm2)
+            return res
+        pass
+
+    def is_hungry(self, atom):
+        """
+        [atom must have been passed to add_atom]
+        """
+        return self.nbonds[atom.key] < self.minbonds[atom.key]
+
+    def bondable_atm(self, atom):
+        """
+        Return bondable_atm(atom), recording atom's values if necessary.
+        """
+        self.add_atom(atom)
+        return self.nbonds[atom.key] < self.maxbonds[atom.key]
+
+    pass
+
+def _bond_cost(atm1, atm2, tables, _enegs = _enegs):
+    """
+    Return bond_cost(atm1, atm2), using (and assuming up to date)
+    the given _BondInferenceTables, to which both atoms must have
+    been added.
+    """
+    # this is bond_cost with its helper functions inlined
+    key1 = atm1.key
+    key2 = atm2.key
+    nbonds = tables.nbonds
+    n1 = nbonds[key1]
+    n2 = nbonds[key2]
+    maxbonds = tables.maxbonds
+    if not (n1 < maxbonds[key1] and n2 < maxbonds[key2]):
+        return None
+    if (n1 or n2) and atoms_are_bonded(atm1, atm2):
+        return None
+    distance = atm_distance(atm1, atm2)
+    best_dist = tables.ideal_length(atm1, atm2)
+    if not best_dist:
+        return None
+    ratio = distance / best_dist
+    minbonds = tables.minbonds
+    if n1 < minbonds[key1] or n2 < minbonds[key2]:
+        max_ratio = MAX_DIST_RATIO_HUNGRY
+    else:
+        max_ratio = MAX_DIST_RATIO_NON_HUNGRY
+    if not (ratio < max_ratio):
+        return None
+    if ratio < 1.0:
+        dc = ratio * 0.01
+    else:
+        dc = 0.01 + DIST_COST_FACTOR * (ratio - 1.0) ** 2
+    if n1 or n2:
+        ac = atm_angle_cost(atm1, atm2, ratio)
+        if ac is None:
+            return None
+    else:
+        ac = 0.0 # no bond angles include this bond
+    if atm1.element.symbol in _enegs and atm2.element.symbol in _enegs:
+        ec = 1.0
+    else:
+        ec = 0.0
+    return ac + dc + ec
+
+def list_potential_bonds(atmlist0, _tables = None):
     """
     Given a list of atoms, return a list of triples (cost, atm1, atm2) for all bondable pairs of atoms in the list.
     Each pair of atoms is considered separately, as if only it would be bonded, in addition to all existing bonds.
     In other words, the returned bonds can't necessarily all be made (due to atom valence), but any one alone can be made,
     in addition to whatever bonds the atoms currently have.
-       Warning: the current implementation takes quadratic time in len(atmlist0). The return value will have reasonable
-    size for physically realistic atmlists, but could be quadratic in size for unrealistic ones (e.g. if all atom
-    positions were compressed into a small region of space).
+       The candidate pairs are found with a cell-list spatial index, in time roughly linear in len(atmlist0),
+    and most of them are rejected by a single batched (Numeric) comparison of their lengths to their maximum
+    permitted lengths, before any per-pair cost is computed.
+    The return value will have reasonable size for physically realistic atmlists, but could be quadratic in size
+    for unrealistic ones (e.g. if all atom positions were compressed into a small region of space).
     """
-    atmlist = filter( bondable_atm, atmlist0 )
-    lst = []
+    tables = _tables or _BondInferenceTables()
+    atmlist = [atm for atm in atmlist0
+               if not atm.is_singlet() and tables.bondable_atm(atm)]
+    # sort by key, so each pair found below has atm2.key < atm1.key,
+    # as in the per-atom loop this replaced
+    atmlist.sort(key = lambda atm: atm.key)
     maxBondLength = 2.0
-    ngen = NeighborhoodGenerator(atmlist, maxBondLength)
-    for atm1 in atmlist:
-        key1 = atm1.key
-        pos1 = atm1.posn()
-        for atm2 in ngen.region(pos1):
-            bondLen = vlen(pos1 - atm2.posn())
-            idealBondLen = idealBondLength(atm1, atm2)
-            if atm2.key < key1 and bondLen < max_dist_ratio(atm1, atm2) * idealBondLen:
-                # i.e. for each pair (atm1, atm2) of bondable atoms
-                cost = bond_cost(atm1, atm2)
-                if cost is not None:
-                    lst.append((cost, atm1, atm2))
+    index = CellListIndex([atm.posn() for atm in atmlist], maxBondLength)
+    ids2, ids1, dist2 = index.pairs_within(return_dist2 = True)
+    if not len(ids1):
+        return []
+    # Batched distance pass: compare every candidate pair's squared length
+    # to its squared maximum permitted length (max_dist_ratio times its ideal
+    # length), which depends only on its elements and on whether either atom
+    # is hungry; only the pairs which pass get their full cost computed.
+    # (This is not bitwise the same as comparing lengths, so we let through
+    #  pairs within a tiny margin of the limit; _bond_cost does the exact
+    #  test on the length ratio, and rejects them if they are too long.)
+    elements = [] # one representative atom of each element
+    elt_codes = {} # maps element to its index in elements
+    atom_codes = []
+    hungry = []
+    for atm in atmlist:
+        code = elt_codes.get(atm.element)
+        if code is None:
+            code = elt_codes[atm.element] = len(elements)
+            elements.append(atm)
+        atom_codes.append(code)
+        hungry.append(tables.is_hungry(atm))
+    nelts = len(elements)
+    limits = [] # squared limits, indexed by (code1 * nelts + code2) * 2 + hungry
+    for atm1 in elements:
+        for atm2 in elements:
+            ideal = tables.ideal_length(atm1, atm2)
+            for ratio in (MAX_DIST_RATIO_NON_HUNGRY, MAX_DIST_RATIO_HUNGRY):
+                limit = ratio * ideal
+                limits.append(limit * limit * (1.0 + 1e-9))
+    atom_codes = Numeric.array(atom_codes)
+    hungry = Numeric.array(hungry)
+    pair_codes = ((Numeric.take(atom_codes, ids1) * nelts +
+                   Numeric.take(atom_codes, ids2)) * 2 +
+                  Numeric.logical_or(Numeric.take(hungry, ids1),
+                                     Numeric.take(hungry, ids2)))
+    maxdist2 = Numeric.take(Numeric.array(limits), pair_codes)
+    keep = Numeric.nonzero(Numeric.less(dist2, maxdist2))
+    lst = []
+    for atm1, atm2 in zip( [atmlist[i] for i in Numeric.take(ids1, keep).tolist()],
+                           [atmlist[i] for i in Numeric.take(ids2, keep).tolist()] ):
+        cost = _bond_cost(atm1, atm2, tables)
+        if cost is not None:
+            lst.append((cost, atm1, atm2))
     lst.sort() # least cost first
     return lst
 
@@ -354,46 +506,52 @@ def make_bonds(atmlist, bondtyp = V_SINGLE):
     Make some bonds between the given atoms. At any moment make the cheapest permitted unmade bond;
     stop only when no more bonds are permitted (i.e. all potential bonds have infinite cost).
        Assume that newly made bonds can never decrease the cost of potential bonds.
-    (This is needed to justify the algorithm, which moves potential bonds later in an ordered list
+    (This is needed to justify the algorithm, which moves potential bonds later in a priority queue
     when their cost has increased since last checked;
     it's true since the bond cost (as defined elsewhere in this module) is a sum of terms,
     and adding a bond can add new terms but doesn't change the value of any existing terms.)
        Return the number of bonds created.
     """
-    # Implementation note: the only way I know of to do this efficiently is to use a linked list
-    # (as the Lisp code did), even though this is less natural in Python.
-    bondlst0 = list_potential_bonds(atmlist) # a list of triples (cost, atm1, atm2)
-    bondlst = linked_list(bondlst0, list) # arg2 (list) is a function to turn the triple (cost, atm1, atm2) into a list.
-        # value is a list [[cost, atm1, atm2], next]; needs to be mutable in next and cost elements
-        # (Note: Lisp code used a Lisp linked list of triples, (cost atm1 atm2 . next), but all Lisp lists are mutable.)
+    # The contributed code kept the potential bonds in a linked list sorted
+    # by their last computed cost, and whenever the cost of the first one
+    # had increased beyond that of the next one, it moved it down the list
+    # by a linear walk. We keep them in a heap instead, which is equivalent:
+    # entries are ordered by (cost, tiebreak), where tiebreak is the
+    # original list position for initial entries, and decreasing negative
+    # numbers for moved entries (since the linked list code inserted moved
+    # entries before any others of equal cost).
+    #    A potential bond's cost depends only on its atoms' positions and
+    # elements and on the bonds they already have, so it can only change
+    # when one of its atoms gains a bond; each entry records the real
+    # neighbor counts of its atoms when it was costed, and is only re-costed
+    # if one of those has changed.
+    tables = _BondInferenceTables()
+    nbonds = tables.nbonds
+    heap = []
+    for cost, atm1, atm2 in list_potential_bonds(atmlist, tables):
+        heap.append( (cost, len(heap), atm1, atm2,
+                      nbonds[atm1.key], nbonds[atm2.key]) )
+    heapify(heap) # (already a heap, since it's sorted)
+    moved = 0
     res = 0
-    while bondlst:
-        entry, bondlst = bondlst
-            # original code assumed this was too early to change bondlst -- we might insert a new element right after entry;
-            # but I think that's not possible, so we can move forward now [bruce 050906]
-        oldcostjunk, atm1, atm2 = entry
-        cost = bond_cost(atm1, atm2) # might be different than last recorded cost
-            #e optim: could invalidate changed costs, avoid recomputing some of them, incrementally adjust others
-        if cost is not None:
-            if (bondlst is None) or bondlst[0][0] >= cost:
-                # if there's no next-best bond, or its cost is no better than this one's, make this bond
-                bond_atoms_faster(atm1, atm2, bondtyp) # optimized bond_atoms, and doesn't make any open bonds
-                res += 1
-            else:
-                # cost has increased beyond next bond in list -- update entry and move it down list
-                entry[0] = cost
-                curr = bondlst # loop variable - next possible list element after which we might insert entry
-                while 1:
-                    # (at this point, we know curr is not None, and we already compared cost to curr[0][0])
-                    junk, next = curr
-                    if (next is None) or next[0][0] >= cost:
-                        break # found insertion point: right after curr, before next (next might be None)
-                    curr = next
-                assert curr[1] is next #e remove when works
-                # insert entry after curr, before next
-                curr[1] = [entry, next]
-            pass
-        pass
+    while heap:
+        cost, junk, atm1, atm2, n1, n2 = heappop(heap)
+        key1, key2 = atm1.key, atm2.key
+        if n1 != nbonds[key1] or n2 != nbonds[key2]:
+            cost = _bond_cost(atm1, atm2, tables) # might be different than last recorded cost
+            if cost is None:
+                continue
+        if (not heap) or heap[0][0] >= cost:
+            # if there's no next-best bond, or its cost is no better than this one's, make this bond
+            bond_atoms_faster(atm1, atm2, bondtyp) # optimized bond_atoms, and doesn't make any open bonds
+            nbonds[key1] += 1
+            nbonds[key2] += 1
+            res += 1
+        else:
+            # cost has increased beyond next bond in queue -- move this one later
+            moved -= 1
+            heappush(heap, (cost, moved, atm1, atm2, nbonds[key1], nbonds[key2]))
+        continue
     return res
 
 # end of translation of contributed code
@@ -409,16 +567,10 @@ def inferBonds(mol): # [probably by Will; TODO: needs docstring]
     # first remove any coincident singlets
     singlets = filter(lambda a: a.is_singlet(), mol.atoms.values())
     removable = { }
-    sngen = NeighborhoodGenerator(singlets, maxBondLength)
-    for sing1 in singlets:
-        key1 = sing1.key
-        pos1 = sing1.posn()
-        for sing2 in sngen.region(pos1):
-            key2 = sing2.key
-            dist = vlen(pos1 - sing2.posn())
-            if key1 != key2:
-                removable[key1] = sing1
-                removable[key2] = sing2
+    sngen = AtomCellListIndex(singlets, maxBondLength)
+    for sing1, sing2 in sngen.atom_pairs_within():
+        removable[sing1.key] = sing1
+        removable[sing2.key] = sing2
     for badGuy in removable.values():
         badGuy.kill()
     from operations.bonds_from_atoms import make_bonds
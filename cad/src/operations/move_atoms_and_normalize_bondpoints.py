@@ -10,9 +10,22 @@ History:
 
 090112 renamed from move_alist_and_snuggle, moved into new file from chem.py
 
+ChunkwiseAtomMover does the same thing for a fixed list of atoms which is
+moved many times (e.g. to each frame of a movie, or of a realtime sim
+run), doing most of the work once per chunk rather than once per atom.
 """
 
+import Numeric
+
 from geometry.VQT import A
+from utilities.debug_prefs import debug_pref, Choice_boolean_True
+
+def debug_pref_move_atoms_chunkwise():
+    res = debug_pref("Movies: move atoms chunk by chunk?",
+                     Choice_boolean_True, # use False to move them one by one
+                     prefs_key = True
+                 )
+    return res
 
 def move_atoms_and_normalize_bondpoints(alist, newPositions):
     """
@@ -54,4 +67,91 @@ def move_atoms_and_normalize_bondpoints(alist, newPositions):
         a.snuggle() # includes a.setposn
     return
 
+# ==
+
+class ChunkwiseAtomMover:
+    """
+    Move the atoms in a fixed list to the positions in a series of arrays,
+    correcting bondpoint positions like move_atoms_and_normalize_bondpoints.
+
+    The atoms are grouped by chunk once, and each chunk's atoms are moved
+    together by a few Numeric operations and one set of chunk invals
+    (see Chunk._f_move_atoms_to_posns), so the per-frame Python work is
+    proportional to the number of chunks (and bondpoints) rather than
+    the number of atoms. The grouping is redone when any chunk's atoms
+    change (which also catches killed atoms and atoms moved into other
+    chunks).
+    """
+    def __init__(self, alist):
+        self.alist = list(alist)
+        self._groups = None # list of (chunk, atlist, chunk_indices, indices)
+        self._loose_atoms = None # list of (atom, index) for killed atoms
+        self._singlets = None
+        return
+
+    def __len__(self):
+        return len(self.alist)
+
+    def _groups_are_valid(self):
+        if self._groups is None:
+            return False
+        for chunk, atlist, chunk_indices, indices in self._groups:
+            if chunk.__dict__.get('atlist') is not atlist:
+                return False
+        return True
+
+    def _group_atoms(self):
+        groups = {} # id(chunk) -> (chunk, atlist, chunk_indices, indices)
+        loose = []
+        singlets = []
+        for i in xrange(len(self.alist)):
+            atom = self.alist[i]
+            if atom.killed():
+                loose.append((atom, i))
+            else:
+                chunk = atom.molecule
+                group = groups.get(id(chunk))
+                if group is None:
+                    group = groups[id(chunk)] = (chunk, chunk.atlist, [], [])
+                        # (accessing chunk.atlist sets atom.index)
+                group[2].append(atom.index)
+                group[3].append(i)
+            if atom.is_singlet():
+                singlets.append(atom)
+        self._groups = [(chunk, atlist, chunk_indices, Numeric.array(indices))
+                        for (chunk, atlist, chunk_indices, indices)
+                        in groups.itervalues()]
+        self._loose_atoms = loose
+        self._singlets = singlets
+        return
+
+    def move_atoms(self, newPositions, scale = None):
+        """
+        Move our atoms to newPositions (a Numeric array of shape (n, 3),
+        in the order of our atom list, multiplied by scale if it's given),
+        then correct the bondpoint positions. Do all needed invals, but
+        no gl_update.
+        """
+        assert len(newPositions) == len(self.alist)
+        newPositions = Numeric.asarray(newPositions) # (e.g. if it's a list)
+        if not self._groups_are_valid():
+            self._group_atoms()
+        for chunk, atlist, chunk_indices, indices in self._groups:
+            posns = Numeric.take(newPositions, indices, 0)
+            if scale is not None:
+                posns = posns * scale
+            chunk._f_move_atoms_to_posns(chunk_indices, posns)
+        for atom, i in self._loose_atoms:
+            pos = A(newPositions[i])
+            if scale is not None:
+                pos = pos * scale
+            atom.setposn(pos)
+        # (as in move_atoms_and_normalize_bondpoints, this must come last)
+        for atom in self._singlets:
+            if atom.is_singlet(): # (might have been transmuted)
+                atom.snuggle()
+        return
+
+    pass
+
 # end
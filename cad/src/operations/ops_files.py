@@ -758,6 +758,7 @@ class fileSlotsMixin: #bruce 050907 moved these methods out of class MWsemantics
         """
         formats = \
                 "Molecular Machine Part (*.mmp);;"\
+                "Molecular Machine Part, binary (*.mmpb);;"\
                 "All Files (*.*)"
         self.fileInsert(formats)
 
@@ -991,7 +992,7 @@ class fileSlotsMixin: #bruce 050907 moved these methods out of class MWsemantics
                 env.history.message( redmsg( "File not found: [ " + fn+ " ]") )
                 return
 
-            if fn[-3:] == "mmp":
+            if fn[-3:] == "mmp" or fn[-5:] == ".mmpb":
                 try:
                     success_code = insertmmp(self.assy, fn)
                 except:
@@ -1098,6 +1099,7 @@ class fileSlotsMixin: #bruce 050907 moved these methods out of class MWsemantics
         else:
             formats = \
                     "Molecular Machine Part (*.mmp);;"\
+                    "Molecular Machine Part, binary (*.mmpb);;"\
                     "GROMACS Coordinates (*.gro);;"\
                     "All Files (*.*)"
 
@@ -1176,7 +1178,7 @@ class fileSlotsMixin: #bruce 050907 moved these methods out of class MWsemantics
 
             ok = SUCCESS
 
-            if fn[-3:] == "mmp":
+            if fn[-3:] == "mmp" or fn[-5:] == ".mmpb":
                 ok, listOfAtoms = readmmp(self.assy,
                                           fn,
                                           showProgressDialog = True,
@@ -1201,7 +1203,7 @@ class fileSlotsMixin: #bruce 050907 moved these methods out of class MWsemantics
                 if ok == SUCCESS and (gromacsCoordinateFile):
                     #bruce 080606 added condition ok == SUCCESS (likely bugfix)
                     newPositions = readGromacsCoordinates(gromacsCoordinateFile, listOfAtoms)
-                    if (type(newPositions) == type([])):
+                    if (type(newPositions) != type("")):
                         move_atoms_and_normalize_bondpoints(listOfAtoms, newPositions)
                     else:
                         env.history.message(redmsg(newPositions))
@@ -1433,8 +1435,10 @@ class fileSlotsMixin: #bruce 050907 moved these methods out of class MWsemantics
         @rtype:  string
         """
         currentFilename = self.getCurrentFilename()
-        format = "Molecular Machine Part (*.mmp)"
-        sfilter = QString(format)
+        format = \
+               "Molecular Machine Part (*.mmp);;"\
+               "Molecular Machine Part, binary (*.mmpb)"
+        sfilter = QString("Molecular Machine Part (*.mmp)")
         options = QFileDialog.DontConfirmOverwrite
             # this fixes bug 2380 [bruce 070619]
             # Note: we can't fix that bug by removing our own confirmation
@@ -1472,10 +1476,12 @@ class fileSlotsMixin: #bruce 050907 moved these methods out of class MWsemantics
         fn = str_or_unicode(fn)
         dir, fil, ext2 = _fileparse(fn)
         del fn #bruce 050927
-        ext = str(sfilter[-5:-1])
+        sfilter = str(sfilter)
+        ext = sfilter[sfilter.rindex("(*") + 2 : -1]
             # Get "ext" from the sfilter. It *can* be different from "ext2"!!!
             # Note: As of 2008-01-23, only the MMP extension is supported.
             # This may change in the future. Mark 2008-01-23.
+            # (Now the binary MMPB extension is supported too.)
         safile = dir + fil + ext # full path of "Save As" filename
 
         # Ask user before overwriting an existing file
@@ -1551,7 +1557,7 @@ class fileSlotsMixin: #bruce 050907 moved these methods out of class MWsemantics
         dir, fil, ext = _fileparse(safile)
             #e only ext needed in most cases here, could replace with os.path.split [bruce 050907 comment]
 
-        if ext == ".mmp" : # Write MMP file.
+        if ext in (".mmp", ".mmpb"): # Write MMP (or binary MMPB) file.
             self.save_mmp_file(safile, brag = brag, savePartFiles = savePartFiles)
             self.setCurrentWorkingDirectory() # Update the CWD.
 
@@ -1667,7 +1673,10 @@ class fileSlotsMixin: #bruce 050907 moved these methods out of class MWsemantics
         tmpname = "" # in case of exceptions
         try:
             tmpname = os.path.join(dir, '~' + fil + '.m~')
-            self.assy.writemmpfile(tmpname, **options)
+            if extjunk == ".mmpb":
+                self.assy.writemmpbfile(tmpname, **options)
+            else:
+                self.assy.writemmpfile(tmpname, **options)
         except:
             #bruce 050419 revised printed error message
             print_compact_traceback( "Problem writing file [%s]: " % safile )
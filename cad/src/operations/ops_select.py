@@ -29,6 +29,7 @@ from utilities.debug import print_compact_traceback
 from utilities import debug_flags
 from platform_dependent.PlatformDependent import fix_plurals
 from utilities.GlobalPreferences import permit_atom_chunk_coselection
+from utilities.debug_prefs import debug_pref, Choice_boolean_True
 from utilities.icon_utilities import geticon
 
 from dna.model.DnaGroup import DnaGroup
@@ -41,6 +42,8 @@ from dna.model.DnaMarker import DnaMarker
 from dna.model.DnaSegment import DnaSegment
 from cnt.model.NanotubeSegment import NanotubeSegment
 
+from model.ChunkPickingIndex import ChunkPickingIndex
+
 # Object flags, used by objectSelected() and its callers.
 ATOMS = 1
 CHUNKS = 2
@@ -124,11 +127,21 @@ def renameableLeafNode(obj, groups_renameable = False): # probably by Mark
 
     return True
 
+def debug_pref_pick_with_chunk_index():
+    res = debug_pref("Picking: use chunk spatial index (faster)?",
+                     Choice_boolean_True, # use False to examine every chunk
+                     prefs_key = True
+                 )
+    return res
+
 class ops_select_Mixin:
     """
     Mixin class for providing selection methods to class L{Part}.
     """
 
+    # ChunkPickingIndex for findAtomUnderMouse, made when first needed
+    _chunk_picking_index = None
+
     # functions from the "Select" menu
     # [these are called to change the set of selected things in this part,
     #  when it's the current part; these are event handlers which should
@@ -905,12 +918,28 @@ class ops_select_Mixin:
         else:
             far_cutoff = None
         z_atom_pairs = []
-        for mol in self.molecules:
-            if mol.hidden:
-                continue
-            pairs = mol.findAtomUnderMouse(point, matrix, \
-                                           far_cutoff = far_cutoff, near_cutoff = near_cutoff )
-            z_atom_pairs.extend( pairs)
+        candidates = None
+        if debug_pref_pick_with_chunk_index():
+            # only examine the chunks (and atoms) which the line of sight
+            # might hit; this finds the same atom as examining them all
+            if self._chunk_picking_index is None:
+                self._chunk_picking_index = ChunkPickingIndex()
+            candidates = self._chunk_picking_index.candidates(
+                self.molecules, point, matrix, self.o.selatom)
+        if candidates is not None:
+            for mol, atom_indices in candidates:
+                pairs = mol.findAtomUnderMouse(point, matrix,
+                                               atom_indices = atom_indices,
+                                               far_cutoff = far_cutoff,
+                                               near_cutoff = near_cutoff )
+                z_atom_pairs.extend( pairs)
+        else:
+            for mol in self.molecules:
+                if mol.hidden:
+                    continue
+                pairs = mol.findAtomUnderMouse(point, matrix, \
+                                               far_cutoff = far_cutoff, near_cutoff = near_cutoff )
+                z_atom_pairs.extend( pairs)
         if not z_atom_pairs:
             return None
         z_atom_pairs.sort() # smallest z == farthest first; we want nearest
@@ -34,8 +34,9 @@ from PM.PM_DoubleSpinBox import PM_DoubleSpinBox
 from PM.PM_Constants import PM_DONE_BUTTON
 from PM.PM_Constants import PM_WHATS_THIS_BUTTON
 from protein.model.Protein import getAllProteinChunksInPart
+from protein.model.protein_comparison import compare_proteins
+from protein.model.protein_comparison import compare_protein_to_many
 from utilities.constants import diPROTEIN
-from utilities.Log import redmsg
 
 _superclass = Command_PropertyManager
 class CompareProteins_PropertyManager(Command_PropertyManager):
@@ -59,6 +60,10 @@ class CompareProteins_PropertyManager(Command_PropertyManager):
 
     @ivar proteinChunk2: The second currently selected protein to be compared.
     @type proteinChunk2: protein chunk
+
+    @ivar proteinChunkList: All the currently selected proteins, if there
+                            are at least two (otherwise empty).
+    @type proteinChunkList: list of protein chunks
     """
 
     title          =  "Compare Proteins"
@@ -66,6 +71,7 @@ class CompareProteins_PropertyManager(Command_PropertyManager):
     iconPath       =  "ui/actions/Command Toolbar/BuildProtein/Compare.png"
     proteinChunk1  =  None
     proteinChunk2  =  None
+    proteinChunkList = ()
 
     def __init__( self, command ):
         """
@@ -194,15 +200,25 @@ class CompareProteins_PropertyManager(Command_PropertyManager):
         """
         Slot for Compare button.
 
-        Compares two selected proteins of the same length.
-        Amino acids that differ greater than the "threshold"
-        value are displayed in two colors (red for the first protein
-        and yellow for the second protein) and are only visible when
-        the two proteins are displayed in the
+        Compares two selected proteins residue by residue. The residues are
+        paired by position if the proteins have the same length; otherwise
+        the protein sequences are aligned first.
+        Amino acids that differ (pairs of different types, and those
+        with no partner) are displayed in two colors (red for the first
+        protein and yellow for the second protein), and pairs whose chi
+        angles differ by more than the "threshold" value in green and cyan.
+        They are only visible when the two proteins are displayed in the
         reduced display style.
+
+        If more than two proteins are selected, compares the first one
+        with each of the others (see _compareManyProteins).
         """
         from utilities.constants import red, orange, green, cyan
 
+        if len(self.proteinChunkList) > 2:
+            self._compareManyProteins()
+            return
+
         if not self.proteinChunk1 or \
            not self.proteinChunk2:
             return
@@ -216,52 +232,74 @@ class CompareProteins_PropertyManager(Command_PropertyManager):
             aa_list_2 = protein_2.get_amino_acids()
             protein_1.collapse_all_rotamers()
             protein_2.collapse_all_rotamers()
-            if len(aa_list_1) == len(aa_list_2):
-                for aa1, aa2 in zip (aa_list_1, aa_list_2):
-                    aa1.color = None
-                    aa2.color = None
-                    #aa1.collapse()
-                    #aa2.collapse()
-                    if aa1.get_one_letter_code() != aa2.get_one_letter_code():
-                        aa1.set_color(red)
-                        aa1.expand()
-                        aa2.set_color(yellow)
-                        aa2.expand()
-                    else:
-                        max = 0.0
-                        for chi in range(0, 3):
-                            angle1 = aa1.get_chi_angle(chi)
-                            angle2 = aa2.get_chi_angle(chi)
-                            if angle1 and \
-                               angle2:
-                                if angle1 < 0.0:
-                                    angle1 += 360.0
-                                if angle2 < 0.0:
-                                    angle2 += 360.0
-                                diff = abs(angle1 - angle2)
-                                if diff > max:
-                                    max = diff
-                        if max >= self.threshold:
-                            # This be a parameter.
-                            aa1.set_color(green)
-                            aa1.expand()
-                            aa2.set_color(cyan)
-                            aa2.expand()
-
-                self.win.glpane.gl_update()
-            else:
-                msg = "The lengths of compared proteins are not equal."
-                self.updateMessage(msg)
-                env.history.redmsg(msg)
+            for aa in aa_list_1 + aa_list_2:
+                aa.color = None
+
+            comparison = compare_proteins(protein_1, protein_2)
+
+            for i in comparison.unpaired1:
+                aa_list_1[i].set_color(red)
+                aa_list_1[i].expand()
+            for i in comparison.unpaired2:
+                aa_list_2[i].set_color(yellow)
+                aa_list_2[i].expand()
+
+            for k in comparison.differing_pairs(self.threshold):
+                aa1 = aa_list_1[comparison.idx1[k]]
+                aa2 = aa_list_2[comparison.idx2[k]]
+                if comparison.same_type[k]:
+                    # This be a parameter.
+                    aa1.set_color(green)
+                    aa2.set_color(cyan)
+                else:
+                    aa1.set_color(red)
+                    aa2.set_color(yellow)
+                aa1.expand()
+                aa2.expand()
+
+            env.history.statusbar_msg(self._comparisonSummary(comparison))
+            self.win.glpane.gl_update()
         return
 
+    def _compareManyProteins(self):
+        """
+        Compares the first selected protein with each of the other
+        selected proteins, and prints a summary of each comparison
+        to the history.
+        """
+        proteinChunk1 = self.proteinChunkList[0]
+        otherProteinChunks = self.proteinChunkList[1:]
+
+        comparisons = compare_protein_to_many(
+            proteinChunk1.protein,
+            [proteinChunk.protein for proteinChunk in otherProteinChunks])
+
+        for proteinChunk, comparison in zip(otherProteinChunks, comparisons):
+            env.history.message("%s vs. %s: %s" % \
+                                (proteinChunk1.name,
+                                 proteinChunk.name,
+                                 self._comparisonSummary(comparison)))
+        return
+
+    def _comparisonSummary(self, comparison):
+        """
+        Returns a one-line summary of a ProteinComparison.
+        """
+        n_diff = len(comparison.differing_pairs(self.threshold)) + \
+               len(comparison.unpaired1) + \
+               len(comparison.unpaired2)
+        if comparison.ca_rmsd is None:
+            rmsd = "n/a"
+        else:
+            rmsd = "%.3f A" % comparison.ca_rmsd
+        return "%d paired amino acids, %d differences, C-alpha RMSD %s" % \
+               (len(comparison.idx1), n_diff, rmsd)
+
     def _hideDifferences(self):
         """
         Slot for the "Hide differences" button.
 
         Hides amino acids that differ greater than the "threshold" value.
-
-        @warning: Untested. Code looks suspicious.
         """
         if not self.proteinChunk1 or \
            not self.proteinChunk2:
@@ -272,16 +310,12 @@ class CompareProteins_PropertyManager(Command_PropertyManager):
 
         if protein_1 and \
            protein_2:
-            aa_list_1 = protein_1.get_amino_acids()
-            aa_list_2 = protein_2.get_amino_acids()
-            if len(aa_list_1) == len(aa_list_2):
-                protein_1.collapse_all_rotamers() #@@@
-                protein_2.collapse_all_rotamers() #@@@
-                for aa1, aa2 in zip (aa_list_1, aa_list_2):
-                    aa1.color = None
-                    aa2.color = None
-                    aa1.collapse()
-                    aa2.collapse()
+            protein_1.collapse_all_rotamers() #@@@
+            protein_2.collapse_all_rotamers() #@@@
+            for aa in protein_1.get_amino_acids() + \
+                      protein_2.get_amino_acids():
+                aa.color = None
+                aa.collapse()
             self.win.glpane.gl_update()
         return
 
@@ -290,7 +324,9 @@ class CompareProteins_PropertyManager(Command_PropertyManager):
         Slot for Threshold spinbox.
         """
         self.threshold = value
-        self._compareProteins()
+        if len(self.proteinChunkList) <= 2:
+            # (don't print the summaries of many comparisons at every step)
+            self._compareProteins()
         return
 
     def _resetAminoAcids(self):
@@ -319,6 +355,7 @@ class CompareProteins_PropertyManager(Command_PropertyManager):
 
         self.proteinChunk1 = None
         self.proteinChunk2 = None
+        self.proteinChunkList = ()
         self.comparePushButton.setEnabled(False)
         self.hidePushButton.setEnabled(False)
 
@@ -327,7 +364,7 @@ class CompareProteins_PropertyManager(Command_PropertyManager):
         if len(selectedProteinList) == 0:
             self.structure1LineEdit.setText("")
             self.structure2LineEdit.setText("")
-            msg = "Select two structures of the same length in the graphics area, "\
+            msg = "Select two structures in the graphics area, "\
                 "then click the <b>Compare</b> button to compare them."
 
         elif len(selectedProteinList) == 1:
@@ -335,8 +372,8 @@ class CompareProteins_PropertyManager(Command_PropertyManager):
             aa1_count = " (%d)" % self.proteinChunk1.protein.count_amino_acids()
             self.structure1LineEdit.setText(self.proteinChunk1.name + aa1_count)
             self.structure2LineEdit.setText("")
-            msg = "Select one more structure in the graphics area that is the same "\
-                "length as <b>" + self.proteinChunk1.name + "</b>. "\
+            msg = "Select one more structure in the graphics area to compare "\
+                "with <b>" + self.proteinChunk1.name + "</b>. "\
                 "Then click the <b>Compare</b> button to compare them."
 
         elif len(selectedProteinList) == 2:
@@ -348,19 +385,26 @@ class CompareProteins_PropertyManager(Command_PropertyManager):
             aa2_count = " (%d)" % self.proteinChunk2.protein.count_amino_acids()
             self.structure2LineEdit.setText(self.proteinChunk2.name + aa2_count)
 
-            if aa1_count == aa2_count:
-                self.comparePushButton.setEnabled(True)
-                self.hidePushButton.setEnabled(True)
-                msg = "Click the <b>Compare</b> button to compare the two selected structures."
-            else:
-                msg = "<b>%s</b> and <b>%s</b> are not the same length." % \
-                    (self.proteinChunk1.name, self.proteinChunk2.name)
-                msg = redmsg(msg)
+            self.proteinChunkList = selectedProteinList
+            self.comparePushButton.setEnabled(True)
+            self.hidePushButton.setEnabled(True)
+            msg = "Click the <b>Compare</b> button to compare the two selected structures."
+            if aa1_count != aa2_count:
+                msg += " They are not the same length, so their sequences "\
+                    "will be aligned first."
 
         else:
-            self.structure1LineEdit.setText("")
-            self.structure2LineEdit.setText("")
-            msg = redmsg("Too many proteins selected.")
+            self.proteinChunk1 = selectedProteinList[0]
+            aa1_count = " (%d)" % self.proteinChunk1.protein.count_amino_acids()
+            self.structure1LineEdit.setText(self.proteinChunk1.name + aa1_count)
+            self.structure2LineEdit.setText("%d other structures" % \
+                                            (len(selectedProteinList) - 1))
+            self.proteinChunkList = selectedProteinList
+            self.comparePushButton.setEnabled(True)
+            msg = "Click the <b>Compare</b> button to compare <b>%s</b> "\
+                "with each of the other selected structures. A summary of "\
+                "each comparison will be printed in the history." % \
+                self.proteinChunk1.name
 
         self.updateMessage(msg)
         env.history.redmsg(msg)
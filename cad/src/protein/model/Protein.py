@@ -123,6 +123,10 @@ class Protein:
         # deleting display lists.
         self.residues_dl = None
 
+        # ProteinFeatures used by the Compare Proteins command
+        # (see protein_comparison.get_protein_features), or None.
+        self._comparison_features = None
+
     def set_chain_id(self, chainId):
         """
         Sets a single letter chain ID.
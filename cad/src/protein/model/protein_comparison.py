@@ -0,0 +1,531 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+protein_comparison.py -- residue-level comparison of Protein objects,
+computed with Numeric arrays (used by the Compare Proteins command).
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+Each Protein gets a ProteinFeatures object (made by get_protein_features
+and cached in the Protein), which holds the positions of a fixed set of
+atom "slots" of each residue (the backbone atoms N, CA, C, O, then CB and
+the last atom of each chi angle of that residue type) in one array of
+shape (number of residues, NSLOTS, 3), and the chi, phi and psi angles
+computed from them. Which atom fills which slot is only worked out again
+when the protein chunk's atom list changes; new positions are gathered
+with one Numeric.take from the chunk's atpos array, and the angles are
+only recomputed when the positions differ from the last ones.
+
+A ProteinComparison of two proteins pairs up their residues (by position
+when they have the same length, otherwise by a global alignment of their
+sequences), superposes the second protein onto the first using the paired
+CA atoms, and computes per-residue differences (chi, phi/psi, RMSD) for
+all the pairs at once. compare_protein_to_many compares one protein with
+many others, using the first one's features for all the comparisons.
+"""
+
+import math
+
+import Numeric
+from Numeric import Float, Int
+from LinearAlgebra import singular_value_decomposition, determinant
+
+from protein.model.Residue import CHI_ANGLES
+
+# ==
+
+# Atom slots of each residue. The first five are the same for all residues;
+# slot CHI_SLOT0 + k holds the last atom of chi angle k, if the residue
+# type has that angle.
+
+BACKBONE_SLOT_NAMES = ("N", "CA", "C", "O", "CB")
+N_SLOT, CA_SLOT, C_SLOT, O_SLOT, CB_SLOT = range(5)
+CHI_SLOT0 = len(BACKBONE_SLOT_NAMES)
+NCHI = 4
+NSLOTS = CHI_SLOT0 + NCHI
+
+# the chi angles compared by ProteinComparison.chi_diff
+# (the Compare Proteins command has always ignored chi4)
+NCHI_COMPARED = 3
+
+# the largest C-N distance (in Angstroms) which we consider a peptide bond,
+# when deciding whether phi and psi are defined
+MAX_PEPTIDE_BOND_LENGTH = 2.0
+
+# sequence alignment scores
+ALIGN_MATCH = 2
+ALIGN_MISMATCH = -1
+ALIGN_GAP = -2
+
+def _make_slot_tables():
+    """
+    Return two dicts from residue name (three-letter code) to:
+    the list of NSLOTS atom names of its slots (None for unused slots),
+    and the list of NCHI chi angle definitions as lists of four slot
+    indices (None for undefined angles).
+    """
+    slot_names = {}
+    chi_slots = {}
+    for resname, chi_list in CHI_ANGLES.items():
+        names = list(BACKBONE_SLOT_NAMES) + [None] * NCHI
+        for k in range(NCHI):
+            if chi_list[k]:
+                names[CHI_SLOT0 + k] = chi_list[k][3]
+        slots = []
+        for k in range(NCHI):
+            if chi_list[k]:
+                slots.append([names.index(name) for name in chi_list[k]])
+            else:
+                slots.append(None)
+        slot_names[resname] = names
+        chi_slots[resname] = slots
+    return slot_names, chi_slots
+
+_SLOT_NAMES, _CHI_SLOTS = _make_slot_tables()
+
+_DEFAULT_SLOT_NAMES = list(BACKBONE_SLOT_NAMES) + [None] * NCHI
+_DEFAULT_CHI_SLOTS = [None] * NCHI
+
+# ==
+
+def _cross(a, b):
+    """
+    Return the cross products of the rows of a and b (arrays of shape (n, 3)).
+    """
+    return Numeric.transpose(Numeric.array([
+        a[:, 1] * b[:, 2] - a[:, 2] * b[:, 1],
+        a[:, 2] * b[:, 0] - a[:, 0] * b[:, 2],
+        a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0] ]))
+
+def _dot(a, b):
+    return Numeric.add.reduce(a * b, -1)
+
+def torsion_angles(p0, p1, p2, p3):
+    """
+    Return an array of the torsion angles (in degrees) of the atom
+    position quadruples whose positions are the rows of p0, p1, p2 and p3
+    (arrays of shape (n, 3)), computed the same way as calc_torsion_angle
+    in Residue.py (so degenerate angles are 360.0).
+    """
+    v12 = p0 - p1
+    v43 = p3 - p2
+    v23 = p1 - p2
+    p = _cross(v23, v12)
+    x = _cross(v23, v43)
+    y = _cross(v23, x)
+    u1 = _dot(x, x)
+    v1 = _dot(y, y)
+    ok = Numeric.logical_and(Numeric.greater(u1, 0.0),
+                             Numeric.greater(v1, 0.0))
+    u1 = Numeric.where(ok, u1, 1.0)
+    v1 = Numeric.where(ok, v1, 1.0)
+    u2 = _dot(p, x) / Numeric.sqrt(u1)
+    v2 = _dot(p, y) / Numeric.sqrt(v1)
+    ok = Numeric.logical_and(ok, Numeric.logical_and(Numeric.not_equal(u2, 0.0),
+                                                     Numeric.not_equal(v2, 0.0)))
+    angles = Numeric.arctan2(v2, u2) * (180.0 / math.pi)
+    return Numeric.where(ok, angles, 360.0)
+
+def _angle_differences(a1, a2):
+    """
+    Return the absolute differences between the angles (in degrees)
+    in a1 and a2, taking periodicity into account (so they're <= 180.0).
+    """
+    diff = Numeric.absolute(a1 - a2) % 360.0
+    return Numeric.where(Numeric.greater(diff, 180.0), 360.0 - diff, diff)
+
+# ==
+
+class ProteinFeatures:
+    """
+    Per-residue arrays describing the structure of one Protein
+    (see module docstring). Get one with get_protein_features(protein),
+    rather than by making one directly, to use the one cached in protein.
+
+    Public attributes (valid after self.update()):
+
+    @ivar nres: number of residues
+
+    @ivar sequence: the one-letter codes of the residues (a string)
+
+    @ivar positions: array of shape (nres, NSLOTS, 3) of slot atom positions
+                     (zeros for missing atoms)
+
+    @ivar present: array of shape (nres, NSLOTS), 1 where the slot's atom
+                   exists
+
+    @ivar chi: array of shape (nres, NCHI) of chi angles (in degrees)
+
+    @ivar chi_defined: array of shape (nres, NCHI), 1 where the residue type
+                       has that chi angle and all its atoms exist
+
+    @ivar phi, psi: arrays of shape (nres,) of backbone torsions (in degrees)
+
+    @ivar phi_defined, psi_defined: arrays of shape (nres,), 1 where the
+                                    torsion exists (i.e. the residue's
+                                    backbone atoms exist and it's bonded
+                                    to the previous (phi) or next (psi)
+                                    residue)
+    """
+    def __init__(self, protein):
+        self.protein = protein
+        self._atlist = None # the chunk atlist our slot indices are for
+        self._chunk = None
+        self.positions = None
+        return
+
+    def update(self):
+        """
+        Make sure our arrays describe the current structure of our protein.
+        """
+        chunk = self._chunk
+        if chunk is None or chunk.killed() or chunk.atlist is not self._atlist:
+            self._extract_structure()
+        positions = self._gather_positions()
+        if self.positions is not None and \
+           Numeric.alltrue(Numeric.equal(Numeric.ravel(positions),
+                                         Numeric.ravel(self.positions))):
+            return # our angles are still valid
+        self.positions = positions
+        self._compute_angles()
+        return
+
+    def _extract_structure(self):
+        """
+        [private]
+        Find the atoms which fill our residues' slots,
+        and the slots of their chi angles.
+        """
+        residues = self.protein.get_amino_acids()
+        self.nres = nres = len(residues)
+        sequence = []
+        atoms = [] # nres * NSLOTS atoms or None, in slot order
+        chi_slots = []
+        for aa in residues:
+            resname = aa.get_three_letter_code()
+            sequence.append(aa.get_one_letter_code())
+            get_atom = aa.atoms.get
+            for name in _SLOT_NAMES.get(resname, _DEFAULT_SLOT_NAMES):
+                atoms.append(name and get_atom(name))
+            for slots in _CHI_SLOTS.get(resname, _DEFAULT_CHI_SLOTS):
+                chi_slots.append(slots or [-1] * 4)
+        self.sequence = "".join(sequence)
+        self._atoms = atoms
+        self.present = Numeric.reshape(
+            Numeric.array([atom is not None for atom in atoms], Int),
+            (nres, NSLOTS))
+        chi_slots = Numeric.reshape(Numeric.array(chi_slots, Int),
+                                    (nres, NCHI, 4))
+        # a chi angle is defined if its slots exist and their atoms exist
+        flat_present = Numeric.ravel(self.present)
+        offsets = Numeric.arange(nres)[:, Numeric.NewAxis, Numeric.NewAxis] * \
+                  NSLOTS
+        self._chi_indices = Numeric.ravel(
+            offsets + Numeric.maximum(chi_slots, 0))
+        chi_atoms_present = Numeric.reshape(
+            Numeric.take(flat_present, self._chi_indices, 0), (nres, NCHI, 4))
+        self.chi_defined = Numeric.logical_and(
+            Numeric.alltrue(Numeric.greater_equal(chi_slots, 0), -1),
+            Numeric.alltrue(chi_atoms_present, -1))
+        # find the atoms' indices in their chunk's atpos array, if they're
+        # all in one chunk
+        self._chunk = self._atlist = self._atom_indices = None
+        chunks = {}
+        for atom in atoms:
+            if atom is not None:
+                chunks[id(atom.molecule)] = atom.molecule
+        if len(chunks) == 1:
+            chunk = chunks.values()[0]
+            self._atlist = chunk.atlist # (this makes the atoms' indices valid)
+            self._atom_indices = Numeric.array(
+                [atom is not None and atom.index or 0 for atom in atoms], Int)
+            self._chunk = chunk
+        self.positions = None
+        return
+
+    def _gather_positions(self):
+        """
+        [private]
+        Return an array of the current positions of our slot atoms.
+        """
+        if self._chunk is not None:
+            positions = Numeric.take(self._chunk.atpos, self._atom_indices, 0)
+            positions = positions * \
+                        Numeric.ravel(self.present)[:, Numeric.NewAxis]
+        else:
+            zero = (0.0, 0.0, 0.0)
+            positions = Numeric.array(
+                [atom is not None and atom.posn() or zero
+                 for atom in self._atoms], Float)
+        return Numeric.reshape(positions, (self.nres, NSLOTS, 3))
+
+    def _compute_angles(self):
+        """
+        [private]
+        Compute our chi, phi and psi arrays from self.positions.
+        """
+        nres = self.nres
+        flat = Numeric.reshape(self.positions, (nres * NSLOTS, 3))
+        quads = Numeric.reshape(Numeric.take(flat, self._chi_indices, 0),
+                                (nres * NCHI, 4, 3))
+        self.chi = Numeric.reshape(
+            torsion_angles(quads[:, 0], quads[:, 1], quads[:, 2], quads[:, 3]),
+            (nres, NCHI))
+
+        n_pos = self.positions[:, N_SLOT]
+        ca_pos = self.positions[:, CA_SLOT]
+        c_pos = self.positions[:, C_SLOT]
+        backbone = Numeric.alltrue(self.present[:, N_SLOT:C_SLOT + 1], -1)
+        self.phi = Numeric.zeros(nres, Float)
+        self.psi = Numeric.zeros(nres, Float)
+        self.phi_defined = Numeric.zeros(nres, Int)
+        self.psi_defined = Numeric.zeros(nres, Int)
+        if nres < 2:
+            return
+        # bonded[i] is 1 if residue i's C is bonded to residue i+1's N
+        delta = c_pos[:-1] - n_pos[1:]
+        bonded = Numeric.logical_and(
+            Numeric.logical_and(backbone[:-1], backbone[1:]),
+            Numeric.less(_dot(delta, delta), MAX_PEPTIDE_BOND_LENGTH ** 2))
+        self.phi[1:] = torsion_angles(c_pos[:-1], n_pos[1:], ca_pos[1:], c_pos[1:])
+        self.psi[:-1] = torsion_angles(n_pos[:-1], ca_pos[:-1], c_pos[:-1], n_pos[1:])
+        self.phi_defined[1:] = bonded
+        self.psi_defined[:-1] = bonded
+        return
+
+    pass
+
+def get_protein_features(protein):
+    """
+    Return the ProteinFeatures of protein (a Protein), updated to describe
+    its current structure.
+    """
+    features = protein._comparison_features
+    if features is None:
+        features = protein._comparison_features = ProteinFeatures(protein)
+    features.update()
+    return features
+
+# ==
+
+def align_sequences(seq1, seq2):
+    """
+    Align two sequences (strings of one-letter codes) by a global
+    (Needleman-Wunsch) alignment with linear gap costs.
+
+    @return: (idx1, idx2), lists of the indices of the paired residues
+             in seq1 and seq2, in increasing order
+    """
+    n = len(seq1)
+    m = len(seq2)
+    codes2 = Numeric.array(map(ord, seq2), Int)
+    gaps = ALIGN_GAP * Numeric.arange(m + 1)
+    scores = Numeric.zeros((n + 1, m + 1), Int)
+    scores[0] = gaps
+    # Each row is computed from the previous one with array operations:
+    # the best score of a diagonal or vertical step into each cell, then the
+    # horizontal steps, which (with linear gap costs) are a running maximum
+    # of those scores relative to the gap cost of their column.
+    for i in range(1, n + 1):
+        prev = scores[i - 1]
+        match = Numeric.where(Numeric.equal(codes2, ord(seq1[i - 1])),
+                              ALIGN_MATCH, ALIGN_MISMATCH)
+        best = Numeric.maximum(prev[:-1] + match, prev[1:] + ALIGN_GAP)
+        row = Numeric.concatenate(([ALIGN_GAP * i], best))
+        scores[i] = Numeric.maximum.accumulate(row - gaps) + gaps
+    # trace back from the end
+    idx1 = []
+    idx2 = []
+    i, j = n, m
+    while i > 0 and j > 0:
+        if seq1[i - 1] == seq2[j - 1]:
+            match = ALIGN_MATCH
+        else:
+            match = ALIGN_MISMATCH
+        score = scores[i, j]
+        if score == scores[i - 1, j - 1] + match:
+            i -= 1
+            j -= 1
+            idx1.append(i)
+            idx2.append(j)
+        elif score == scores[i - 1, j] + ALIGN_GAP:
+            i -= 1
+        else:
+            j -= 1
+    idx1.reverse()
+    idx2.reverse()
+    return idx1, idx2
+
+def superposition(points, ref_points):
+    """
+    Return (rotation, center, ref_center) for the least-squares
+    superposition of points onto ref_points (arrays of shape (n, 3)),
+    found by the Kabsch method. The superposed points are
+    Numeric.dot(points - center, rotation) + ref_center.
+    """
+    center = Numeric.add.reduce(points) / len(points)
+    ref_center = Numeric.add.reduce(ref_points) / len(ref_points)
+    h = Numeric.dot(Numeric.transpose(points - center), ref_points - ref_center)
+    u, s, vt = singular_value_decomposition(h)
+    rotation = Numeric.dot(u, vt)
+    if determinant(rotation) < 0.0:
+        # avoid a reflection
+        u = Numeric.array(u)
+        u[:, 2] = - u[:, 2]
+        rotation = Numeric.dot(u, vt)
+    return rotation, center, ref_center
+
+# ==
+
+class ProteinComparison:
+    """
+    Residue-level comparison of two proteins (see module docstring).
+
+    Public attributes:
+
+    @ivar features1, features2: the ProteinFeatures of the two proteins
+
+    @ivar idx1, idx2: Numeric arrays of the indices of the paired residues
+                      in the two proteins
+
+    @ivar unpaired1, unpaired2: lists of the indices of the residues of each
+                                protein which have no partner
+
+    @ivar same_type: for each pair, 1 if the residues have the same
+                     one-letter code
+
+    @ivar chi_diff: for each pair of residues of the same type, the largest
+                    difference of their first NCHI_COMPARED chi angles, as
+                    computed by the Compare Proteins command (angles in
+                    0..360 degrees, compared without wrapping around);
+                    0.0 for other pairs
+
+    @ivar phi_diff, psi_diff: for each pair, the (periodic) differences of
+                              their phi and psi angles (0.0 if undefined)
+
+    @ivar residue_rmsd: for each pair, the RMSD of their common slot atoms
+                        (after superposition)
+
+    @ivar ca_rmsd: the RMSD of the paired CA atoms after superposition
+                   (None if there are fewer than three such pairs)
+    """
+    def __init__(self, features1, features2):
+        self.features1 = f1 = features1
+        self.features2 = f2 = features2
+        if f1.nres == f2.nres:
+            # compare residues by position, as the Compare Proteins
+            # command always has, even if their sequences differ
+            idx1 = idx2 = range(f1.nres)
+        else:
+            idx1, idx2 = align_sequences(f1.sequence, f2.sequence)
+        self.idx1 = Numeric.array(idx1, Int)
+        self.idx2 = Numeric.array(idx2, Int)
+        paired1 = dict.fromkeys(idx1)
+        paired2 = dict.fromkeys(idx2)
+        self.unpaired1 = [i for i in range(f1.nres) if not paired1.has_key(i)]
+        self.unpaired2 = [i for i in range(f2.nres) if not paired2.has_key(i)]
+        self.same_type = Numeric.array(
+            [f1.sequence[i] == f2.sequence[j] for i, j in zip(idx1, idx2)],
+            Int)
+        self._compare_angles()
+        self._superpose()
+        return
+
+    def _take1(self, array):
+        return Numeric.take(array, self.idx1, 0)
+
+    def _take2(self, array):
+        return Numeric.take(array, self.idx2, 0)
+
+    def _compare_angles(self):
+        chi1 = self._take1(self.features1.chi)[:, :NCHI_COMPARED]
+        chi2 = self._take2(self.features2.chi)[:, :NCHI_COMPARED]
+        defined = Numeric.logical_and(
+            self._take1(self.features1.chi_defined)[:, :NCHI_COMPARED],
+            self._take2(self.features2.chi_defined)[:, :NCHI_COMPARED])
+        defined = Numeric.logical_and(defined,
+                                      self.same_type[:, Numeric.NewAxis])
+        chi1 = Numeric.where(Numeric.less(chi1, 0.0), chi1 + 360.0, chi1)
+        chi2 = Numeric.where(Numeric.less(chi2, 0.0), chi2 + 360.0, chi2)
+        diff = Numeric.where(defined, Numeric.absolute(chi1 - chi2), 0.0)
+        if len(diff):
+            self.chi_diff = Numeric.maximum.reduce(diff, -1)
+        else:
+            self.chi_diff = Numeric.zeros(0, Float)
+        for name in ('phi', 'psi'):
+            defined = Numeric.logical_and(
+                self._take1(getattr(self.features1, name + '_defined')),
+                self._take2(getattr(self.features2, name + '_defined')))
+            diff = _angle_differences(self._take1(getattr(self.features1, name)),
+                                      self._take2(getattr(self.features2, name)))
+            setattr(self, name + '_diff', Numeric.where(defined, diff, 0.0))
+        return
+
+    def _superpose(self):
+        """
+        [private]
+        Superpose the second protein onto the first (using the paired
+        CA atoms), and compute the RMSDs.
+        """
+        pos1 = self._take1(self.features1.positions)
+        pos2 = self._take2(self.features2.positions)
+        npairs = len(self.idx1)
+        common = Numeric.logical_and(self._take1(self.features1.present),
+                                     self._take2(self.features2.present))
+        if npairs:
+            # side chain slots only correspond for residues of the same type
+            common[:, CHI_SLOT0:] = Numeric.logical_and(
+                common[:, CHI_SLOT0:], self.same_type[:, Numeric.NewAxis])
+        ca_pairs = Numeric.nonzero(common[:, CA_SLOT])
+        self.ca_rmsd = None
+        self.rotation = None
+        if len(ca_pairs) >= 3:
+            ca1 = Numeric.take(pos1[:, CA_SLOT], ca_pairs, 0)
+            ca2 = Numeric.take(pos2[:, CA_SLOT], ca_pairs, 0)
+            rotation, center, ref_center = superposition(ca2, ca1)
+            self.rotation = rotation
+            pos2 = Numeric.reshape(
+                Numeric.dot(Numeric.reshape(pos2, (npairs * NSLOTS, 3)) - center,
+                            rotation) + ref_center,
+                (npairs, NSLOTS, 3))
+            delta = Numeric.take(pos2[:, CA_SLOT], ca_pairs, 0) - ca1
+            self.ca_rmsd = math.sqrt(Numeric.add.reduce(_dot(delta, delta)) /
+                                     len(ca_pairs))
+        delta = pos1 - pos2
+        sq = _dot(delta, delta) * common
+        counts = Numeric.add.reduce(common, -1)
+        self.residue_rmsd = Numeric.sqrt(Numeric.add.reduce(sq, -1) /
+                                         Numeric.maximum(counts, 1))
+        return
+
+    def differing_pairs(self, threshold):
+        """
+        Return a list of the indices (into self.idx1 and self.idx2)
+        of the pairs of residues which differ: those of different types,
+        and those whose chi_diff is at least threshold (in degrees).
+        """
+        differ = Numeric.logical_or(
+            Numeric.logical_not(self.same_type),
+            Numeric.greater_equal(self.chi_diff, threshold))
+        return list(Numeric.nonzero(differ))
+
+    pass
+
+def compare_proteins(protein1, protein2):
+    """
+    Return a ProteinComparison of two Proteins.
+    """
+    return ProteinComparison(get_protein_features(protein1),
+                             get_protein_features(protein2))
+
+def compare_protein_to_many(protein, proteins):
+    """
+    Return a list of ProteinComparisons of protein with each of proteins
+    (all Proteins).
+    """
+    features = get_protein_features(protein)
+    return [ProteinComparison(features, get_protein_features(protein2))
+            for protein2 in proteins]
+
+# end
@@ -5,13 +5,69 @@ Responsible for maintaining references to strings which are passed
 to the C code, and which end up referenced by variables defined in
 src/sim/globals.c.
 
+Repeated minimizations of a structure whose bonds don't change (e.g.
+repeated Adjust Atoms on a large part) reuse a simulator session (see
+sim/src/simhelp.c), which keeps the part read from the first mmp file
+and only gives it the new atom positions, rather than rebuilding all
+its tables.
+
 @version: $Id$
 @copyright: 2004-2008 Nanorex, Inc.  See LICENSE file for details.
 """
 
+import md5
 import os
+import re
+
 import foundation.env as env
 from platform_dependent.PlatformDependent import find_plugin_dir
+from utilities.debug_prefs import debug_pref, Choice_boolean_False
+
+def debug_pref_reuse_simulator_session():
+    # (off until the session functions in sim.pyx have been built and
+    #  its test_sessionMatchesGo passes)
+    res = debug_pref("Simulator: reuse part between minimizations?",
+                     Choice_boolean_False,
+                     prefs_key = True
+                 )
+    return res
+
+# matches the position in an mmp atom record, in units of 0.1 pm
+_ATOM_POSITION_PATTERN = re.compile(
+    r"^(atom \d+ \(\d+\) )\((-?\d+), (-?\d+), (-?\d+)\)", re.MULTILINE)
+
+def _split_mmp_positions(mmp_text):
+    """
+    Return (topology, positions) for the text of an mmp file:
+    the text with the positions removed from its atom records,
+    and a list of the atom positions (x, y, z in pm), in file order.
+    """
+    positions = []
+    def strip_position(match):
+        x, y, z = match.group(2, 3, 4)
+        # (same arithmetic as readmmp.c, so the result is exactly
+        #  what the simulator would read)
+        positions.append((int(x) * 0.1, int(y) * 0.1, int(z) * 0.1))
+        return match.group(1) + "()"
+    topology = _ATOM_POSITION_PATTERN.sub(strip_position, mmp_text)
+    return topology, positions
+
+# the simulator globals which affect the tables built for a part
+_SESSION_GLOBALS = (
+    "debug_flags",
+    "VanDerWaalsCutoffRadius",
+    "VanDerWaalsCutoffFactor",
+    "EnableElectrostatic",
+    "NeighborSearching",
+    "UseAMBER",
+    "Dt",
+    "Dx",
+    "Dmass",
+    "SystemParametersFileName",
+    "AmberBondedParametersFileName",
+    "AmberNonbondedParametersFileName",
+    "AmberChargesFileName",
+ )
 
 _thePyrexSimulator = None
 
@@ -31,6 +87,7 @@ class _PyrexSimulator(object):
         self.amber_bonded_parameters_file = os.path.join(nd1_plugin_path, "ffamber03bon.itp")
         self.amber_nonbonded_parameters_file = os.path.join(nd1_plugin_path, "ffamber03nb.itp")
         self.amber_charges_file = os.path.join(nd1_plugin_path, "ffamber03charge.itp")
+        self._session_key = None # key of the active session, if any
 
     def reInitialize(self):
         self.sim.reinitGlobals()
@@ -71,7 +128,53 @@ class _PyrexSimulator(object):
             self.sim.OutputFormat = 0
         else:
             self.sim.OutputFormat = 1
-        self.sim.go(frame_callback, trace_callback)
+        if self._can_use_session():
+            self._run_session(frame_callback, trace_callback)
+        else:
+            self._end_session()
+            self.sim.go(frame_callback, trace_callback)
+
+    def _can_use_session(self):
+        return (debug_pref_reuse_simulator_session() and
+                self.sim.ToMinimize and
+                not self.sim.TypeFeedback and
+                not self.sim.GromacsOutputBaseName)
+
+    def _run_session(self, frame_callback, trace_callback):
+        """
+        Minimize the structure in our input file, reusing the active
+        session's part if it has the same topology and options,
+        or starting a new session otherwise.
+        """
+        file = open(self.inputFileName, "r")
+        try:
+            mmp_text = file.read()
+        finally:
+            file.close()
+        topology, positions = _split_mmp_positions(mmp_text)
+        key = (md5.new(topology).digest(),
+               [getattr(self.sim, name) for name in _SESSION_GLOBALS])
+        try:
+            if key == self._session_key:
+                self.sim.setSessionPositions(positions)
+            else:
+                self._end_session()
+                self.sim.beginSession()
+                self._session_key = key
+            self.sim.runSession(frame_callback, trace_callback)
+        except:
+            # (after an error or interruption, don't trust the part)
+            self._end_session()
+            raise
+        if not self.sim.sessionIsReusable():
+            self._end_session()
+        return
+
+    def _end_session(self):
+        if self._session_key is not None:
+            self._session_key = None
+            self.sim.endSession()
+        return
 
     def getEquilibriumDistanceForBond(self, element1, element2, order):
         self.reInitialize()
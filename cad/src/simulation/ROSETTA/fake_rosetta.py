@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+fake_rosetta.py -- a stand-in for the Rosetta executable, for testing
+NE1's Rosetta runs (and RosettaScheduler) without Rosetta.
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+It accepts the command lines RosettaRunner uses, takes a little time,
+and writes output files in the same places and formats that NE1 reads
+from Rosetta (in the current directory, like Rosetta):
+
+- fixed backbone design (-design -fixbb -ndruns N -pdbout NAME -s IN.pdb):
+  NAME_0001.pdb ... NAME_000N.pdb (a copy of IN.pdb's atoms with a random
+  "score" line; the scores depend only on -jran, if given) and
+  NAME_design.fasta (the input and designed sequences)
+
+- backrub design (-backrub_mc -s IN.pdb): backrub_low.pdb with a SCORE line
+
+- scoring (-score -scorefile NAME -s IN.pdb): NAME.sc
+
+To use it from NE1, make it executable and set the Rosetta executable
+path in the preferences to it. Environment variables:
+FAKE_ROSETTA_SECONDS is how long each trajectory takes (default 1.0), and
+if FAKE_ROSETTA_FAIL is set, it prints an ERROR message and writes no
+output files.
+"""
+
+import sys, os, time, random
+
+_AA_3_TO_1 = {
+    'ALA':'A', 'VAL':'V', 'PHE':'F', 'PRO':'P', 'MET':'M',
+    'ILE':'I', 'LEU':'L', 'ASP':'D', 'GLU':'E', 'LYS':'K',
+    'ARG':'R', 'SER':'S', 'THR':'T', 'TYR':'Y', 'HIS':'H',
+    'CYS':'C', 'ASN':'N', 'GLN':'Q', 'TRP':'W', 'GLY':'G' }
+
+_OPTIONS_WITH_VALUES = ('-paths', '-ndruns', '-ntrials', '-resfile',
+                        '-pdbout', '-s', '-scorefile', '-jran')
+
+def parse_arguments(argv):
+    """
+    Return a dict from option name (without the '-') to its value
+    (or True, for options without values).
+    """
+    options = {}
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in _OPTIONS_WITH_VALUES and i + 1 < len(argv):
+            options[arg[1:]] = argv[i + 1]
+            i += 2
+        else:
+            options[arg.lstrip('-')] = True
+            i += 1
+    return options
+
+def read_pdb(filename):
+    """
+    Return (atom lines, sequence) of a PDB file.
+    """
+    atom_lines = []
+    sequence = []
+    for line in open(filename).readlines():
+        if line.startswith("ATOM") or line.startswith("HETATM"):
+            atom_lines.append(line)
+            if line[12:16].strip() == "CA":
+                sequence.append(_AA_3_TO_1.get(line[17:20], 'X'))
+    return atom_lines, "".join(sequence)
+
+def design_sequence(sequence, rng):
+    """
+    Return sequence with about a tenth of its residues mutated.
+    """
+    letters = _AA_3_TO_1.values()
+    return "".join([(rng.random() < 0.1 and rng.choice(letters)) or aa
+                    for aa in sequence])
+
+def fixed_backbone_design(options, rng, seconds):
+    infile = options['s']
+    outfile = options.get('pdbout', infile[:-4] + '_out')
+    ndruns = int(options.get('ndruns', 1))
+    atom_lines, sequence = read_pdb(infile)
+    fasta = ["> %s\n%s\n" % (infile, sequence)]
+    for k in range(1, ndruns + 1):
+        print "fake rosetta: design trajectory %d of %d" % (k, ndruns)
+        sys.stdout.flush()
+        time.sleep(seconds)
+        pdbFile = "%s_%04d.pdb" % (outfile, k)
+        score = -100.0 * len(sequence) / 50.0 + rng.uniform(-20.0, 20.0)
+        f = open(pdbFile, 'w')
+        f.write("HEADER    FAKE ROSETTA DESIGN\n")
+        # (NE1 reads the score from character 15 on)
+        f.write("%-15s%.4f\n" % ("REMARK score", score))
+        f.writelines(atom_lines)
+        f.write("END\n")
+        f.close()
+        fasta.append("> %s\n%s\n" % (pdbFile, design_sequence(sequence, rng)))
+    f = open(outfile + "_design.fasta", 'w')
+    f.writelines(fasta)
+    f.close()
+    return
+
+def backrub_design(options, rng, seconds):
+    atom_lines, sequence = read_pdb(options['s'])
+    time.sleep(seconds)
+    f = open("backrub_low.pdb", 'w')
+    # (NE1 reads the score from character 16 on)
+    f.write("%-16s%.4f\n" % ("REMARK SCORE", rng.uniform(-200.0, -100.0)))
+    f.writelines(atom_lines)
+    f.write("END\n")
+    f.close()
+    return
+
+def score(options, rng, seconds):
+    time.sleep(seconds)
+    f = open(options['scorefile'] + '.sc', 'w')
+    f.write("filename score fa_atr fa_rep\n")
+    f.write("%s %.3f %.3f %.3f\n" % (options['s'], rng.uniform(-200.0, -100.0),
+                                     rng.uniform(-300.0, -200.0),
+                                     rng.uniform(10.0, 50.0)))
+    f.close()
+    return
+
+def main(argv):
+    options = parse_arguments(argv[1:])
+    print "fake rosetta: arguments", argv[1:]
+    if os.environ.get('FAKE_ROSETTA_FAIL'):
+        print "ERROR: fake rosetta was asked to fail"
+        return 1
+    seconds = float(os.environ.get('FAKE_ROSETTA_SECONDS', 1.0))
+    if options.has_key('jran'):
+        rng = random.Random(int(options['jran']))
+    else:
+        rng = random.Random()
+    if options.has_key('fixbb'):
+        fixed_backbone_design(options, rng, seconds)
+    elif options.has_key('backrub_mc'):
+        backrub_design(options, rng, seconds)
+    elif options.has_key('score'):
+        score(options, rng, seconds)
+    else:
+        print "ERROR: fake rosetta doesn't know what to do"
+        return 1
+    print "fake rosetta: done"
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
+
+# end
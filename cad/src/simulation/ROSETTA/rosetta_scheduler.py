@@ -0,0 +1,384 @@
+# Copyright 2009 Nanorex, Inc.  See LICENSE file for details.
+"""
+rosetta_scheduler.py -- run independent Rosetta runs concurrently,
+as background processes.
+
+@author: Will
+@version: $Id$
+@copyright: 2009 Nanorex, Inc.  See LICENSE file for details.
+
+A RosettaScheduler is given RosettaJobs. Each one is a complete Rosetta
+command line, e.g. one design trajectory with its own random seed and
+output file name, or a run on another protein chunk. It runs them in
+Process objects, with at most maxProcesses running at once. Nothing
+polls the processes. When one exits (its finished() signal), the
+scheduler at once:
+- scores the job's output, using the job's scoreFunction;
+- updates the best job so far;
+- tells its client, via jobFinishedCallback;
+- starts the next queued job.
+
+RosettaScheduler.wait() runs a local Qt event loop until all the jobs
+are done, so NE1 keeps processing events (e.g. redrawing) meanwhile.
+Only the abort button is polled.
+
+fake_rosetta.py (in this directory) stands in for the Rosetta
+executable, for testing without Rosetta. Running this module as a
+script runs a few design jobs with it.
+"""
+
+import os, sys
+
+from PyQt4.Qt import QObject, QProcess, QEventLoop, QTimer, SIGNAL
+
+from processes.Process import Process
+from utilities.debug import print_compact_traceback
+
+def number_of_processors():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+    pass
+
+# ==
+
+# job states
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+JOB_ABORTED = 'aborted'
+
+class RosettaJob:
+    """
+    One Rosetta run (one process) for a RosettaScheduler.
+
+    @ivar state: one of JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED,
+                 JOB_FAILED, JOB_ABORTED
+
+    @ivar exitCode: the process exit code (None until it exits, or if it
+                    failed to start; -2 if it crashed or was killed)
+
+    @ivar score: the score of the job's output (lower is better),
+                 or None
+
+    @ivar outputFile: the output file with that score, or None
+    """
+    def __init__(self, name, arguments, stdoutPath, stderrPath,
+                 scoreFunction = None):
+        """
+        @param name: name of the job for messages, e.g. "run 3"
+        @type name: str
+
+        @param arguments: the Rosetta command line arguments
+        @type arguments: list of str
+
+        @param stdoutPath: file to which the process's stdout is written
+        @type stdoutPath: str
+
+        @param stderrPath: file to which the process's stderr is written
+        @type stderrPath: str
+
+        @param scoreFunction: if provided, called with this job after its
+                              process exits successfully; must return
+                              (score, outputFile), or (None, None) if the
+                              job produced no output
+        @type scoreFunction: function
+        """
+        self.name = name
+        self.arguments = arguments
+        self.stdoutPath = stdoutPath
+        self.stderrPath = stderrPath
+        self.scoreFunction = scoreFunction
+        self.state = JOB_QUEUED
+        self.exitCode = None
+        self.score = None
+        self.outputFile = None
+        self.process = None
+        return
+
+    def errorInStdout(self):
+        """
+        Return True if Rosetta printed an error message to stdout
+        (it doesn't always exit with a nonzero code when it fails).
+        """
+        try:
+            doc = open(self.stdoutPath, 'r').read()
+        except IOError:
+            return False
+        return doc.find("ERROR") != -1
+
+    pass
+
+class RosettaScheduler(QObject):
+    """
+    Run RosettaJobs concurrently (see module docstring).
+
+    @ivar jobs: all the jobs added, in order
+
+    @ivar bestJob: the succeeded job with the lowest score so far, or None
+
+    @ivar aborted: whether self.abort() was called
+    """
+    def __init__(self, program, workingDirectory, maxProcesses = 1,
+                 jobFinishedCallback = None):
+        """
+        @param program: path of the Rosetta executable
+        @type program: str
+
+        @param workingDirectory: directory in which to run all the jobs
+        @type workingDirectory: str
+
+        @param maxProcesses: how many jobs can run at once
+                             (0 means one per CPU)
+        @type maxProcesses: int
+
+        @param jobFinishedCallback: if provided, called with each job when
+                                    it has finished, failed, or been
+                                    aborted (after self.bestJob is updated)
+        @type jobFinishedCallback: function
+        """
+        QObject.__init__(self)
+        self.program = program
+        self.workingDirectory = workingDirectory
+        if maxProcesses <= 0:
+            maxProcesses = number_of_processors()
+        self.maxProcesses = maxProcesses
+        self.jobFinishedCallback = jobFinishedCallback
+        self.jobs = []
+        self.bestJob = None
+        self.aborted = False
+        self._started = False
+        self._queue = []
+        self._running = []
+        self._eventLoop = None
+        self._abortHandler = None
+        return
+
+    def addJob(self, job):
+        """
+        Add a job to the end of the queue. (Jobs added after self.start()
+        are started as soon as a process is free.)
+        """
+        self.jobs.append(job)
+        self._queue.append(job)
+        self._startQueuedJobs()
+        return
+
+    def start(self):
+        """
+        Start running the queued jobs, and return at once.
+        """
+        self._started = True
+        self._startQueuedJobs()
+        return
+
+    def isDone(self):
+        """
+        Return True if no jobs are queued or running.
+        """
+        return not self._queue and not self._running
+
+    def countFinishedJobs(self):
+        """
+        Return the number of jobs which are no longer queued or running.
+        """
+        return len(self.jobs) - len(self._queue) - len(self._running)
+
+    def succeededJobs(self):
+        """
+        Return a list of the jobs which succeeded, in the order added.
+        """
+        return [job for job in self.jobs if job.state == JOB_SUCCEEDED]
+
+    def wait(self, abortHandler = None):
+        """
+        Start the jobs (if self.start() wasn't called), and return when
+        they have all finished (or been aborted), processing Qt events
+        meanwhile.
+
+        @param abortHandler: if provided, abort all jobs when its abort
+                             button is pressed (and call its finish()
+                             method before returning)
+        @type abortHandler: L{AbortHandler}
+        """
+        self.start()
+        if not self.isDone():
+            self._abortHandler = abortHandler
+            timer = QTimer()
+            self.connect(timer, SIGNAL("timeout()"), self._checkAbortHandler)
+            timer.start(100)
+            self._eventLoop = QEventLoop()
+            self._eventLoop.exec_()
+            self._eventLoop = None
+            timer.stop()
+            self._abortHandler = None
+        if abortHandler:
+            abortHandler.finish()
+        return
+
+    def abort(self):
+        """
+        Kill the running jobs, and don't start the queued ones.
+        """
+        self.aborted = True
+        queue = self._queue
+        self._queue = []
+        for job in queue:
+            job.state = JOB_ABORTED
+            self._jobDone(job)
+        for job in list(self._running):
+            job.process.kill()
+        self._quitIfDone()
+        return
+
+    def _checkAbortHandler(self):
+        if self._abortHandler and \
+           self._abortHandler.getPressCount() > 0 and \
+           not self.aborted:
+            self.abort()
+        return
+
+    def _startQueuedJobs(self):
+        while self._started and \
+              self._queue and \
+              len(self._running) < self.maxProcesses:
+            self._startJob(self._queue.pop(0))
+        return
+
+    def _startJob(self, job):
+        process = Process()
+        process.setProcessName("rosetta (%s)" % job.name)
+        process.redirect_stdout_to_file(job.stdoutPath)
+        process.redirect_stderr_to_file(job.stderrPath)
+        process.setWorkingDirectory(self.workingDirectory)
+        # (PyQt doesn't keep these alive for us)
+        job._finishedSlot = lambda exitCode, job = job: \
+                            self._processFinished(job, exitCode)
+        job._errorSlot = lambda error, job = job: \
+                         self._processError(job, error)
+        self.connect(process, SIGNAL('finished(int)'), job._finishedSlot)
+        self.connect(process, SIGNAL('error(int)'), job._errorSlot)
+        job.process = process
+        job.state = JOB_RUNNING
+        self._running.append(job)
+        print "\n%s [%s]: starting in the background with args:\n%s" \
+              % (process.processName, self.program, job.arguments)
+        process.start(self.program, job.arguments)
+        return
+
+    def _processError(self, job, error):
+        if error == QProcess.FailedToStart and job.state == JOB_RUNNING:
+            # (no finished signal will follow)
+            job.process.set_stdout(None) # closes the files
+            job.process.set_stderr(None)
+            self._processFinished(job, None)
+        return
+
+    def _processFinished(self, job, exitCode):
+        if job.state != JOB_RUNNING:
+            return
+        process = job.process
+        self._running.remove(job)
+        job.process = None
+        if exitCode is not None and \
+           process.exitStatus() != QProcess.NormalExit:
+            exitCode = -2
+        job.exitCode = exitCode
+        if self.aborted:
+            job.state = JOB_ABORTED
+        elif exitCode != 0 or job.errorInStdout():
+            job.state = JOB_FAILED
+        else:
+            job.state = JOB_SUCCEEDED
+            if job.scoreFunction:
+                try:
+                    job.score, job.outputFile = job.scoreFunction(job)
+                except:
+                    print_compact_traceback("bug in score function of " \
+                                            "rosetta job %r: " % job.name)
+                    job.score = job.outputFile = None
+                if job.score is None:
+                    # Rosetta sometimes exits normally with no output
+                    job.state = JOB_FAILED
+                elif self.bestJob is None or job.score < self.bestJob.score:
+                    self.bestJob = job
+        print "%s: %s, exit code %r, score %r" % \
+              (process.processName, job.state, exitCode, job.score)
+        self._jobDone(job)
+        self._startQueuedJobs()
+        self._quitIfDone()
+        return
+
+    def _jobDone(self, job):
+        if self.jobFinishedCallback:
+            try:
+                self.jobFinishedCallback(job)
+            except:
+                print_compact_traceback("bug in jobFinishedCallback " \
+                                        "of RosettaScheduler: ")
+        return
+
+    def _quitIfDone(self):
+        if self.isDone() and self._eventLoop is not None:
+            self._eventLoop.quit()
+        return
+
+    pass
+
+# ==
+
+def _test(njobs = 6, maxProcesses = 3):
+    """
+    Run njobs single-trajectory fake Rosetta designs of a small peptide
+    in a temporary directory, printing each score as its job finishes.
+    """
+    import tempfile, time
+    from PyQt4.Qt import QCoreApplication
+    app = QCoreApplication(sys.argv)
+    workingDirectory = tempfile.mkdtemp()
+    pdb = open(os.path.join(workingDirectory, "test.pdb"), 'w')
+    for i, resname in enumerate(["ALA", "GLY", "LEU", "SER", "TRP"]):
+        pdb.write("ATOM  %5d  CA  %s A%4d    %8.3f%8.3f%8.3f  1.00  0.00\n" %
+                  (i + 1, resname, i + 1, 3.8 * i, 0.0, 0.0))
+    pdb.close()
+    stub = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "fake_rosetta.py")
+    def scoreFunction(job):
+        pdbFile = job.outfile + "_0001.pdb"
+        for line in open(os.path.join(workingDirectory, pdbFile)):
+            if line.find("score") != -1:
+                return float(line[15:]), pdbFile
+        return None, None
+    def jobFinished(job):
+        print "%s %s: score %r, best so far %r" % \
+              (job.name, job.state, job.score,
+               scheduler.bestJob and scheduler.bestJob.score)
+    scheduler = RosettaScheduler(sys.executable, workingDirectory,
+                                 maxProcesses = maxProcesses,
+                                 jobFinishedCallback = jobFinished)
+    for k in range(njobs):
+        job = RosettaJob("run %d" % (k + 1),
+                         [stub, '-design', '-fixbb', '-ndruns', '1',
+                          '-pdbout', 'test_out_run%d' % (k + 1),
+                          '-s', 'test.pdb', '-constant_seed',
+                          '-jran', str(k + 1)],
+                         os.path.join(workingDirectory, "run%d-stdout.txt" % k),
+                         os.path.join(workingDirectory, "run%d-stderr.txt" % k),
+                         scoreFunction = scoreFunction)
+        job.outfile = 'test_out_run%d' % (k + 1)
+        scheduler.addJob(job)
+    start = time.time()
+    scheduler.wait()
+    print "%d jobs, %d at a time, took %.1f sec; best: %s, score %r, in %s" % \
+          (njobs, maxProcesses, time.time() - start, scheduler.bestJob.name,
+           scheduler.bestJob.score, scheduler.bestJob.outputFile)
+    print "(files are in %s)" % workingDirectory
+    return
+
+if __name__ == '__main__':
+    _test()
+
+# end
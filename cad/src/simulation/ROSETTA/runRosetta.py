@@ -30,6 +30,9 @@ from utilities.prefs_constants import rosetta_enabled_prefs_key, rosetta_path_pr
 from utilities.prefs_constants import rosetta_database_enabled_prefs_key, rosetta_dbdir_prefs_key
 from protein.model.Protein import write_rosetta_resfile
 from foundation.wiki_help import WikiHelpBrowser
+from utilities.debug_prefs import debug_pref, Choice
+from simulation.ROSETTA.rosetta_scheduler import RosettaScheduler, RosettaJob
+from simulation.ROSETTA.rosetta_scheduler import JOB_SUCCEEDED, JOB_ABORTED
 
 #global counter so that repeat run of rosetta can produce uniquely named
 #output file.
@@ -37,6 +40,19 @@ count = 1
 #same with backrub
 count_backrub = 1
 
+def debug_pref_rosetta_design_processes():
+    """
+    How many Rosetta processes a fixed backbone sequence design of more
+    than one trajectory can run at once (0 means one per CPU; 1 means
+    run all the trajectories in one Rosetta process).
+    """
+    res = debug_pref("Rosetta: concurrent design processes",
+                     Choice([0, 1, 2, 4, 8],
+                            names = ["all CPUs", "1", "2", "4", "8"]),
+                     prefs_key = True
+                 )
+    return res
+
 def showRosettaScore(tmp_file_prefix, scorefile, win):
     """
     Show the rosetta score of the current protein sequence
@@ -961,6 +977,14 @@ class RosettaRunner:
             rosettaWorkingDir = rosettaFullBaseFileInfo.dir().absolutePath()
             rosettaBaseFileName = rosettaFullBaseFileInfo.fileName()
 
+            if self._runs_design_concurrently():
+                self._run_concurrent_design()
+                # (same cleanup as below)
+                self.set_waitcursor(False)
+                self.win.disable_QActions_for_sim(False)
+                env.history.statusbar_msg("")
+                return
+
             rosettaProcess = Process()
             rosettaProcess.setProcessName("rosetta")
             rosettaProcess.redirect_stdout_to_file("%s-rosetta-stdout.txt" %
@@ -1029,24 +1053,8 @@ class RosettaRunner:
                             #may be we will do it some day, but for now we only output
                             #the chunk with the lowest energy (Score)
                             score, bestSimOutFileName = getScoreFromOutputFile(self.tmp_file_prefix, self.outfile, self.numSim)
-                            chosenOutPath = os.path.join(os.path.dirname(self.tmp_file_prefix), bestSimOutFileName)
-                            insertpdb(self.assy, str(chosenOutPath), None)
-                            #set the secondary structure of the rosetta output protein
-                            #to that of the inpput protein
-                            outProtein = self._set_secondary_structure_of_rosetta_output_protein(bestSimOutFileName)
-                            #update the protein combo box in build protein mode with
-                            #newly created protein chunk
-                            self._updateProteinComboBoxInBuildProteinMode(outProtein)
-                            env.history.statusbar_msg("")
                             fastaFile = self.outfile + "_design.fasta"
-                            fastaFilePath = os.path.join(os.path.dirname(self.tmp_file_prefix), fastaFile)
-                            #process th fasta file to find the sequence of the protein
-                            #with lowest score
-                            proteinSeqList = processFastaFile(fastaFilePath, bestSimOutFileName, self.sim_input_file[0:len(self.sim_input_file)-4])
-                            #show a pop up dialog to show the best score and most
-                            #optimized sequence
-                            if score is not None and proteinSeqList is not []:
-                                self.showResults(score, proteinSeqList)
+                            self._insert_fixed_backbone_design(score, bestSimOutFileName, fastaFile)
                         else:
                             #even when there's nothing in stderr or errocode is zero,
                             #rosetta may not output anything.
@@ -1098,6 +1106,140 @@ class RosettaRunner:
             return # success
         return # caller should look at self.errcode
 
+    def _insert_fixed_backbone_design(self, score, bestSimOutFileName, fastaFile):
+        """
+        Insert the best output protein of a successful fixed backbone
+        sequence design into the model, and show the results
+
+        @param score: score of the best output protein
+        @type score: str
+
+        @param bestSimOutFileName: name of the output pdb file with that score
+        @type bestSimOutFileName: str
+
+        @param fastaFile: name of the fasta file which has the sequences of
+                          the input protein and that output protein
+        @type fastaFile: str
+        """
+        dir = os.path.dirname(self.tmp_file_prefix)
+        chosenOutPath = os.path.join(dir, bestSimOutFileName)
+        insertpdb(self.assy, str(chosenOutPath), None)
+        #set the secondary structure of the rosetta output protein
+        #to that of the inpput protein
+        outProtein = self._set_secondary_structure_of_rosetta_output_protein(bestSimOutFileName)
+        #update the protein combo box in build protein mode with
+        #newly created protein chunk
+        self._updateProteinComboBoxInBuildProteinMode(outProtein)
+        env.history.statusbar_msg("")
+        fastaFilePath = os.path.join(dir, fastaFile)
+        #process th fasta file to find the sequence of the protein
+        #with lowest score
+        proteinSeqList = processFastaFile(fastaFilePath, bestSimOutFileName, self.sim_input_file[0:len(self.sim_input_file)-4])
+        #show a pop up dialog to show the best score and most
+        #optimized sequence
+        if score is not None and proteinSeqList is not []:
+            self.showResults(score, proteinSeqList)
+        return
+
+    def _runs_design_concurrently(self):
+        """
+        Whether to run the current fixed backbone sequence design
+        as one Rosetta process per trajectory (see _run_concurrent_design)
+        """
+        return self.cmd_type == "ROSETTA_FIXED_BACKBONE_SEQUENCE_DESIGN" and \
+               self.numSim > 1 and \
+               debug_pref_rosetta_design_processes() != 1
+
+    def _run_concurrent_design(self):
+        """
+        Run the fixed backbone sequence design as self.numSim independent
+        Rosetta runs of one trajectory each, with their own random seeds
+        and output files, running several at once in the background
+        (see rosetta_scheduler.py). Report each run's score as it finishes,
+        and insert the best design into the model.
+        """
+        dir = os.path.dirname(self.tmp_file_prefix)
+        msg = greenmsg("Starting Rosetta sequence design")
+        env.history.message(self.cmdname + ": " + msg)
+        env.history.message("%s: Rosetta files at %s%s%s.*" %
+            (self.cmdname, dir, os.sep,
+             os.path.basename(self.tmp_file_prefix)))
+        abortHandler = AbortHandler(self.win.statusBar(), "rosetta")
+        scheduler = RosettaScheduler(self.program, dir,
+                                     maxProcesses = debug_pref_rosetta_design_processes(),
+                                     jobFinishedCallback = self._concurrent_design_run_finished)
+        self._scheduler = scheduler
+        #each run makes one trajectory and writes it to its own pdbout;
+        #Rosetta's random seed is taken from the clock unless we give it one,
+        #so runs started at the same time would make the same trajectory
+        baseSeed = int(time.time()) % 1000000
+        for i in range(self.numSim):
+            runOutfile = "%s_run%d" % (self.outfile, i + 1)
+            args = list(self._arguments)
+            args[args.index('-ndruns') + 1] = '1'
+            args[args.index('-pdbout') + 1] = runOutfile
+            args.extend(['-constant_seed', '-jran', str(baseSeed + i)])
+            runFilePrefix = "%s-run%d" % (self.tmp_file_prefix, i + 1)
+            job = RosettaJob("run %d" % (i + 1), args,
+                             runFilePrefix + "-rosetta-stdout.txt",
+                             runFilePrefix + "-rosetta-stderr.txt",
+                             scoreFunction = self._score_concurrent_design_run)
+            job.outfile = runOutfile
+            scheduler.addJob(job)
+        env.history.message("%s: running %d Rosetta processes at a time" %
+                            (self.cmdname, scheduler.maxProcesses))
+        scheduler.wait(abortHandler)
+        self._scheduler = None
+        env.history.statusbar_msg("")
+
+        bestJob = scheduler.bestJob
+        if scheduler.aborted:
+            msg = redmsg("Aborted.")
+            env.history.message(self.cmdname + ": " + msg)
+        elif bestJob is None:
+            msg = redmsg("Rosetta sequence design failed. For details check " +
+                         scheduler.jobs[0].stdoutPath)
+            env.history.message(self.cmdname + ": " + msg)
+            self.errcode = 2
+        else:
+            msg = greenmsg("Rosetta sequence design succeeded (%d of %d runs)" %
+                           (len(scheduler.succeededJobs()), self.numSim))
+            env.history.message(self.cmdname + "> " + self.cmd_type + ": " + msg)
+            self._insert_fixed_backbone_design(str(bestJob.score),
+                                               bestJob.outputFile,
+                                               bestJob.outfile + "_design.fasta")
+        return
+
+    def _score_concurrent_design_run(self, job):
+        """
+        Return the score and output pdb file name of a finished run
+        of _run_concurrent_design, or (None, None) if Rosetta didn't
+        write the output file.
+        """
+        outputFile = job.outfile + '_0001.pdb'
+        outPath = os.path.join(os.path.dirname(self.tmp_file_prefix), outputFile)
+        if not os.path.exists(outPath):
+            return None, None
+        score, pdbFile = getScoreFromOutputFile(self.tmp_file_prefix, job.outfile, 1)
+        return float(score), pdbFile
+
+    def _concurrent_design_run_finished(self, job):
+        """
+        Report a finished run of _run_concurrent_design.
+        """
+        scheduler = self._scheduler
+        if job.state == JOB_SUCCEEDED:
+            msg = "%s: %s finished, score %s (best so far: %s)" % \
+                  (self.cmdname, job.name, job.score, scheduler.bestJob.score)
+            env.history.message(msg)
+        elif job.state != JOB_ABORTED:
+            msg = redmsg("%s failed. For details check %s" %
+                         (job.name, job.stdoutPath))
+            env.history.message(self.cmdname + ": " + msg)
+        env.history.statusbar_msg("Running Rosetta: %d of %d runs done" %
+                                  (scheduler.countFinishedJobs(), len(scheduler.jobs)))
+        return
+
     def _updateProteinComboBoxInBuildProteinMode(self, outProtein):
         """
         update protein combo box in build protein mode with the newly generated
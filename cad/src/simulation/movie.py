@@ -20,6 +20,8 @@ from utilities.Log import redmsg, orangemsg, greenmsg
 from geometry.VQT import A
 from foundation.state_utils import IdentityCopyMixin
 from operations.move_atoms_and_normalize_bondpoints import move_atoms_and_normalize_bondpoints
+from operations.move_atoms_and_normalize_bondpoints import ChunkwiseAtomMover
+from operations.move_atoms_and_normalize_bondpoints import debug_pref_move_atoms_chunkwise
 from utilities import debug_flags
 from platform_dependent.PlatformDependent import fix_plurals
 from utilities.debug import print_compact_stack, print_compact_traceback
@@ -236,6 +238,8 @@ class Movie(IdentityCopyMixin): #bruce 080321 bugfix: added IdentityCopyMixin
         # bruce 050324 added these:
         self.alist = None # list of atoms for which this movie was made, if this has yet been defined
         self.alist_and_moviefile = None #bruce 050427: hold checked correspondence between alist and moviefile, if we have one
+        self._atom_mover = None # ChunkwiseAtomMover used by moveAtoms...
+        self._atom_mover_alist = None # ... and the alist it was made for
         self.debug_dump("end of init")
         return
 
@@ -305,6 +309,7 @@ class Movie(IdentityCopyMixin): #bruce 080321 bugfix: added IdentityCopyMixin
         # it should be revised to work either way and _close if necessary.
         # for now, just break cycles.
         self.win = self.assy = self.part = self.alist = self.fileobj = None
+        self._atom_mover = self._atom_mover_alist = None
         del self.fileobj # obs attrname
         del self.part
 
@@ -646,8 +651,16 @@ class Movie(IdentityCopyMixin): #bruce 080321 bugfix: added IdentityCopyMixin
 
         You may then make a move of it with:
             mencoder "mf://*.png" -mf fps=25 -o output.avi -ovc lavc -lavcopts vcodec=mpeg4
+
+        If a debug_pref says to, the macros, camera and lighting (which
+        are the same in every frame) are written only once, into
+        foobar.scene.inc, which each frame's file includes; povray must
+        then be run in the directory which contains it (as in the command
+        above). That only saves about 7 KB per file (see PovraySeriesWriter).
         """
         from graphics.rendering.povray.writepovfile import writepovfile
+        from graphics.rendering.povray.writepovfile import PovraySeriesWriter
+        from graphics.rendering.povray.writepovfile import debug_pref_povray_series_shares_scene
 
         if not self.isOpen: #bruce 050428 not sure if this is the best condition to use here ###@@@
             if (not self.might_be_playable()) and 0: ## self.why_not_playable:
@@ -662,6 +675,10 @@ class Movie(IdentityCopyMixin): #bruce 080321 bugfix: added IdentityCopyMixin
         # Writes the POV-Ray series starting at the current frame until the last frame,
         # skipping frames if "Skip" (on the dashboard) is != 0.  Mark 050908
         nfiles = 0
+        series_writer = None
+        if debug_pref_povray_series_shares_scene():
+            scene_filename = "%s.scene.inc" % name
+            series_writer = PovraySeriesWriter(self.assy.o, scene_filename)
         for i in range(self.currentFrame,
                        self.totalFramesActual+1,
                        self.propMgr.frameSkipSpinBox.value()):
@@ -670,7 +687,10 @@ class Movie(IdentityCopyMixin): #bruce 080321 bugfix: added IdentityCopyMixin
             # For 100s of files, printing a history message for each file is undesired.
             # Instead, I include a summary message below. Fixes bug 953.  Mark 051119.
             # env.history.message( "Writing file: " + filename )
-            writepovfile(self.assy.part, self.assy.o, filename) #bruce 050927 revised arglist
+            if series_writer:
+                series_writer.write(self.assy.part, filename)
+            else:
+                writepovfile(self.assy.part, self.assy.o, filename) #bruce 050927 revised arglist
             nfiles += 1
             self.framecounter  =  i #  gets the the last frame number of the file written. This will be passed in the history message ninad060809
 
@@ -683,6 +703,10 @@ class Movie(IdentityCopyMixin): #bruce 080321 bugfix: added IdentityCopyMixin
         filenames = "%s.%06d.pov - %06d.pov" % (name, self.currentFrame, self.framecounter)#ninad060809 fixed bugs 2147 and 2148
         msg = "Files are named %s." % filenames
         env.history.message(msg)
+        if series_writer:
+            msg = "They all include %s (the shared POV-Ray header)." % \
+                  scene_filename
+            env.history.message(msg)
 
 
     def _continue(self, hflag = True): # [bruce 050427 comment: only called from self._play]
@@ -874,7 +898,9 @@ class Movie(IdentityCopyMixin): #bruce 080321 bugfix: added IdentityCopyMixin
                     else:
                         env.history.message(playDirection[ inc ] + "ing to frame " + str(fnum))
         else:
-            if abs(fnum - self.currentFrame) > 1000:
+            # (with the moviefile's keyframe index and frame cache, most slider
+            #  moves are fast no matter how far they go)
+            if self.alist_and_moviefile.frames_to_read(fnum) > 1000:
                 env.history.message("Advancing to frame " + str(fnum) + ". Please wait...")
                 env.history.h_update() #bruce 060707
                 waitCursor = True
@@ -1091,7 +1117,7 @@ class Movie(IdentityCopyMixin): #bruce 080321 bugfix: added IdentityCopyMixin
         fullpath, ext = os.path.splitext(self.filename)
         return fullpath + "-plot.txt"
 
-    def moveAtoms(self, newPositions): # used when reading xyz files
+    def moveAtoms(self, newPositions, scale = None): # used when reading xyz files
         """
         Move a list of atoms to newPosition. After all atoms moving
         [and singlet positions updated], bond updated, update display once.
@@ -1099,6 +1125,10 @@ class Movie(IdentityCopyMixin): #bruce 080321 bugfix: added IdentityCopyMixin
         @param newPosition: a list of atom absolute position,
                             the list order is the same as self.alist
         @type  newPosition: list
+
+        @param scale: if given, multiply newPositions by this first
+                      (e.g. 0.01 for a simulator frame in pm)
+        @type  scale: float
         """
         if len(newPositions) != len(self.alist):
             #bruce 050225 added some parameters to this error message
@@ -1110,7 +1140,16 @@ class Movie(IdentityCopyMixin): #bruce 080321 bugfix: added IdentityCopyMixin
             print msg
             raise ValueError, msg
                 #bruce 060108 reviewed/revised all 2 calls, added this exception to preexisting noop/errorprint (untested)
-        move_atoms_and_normalize_bondpoints(self.alist, newPositions) #bruce 051221 fixed bug 1239 in this function, then split it out
+        if debug_pref_move_atoms_chunkwise():
+            mover = self._atom_mover
+            if mover is None or self._atom_mover_alist is not self.alist:
+                mover = self._atom_mover = ChunkwiseAtomMover(self.alist)
+                self._atom_mover_alist = self.alist
+            mover.move_atoms(newPositions, scale)
+        else:
+            if scale is not None:
+                newPositions = A(newPositions) * scale
+            move_atoms_and_normalize_bondpoints(self.alist, newPositions) #bruce 051221 fixed bug 1239 in this function, then split it out
         self.glpane.gl_update()
         return
 
@@ -1143,6 +1182,7 @@ class MovableAtomList: #bruce 050426 splitting this out of class Movie... except
         self.alist = list(alist) # use A()?
             # is alist a public attribute? (if so, no need for methods to prune its atoms by part or killedness, etc)
         self.natoms = len(self.alist)
+        self._mover = None # ChunkwiseAtomMover for self.alist, made when needed
 
     def get_sim_posns(self): #bruce 060111 renamed and revised this from get_posns, for use in approximate fix of bug 1297
         # note: this method is no longer called as of bruce 060112, but its comments are relevant and are referred to
@@ -1184,7 +1224,12 @@ class MovableAtomList: #bruce 050426 splitting this out of class Movie... except
         # atoms
         #bruce 060111 comment: should probably be renamed set_sim_posns
         # since it corrects singlet posns
-        move_atoms_and_normalize_bondpoints(self.alist, newposns)
+        if debug_pref_move_atoms_chunkwise():
+            if self._mover is None:
+                self._mover = ChunkwiseAtomMover(self.alist)
+            self._mover.move_atoms(newposns)
+        else:
+            move_atoms_and_normalize_bondpoints(self.alist, newposns)
 
     set_posns_no_inval = set_posns #e for now... later this can be faster, and require own/release around it
 
@@ -1207,6 +1252,7 @@ class MovableAtomList: #bruce 050426 splitting this out of class Movie... except
 
     def destroy(self):
         self.alist = None
+        self._mover = None
 
     pass # end of class MovableAtomList
 
@@ -1337,6 +1383,11 @@ class alist_and_moviefile:
         pass
     def get_totalFramesActual(self):
         return self.moviefile.get_totalFramesActual()
+    def frames_to_read(self, n):
+        """
+        Return roughly how many delta frames play_frame(n) would need to read.
+        """
+        return self.moviefile.frames_to_read(n)
     def close_file(self):
         self.moviefile.close_file()
     pass # end of class alist_and_moviefile
@@ -53,6 +53,7 @@ from utilities.Log import redmsg, greenmsg, orangemsg, quote_html, _graymsg
 import foundation.env as env
 from foundation.env import seen_before
 from geometry.VQT import A, vlen
+import Numeric
 import re
 from model.chunk import Chunk
 from model.elements import Singlet
@@ -65,6 +66,7 @@ from simulation.PyrexSimulator import thePyrexSimulator
 from simulation.SimulatorParameters import SimulatorParameters
 from simulation.YukawaPotential import YukawaPotential
 from simulation.GromacsLog import GromacsLog
+from files.xyz.files_xyz import parse_xyz_atom_lines, XYZFormatError
 
 from utilities.prefs_constants import electrostaticsForDnaDuringAdjust_prefs_key
 from utilities.prefs_constants import electrostaticsForDnaDuringMinimize_prefs_key
@@ -1844,13 +1846,14 @@ class SimRunner:
 ##                  (self.mflag and env.prefs[Adjust_watchRealtimeMinimization_prefs_key])):
             elif self._movie.watch_motion:
                 from sim import theSimulator
-                frame = theSimulator().getFrame()
+                frame = theSimulator().getFrameView()
+                    # (in pm, and only valid during this callback)
                 # stick the atom posns in, and adjust the singlet posns
                 newPositions = frame
                 movie = self._movie
                 #bruce 060102 note: following code is approximately duplicated somewhere else in this file.
                 try:
-                    movie.moveAtoms(newPositions)
+                    movie.moveAtoms(newPositions, scale = 0.01) # pm -> Angstroms
                 except ValueError: #bruce 060108
                     # wrong number of atoms in newPositions (only catches a subset of possible model-editing-induced errors)
                     self.abort_sim_run("can't apply frame %d, model has changed" % frame_number)
@@ -2614,7 +2617,7 @@ def readxyz(filename, alist):
     is involved), then the fact that we sort atoms by key when creating
     alists for writing sim-input mmp files might make this order likely to match.
        On error, print a message to stdout and also return it to the caller.
-       On success, return a list of atom new positions
+       On success, return an (N,3) Numeric array of new atom positions
     in the same order as in the xyz file (hopefully the same order as in alist).
     """
     from model.elements import Singlet
@@ -2629,8 +2632,6 @@ def readxyz(filename, alist):
 
     atomList = alist ## was assy.alist, with assy passed as an arg
         # bruce comment 050324: this list or its atoms are not modified in this function
-    ## stores the new position for each atom in atomList
-    newAtomsPos = []
 
     try:
         numAtoms_junk = int(lines[0])
@@ -2640,17 +2641,34 @@ def readxyz(filename, alist):
         print msg
         return msg
 
-    atomIndex = 0
-    for line in lines[2:]:
-        words = line.split()
-        if len(words) != 4:
-            msg = "readxyz: %s: Line %d format error." % (xyzFile, lines.index(line) + 1)
-                #bruce 050404 fixed order of printfields, added 1 to index
-            print msg
-            return msg
-        try:
-            if words[0] != atomList[atomIndex].element.symbol:
-                if words[0] == 'H' and atomList[atomIndex].element == Singlet:
+    # Parse all the atom lines at once into an array of positions
+    # (see files_xyz for details).
+    try:
+        symbols, newAtomsPos = parse_xyz_atom_lines(lines[2:])
+    except XYZFormatError, e:
+        atomIndex = e.index
+        if e.kind == 'fields':
+            msg = "readxyz: %s: Line %d format error." % (xyzFile, atomIndex + 3)
+        elif atomIndex >= len(atomList):
+            msg = "readxyz: %s: error (perhaps fewer atoms in model than in xyz file)" % (xyzFile,)
+        else:
+            msg = "readxyz: %s: atom %d (%s) position number format error." % (xyzFile, atomIndex+1, atomList[atomIndex])
+        print msg
+        return msg
+
+    if len(symbols) > len(atomList):
+        msg = "readxyz: %s: error (perhaps fewer atoms in model than in xyz file)" % (xyzFile,)
+        print msg
+        return msg
+
+    # Check the elements. The simulator writes H for singlets, so in the
+    # usual case this one comparison of lists of symbols suffices.
+    expected = [(atom.element is Singlet and 'H' or atom.element.symbol)
+                for atom in atomList[:len(symbols)]]
+    if symbols != expected:
+        for atomIndex in range(len(symbols)):
+            if symbols[atomIndex] != atomList[atomIndex].element.symbol:
+                if symbols[atomIndex] == 'H' and atomList[atomIndex].element == Singlet:
                     #bruce 050406 permit this, to help fix bug 254 by writing H to sim for Singlets in memory
                     pass
                 else:
@@ -2658,22 +2676,8 @@ def readxyz(filename, alist):
                         #bruce 050404: atomIndex is not very useful, so I added 1
                         # (to make it agree with likely number in mmp file)
                         # and the atom name from the model.
-                        ###@@@ need to fix this for H vs singlet (then do we revise posn here or in caller?? probably in caller)
                     print msg
                     return msg
-            newAtomsPos += [map(float, words[1:])]
-        except ValueError:
-            msg = "readxyz: %s: atom %d (%s) position number format error." % (xyzFile, atomIndex+1, atomList[atomIndex])
-                #bruce 050404: same revisions as above.
-            print msg
-            return msg
-        except:
-            #bruce 060108 added this case (untested) since it looks necessary to catch atomList[atomIndex] attributeerrors
-            msg = "readxyz: %s: error (perhaps fewer atoms in model than in xyz file)" % (xyzFile,)
-            print msg
-            return msg
-
-        atomIndex += 1
 
     if (len(newAtomsPos) != len(atomList)): #bruce 050225 added some parameters to this error message
         msg = "readxyz: The number of atoms from %s (%d) is not matching with the current model (%d)." % \
@@ -2688,7 +2692,7 @@ def readGromacsCoordinates(filename, atomList, tracefileProcessor = None):
     Read a coordinate file created by gromacs, typically for
     minimizing a part.
        On error, print a message to stdout and also return it to the caller.
-       On success, return a list of atom new positions
+       On success, return an (N,3) Numeric array of new atom positions
     in the same order as in the xyz file (hopefully the same order as in alist).
     """
     translateFileName = None
@@ -2725,9 +2729,6 @@ def readGromacsCoordinates(filename, atomList, tracefileProcessor = None):
         print msg
         return msg
 
-    newAtomsPos = []
-    allAtomPositions = []
-
     try:
         numAtoms_junk = int(lines[1])
     except ValueError:
@@ -2735,31 +2736,33 @@ def readGromacsCoordinates(filename, atomList, tracefileProcessor = None):
         print msg
         return msg
 
-    atomIndex = 0
-    for line in lines[2:-1]:
-        #          1         2         3         4
-        #01234567890123456789012345678901234567890123456789
-        #    1xxx     A1    1   9.683   9.875   0.051
-        xstr = line[20:28]
-        ystr = line[28:36]
-        zstr = line[36:44]
-        extraString = line[44:]
-        if (extraString.strip() != ""):
-            return "GROMACS minimize returned malformed results (output overflow?)"
-        if (xstr == "     nan" or ystr == "     nan" or zstr == "     nan"):
-            return "GROMACS minimize returned undefined results"
-        try:
-            x = float(xstr) * 10.0 + dX
-            y = float(ystr) * 10.0 + dY
-            z = float(zstr) * 10.0 + dZ
-        except ValueError, e:
-            return "Error parsing GROMACS minimize results: [%s][%s][%s]" % (xstr, ystr, zstr)
-        atomIndex += 1
-        if (atomIndex <= len(atomList)):
-            # coordinates of virtual sites are reported at end of
-            # list, and we want to ignore them.
-            newAtomsPos += [[x, y, z]]
-        allAtomPositions += [[x, y, z]]
+    # The coordinates are in fixed columns:
+    #          1         2         3         4
+    #01234567890123456789012345678901234567890123456789
+    #    1xxx     A1    1   9.683   9.875   0.051
+    # Convert all of them at once (rather than one line at a time).
+    atomLines = lines[2:-1]
+    if "".join([line[44:] for line in atomLines]).strip() != "":
+        return "GROMACS minimize returned malformed results (output overflow?)"
+    xstrs = [line[20:28] for line in atomLines]
+    ystrs = [line[28:36] for line in atomLines]
+    zstrs = [line[36:44] for line in atomLines]
+    if "     nan" in xstrs or "     nan" in ystrs or "     nan" in zstrs:
+        return "GROMACS minimize returned undefined results"
+    try:
+        allAtomPositions = A([map(float, xstrs), map(float, ystrs), map(float, zstrs)])
+    except ValueError:
+        for xstr, ystr, zstr in zip(xstrs, ystrs, zstrs):
+            try:
+                map(float, (xstr, ystr, zstr))
+            except ValueError:
+                return "Error parsing GROMACS minimize results: [%s][%s][%s]" % (xstr, ystr, zstr)
+        raise # not reached
+    allAtomPositions = Numeric.transpose(allAtomPositions) * 10.0 + A([dX, dY, dZ])
+
+    # coordinates of virtual sites are reported at end of
+    # list, and we want to ignore them.
+    newAtomsPos = allAtomPositions[:len(atomList)]
     if (len(newAtomsPos) != len(atomList)):
         msg = "readGromacsCoordinates: The number of atoms from %s (%d) is not matching with the current model (%d)." % \
             (filename, len(newAtomsPos), len(atomList))
@@ -612,9 +612,8 @@ class Minimize_CommandRun(CommandRun):
             else:
                 newPositions = readxyz( movie.filename, movie.alist )
                     # movie.alist is now created in writemovie [bruce 050325]
-            # retval is either a list of atom posns or an error message string.
-            assert type(newPositions) in [type([]),type("")]
-            if type(newPositions) == type([]):
+            # retval is either an array of atom posns or an error message string.
+            if type(newPositions) != type(""):
                 #bruce 060102 note: following code is approximately duplicated somewhere else in this file.
                 movie.moveAtoms(newPositions)
                 # bruce 050311 hand-merged mark's 1-line bugfix in assembly.py (rev 1.135):
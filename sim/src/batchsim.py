@@ -28,12 +28,58 @@
  executed.  When it exits, the job directory is moved to the OUTPUT
  directory, and the queue runner scans the QUEUE directory again.
  When it finds nothing in the QUEUE directory, it exits.
+
+ Batch mode (batchsim --manifest FILE) runs a list of minimizations
+ without asking any questions, for runs of thousands of jobs:
+
+   batchsim --manifest jobs.json [--jobs N] [--timeout SECONDS]
+            [--output DIR] [--simulator PATH] [--system-parameters FILE]
+            [--in-process] [--retry-failed]
+
+ The manifest is either a JSON file (name ending in .json) holding a
+ list of objects, or a CSV file with a header line.  Each job has the
+ fields:
+
+   mmp      the input .mmp file (relative to the manifest's directory)
+   args     simulator flags, as one string (default "-m")
+   name     the job's name (default: the .mmp file's base name; path
+            separators are replaced with "_")
+   timeout  seconds before the job is killed (default: --timeout)
+   params   (JSON only, used with --in-process) a dict of simulator
+            attributes to set, like {"MinimizeThresholdEndRMS": 50.0}
+
+ Up to N jobs (default: the number of processors) run at once, each
+ in its own process, in its own directory DIR/jobs/<name>.  Normally
+ each job runs the simulator executable, as
+
+   simulator <args> --trace-file <name>-trace.txt <name>.mmp
+
+ With --in-process, each job process runs the simulator through the
+ sim module (sim.pyx) instead, using theSimulator(), which must have
+ been built in this directory.
+
+ The result of each job is recorded in DIR/state.json as soon as it
+ finishes, so if batchsim is interrupted, running it again with the
+ same manifest and output directory only runs the jobs which haven't
+ finished yet (and those which failed or timed out, with
+ --retry-failed).  When all jobs are finished, a report of each job's
+ status, run time, and final RMS force, maximum force and energy (from
+ the "# Done:" line of its trace file) is printed, and written to
+ DIR/summary.txt and DIR/summary.csv.
 """
 
 import sys
 import os
 import time
 import fcntl
+import signal
+import shutil
+import shlex
+import csv
+import json
+import re
+import traceback
+from optparse import OptionParser
 
 baseDirectory = "/tmp/batchsim"
 
@@ -277,12 +323,422 @@ def makeDirectory(path):
         return
     os.makedirs(path)
 
+# Batch mode
+
+POLL_INTERVAL = 0.1 # seconds between checks for finished jobs
+
+# status values recorded for finished jobs
+DONE = "done"
+FAILED = "failed"
+TIMEOUT = "timeout"
+
+class BatchJob:
+    """
+      One minimization from a batch manifest.
+    """
+    def __init__(self, name, mmp, args, timeout, params):
+        self.name = name
+        self.mmp = mmp # absolute path of the input file
+        self.args = args # list of simulator flags
+        self.timeout = timeout # seconds, or None for no limit
+        self.params = params # simulator attributes, for --in-process
+        self.directory = None # set when the job is started
+        self.startTime = None
+        self.timedOut = False
+
+def jobName(name):
+    """
+      Return name made safe to use as a job directory name: path
+      separators become underscores, and names like "." and ".." get an
+      underscore prefix.
+    """
+    for separator in ("/", "\\", os.sep):
+        name = name.replace(separator, "_")
+    if (os.altsep):
+        name = name.replace(os.altsep, "_")
+    if (not name or name.strip(".") == ""):
+        name = "_" + name
+    return name
+
+def readManifest(manifestName, defaultTimeout):
+    """
+      Return a list of BatchJobs for the jobs listed in a JSON or CSV
+      manifest file (see module docstring).
+    """
+    manifestDirectory = os.path.dirname(os.path.abspath(manifestName))
+    f = open(manifestName)
+    if (manifestName.endswith(".json")):
+        entries = json.load(f)
+    else:
+        entries = list(csv.DictReader(f))
+    f.close()
+    jobs = []
+    names = {}
+    for entry in entries:
+        mmp = entry.get("mmp")
+        if (not mmp):
+            raise ValueError("manifest entry has no mmp file: %r" % (entry,))
+        mmp = os.path.join(manifestDirectory, str(mmp))
+        name = entry.get("name")
+        if (not name):
+            name = os.path.basename(mmp)
+            if (name.endswith(".mmp")):
+                name = name[:-4]
+        name = jobName(str(name))
+        # make names unique, so each job gets its own directory and state
+        if (names.has_key(name)):
+            base = name
+            while (names.has_key(name)):
+                names[base] += 1
+                name = "%s-%d" % (base, names[base])
+        names[name] = 1
+        args = entry.get("args") or "-m"
+        if (isinstance(args, basestring)):
+            args = shlex.split(str(args))
+        else:
+            args = map(str, args)
+        timeout = entry.get("timeout")
+        if (timeout):
+            timeout = float(timeout)
+        else:
+            timeout = defaultTimeout
+        params = {}
+        for attr, value in (entry.get("params") or {}).items():
+            if (isinstance(value, unicode)):
+                value = str(value) # the simulator needs byte strings
+            params[str(attr)] = value
+        jobs.append(BatchJob(name, mmp, args, timeout, params))
+    return jobs
+
+def loadState(stateFileName):
+    """
+      Return the dict of finished job results saved by saveState, or an
+      empty dict if there is none.
+    """
+    try:
+        f = open(stateFileName)
+    except IOError:
+        return {}
+    state = json.load(f)
+    f.close()
+    return state
+
+def saveState(state, stateFileName):
+    # write and rename, so an interrupted write never loses old results
+    tempName = stateFileName + ".tmp"
+    f = open(tempName, 'w')
+    json.dump(state, f, indent = 1, sort_keys = True)
+    f.close()
+    os.rename(tempName, stateFileName)
+
+def runJobInProcess(job, traceFileName, outputFileName, options):
+    """
+      Run job's minimization through sim.theSimulator(), in the current
+      (forked) process.  The sim module keeps its settings in C globals,
+      which is why each job gets a process of its own.
+    """
+    import sim
+    simulator = sim.theSimulator()
+    simulator.reinitGlobals()
+    if (options.systemParameters):
+        simulator.SystemParametersFileName = options.systemParameters
+    simulator.ToMinimize = 1
+    simulator.DumpAsText = 1
+    simulator.OutputFormat = 0
+    simulator.PrintFrameNums = 0
+    simulator.InputFileName = job.name + ".mmp"
+    simulator.OutputFileName = outputFileName
+    simulator.TraceFileName = traceFileName
+    for attr, value in job.params.items():
+        setattr(simulator, attr, value)
+    simulator.go()
+
+def startJob(job, outputDirectory, options):
+    """
+      Fork a process to run job in its own directory, and return its pid.
+    """
+    job.directory = os.path.join(outputDirectory, "jobs", job.name)
+    makeDirectory(job.directory)
+    mmpName = job.name + ".mmp"
+    shutil.copy(job.mmp, os.path.join(job.directory, mmpName))
+    traceFileName = job.name + "-trace.txt"
+    if (os.path.exists(os.path.join(job.directory, traceFileName))):
+        os.remove(os.path.join(job.directory, traceFileName))
+    argv = [options.simulator] + job.args
+    if (options.systemParameters and not "--system-parameters" in job.args):
+        argv += ["--system-parameters", options.systemParameters]
+    argv += ["--trace-file", traceFileName, mmpName]
+
+    job.startTime = time.time()
+    pid = os.fork()
+    if (pid):
+        return pid
+
+    # child: like runJob, but exits rather than returning
+    try:
+        os.chdir(job.directory)
+        childStdin = open("/dev/null")
+        childStdout = open("stdout", 'w')
+        childStderr = open("stderr", 'w')
+        os.dup2(childStdin.fileno(), 0)
+        os.dup2(childStdout.fileno(), 1)
+        os.dup2(childStderr.fileno(), 2)
+        sys.stdout = os.fdopen(1, 'w', 0)
+        sys.stderr = os.fdopen(2, 'w', 0)
+        if (options.inProcess):
+            runJobInProcess(job, traceFileName, job.name + ".xyz", options)
+            os._exit(0)
+        f = open("run", 'w')
+        print >>f, " ".join(argv)
+        f.close()
+        os.execvp(argv[0], argv)
+    except:
+        traceback.print_exc()
+    os._exit(127)
+
+_doneLine = re.compile(r"# Done: Final forces: rms ([^ ]+) pN, high ([^ ]+) pN, "
+                       r"model energy: ([^ ]+) aJ")
+
+def readTraceResults(traceFileName):
+    """
+      Return (rms, high, energy, error) from a minimization trace file:
+      the final RMS and maximum force (pN) and energy (aJ) from its
+      "# Done:" line (each None if not found), and its first error
+      message (or None).
+    """
+    rms = high = energy = error = None
+    try:
+        f = open(traceFileName)
+    except IOError:
+        return rms, high, energy, error
+    for line in f:
+        if (line.startswith("# Error") and error is None):
+            error = line[1:].strip()
+        match = _doneLine.match(line)
+        if (match):
+            rms, high, energy = map(float, match.groups())
+    f.close()
+    return rms, high, energy, error
+
+def lastLine(fileName):
+    try:
+        f = open(fileName)
+    except IOError:
+        return None
+    lines = [line.strip() for line in f if not line.isspace()]
+    f.close()
+    if (lines):
+        return lines[-1][:200]
+    return None
+
+def decodeWaitStatus(waitStatus):
+    """
+      Return (exitStatus, signalNumber) for a status from os.waitpid.
+      One of them is None: exitStatus if the process was killed by a
+      signal, signalNumber if it exited.
+    """
+    if (os.WIFSIGNALED(waitStatus)):
+        return None, os.WTERMSIG(waitStatus)
+    return os.WEXITSTATUS(waitStatus), None
+
+def finishJob(job, waitStatus):
+    """
+      Return the result dict for a job whose process has exited, given
+      its status from os.waitpid.
+    """
+    exitStatus, signalNumber = decodeWaitStatus(waitStatus)
+    seconds = time.time() - job.startTime
+    rms, high, energy, error = \
+         readTraceResults(os.path.join(job.directory, job.name + "-trace.txt"))
+    if (job.timedOut):
+        status = TIMEOUT
+        error = "killed after %g seconds" % job.timeout
+    elif (signalNumber is not None):
+        status = FAILED
+        error = "killed by signal %d" % signalNumber
+    elif (exitStatus or rms is None):
+        status = FAILED
+        if (error is None):
+            error = lastLine(os.path.join(job.directory, "stderr")) or \
+                    "exit status %d, no final forces in trace file" % exitStatus
+    else:
+        status = DONE
+    return {
+        "status": status,
+        "exitStatus": exitStatus,
+        "signal": signalNumber,
+        "seconds": round(seconds, 3),
+        "rms": rms,
+        "high": high,
+        "energy": energy,
+        "error": error,
+        "directory": job.directory,
+        }
+
+def killJobs(running):
+    for pid in running.keys():
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+def runBatch(jobs, state, stateFileName, outputDirectory, options):
+    """
+      Run jobs, at most options.jobs at a time, recording each result in
+      state (and saving it) as soon as the job finishes.
+    """
+    pending = list(jobs)
+    running = {} # pid -> BatchJob
+    finished = 0
+    try:
+        while (pending or running):
+            while (pending and len(running) < options.jobs):
+                job = pending.pop(0)
+                running[startJob(job, outputDirectory, options)] = job
+            pid, waitStatus = os.waitpid(-1, os.WNOHANG)
+            if (not pid):
+                now = time.time()
+                for pid, job in running.items():
+                    if (job.timeout and not job.timedOut and
+                        now - job.startTime > job.timeout):
+                        job.timedOut = True
+                        os.kill(pid, signal.SIGKILL)
+                time.sleep(POLL_INTERVAL)
+                continue
+            job = running.pop(pid, None)
+            if (job is None):
+                continue
+            result = finishJob(job, waitStatus)
+            state[job.name] = result
+            saveState(state, stateFileName)
+            finished += 1
+            print "[%d/%d] %s: %s (%.1f s)" % \
+                  (finished, len(jobs), job.name, result["status"], result["seconds"])
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        killJobs(running)
+        print
+        print "Interrupted; %d jobs not finished.  Run again to resume." % \
+              (len(pending) + len(running))
+        sys.exit(1)
+
+def formatValue(value, format):
+    if (value is None):
+        return "-"
+    return format % value
+
+def writeSummary(jobs, state, outputDirectory):
+    """
+      Print and save a report of the results of all jobs.
+    """
+    lines = []
+    counts = {}
+    totalSeconds = 0.0
+    lines.append("%-30s %-8s %10s %12s %12s %12s" %
+                 ("job", "status", "seconds", "rms (pN)", "high (pN)", "energy (aJ)"))
+    csvFile = open(os.path.join(outputDirectory, "summary.csv"), 'w')
+    writer = csv.writer(csvFile)
+    writer.writerow(["job", "status", "seconds", "rms", "high", "energy", "error"])
+    for job in jobs:
+        result = state.get(job.name)
+        if (result is None):
+            continue
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+        totalSeconds += result["seconds"]
+        lines.append("%-30s %-8s %10.2f %12s %12s %12s" %
+                     (job.name, result["status"], result["seconds"],
+                      formatValue(result["rms"], "%.3f"),
+                      formatValue(result["high"], "%.3f"),
+                      formatValue(result["energy"], "%.4g")))
+        if (result["error"]):
+            lines.append("    %s" % result["error"])
+        writer.writerow([job.name, result["status"], result["seconds"],
+                         result["rms"], result["high"], result["energy"],
+                         result["error"] or ""])
+    csvFile.close()
+    statuses = counts.keys()
+    statuses.sort()
+    lines.append("")
+    lines.append("%d jobs: %s; %.1f seconds of job time" %
+                 (len(jobs),
+                  ", ".join(["%d %s" % (counts[status], status) for status in statuses]),
+                  totalSeconds))
+    summary = "\n".join(lines)
+    f = open(os.path.join(outputDirectory, "summary.txt"), 'w')
+    print >>f, summary
+    f.close()
+    print
+    print summary
+
+def numberOfProcessors():
+    try:
+        n = os.sysconf("SC_NPROCESSORS_ONLN")
+    except (AttributeError, ValueError, OSError):
+        n = 1
+    return max(1, n)
+
+def runManifest(options):
+    # jobs run in their own directories
+    if (os.sep in options.simulator):
+        options.simulator = os.path.abspath(options.simulator)
+    if (options.systemParameters):
+        options.systemParameters = os.path.abspath(options.systemParameters)
+    jobs = readManifest(options.manifest, options.timeout)
+    outputDirectory = os.path.abspath(options.output)
+    makeDirectory(outputDirectory)
+    stateFileName = os.path.join(outputDirectory, "state.json")
+    state = loadState(stateFileName)
+    toRun = []
+    for job in jobs:
+        result = state.get(job.name)
+        if (result is None or
+            (options.retryFailed and result["status"] != DONE)):
+            toRun.append(job)
+    print "%d jobs in manifest, %d to run, %d at a time" % \
+          (len(jobs), len(toRun), options.jobs)
+    runBatch(toRun, state, stateFileName, outputDirectory, options)
+    writeSummary(jobs, state, outputDirectory)
+
+def parseOptions():
+    parser = OptionParser(usage = "%prog [--run-queue | --manifest FILE [options]]")
+    parser.add_option("--run-queue", action = "store_true", dest = "runQueue",
+                      help = "only (re)start the queue runner")
+    parser.add_option("--manifest", dest = "manifest",
+                      help = "run the jobs in this JSON or CSV file, without asking questions")
+    parser.add_option("-j", "--jobs", type = "int", dest = "jobs",
+                      default = numberOfProcessors(),
+                      help = "number of jobs to run at once [default: %default]")
+    parser.add_option("--timeout", type = "float", dest = "timeout",
+                      help = "default seconds before a job is killed [default: none]")
+    parser.add_option("--output", dest = "output",
+                      default = os.path.join(baseDirectory, "batch"),
+                      help = "directory for results and state [default: %default]")
+    parser.add_option("--simulator", dest = "simulator", default = "simulator",
+                      help = "simulator executable [default: %default]")
+    parser.add_option("--system-parameters", dest = "systemParameters",
+                      help = "sim-params.txt file to pass to every job")
+    parser.add_option("--in-process", action = "store_true", dest = "inProcess",
+                      help = "run jobs through the sim module rather than the executable")
+    parser.add_option("--retry-failed", action = "store_true", dest = "retryFailed",
+                      help = "also rerun jobs which failed or timed out")
+    options, args = parser.parse_args()
+    if (args):
+        parser.error("unexpected arguments: %s" % " ".join(args))
+    if (options.jobs < 1):
+        parser.error("--jobs must be at least 1")
+    return options
+
 def main():
+    options = parseOptions()
+    if (options.manifest):
+        runManifest(options)
+        return
     makeDirectory(INPUT)
     makeDirectory(QUEUE)
     makeDirectory(CURRENT)
     makeDirectory(OUTPUT)
-    if (len(sys.argv) > 1 and sys.argv[1] == '--run-queue'):
+    if (options.runQueue):
         runQueue()
     else:
         print
@@ -71,11 +71,18 @@ cdef extern from "simhelp.c":
     setWriteTraceCallbackFunc(PyObject)
     setFrameCallbackFunc(PyObject)
     getFrame_c()
+    getFrameBuffer_c()
     pyrexInitBondTable()
     void dumpPart()
     void reinit_globals()
     everythingElse()
     everythingDone()
+    beginSession()
+    sessionIsReusable()
+    setSessionPositions(PyObject)
+    runSession()
+    runSessionDone()
+    endSession()
     cdef char *structCompareHelp()
 
     void strcpy(char *, char *) #bruce 051230 guess
@@ -369,6 +376,38 @@ cdef class _Simulator:
         everythingDone()
         return
 
+    # Sessions (see simhelp.c) let repeated minimizations of one
+    # structure reuse the part's tables, as long as its bonds don't
+    # change. Usage: set the globals as for go, beginSession(), then
+    # runSession(); later, setSessionPositions(positions) and
+    # runSession() again, as long as sessionIsReusable(); finally
+    # endSession(). go() must not be used while a session is active.
+
+    def beginSession(self):
+        "read InputFileName and build its tables, ending any earlier session"
+        beginSession()
+
+    def sessionIsReusable(self):
+        "whether the session's part can be rerun from new atom positions"
+        return sessionIsReusable()
+
+    def setSessionPositions(self, positions):
+        "positions is an array of shape (num_atoms, 3), in pm, in mmp file atom order"
+        data = Numeric.array(positions, Numeric.Float64).tostring()
+        setSessionPositions(data)
+
+    def runSession(self, frame_callback=None, trace_callback=None):
+        "like go, but keep the session's part for another run"
+        setFrameCallbackFunc(frame_callback)
+        setWriteTraceCallbackFunc(trace_callback)
+        srand(0)
+        runSession()
+        runSessionDone()
+        return
+
+    def endSession(self):
+        endSession()
+
     def structCompare(self):
         r = structCompare()
         if r:
@@ -401,6 +440,21 @@ cdef class _Simulator:
         array = Numeric.fromstring(frm, Numeric.Float64)
         return Numeric.resize(array, [num_atoms, 3])
 
+    def getFrameView(self):
+        """
+        Return the positions of the current frame, in pm, as an array of
+        shape (num_atoms, 3) which shares the simulator's memory, if
+        Numeric can make one (otherwise it's a copy). It's only valid
+        during a frame callback; copy anything you need to keep.
+        """
+        buf = getFrameBuffer_c()
+        if hasattr(Numeric, 'frombuffer'):
+            array = Numeric.frombuffer(buf, Numeric.Float64)
+        else:
+            array = Numeric.fromstring(str(buf), Numeric.Float64)
+        array.shape = (len(array) / 3, 3)
+        return array
+
 _theSimulator = None
 
 def theSimulator():
@@ -485,6 +539,37 @@ class Tests(unittest.TestCase):
         m.go(frame_callback=func)
         assert _callbackCounter == 3, "Callback counter is %d, not 3" %(_callbackCounter)
 
+    def test_sessionMatchesGo(self):
+        # a rerun of a session from the mmp file's own positions must
+        # give the same minimized structure as go()
+        m = theSimulator()
+        def setup():
+            m.reinitGlobals()
+            m.InputFileName = "tests/minimize/test_h2.mmp"
+            m.OutputFileName = "tests/minimize/test_h2.xyz"
+            m.ToMinimize = 1
+            m.DumpAsText = 1
+            m.OutputFormat = 0
+        def result():
+            return open("tests/minimize/test_h2.xyz").read()
+        setup()
+        m.go()
+        expected = result()
+        setup()
+        m.beginSession()
+        try:
+            m.runSession()
+            assert result() == expected
+            assert m.sessionIsReusable()
+            # atom positions from test_h2.mmp, converted to pm as readmmp.c does
+            m.setSessionPositions(Numeric.array([[-348, 89, -118],
+                                                 [769, -82, -11]]) * 0.1)
+            setup()
+            m.runSession()
+            assert result() == expected
+        finally:
+            m.endSession()
+
     def test_frameAndTraceCallback(self):
         func = _testsetup(10)
         d = theSimulator()
@@ -287,6 +287,11 @@ getFrame_c(void)
 				    "part is null");
 	return NULL;
     }
+    if (pos == NULL) {
+	raiseExceptionIfNoneEarlier(PyExc_RuntimeError,
+				    "no current frame");
+	return NULL;
+    }
     if (part->num_atoms == 0) {
 	return PyString_FromString("");
     }
@@ -307,6 +312,24 @@ getFrame_c(void)
     return finish_python_call(retval);
 }
 
+// Make the positions of the current frame available to python without
+// copying them: return a read-only buffer object (3 doubles per atom,
+// in pm) which refers to the simulator's own position array.  It must
+// not be used after the frame callback returns.
+static PyObject *
+getFrameBuffer_c(void)
+{
+    start_python_call();
+    if (part == NULL || pos == NULL) {
+	raiseExceptionIfNoneEarlier(PyExc_RuntimeError,
+				    "no current frame");
+	return NULL;
+    }
+    return finish_python_call(
+        PyBuffer_FromMemory((void *) pos,
+                            part->num_atoms * sizeof(struct xyz)));
+}
+
 static PyObject *
 pyrexInitBondTable(void)
 {
@@ -331,50 +354,57 @@ dumpPart(void)
 }
 */
 
-static PyObject *
-everythingElse(void) // WARNING: this duplicates some code from simulator.c
+// Open the trace file named by TraceFileName, if any.  Returns 0 if
+// it can't be opened (after raising a Python exception).
+static int
+openTraceFile(void)
 {
-    char *problem;
-    int needVDW = 1;
-    
-    // wware 060109  python exception handling
-    start_python_call();
-
     if (TraceFileName != NULL) {
 	TraceFile = fopen(TraceFileName, "w");
 	if (TraceFile == NULL) {
 	    snprintf(buf, 1024, "can't open tracefile for writing: %s", TraceFileName);
 	    raiseExceptionIfNoneEarlier(PyExc_IOError, buf);
-	    return NULL;
+	    return 0;
 	}
         traceFileVersion(); // call this before any other writes to trace file.
 	// tell where and how the pyrex sim was built, whether with or without distutils.
 	fprintf(TraceFile, "%s", tracePrefix);
         CommandLine = "run from pyrex interface";
     }
+    return 1;
+}
+
+static int
+writingGromacs(void)
+{
+    return GromacsOutputBaseName != NULL && GromacsOutputBaseName[0] != '\0';
+}
 
+// Read InputFileName into part, and build all its tables.
+static void
+loadPart(void)
+{
     // this has to happen after opening the trace file and setting up
     // trace callbacks, since we might emit warnings when we do this.
     initializeBondTable();
 
     part = readMMP(InputFileName);
-    PYBAIL();
+    BAIL();
     if (part == NULL) {
-	set_py_exc_str(__FILE__, __LINE__, "part is null");
-	PYBAIL();
-    }
-    if (GromacsOutputBaseName != NULL && GromacsOutputBaseName[0] != '\0') {
-        needVDW = 0;
+	RAISE("part is null");
     }
-    initializePart(part, needVDW);
-    PYBAIL();
+    initializePart(part, !writingGromacs());
+    BAIL();
     createPatterns();
     matchPartToAllPatterns(part);
-    PYBAIL();
+}
 
-    if (TypeFeedback) {
-        return finish_python_call(Py_None);
-    }
+// Minimize part, or run dynamics on it, or write it out for GROMACS,
+// writing OutputFileName (and the trace file, if it's open).
+static PyObject *
+runPart(void)
+{
+    char *problem;
 
     // ##e should print options set before run, but it's too early to do that in this code
 
@@ -390,7 +420,7 @@ everythingElse(void) // WARNING: this duplicates some code from simulator.c
         traceJigHeader(part);
     }
 
-    if (GromacsOutputBaseName != NULL && GromacsOutputBaseName[0] != '\0') {
+    if (writingGromacs()) {
         problem = printGromacsToplogy(GromacsOutputBaseName, part);
         if (problem != NULL) {
             raiseExceptionIfNoneEarlier(PyExc_IOError, problem);
@@ -438,9 +468,27 @@ everythingElse(void) // WARNING: this duplicates some code from simulator.c
 }
 
 static PyObject *
-everythingDone(void)
+everythingElse(void) // WARNING: this duplicates some code from simulator.c
 {
+    // wware 060109  python exception handling
     start_python_call();
+
+    if (!openTraceFile()) {
+	return NULL;
+    }
+    loadPart();
+    PYBAIL();
+
+    if (TypeFeedback) {
+        return finish_python_call(Py_None);
+    }
+    return runPart();
+}
+
+// Finish the trace of a run, and forget its callbacks.
+static void
+finishRun(void)
+{
     done("");
     WHERE_ARE_WE();  SAY("closing tracefile\n");
     fcloseIfNonNull(&TraceFile);
@@ -452,11 +500,137 @@ everythingDone(void)
     }
     writeTraceCallbackFunc = NULL;
     frameCallbackFunc = NULL;
+    pos = NULL;
+}
+
+static PyObject *
+everythingDone(void)
+{
+    start_python_call();
+    finishRun();
     destroyPart(part);
     part = NULL;
     return finish_python_call(Py_None);
 }
 
+/*
+ * Simulator sessions.
+ *
+ * A session keeps the part read by beginSession alive after a run,
+ * so the same structure can be minimized again from new atom
+ * positions (given to setSessionPositions) without rereading the mmp
+ * file and rebuilding its bond, bend, torsion and pattern tables.
+ * Only the dynamic van der Waals list depends on the positions, and
+ * setSessionPositions rebuilds it.
+ *
+ * Some parts compute things from the atom positions in the mmp file
+ * as they are read (motor axes, PAM5 pattern matches, virtual atoms,
+ * rigid bodies).  sessionIsReusable returns 0 for those, and the
+ * caller must start a new session instead.
+ */
+
+static PyObject *
+beginSession(void)
+{
+    start_python_call();
+    if (part != NULL) {
+	destroyPart(part);
+	part = NULL;
+    }
+    if (!openTraceFile()) {
+	return NULL;
+    }
+    loadPart();
+    PYBAIL();
+    return finish_python_call(Py_None);
+}
+
+static PyObject *
+sessionIsReusable(void)
+{
+    int i;
+
+    if (part == NULL || part->num_generated_atoms > 0 || part->num_rigidBodies > 0) {
+	return PyInt_FromLong(0);
+    }
+    for (i=0; i<part->num_jigs; i++) {
+	switch (part->jigs[i]->type) {
+	case RotaryMotor:
+	case LinearMotor:
+	    return PyInt_FromLong(0);
+	default:
+	    break;
+	}
+    }
+    return PyInt_FromLong(1);
+}
+
+// data is a string of 3 doubles (x, y, z in pm) for each atom of the
+// session's part, in the order of the atoms in its mmp file.
+static PyObject *
+setSessionPositions(PyObject *data)
+{
+    double *xyz;
+    int i;
+
+    start_python_call();
+    if (part == NULL) {
+	raiseExceptionIfNoneEarlier(PyExc_RuntimeError, "no simulator session");
+	return NULL;
+    }
+    if (!PyString_Check(data) ||
+        PyString_Size(data) != (int)(3 * part->num_atoms * sizeof(double))) {
+	snprintf(buf, 1024, "need positions for %d atoms", part->num_atoms);
+	raiseExceptionIfNoneEarlier(PyExc_ValueError, buf);
+	return NULL;
+    }
+    xyz = (double *) PyString_AsString(data);
+    for (i = 0; i < part->num_atoms; i++) {
+	part->positions[i].x = xyz[i * 3 + 0];
+	part->positions[i].y = xyz[i * 3 + 1];
+	part->positions[i].z = xyz[i * 3 + 2];
+    }
+    if (!writingGromacs()) {
+	// a NULL validity tag forces a rescan
+	updateVanDerWaals(part, NULL, part->positions);
+    }
+    return finish_python_call(Py_None);
+}
+
+static PyObject *
+runSession(void)
+{
+    start_python_call();
+    if (part == NULL) {
+	raiseExceptionIfNoneEarlier(PyExc_RuntimeError, "no simulator session");
+	return NULL;
+    }
+    if (TraceFile == NULL && !openTraceFile()) {
+	return NULL;
+    }
+    return runPart();
+}
+
+static PyObject *
+runSessionDone(void)
+{
+    start_python_call();
+    finishRun();
+    return finish_python_call(Py_None);
+}
+
+static PyObject *
+endSession(void)
+{
+    start_python_call();
+    fcloseIfNonNull(&TraceFile);
+    if (part != NULL) {
+	destroyPart(part);
+	part = NULL;
+    }
+    return finish_python_call(Py_None);
+}
+
 
 /**
  * If we return a non-empty string, it's an error message.